@@ -8,6 +8,10 @@ Library for building Clownfish
 import traceback
 import os
 import re
+import hashlib
+import shutil
+import time
+import filelock
 import yaml
 
 # Local libs
@@ -17,9 +21,33 @@ from pylcommon import cstr
 from pylcommon import constants
 from pylcommon import install_common
 from pylcommon import cmd_general
+from pylcommon import broadcast
 from pyclownfish import clownfish_common
 
 SOURCE_DIR = None
+# The directory to cache the dependent RPMs, shared by all builds on the host
+RPM_CACHE_DIR = "/var/cache/clownfish_build"
+# The resolved dependent RPMs will be reused without running repotrack for
+# this long in online mode
+RPM_CACHE_RESOLVE_EXPIRE = 86400
+# The longest time to wait for other builds that are using the RPM cache
+RPM_CACHE_LOCK_TIMEOUT = 3600
+# The manifest under the source dir that records the stages of last build
+BUILD_MANIFEST_FNAME = "clownfish_build_manifest.yaml"
+# The stages of building the ISO
+BUILD_STAGE_DEPENDENT_RPMS = "dependent_rpms"
+BUILD_STAGE_CONFIGURE = "configure"
+BUILD_STAGE_RPMS = "rpms"
+BUILD_STAGE_CREATEREPO = "createrepo"
+BUILD_STAGE_MKISOFS = "mkisofs"
+# The files that change the result of autogen.sh and configure
+BUILD_CONFIGURE_FILES = ["autogen.sh", "configure.ac", "Makefile.am",
+                         "pybuild/Makefile.am", "version-gen.sh",
+                         "clownfish.spec.in"]
+# The directory under the source dir to assemble the ISO, same with Makefile
+BUILD_ISO_DIR = "ISO"
+# The directory under the source dir that rpmbuild saves the RPMs
+BUILD_RPM_DIR = "build/RPMS/x86_64"
 
 
 def clone_src_from_git(log, build_dir, git_url, branch,
@@ -58,39 +86,194 @@ def clone_src_from_git(log, build_dir, git_url, branch,
     return 0
 
 
-def download_dependent_rpms(log, host, packages_dir):
+class RPMCache(object):
     """
-    Download dependent RPMs
+    Content-addressed cache of RPMs on local host. The RPM files are saved
+    as objects/<sha256>/<fname>, and the index maps the RPM file names,
+    i.e. the NEVRAs, to the checksums. The objects are copied from the
+    download directory of repotrack, so the hard links of the objects are
+    never written by repotrack.
     """
-    # pylint: disable=too-many-locals,too-many-return-statements
-    # pylint: disable=too-many-branches,too-many-statements
-    # The yumdb might be broken, so sync
-    log.cl_info("downloading dependency RPMs")
-    command = "yumdb sync"
-    retval = host.sh_run(log, command)
-    if retval.cr_exit_status:
-        log.cl_error("failed to run command [%s] on host [%s], "
-                     "ret = [%d], stdout = [%s], stderr = [%s]",
-                     command,
-                     host.sh_hostname,
-                     retval.cr_exit_status,
-                     retval.cr_stdout,
-                     retval.cr_stderr)
-        return -1
+    def __init__(self, cache_dir):
+        self.rc_cache_dir = cache_dir
+        self.rc_objects_dir = cache_dir + "/objects"
+        # The directory that repotrack downloads the RPMs to
+        self.rc_download_dir = cache_dir + "/download"
+        self.rc_resolved_dir = cache_dir + "/resolved"
+        self.rc_index_fpath = cache_dir + "/index.yaml"
+        # Keys are RPM file names, values are SHA256 checksums
+        self.rc_index = {}
+
+    def rc_init(self, log):
+        """
+        Create the directories and load the index
+        """
+        # pylint: disable=bare-except
+        for directory in [self.rc_cache_dir, self.rc_objects_dir,
+                          self.rc_download_dir, self.rc_resolved_dir]:
+            ret = utils.mkdir(directory)
+            if ret:
+                log.cl_error("failed to create directory [%s] on local host",
+                             directory)
+                return -1
+
+        if not os.path.exists(self.rc_index_fpath):
+            return 0
+
+        try:
+            with open(self.rc_index_fpath) as index_file:
+                index = yaml.load(index_file)
+        except:
+            log.cl_error("not able to load [%s] as yaml file: %s",
+                         self.rc_index_fpath, traceback.format_exc())
+            return -1
+        if index is not None:
+            self.rc_index = index
+        return 0
+
+    def _rc_yaml_save(self, fpath, data):
+        """
+        Save the data to a yaml file atomically
+        """
+        # pylint: disable=no-self-use
+        tmp_fpath = fpath + ".tmp"
+        with open(tmp_fpath, "w") as tmp_file:
+            yaml.dump(data, tmp_file, default_flow_style=False)
+        os.rename(tmp_fpath, fpath)
+
+    def rc_index_save(self):
+        """
+        Save the index
+        """
+        self._rc_yaml_save(self.rc_index_fpath, self.rc_index)
+
+    def rc_object_fpath(self, fname):
+        """
+        Return the path of the cached RPM, None if not cached
+        """
+        if fname not in self.rc_index:
+            return None
+        fpath = (self.rc_objects_dir + "/" + self.rc_index[fname] + "/" +
+                 fname)
+        if not os.path.isfile(fpath):
+            return None
+        return fpath
+
+    def rc_add(self, log, fpath):
+        """
+        Add a RPM file to the cache
+        """
+        fname = os.path.basename(fpath)
+        sha256 = hashlib.sha256()
+        with open(fpath, "rb") as rpm_file:
+            while True:
+                data = rpm_file.read(1048576)
+                if not data:
+                    break
+                sha256.update(data)
+        checksum = sha256.hexdigest()
+
+        object_dir = self.rc_objects_dir + "/" + checksum
+        object_fpath = object_dir + "/" + fname
+        if not os.path.isfile(object_fpath):
+            ret = utils.mkdir(object_dir)
+            if ret:
+                log.cl_error("failed to create directory [%s] on local host",
+                             object_dir)
+                return -1
+            tmp_fpath = object_fpath + ".tmp"
+            shutil.copyfile(fpath, tmp_fpath)
+            os.rename(tmp_fpath, object_fpath)
+        log.cl_debug("cached RPM [%s] with checksum [%s]", fname, checksum)
+        self.rc_index[fname] = checksum
+        return 0
+
+    def _rc_resolved_fpath(self, rpm_names):
+        """
+        Return the file path to save the resolved RPMs of the RPM names
+        """
+        key = hashlib.sha1(" ".join(sorted(rpm_names))).hexdigest()
+        return self.rc_resolved_dir + "/" + key + ".yaml"
+
+    def rc_resolved_load(self, log, rpm_names):
+        """
+        Return (RPM file names, resolve time) of the RPM names and all of
+        their dependencies, (None, None) if never resolved
+        """
+        # pylint: disable=bare-except
+        fpath = self._rc_resolved_fpath(rpm_names)
+        if not os.path.exists(fpath):
+            return None, None
+        try:
+            with open(fpath) as resolved_file:
+                rpm_fnames = yaml.load(resolved_file)
+        except:
+            log.cl_error("not able to load [%s] as yaml file: %s",
+                         fpath, traceback.format_exc())
+            return None, None
+        return rpm_fnames, os.path.getmtime(fpath)
+
+    def rc_resolved_save(self, rpm_names, rpm_fnames):
+        """
+        Save the RPM file names of the RPM names and all of their
+        dependencies
+        """
+        self._rc_yaml_save(self._rc_resolved_fpath(rpm_names),
+                           sorted(rpm_fnames))
+
+    def rc_checkout(self, log, rpm_fnames, packages_dir):
+        """
+        Link the cached RPMs into the directory, and remove the other files
+        in the directory. The RPMs in the directory should never be changed
+        in place, since they are the objects of the cache.
+        """
+        for fname in rpm_fnames:
+            object_fpath = self.rc_object_fpath(fname)
+            if object_fpath is None:
+                log.cl_error("RPM [%s] is not cached in [%s]",
+                             fname, self.rc_cache_dir)
+                return -1
+            fpath = packages_dir + "/" + fname
+            if os.path.exists(fpath):
+                if os.path.samefile(fpath, object_fpath):
+                    continue
+                os.remove(fpath)
+            try:
+                os.link(object_fpath, fpath)
+            except OSError:
+                # The cache might be on another file system
+                shutil.copyfile(object_fpath, fpath)
+
+        for fname in os.listdir(packages_dir):
+            if fname in rpm_fnames:
+                continue
+            fpath = packages_dir + "/" + fname
+            log.cl_debug("found unnecessary file [%s] under directory [%s], "
+                         "removing it", fname, packages_dir)
+            if os.path.isdir(fpath):
+                shutil.rmtree(fpath)
+            else:
+                os.remove(fpath)
+        return 0
+
+    def rc_digest(self, rpm_fnames):
+        """
+        Return the digest of the cached RPMs
+        """
+        items = []
+        for fname in sorted(rpm_fnames):
+            items.append(fname)
+            items.append(self.rc_index.get(fname))
+        return build_digest(items)
 
-    command = ("mkdir -p %s" % (packages_dir))
-    retval = host.sh_run(log, command)
-    if retval.cr_exit_status:
-        log.cl_error("failed to run command [%s] on host [%s], "
-                     "ret = [%d], stdout = [%s], stderr = [%s]",
-                     command,
-                     host.sh_hostname,
-                     retval.cr_exit_status,
-                     retval.cr_stdout,
-                     retval.cr_stderr)
-        return -1
 
-    command = ("ls %s" % (packages_dir))
+def repotrack_dependent_rpms(log, host, packages_dir, dependent_rpms):
+    """
+    Download the dependent RPMs with repotrack, return the file names of
+    all the RPMs that are needed
+    """
+    # The yumdb might be broken, so sync
+    command = "yumdb sync"
     retval = host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -100,13 +283,7 @@ def download_dependent_rpms(log, host, packages_dir):
                      retval.cr_exit_status,
                      retval.cr_stdout,
                      retval.cr_stderr)
-        return -1
-    existing_rpm_fnames = retval.cr_stdout.split()
-
-    dependent_rpms = clownfish_common.CLOWNFISH_DEPENDENT_RPMS[:]
-    for rpm_name in install_common.CLOWNFISH_INSTALL_DEPENDENT_RPMS:
-        if rpm_name not in dependent_rpms:
-            dependent_rpms.append(rpm_name)
+        return None
 
     command = "repotrack -a x86_64 -p %s" % (packages_dir)
     for rpm_name in dependent_rpms:
@@ -121,7 +298,7 @@ def download_dependent_rpms(log, host, packages_dir):
                      retval.cr_exit_status,
                      retval.cr_stdout,
                      retval.cr_stderr)
-        return -1
+        return None
 
     exist_pattern = (r"^%s/(?P<rpm_fname>\S+) already exists and appears to be "
                      "complete$" % (packages_dir))
@@ -129,6 +306,7 @@ def download_dependent_rpms(log, host, packages_dir):
     download_pattern = (r"^Downloading (?P<rpm_fname>\S+)$")
     download_regular = re.compile(download_pattern)
     lines = retval.cr_stdout.splitlines()
+    rpm_fnames = []
     for line in lines:
         match = exist_regular.match(line)
         if match:
@@ -141,18 +319,104 @@ def download_dependent_rpms(log, host, packages_dir):
                 log.cl_error("unkown output [%s] of repotrack on host "
                              "[%s], stdout = [%s]",
                              line, host.sh_hostname, retval.cr_stdout)
-                return -1
-        if rpm_fname in existing_rpm_fnames:
-            existing_rpm_fnames.remove(rpm_fname)
-
-    for fname in existing_rpm_fnames:
-        fpath = packages_dir + "/" + fname
-        log.cl_debug("found unnecessary file [%s] under directory [%s], "
-                     "removing it", fname, packages_dir)
-        ret = host.sh_remove_file(log, fpath)
+                return None
+        if rpm_fname not in rpm_fnames:
+            rpm_fnames.append(rpm_fname)
+    return rpm_fnames
+
+
+def _download_dependent_rpms(log, host, packages_dir, rpm_cache, offline):
+    """
+    Download dependent RPMs holding the lock of the cache
+    """
+    # pylint: disable=too-many-return-statements
+    ret = rpm_cache.rc_init(log)
+    if ret:
+        log.cl_error("failed to init RPM cache [%s]", rpm_cache.rc_cache_dir)
+        return -1
+
+    dependent_rpms = clownfish_common.CLOWNFISH_DEPENDENT_RPMS[:]
+    for rpm_name in install_common.CLOWNFISH_INSTALL_DEPENDENT_RPMS:
+        if rpm_name not in dependent_rpms:
+            dependent_rpms.append(rpm_name)
+
+    command = ("mkdir -p %s" % (packages_dir))
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+
+    rpm_fnames, resolve_time = rpm_cache.rc_resolved_load(log, dependent_rpms)
+    if offline:
+        if rpm_fnames is None:
+            log.cl_error("dependent RPMs have never been resolved in cache "
+                         "[%s], please build in online mode first",
+                         rpm_cache.rc_cache_dir)
+            return -1
+        log.cl_info("using [%d] cached dependent RPMs in offline mode",
+                    len(rpm_fnames))
+        return rpm_cache.rc_checkout(log, rpm_fnames, packages_dir)
+
+    if (rpm_fnames is not None and
+            time.time() - resolve_time < RPM_CACHE_RESOLVE_EXPIRE):
+        ret = rpm_cache.rc_checkout(log, rpm_fnames, packages_dir)
+        if ret == 0:
+            log.cl_info("using [%d] cached dependent RPMs resolved [%d] "
+                        "seconds ago", len(rpm_fnames),
+                        time.time() - resolve_time)
+            return 0
+
+    # The RPMs downloaded last time are kept in the download directory, so
+    # repotrack only downloads the changed ones
+    download_dir = rpm_cache.rc_download_dir
+    log.cl_info("downloading dependency RPMs")
+    rpm_fnames = repotrack_dependent_rpms(log, host, download_dir,
+                                          dependent_rpms)
+    if rpm_fnames is None:
+        log.cl_error("failed to download dependent RPMs")
+        return -1
+
+    for fname in os.listdir(download_dir):
+        if fname not in rpm_fnames:
+            os.remove(download_dir + "/" + fname)
+
+    for fname in rpm_fnames:
+        ret = rpm_cache.rc_add(log, download_dir + "/" + fname)
         if ret:
+            log.cl_error("failed to add RPM [%s] to cache", fname)
             return -1
-    return 0
+    rpm_cache.rc_index_save()
+    rpm_cache.rc_resolved_save(dependent_rpms, rpm_fnames)
+    return rpm_cache.rc_checkout(log, rpm_fnames, packages_dir)
+
+
+def download_dependent_rpms(log, host, packages_dir,
+                            cache_dir=RPM_CACHE_DIR, offline=False):
+    """
+    Download dependent RPMs into the packages directory on local host
+
+    The RPMs are saved in the cache shared by all builds on local host. In
+    offline mode, the RPMs resolved last time are used from the cache
+    without accessing any yum repository.
+    """
+    # pylint: disable=too-many-arguments
+    rpm_cache = RPMCache(cache_dir)
+    lock_file = cache_dir + ".lock"
+    lock = filelock.FileLock(lock_file)
+    try:
+        with lock.acquire(timeout=RPM_CACHE_LOCK_TIMEOUT):
+            ret = _download_dependent_rpms(log, host, packages_dir,
+                                           rpm_cache, offline)
+    except filelock.Timeout:
+        log.cl_error("timeout when waiting for lock of file [%s]", lock_file)
+        return -1
+    return ret
 
 
 def check_dir_content(log, host, directory, contents, cleanup=False):
@@ -193,12 +457,179 @@ def check_dir_content(log, host, directory, contents, cleanup=False):
     return 0
 
 
+def build_digest(items):
+    """
+    Return the digest of a list of strings
+    """
+    sha1 = hashlib.sha1()
+    for item in items:
+        sha1.update(str(item))
+        sha1.update("\0")
+    return sha1.hexdigest()
+
+
+def build_files_digest(source_dir, fnames):
+    """
+    Return the digest of the files under the source dir, missing files are
+    included too
+    """
+    items = []
+    for fname in fnames:
+        fpath = source_dir + "/" + fname
+        items.append(fname)
+        if os.path.isfile(fpath):
+            items.append(broadcast.file_sha1sum(fpath))
+        else:
+            items.append(None)
+    return build_digest(items)
+
+
+def source_tree_digest(log, host, source_dir):
+    """
+    Return the digest of the files tracked by git in the source dir, None
+    if it is not a git repository
+    """
+    command = ("cd %s && git ls-files" % (source_dir))
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_info("source dir [%s] is not a git repository, RPMs will "
+                    "always be rebuilt", source_dir)
+        return None
+    return build_files_digest(source_dir,
+                              sorted(retval.cr_stdout.splitlines()))
+
+
+class BuildManifest(object):
+    """
+    The manifest of the ISO build. It records the input digest, outputs and
+    time of each stage, and whether the stage reused the outputs of last
+    build.
+    """
+    def __init__(self, source_dir):
+        self.bm_source_dir = source_dir
+        self.bm_fpath = source_dir + "/" + BUILD_MANIFEST_FNAME
+        # The stages of last build, keys are stage names, values are dicts
+        self.bm_last_stages = {}
+        # The stages of this build
+        self.bm_stages = {}
+
+    def bm_load(self, log):
+        """
+        Load the manifest of last build, ignore it if broken
+        """
+        # pylint: disable=bare-except
+        if not os.path.exists(self.bm_fpath):
+            return
+        try:
+            with open(self.bm_fpath) as manifest_file:
+                manifest = yaml.load(manifest_file)
+            self.bm_last_stages = manifest["stages"]
+        except:
+            log.cl_warning("ignoring broken build manifest [%s]: %s",
+                           self.bm_fpath, traceback.format_exc())
+            self.bm_last_stages = {}
+
+    def bm_reusable(self, stage, digest):
+        """
+        Return True if last build ran the stage with the same digest and
+        the outputs still exist
+        """
+        if digest is None or stage not in self.bm_last_stages:
+            return False
+        last_stage = self.bm_last_stages[stage]
+        if last_stage["digest"] != digest:
+            return False
+        for output in last_stage["outputs"]:
+            if not os.path.exists(self.bm_source_dir + "/" + output):
+                return False
+        return True
+
+    def bm_outputs(self, stage):
+        """
+        Return the outputs of the stage in this build
+        """
+        return self.bm_stages[stage]["outputs"]
+
+    def bm_stage_finish(self, stage, digest, reused, start_time, outputs):
+        """
+        Record the stage and save the manifest
+        """
+        # pylint: disable=too-many-arguments
+        self.bm_stages[stage] = {"digest": digest,
+                                 "reused": reused,
+                                 "seconds": round(time.time() - start_time, 3),
+                                 "outputs": outputs}
+        manifest = {"stages": self.bm_stages}
+        tmp_fpath = self.bm_fpath + ".tmp"
+        with open(tmp_fpath, "w") as tmp_file:
+            yaml.dump(manifest, tmp_file, default_flow_style=False)
+        os.rename(tmp_fpath, self.bm_fpath)
+
+
+def build_stage(log, host, manifest, stage, digest, command, output_funct):
+    """
+    Run the command of the stage, unless last build ran it with the same
+    digest. The output_funct returns the outputs after running the command.
+    """
+    # pylint: disable=too-many-arguments
+    start_time = time.time()
+    if manifest.bm_reusable(stage, digest):
+        log.cl_info("reusing stage [%s] of last build", stage)
+        outputs = manifest.bm_last_stages[stage]["outputs"]
+        manifest.bm_stage_finish(stage, digest, True, start_time, outputs)
+        return 0
+
+    log.cl_info("running stage [%s]", stage)
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+    manifest.bm_stage_finish(stage, digest, False, start_time,
+                             output_funct())
+    return 0
+
+
+def build_rpm_outputs(source_dir):
+    """
+    Return the RPMs built by rpmbuild
+    """
+    outputs = []
+    for fname in sorted(os.listdir(source_dir + "/" + BUILD_RPM_DIR)):
+        if fname.endswith(".rpm"):
+            outputs.append(BUILD_RPM_DIR + "/" + fname)
+    return outputs
+
+
+def build_package_version(log, source_dir):
+    """
+    Return the package version configured in the Makefile
+    """
+    makefile = source_dir + "/Makefile"
+    regular = re.compile(r"^PACKAGE_VERSION = (?P<version>\S+)$")
+    with open(makefile) as makefile_fd:
+        for line in makefile_fd:
+            match = regular.match(line.rstrip("\n"))
+            if match:
+                return match.group("version")
+    log.cl_error("failed to find PACKAGE_VERSION in [%s]", makefile)
+    return None
+
+
 def do_build(log, source_dir, config, config_fpath):
     """
     Build the ISO
+
+    The input digest of each stage is compared with the manifest of last
+    build, so the stages with unchanged inputs are skipped.
     """
     # pylint: disable=too-many-return-statements,too-many-locals
-    # pylint: disable=unused-argument
+    # pylint: disable=unused-argument,too-many-branches,too-many-statements
     log.cl_info("building using config [%s]", config_fpath)
     local_host = ssh_host.SSHHost("localhost", local=True)
     distro = local_host.sh_distro(log)
@@ -221,27 +652,49 @@ def do_build(log, source_dir, config, config_fpath):
 
     package_dir = iso_cached_dir + "/" + cstr.CSTR_PACKAGES
 
-    ret = download_dependent_rpms(log, local_host, package_dir)
+    if config is None:
+        config = {}
+    rpm_cache_dir = utils.config_value(config, cstr.CSTR_RPM_CACHE_DIR)
+    if rpm_cache_dir is None:
+        rpm_cache_dir = RPM_CACHE_DIR
+    offline = utils.config_value(config, cstr.CSTR_OFFLINE)
+    if offline is None:
+        offline = False
+
+    manifest = BuildManifest(source_dir)
+    manifest.bm_load(log)
+
+    start_time = time.time()
+    ret = download_dependent_rpms(log, local_host, package_dir,
+                                  cache_dir=rpm_cache_dir, offline=offline)
     if ret:
         log.cl_error("failed to download dependent rpms")
         return -1
 
-    contents = [cstr.CSTR_PACKAGES]
-    ret = check_dir_content(log, local_host, iso_cached_dir, contents,
-                            cleanup=True)
+    rpm_cache = RPMCache(rpm_cache_dir)
+    ret = rpm_cache.rc_init(log)
     if ret:
-        log.cl_error("directory [%s] doesn't have expected content",
-                     iso_cached_dir)
+        log.cl_error("failed to init RPM cache [%s]", rpm_cache_dir)
         return -1
+    dependent_digest = rpm_cache.rc_digest(os.listdir(package_dir))
+    # The content of the cached ISO dir only needs to be checked if the
+    # dependent RPMs changed
+    reused = manifest.bm_reusable(BUILD_STAGE_DEPENDENT_RPMS,
+                                  dependent_digest)
+    if not reused:
+        contents = [cstr.CSTR_PACKAGES]
+        ret = check_dir_content(log, local_host, iso_cached_dir, contents,
+                                cleanup=True)
+        if ret:
+            log.cl_error("directory [%s] doesn't have expected content",
+                         iso_cached_dir)
+            return -1
+    manifest.bm_stage_finish(BUILD_STAGE_DEPENDENT_RPMS, dependent_digest,
+                             reused, start_time, [])
 
     log.cl_info("building Clownfish ISO")
 
-    command = ("cd %s && rm clownfish-*.tar.bz2 clownfish-*.tar.gz -f && "
-               "sh autogen.sh && "
-               "./configure --with-cached-iso=%s && "
-               "make && "
-               "make iso" %
-               (source_dir, iso_cached_dir))
+    command = ("cd %s && sh version-gen.sh" % (source_dir))
     retval = local_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -252,7 +705,72 @@ def do_build(log, source_dir, config, config_fpath):
                      retval.cr_stdout,
                      retval.cr_stderr)
         return -1
+    configure_digest = build_digest([retval.cr_stdout, iso_cached_dir,
+                                     build_files_digest(source_dir,
+                                                        BUILD_CONFIGURE_FILES)])
+    command = ("cd %s && sh autogen.sh && ./configure --with-cached-iso=%s" %
+               (source_dir, iso_cached_dir))
+    ret = build_stage(log, local_host, manifest, BUILD_STAGE_CONFIGURE,
+                      configure_digest, command, lambda: ["Makefile"])
+    if ret:
+        return -1
+
+    source_digest = source_tree_digest(log, local_host, source_dir)
+    if source_digest is None:
+        rpms_digest = None
+    else:
+        rpms_digest = build_digest([configure_digest, source_digest])
+    command = ("cd %s && rm clownfish-*.tar.bz2 clownfish-*.tar.gz -f && "
+               "rm -fr %s && make && make rpms" %
+               (source_dir, BUILD_RPM_DIR))
+    ret = build_stage(log, local_host, manifest, BUILD_STAGE_RPMS,
+                      rpms_digest, command,
+                      lambda: build_rpm_outputs(source_dir))
+    if ret:
+        return -1
+
+    rpm_outputs = manifest.bm_outputs(BUILD_STAGE_RPMS)
+    createrepo_digest = build_digest([dependent_digest] +
+                                     [build_files_digest(source_dir,
+                                                         rpm_outputs)])
+    # Keep the repodata, so that createrepo only handles the changed RPMs
+    iso_dir = source_dir + "/" + BUILD_ISO_DIR
+    iso_package_dir = iso_dir + "/" + cstr.CSTR_PACKAGES
+    command = ("mkdir -p %s && "
+               "rsync -a --delete --exclude=/%s/repodata %s/ %s/ && "
+               "cd %s && cp %s %s && createrepo --update %s" %
+               (iso_dir, cstr.CSTR_PACKAGES, iso_cached_dir, iso_dir,
+                source_dir, " ".join(rpm_outputs), iso_package_dir,
+                iso_package_dir))
+    repomd = (BUILD_ISO_DIR + "/" + cstr.CSTR_PACKAGES +
+              "/repodata/repomd.xml")
+    ret = build_stage(log, local_host, manifest, BUILD_STAGE_CREATEREPO,
+                      createrepo_digest, command, lambda: [repomd])
+    if ret:
+        return -1
+
+    version = build_package_version(log, source_dir)
+    if version is None:
+        return -1
+    iso_fname = "clownfish-%s.x86_64.iso" % version
+    md5_fname = "clownfish-%s.x86_64.md5" % version
+    mkisofs_digest = build_digest([createrepo_digest, iso_fname])
+    command = ("cd %s && rm -f clownfish-*.iso clownfish-*.md5 && "
+               "mkisofs -joliet-long -R -o %s %s && md5sum %s > %s" %
+               (source_dir, iso_fname, BUILD_ISO_DIR, iso_fname, md5_fname))
+    ret = build_stage(log, local_host, manifest, BUILD_STAGE_MKISOFS,
+                      mkisofs_digest, command,
+                      lambda: [iso_fname, md5_fname])
+    if ret:
+        return -1
 
+    reused_stages = []
+    for stage, stage_dict in manifest.bm_stages.iteritems():
+        if stage_dict["reused"]:
+            reused_stages.append(stage)
+    log.cl_info("built ISO [%s] reusing stages %s of last build, manifest "
+                "saved to [%s]", iso_fname, sorted(reused_stages),
+                manifest.bm_fpath)
     return 0
 
 
@@ -7,20 +7,52 @@ Clownfish is an automatic management system for Lustre
 """
 # pylint: disable=too-many-lines
 import getopt
+import fnmatch
 import threading
 import os
 import time
+import marshal
+import socket
 import yaml
 
 # Local libs
 from pylcommon import utils
 from pylcommon import parallel
+from pylcommon import pdsh
 from pylcommon import lustre
 from pylcommon import cstr
 from pylcommon import lyaml
+from pylcommon import lconfig
+from pylcommon import constants
+from pylcommon import ssh_host
+from pylcommon import metrics
 from pyclownfish import clownfish_qos
+from pyclownfish import clownfish_common
 
 CLOWNFISH_STATUS_CHECK_INTERVAL = 1
+# The max number of threads that check the status of services in parallel
+CLOWNFISH_STATUS_THREAD_NUMBER = 16
+# The max number of console commands that run in parallel
+CLOWNFISH_COMMAND_THREAD_NUMBER = 32
+# The timeout when waiting the thread pools to quit
+CLOWNFISH_THREAD_POOL_SHUTDOWN_TIMEOUT = 10
+# The interval to save the status snapshot and send it to the standby hosts
+CLOWNFISH_SNAPSHOT_INTERVAL = 10
+# The format version of the status snapshot
+CLOWNFISH_SNAPSHOT_VERSION = 1
+# The durations of fixing services, labeled by the result
+CLOWNFISH_FIX_SECONDS = metrics.metrics_histogram("clownfish_fix_seconds",
+                                                  "Duration of fixing services",
+                                                  label_names=("result",))
+CLOWNFISH_FIX_SECONDS_FIXED = CLOWNFISH_FIX_SECONDS.mf_child("fixed")
+CLOWNFISH_FIX_SECONDS_FAILED = CLOWNFISH_FIX_SECONDS.mf_child("failed")
+CLOWNFISH_FIX_SECONDS_DISAPPEARED = CLOWNFISH_FIX_SECONDS.mf_child("disappeared")
+# The gauges registered by clownfish_metrics_register()
+CLOWNFISH_METRICS_GAUGES = ["clownfish_fix_queue_depth",
+                            "clownfish_fix_in_progress",
+                            "clownfish_qos_throttled_uids",
+                            "clownfish_thread_pool_busy_threads",
+                            "clownfish_thread_pool_queued"]
 
 CLOWNFISH_COMMNAD_CD = "cd"
 CLOWNFISH_COMMNAD_DISABLE = "disable"
@@ -35,12 +67,44 @@ CLOWNFISH_COMMNAD_LS_OPTION_LONG_STATUS = "status"
 CLOWNFISH_COMMNAD_MANUAL = "m"
 CLOWNFISH_COMMNAD_MOUNT = "mount"
 CLOWNFISH_COMMNAD_NONEXISTENT = "nonexistent"
+CLOWNFISH_COMMNAD_PDSH = "pdsh"
 CLOWNFISH_COMMNAD_PREPARE = "prepare"
 CLOWNFISH_COMMNAD_PWD = "pwd"
 CLOWNFISH_COMMNAD_QUIT = "q"
+CLOWNFISH_COMMNAD_RELOAD = "reload"
 CLOWNFISH_COMMNAD_RETVAL = "retval"
 CLOWNFISH_COMMNAD_UMOUNT = "umount"
 
+# The commands that the pdsh command is allowed to run. Values are the
+# allowed first arguments, None means any arguments are allowed, and an
+# empty tuple means no argument is allowed.
+CLOWNFISH_PDSH_READ_ONLY_COMMANDS = {
+    "cat": None,
+    "date": (),
+    "df": None,
+    "dmesg": ("-T",),
+    "free": None,
+    "grep": None,
+    "head": None,
+    "hostname": (),
+    "lctl": ("dl", "device_list", "get_param", "list_param",
+             "lustre_build_version"),
+    "lfs": ("df", "fid2path", "getstripe", "hsm_state", "path2fid",
+            "quota"),
+    "ls": None,
+    "lsmod": (),
+    "mount": (),
+    "ps": None,
+    "rpm": ("-q", "-qa", "-qi", "-ql"),
+    "stat": None,
+    "systemctl": ("is-active", "is-enabled", "status"),
+    "tail": None,
+    "uname": None,
+    "uptime": None,
+}
+# The characters that could chain or redirect commands in shell
+CLOWNFISH_PDSH_SHELL_CHARACTERS = ";&|<>`$(){}\\\n"
+
 CLOWNFISH_DELIMITER_AND = "AND"
 CLOWNFISH_DELIMITER_OR = "OR"
 CLOWNFISH_DELIMITER_CONT = "CONT"
@@ -88,7 +152,9 @@ def clownfish_command_help(connection, args):
    q                    quit
    m                    show the manual about the current path
    mount                mount the filesystem
+   pdsh $hosts $cmd     run read-only command $cmd on hosts matching glob $hosts
    pwd                  print the current path
+   reload               reload the config file and apply the changes
    umount               umount the filesystem""")
 
     return 0
@@ -396,6 +462,102 @@ CLOWNFISH_SERVER_COMMNADS[CLOWNFISH_COMMNAD_UMOUNT] = \
                      speed=SPEED_ALWAYS_SLOW)
 
 
+def clownfish_hosts_glob(log, walk, path_glob):
+    """
+    Return the hosts that match the path glob, e.g. /hosts/server*
+    """
+    if path_glob.startswith("/"):
+        full_glob = path_glob
+    else:
+        current_path = walk.cw_entry_current.ce_path
+        full_glob = current_path.rstrip("/") + "/" + path_glob
+
+    leading = "/" + cstr.CSTR_HOSTS + "/"
+    if not full_glob.startswith(leading):
+        log.cl_stderr("path [%s] is not under [%s]", full_glob, leading)
+        return None
+
+    host_glob = full_glob[len(leading):]
+    if host_glob == "" or "/" in host_glob:
+        log.cl_stderr("path [%s] is not a glob of hosts", full_glob)
+        return None
+
+    instance = walk.cw_instance
+    hosts = []
+    for host_id in sorted(instance.ci_hosts.keys()):
+        if fnmatch.fnmatchcase(host_id, host_glob):
+            hosts.append(instance.ci_hosts[host_id])
+    return hosts
+
+
+def clownfish_pdsh_command_check(log, command_args):
+    """
+    Check whether the command is read-only, return 0 if so
+    """
+    for argument in command_args:
+        for character in argument:
+            if character in CLOWNFISH_PDSH_SHELL_CHARACTERS:
+                log.cl_stderr("character [%s] is not allowed in the command "
+                              "of %s", character, CLOWNFISH_COMMNAD_PDSH)
+                return -1
+
+    program = command_args[0]
+    if program not in CLOWNFISH_PDSH_READ_ONLY_COMMANDS:
+        log.cl_stderr("command [%s] is not allowed by %s, allowed commands: "
+                      "%s", program, CLOWNFISH_COMMNAD_PDSH,
+                      " ".join(sorted(CLOWNFISH_PDSH_READ_ONLY_COMMANDS)))
+        return -1
+
+    allowed_arguments = CLOWNFISH_PDSH_READ_ONLY_COMMANDS[program]
+    if allowed_arguments is None or len(command_args) == 1:
+        return 0
+    if command_args[1] not in allowed_arguments:
+        if len(allowed_arguments) == 0:
+            log.cl_stderr("command [%s] is only allowed without argument by "
+                          "%s", program, CLOWNFISH_COMMNAD_PDSH)
+        else:
+            log.cl_stderr("command [%s %s] is not allowed by %s, allowed "
+                          "arguments: %s", program, command_args[1],
+                          CLOWNFISH_COMMNAD_PDSH,
+                          " ".join(allowed_arguments))
+        return -1
+    return 0
+
+
+def clownfish_command_pdsh(connection, args):
+    """
+    Run a read-only command on the hosts that match a path glob
+    """
+    walk = connection.cc_walk
+    log = connection.cc_command_log
+
+    if len(args) < 3:
+        log.cl_stderr("usage: %s $hosts $command", CLOWNFISH_COMMNAD_PDSH)
+        return -1
+
+    hosts = clownfish_hosts_glob(log, walk, args[1])
+    if hosts is None:
+        return -1
+
+    if len(hosts) == 0:
+        log.cl_stderr("no host matches [%s]", args[1])
+        return -1
+
+    ret = clownfish_pdsh_command_check(log, args[2:])
+    if ret:
+        return -1
+
+    command = " ".join(args[2:])
+    result = pdsh.pdsh_run(log, hosts, command)
+    result.pr_dshbak(log)
+    return result.pr_retval()
+
+
+CLOWNFISH_SERVER_COMMNADS[CLOWNFISH_COMMNAD_PDSH] = \
+    ClownfishCommand(CLOWNFISH_COMMNAD_PDSH, clownfish_command_pdsh,
+                     need_child=True, speed=SPEED_SLOW_OR_FAST)
+
+
 def clownfish_pwd(walk):
     """
     Print the config in the current directory
@@ -437,6 +599,41 @@ CLOWNFISH_SERVER_COMMNADS[CLOWNFISH_COMMNAD_PWD] = \
     ClownfishCommand(CLOWNFISH_COMMNAD_PWD, clownfish_command_pwd)
 
 
+def clownfish_command_reload(connection, args):
+    """
+    Reload the config file
+    """
+    # pylint: disable=unused-argument
+    walk = connection.cc_walk
+    log = connection.cc_command_log
+    instance = walk.cw_instance
+
+    ret = instance.ci_reload(log)
+    clownfish_walk_refresh(connection)
+    return ret
+
+
+CLOWNFISH_SERVER_COMMNADS[CLOWNFISH_COMMNAD_RELOAD] = \
+    ClownfishCommand(CLOWNFISH_COMMNAD_RELOAD, clownfish_command_reload,
+                     speed=SPEED_SLOW_OR_FAST)
+
+
+def clownfish_walk_refresh(connection):
+    """
+    The entries of the current path might refer to the objects replaced by
+    reloading the config, so enter the same path again, or go back to the
+    root if the path doesn't exist any more
+    """
+    walk = connection.cc_walk
+    generation = walk.cw_instance.ci_config_generation
+    if walk.cw_config_generation == generation:
+        return
+    walk.cw_config_generation = generation
+    path = clownfish_pwd(walk)
+    if clownfish_command_cd(connection, [CLOWNFISH_COMMNAD_CD, path]):
+        walk.cw_entry_current = walk.cw_entry_root
+
+
 def clownfish_children(walk):
     """
     Return the names/IDs of children
@@ -444,6 +641,90 @@ def clownfish_children(walk):
     return walk.cw_entry_current.ce_encode(False, False)
 
 
+def clownfish_services(mgs_dict, lustres):
+    """
+    Return the services of the MGSs and file systems, keys are the service
+    names
+    """
+    services = {}
+    for mgs in mgs_dict.values():
+        services[mgs.ls_service_name] = mgs
+
+    for lustrefs in lustres.values():
+        for service in lustrefs.lf_services():
+            services[service.ls_service_name] = service
+    return services
+
+
+def clownfish_snapshot_send(log, host, snapshot_fpath):
+    """
+    Send the status snapshot to the same path on a standby host
+    """
+    command = "mkdir -p %s" % os.path.dirname(snapshot_fpath)
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+
+    # rsync replaces the file atomically
+    ret = host.sh_send_file(log, snapshot_fpath, snapshot_fpath)
+    if ret:
+        log.cl_error("failed to send file [%s] on local host to host [%s]",
+                     snapshot_fpath, host.sh_hostname)
+        return -1
+    return 0
+
+
+def clownfish_snapshot_load(log, snapshot_fpath):
+    """
+    Load the status snapshot saved by the previous server, return None if
+    it does not exist or is invalid
+    """
+    if not os.path.exists(snapshot_fpath):
+        log.cl_info("no status snapshot [%s], starting without saved status",
+                    snapshot_fpath)
+        return None
+
+    try:
+        with open(snapshot_fpath, "rb") as snapshot_file:
+            snapshot = marshal.load(snapshot_file)
+    except (IOError, EOFError, ValueError, TypeError) as error:
+        log.cl_error("failed to load status snapshot [%s]: %s",
+                     snapshot_fpath, error)
+        return None
+
+    if (not isinstance(snapshot, tuple) or len(snapshot) != 5 or
+            snapshot[0] != CLOWNFISH_SNAPSHOT_VERSION or
+            not isinstance(snapshot[2], dict) or
+            not isinstance(snapshot[3], dict) or
+            not isinstance(snapshot[4], dict)):
+        log.cl_error("status snapshot [%s] has unsupported format, ignoring",
+                     snapshot_fpath)
+        return None
+
+    log.cl_info("loaded status snapshot [%s] saved [%d] seconds ago",
+                snapshot_fpath, time.time() - snapshot[1])
+    return snapshot
+
+
+def qos_config_without_users(qos_config):
+    """
+    Return a copy of the QoS config without the users
+    """
+    if qos_config is None:
+        return None
+    qos_config = dict(qos_config)
+    if cstr.CSTR_USERS in qos_config:
+        del qos_config[cstr.CSTR_USERS]
+    return qos_config
+
+
 class ClownfishWalk(object):
     """
     Each connection that is walking in the paths has a object of this type
@@ -453,6 +734,8 @@ class ClownfishWalk(object):
         self.cw_entry_root = ClownfishEntryRoot(self)
         self.cw_entry_current = self.cw_entry_root
         self.cw_instance = instance
+        # The generation of the config when the current entry is entered
+        self.cw_config_generation = instance.ci_config_generation
 
 
 class ClownfishServiceStatus(object):
@@ -460,7 +743,7 @@ class ClownfishServiceStatus(object):
     A global object for service status
     """
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, instance, log):
+    def __init__(self, instance, log, snapshot=None):
         self.css_instance = instance
         # Keys are the LustreService.ls_service_name, value is instance of
         # LustreServiceStatus
@@ -481,8 +764,25 @@ class ClownfishServiceStatus(object):
         # Protected by css_problem_condition
         self.css_fix_thread_waiting_number = 0
         self.css_fix_thread_number = 5
+        # The services to check status, keys are the service names,
+        # protected by css_status_condition
+        self.css_status_services = {}
+        # Keys are the names of services that are being checked or queued in
+        # the status thread pool, values are the services, protected by
+        # css_status_condition
+        self.css_status_checking = {}
+        # Keys are the service names, values are the time of next checks,
+        # protected by css_status_condition
+        self.css_status_check_time = {}
+        self.css_status_condition = threading.Condition()
+        # Keys are the service names, values are the logs of status checks.
+        # A service is never checked by multiple threads at the same time,
+        # so no lock is needed.
+        self.css_status_logs = {}
+        # Used to wake up the snapshot thread when quiting
+        self.css_snapshot_condition = threading.Condition()
         self.css_log = log
-        self.css_start_status_threads()
+        self.css_start_status_threads(snapshot)
         self.css_start_fix_threads()
 
     def css_service_status(self, service_name):
@@ -503,6 +803,12 @@ class ClownfishServiceStatus(object):
         """
         service = status.lss_service
         service_name = service.ls_service_name
+        self.css_status_condition.acquire()
+        if self.css_status_services.get(service_name) is not service:
+            # The service has been removed or changed by reloading the config
+            self.css_status_condition.release()
+            return
+
         self.css_service_status_condition.acquire()
         self.css_service_status_dict[service_name] = status
         self.css_service_status_condition.release()
@@ -515,14 +821,45 @@ class ClownfishServiceStatus(object):
             if service_name in self.css_problem_status_dict:
                 del self.css_problem_status_dict[service_name]
         self.css_problem_condition.release()
+        self.css_status_condition.release()
 
-    def css_status_thread(self, service):
+    def css_services_replace(self, services, stale_names):
         """
-        Thread that checks status of a service
+        Replace the services to check after reloading the config. The status
+        of the services in stale_names is dropped, so they will be checked
+        as soon as possible. The status of the other services is kept.
         """
-        service_name = service.ls_service_name
-        instance = self.css_instance
+        self.css_status_condition.acquire()
+        self.css_service_status_condition.acquire()
+        self.css_problem_condition.acquire()
+        for service_name in stale_names:
+            if service_name in self.css_service_status_dict:
+                del self.css_service_status_dict[service_name]
+            if service_name in self.css_problem_status_dict:
+                del self.css_problem_status_dict[service_name]
+            if service_name in self.css_status_check_time:
+                del self.css_status_check_time[service_name]
+
+        for status_dict in [self.css_service_status_dict,
+                            self.css_problem_status_dict]:
+            for service_name, status in status_dict.items():
+                status_dict[service_name] = \
+                    status.lss_rebind(services[service_name])
+        self.css_status_services = services
+        self.css_problem_condition.notifyAll()
+        self.css_problem_condition.release()
+        self.css_service_status_condition.release()
+        self.css_status_condition.notifyAll()
+        self.css_status_condition.release()
 
+    def css_status_log(self, service_name):
+        """
+        Return the log of checking the status of a service
+        """
+        if service_name in self.css_status_logs:
+            return self.css_status_logs[service_name]
+
+        instance = self.css_instance
         name = "thread_checking_service_%s" % service_name
         thread_workspace = instance.ci_workspace + "/" + name
         if not os.path.exists(thread_workspace):
@@ -530,40 +867,224 @@ class ClownfishServiceStatus(object):
             if ret:
                 self.css_log.cl_error("failed to create direcotry [%s] on local host",
                                       thread_workspace)
-                return -1
+                return None
         elif not os.path.isdir(thread_workspace):
             self.css_log.cl_error("[%s] is not a directory", thread_workspace)
-            return -1
+            return None
         log = self.css_log.cl_get_child(name, resultsdir=thread_workspace)
+        self.css_status_logs[service_name] = log
+        return log
 
-        log.cl_info("starting thread that checks status of service [%s]",
-                    service_name)
-        while instance.ci_running:
+    def css_status_check(self, service):
+        """
+        Check the status of a service once, run in the status thread pool
+        """
+        service_name = service.ls_service_name
+        log = self.css_status_log(service_name)
+        if log is not None:
             status = lustre.LustreServiceStatus(service)
             status.lss_check(log)
-
             self.css_update_status(status)
 
-            time.sleep(CLOWNFISH_STATUS_CHECK_INTERVAL)
-        log.cl_info("thread that checks status of service [%s] exited",
-                    service_name)
+        self.css_status_condition.acquire()
+        # The check of a service changed by reloading is not delayed
+        if self.css_status_services.get(service_name) is service:
+            self.css_status_check_time[service_name] = \
+                time.time() + CLOWNFISH_STATUS_CHECK_INTERVAL
+        del self.css_status_checking[service_name]
+        self.css_status_condition.notifyAll()
+        self.css_status_condition.release()
+        if log is None:
+            return -1
         return 0
 
-    def css_start_status_threads(self):
+    def css_status_thread(self):
         """
-        Start the status thread
+        Thread that submits the status checks of services to the status
+        thread pool when they are due
+        """
+        instance = self.css_instance
+        log = self.css_log
+        log.cl_info("starting thread that schedules status checks of "
+                    "[%d] services", len(self.css_status_services))
+        self.css_status_condition.acquire()
+        while instance.ci_running:
+            now = time.time()
+            wait_time = CLOWNFISH_STATUS_CHECK_INTERVAL
+            # List of (check_time, service)
+            due_services = []
+            for service_name, service in self.css_status_services.items():
+                if service_name in self.css_status_checking:
+                    continue
+                check_time = self.css_status_check_time.get(service_name, 0)
+                if check_time > now:
+                    if check_time - now < wait_time:
+                        wait_time = check_time - now
+                    continue
+                due_services.append((check_time, service))
+
+            # Check the service that has waited for the longest time first.
+            # Never queue more checks than the threads in the pool, so the
+            # pool is never saturated and the finishing checks wake up this
+            # thread for the remaining services.
+            due_services.sort(key=lambda due: due[0])
+            for due in due_services:
+                if (len(self.css_status_checking) >=
+                        CLOWNFISH_STATUS_THREAD_NUMBER):
+                    break
+                service = due[1]
+                self.css_status_checking[service.ls_service_name] = service
+                utils.thread_start(self.css_status_check, (service, ),
+                                   pool=utils.THREAD_POOL_STATUS)
+            self.css_status_condition.wait(wait_time)
+        self.css_status_condition.release()
+        log.cl_info("thread that schedules status checks exited")
+        return 0
+
+    def _css_snapshot_restore(self, snapshot):
+        """
+        Restore the status saved in the snapshot by the previous server.
+        The status of the services changed since then is dropped. The
+        restored status is checked again after the services without status.
+        A restored problem is only a hint, the service is not fixed until
+        the problem is confirmed by a new check, which is done first.
+        """
+        log = self.css_log
+        services = snapshot[2]
+        fix_times = snapshot[3]
+        restored = 0
+        hints = 0
+        for service_name, saved in services.items():
+            service = self.css_status_services.get(service_name)
+            if service is None:
+                continue
+            signature, update_time, instance_name = saved
+            if signature != service.ls_signature():
+                continue
+
+            status = lustre.LustreServiceStatus(service)
+            status.lss_update_time = update_time
+            if instance_name is not None:
+                status.lss_mounted_instance = \
+                    service.ls_instances.get(instance_name)
+            self.css_service_status_dict[service_name] = status
+            if status.lss_has_problem():
+                self.css_status_check_time[service_name] = 0
+                hints += 1
+            else:
+                self.css_status_check_time[service_name] = update_time
+            restored += 1
+
+        for service_name, fix_time in fix_times.items():
+            if service_name in self.css_status_services:
+                self.css_fix_time_dict[service_name] = fix_time
+        log.cl_info("restored the status of [%d] services from snapshot, "
+                    "[%d] services will be checked first", restored,
+                    len(self.css_status_services) - restored + hints)
+
+    def css_snapshot_encode(self):
+        """
+        Return the status snapshot that can be saved by marshal
+        """
+        services = {}
+        self.css_service_status_condition.acquire()
+        for service_name, status in self.css_service_status_dict.items():
+            instance = status.lss_mounted_instance
+            if instance is None:
+                instance_name = None
+            else:
+                instance_name = instance.lsi_service_instance_name
+            services[service_name] = (status.lss_service.ls_signature(),
+                                      status.lss_update_time, instance_name)
+        self.css_service_status_condition.release()
+
+        self.css_problem_condition.acquire()
+        fix_times = dict(self.css_fix_time_dict)
+        self.css_problem_condition.release()
+
+        qos_states = {}
+        for fsname, qos in self.css_instance.ci_qos_dict.items():
+            qos_states[fsname] = qos.cdqos_state()
+        return (CLOWNFISH_SNAPSHOT_VERSION, time.time(), services, fix_times,
+                qos_states)
+
+    def css_snapshot_save(self, log):
+        """
+        Save the status snapshot to local file, and send it to the standby
+        hosts
         """
         instance = self.css_instance
+        snapshot_fpath = instance.ci_snapshot_fpath
+        snapshot_dir = os.path.dirname(snapshot_fpath)
+        ret = utils.mkdir(snapshot_dir)
+        if ret:
+            log.cl_error("failed to create directory [%s] on local host",
+                         snapshot_dir)
+            return -1
 
-        for mgs in instance.ci_mgs_dict.values():
-            utils.thread_start(self.css_status_thread,
-                               (mgs, ))
+        data = marshal.dumps(self.css_snapshot_encode())
+        tmp_fpath = snapshot_fpath + ".tmp"
+        try:
+            with open(tmp_fpath, "wb") as snapshot_file:
+                snapshot_file.write(data)
+            os.rename(tmp_fpath, snapshot_fpath)
+        except (IOError, OSError) as error:
+            log.cl_error("failed to save status snapshot to [%s]: %s",
+                         snapshot_fpath, error)
+            return -1
 
-        for lustrefs in instance.ci_lustres.values():
-            services = lustrefs.lf_services()
-            for service in services:
-                utils.thread_start(self.css_status_thread,
-                                   (service, ))
+        standby_hosts = instance.ci_standby_hosts
+        if len(standby_hosts) == 0:
+            return 0
+
+        result = pdsh.pdsh_call(log, standby_hosts, clownfish_snapshot_send,
+                                args=(snapshot_fpath, ))
+        failed_hostnames = result.pr_failed_hostnames()
+        if len(failed_hostnames) > 0:
+            log.cl_error("failed to send status snapshot to hosts [%s]",
+                         pdsh.hostlist_compress(failed_hostnames))
+            return -1
+        return 0
+
+    def css_snapshot_thread(self):
+        """
+        Thread that saves the status snapshot periodically
+        """
+        instance = self.css_instance
+        log = self.css_log
+        log.cl_info("starting thread that saves status snapshot to [%s]",
+                    instance.ci_snapshot_fpath)
+        while True:
+            self.css_snapshot_condition.acquire()
+            if instance.ci_running:
+                self.css_snapshot_condition.wait(CLOWNFISH_SNAPSHOT_INTERVAL)
+            self.css_snapshot_condition.release()
+            # Save the snapshot when quiting too, so that the next server
+            # starts from the latest status
+            self.css_snapshot_save(log)
+            if not instance.ci_running:
+                break
+        log.cl_info("thread that saves status snapshot exited")
+        return 0
+
+    def css_start_status_threads(self, snapshot):
+        """
+        Start the status thread
+        """
+        instance = self.css_instance
+        self.css_status_services = clownfish_services(instance.ci_mgs_dict,
+                                                      instance.ci_lustres)
+        if snapshot is not None:
+            self._css_snapshot_restore(snapshot)
+        # One thread of the pool is used by the scheduling thread, and
+        # another one by the snapshot thread
+        utils.thread_pool_get(utils.THREAD_POOL_STATUS,
+                              max_threads=CLOWNFISH_STATUS_THREAD_NUMBER + 2)
+        utils.thread_start(self.css_status_thread, (),
+                           pool=utils.THREAD_POOL_STATUS)
+        if instance.ci_snapshot_fpath is not None:
+            utils.thread_start(self.css_snapshot_thread, (),
+                               pool=utils.THREAD_POOL_STATUS)
 
     def css_fix_thread(self, thread_id):
         """
@@ -598,10 +1119,14 @@ class ClownfishServiceStatus(object):
             # When HA is disabled, this thread does nothing
             self.css_fix_thread_waiting_number += 1
             self.css_problem_condition.notifyAll()
-            while ((not instance.ci_high_availability) or
-                   (len(self.css_problem_status_dict) == 0)):
+            while (instance.ci_running and
+                   ((not instance.ci_high_availability) or
+                    (len(self.css_problem_status_dict) == 0))):
                 self.css_problem_condition.wait()
             self.css_fix_thread_waiting_number -= 1
+            if not instance.ci_running:
+                self.css_problem_condition.release()
+                break
             #
             # Do no remove the status from the dictionary, remove it after
             # fixing, because the check threads might add the status when
@@ -681,6 +1206,7 @@ class ClownfishServiceStatus(object):
             service_name = service.ls_service_name
 
             log.cl_info("checking the status of service [%s]", service_name)
+            time_start = time.time()
             # Check the status by myself, since the status might be outdated
             status = lustre.LustreServiceStatus(fixing_status.lss_service)
             status.lss_check(log)
@@ -697,23 +1223,60 @@ class ClownfishServiceStatus(object):
                 if status.lss_has_problem():
                     log.cl_error("service [%s] still has problem after fixing",
                                  service_name)
+                    fix_seconds = CLOWNFISH_FIX_SECONDS_FAILED
                 else:
                     log.cl_info("service [%s] was successfully fixed",
                                 service_name)
+                    fix_seconds = CLOWNFISH_FIX_SECONDS_FIXED
             else:
                 log.cl_info("the problem of service [%s] has disapeared "
                             "without fixing", service_name)
+                fix_seconds = CLOWNFISH_FIX_SECONDS_DISAPPEARED
+            fix_seconds.mc_observe(time.time() - time_start)
 
             # Update the status
             self.css_update_status(status)
         log.cl_info("thread [%s] that fix services exited", thread_id)
 
+    def css_fix_queue(self):
+        """
+        Return the number of services that are waiting to be fixed, and the
+        number of services that are being fixed
+        """
+        self.css_problem_condition.acquire()
+        fixing_number = len(self.css_fix_services)
+        waiting_number = 0
+        for service_name in self.css_problem_status_dict:
+            if service_name not in self.css_fix_services:
+                waiting_number += 1
+        self.css_problem_condition.release()
+        return waiting_number, fixing_number
+
     def css_start_fix_threads(self):
         """
         Start the status thread
         """
+        utils.thread_pool_get(utils.THREAD_POOL_FIX,
+                              max_threads=self.css_fix_thread_number)
         for thread_id in range(self.css_fix_thread_number):
-            utils.thread_start(self.css_fix_thread, (thread_id, ))
+            utils.thread_start(self.css_fix_thread, (thread_id, ),
+                               pool=utils.THREAD_POOL_FIX)
+
+    def css_stop(self):
+        """
+        Wake up the status and fix threads so that they can quit
+        """
+        self.css_status_condition.acquire()
+        self.css_status_condition.notifyAll()
+        self.css_status_condition.release()
+
+        self.css_problem_condition.acquire()
+        self.css_problem_condition.notifyAll()
+        self.css_problem_condition.release()
+
+        self.css_snapshot_condition.acquire()
+        self.css_snapshot_condition.notifyAll()
+        self.css_snapshot_condition.release()
 
 
 class ClownfishInstance(object):
@@ -722,21 +1285,72 @@ class ClownfishInstance(object):
     """
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
     # pylint: disable=too-many-arguments,too-many-public-methods
-    def __init__(self, log, workspace, lazy_prepare, hosts, mgs_dict, lustres,
-                 high_availability, qos_dict, no_operation=False):
-        self.ci_lazy_prepare = lazy_prepare
+    def __init__(self, log, workspace, instance_config, qos_dict,
+                 config_fpath=None, host_factory=None, no_operation=False,
+                 snapshot_fpath=None, snapshot=None):
+        self.ci_lazy_prepare = instance_config.cic_lazy_prepare
         # Keys are the host IDs, not the hostnames
-        self.ci_hosts = hosts
+        self.ci_hosts = instance_config.cic_hosts
         # Keys are the MGS IDs, values ares instances of LustreService
-        self.ci_mgs_dict = mgs_dict
+        self.ci_mgs_dict = instance_config.cic_mgs_dict
         # Keys are the fsname, values ares instances of LustreFilesystem
-        self.ci_lustres = lustres
+        self.ci_lustres = instance_config.cic_lustres
+        # Keys are the fsname, values are the configs of the file systems
+        self.ci_lustre_configs = instance_config.cic_lustre_configs
+        # Keys are the distribution IDs, values are the prepared LustreRPMs
+        self.ci_lustre_distributions = instance_config.cic_lustre_distributions
+        # The config file to reload
+        self.ci_config_fpath = config_fpath
+        # The hosts to send the status snapshot to
+        self.ci_standby_hosts = instance_config.cic_standby_hosts
+        # The file to save the status snapshot, None if not saved
+        self.ci_snapshot_fpath = snapshot_fpath
+        self.ci_host_factory = host_factory
+        self.ci_no_operation = no_operation
         self.ci_workspace = workspace
         self.ci_running = True
-        self.ci_high_availability = high_availability
-        if not no_operation:
-            self.ci_service_status = ClownfishServiceStatus(self, log)
+        self.ci_high_availability = instance_config.cic_high_availability
+        # The high availability in the config, which could be different
+        # from ci_high_availability changed by commands
+        self.ci_high_availability_config = instance_config.cic_high_availability
+        # Increased whenever the config is reloaded, so the walks of the
+        # connections know they need to enter their paths again
+        self.ci_config_generation = 0
+        self.ci_service_status = None
+        utils.thread_pool_get(utils.THREAD_POOL_COMMANDS,
+                              max_threads=CLOWNFISH_COMMAND_THREAD_NUMBER)
         self.ci_qos_dict = qos_dict
+        if not no_operation:
+            self.ci_service_status = ClownfishServiceStatus(self, log,
+                                                            snapshot=snapshot)
+
+    def ci_metrics_fix_waiting(self):
+        """
+        Collect the number of services waiting to be fixed
+        """
+        if self.ci_service_status is None:
+            return []
+        return [((), self.ci_service_status.css_fix_queue()[0])]
+
+    def ci_metrics_fix_running(self):
+        """
+        Collect the number of services being fixed
+        """
+        if self.ci_service_status is None:
+            return []
+        return [((), self.ci_service_status.css_fix_queue()[1])]
+
+    def ci_metrics_qos_throttled_uids(self):
+        """
+        Collect the number of UIDs throttled by QoS
+        """
+        values = []
+        for fsname, qos in self.ci_qos_dict.items():
+            values.append(((fsname, "oss"),
+                           len(qos.cdqos_oss_throttled_uids)))
+            values.append(((fsname, "mds"),
+                           len(qos.cdqos_mds_throttled_uids)))
+        return values
 
     def ci_mount_lustres(self, log):
         """
@@ -954,11 +1568,228 @@ class ClownfishInstance(object):
 
         return ret
 
-    def ci_fini(self):
+    def _ci_reload_qos(self, log, instance_config):
+        """
+        Apply the QoS changes of the reloaded config. The QoS which has
+        only the users changed keeps running, the others are restarted.
+        """
+        # pylint: disable=too-many-locals
+        config_fpath = self.ci_config_fpath
+        # Keys are the fsname, values are the new users of the QoS that keep
+        # running
+        qos_users_dict = {}
+        for fsname, qos in self.ci_qos_dict.items():
+            if fsname not in instance_config.cic_lustres:
+                continue
+            lustre_fs = instance_config.cic_lustres[fsname]
+            old_qos_config = utils.config_value(self.ci_lustre_configs[fsname],
+                                                cstr.CSTR_QOS)
+            qos_config = utils.config_value(instance_config.cic_lustre_configs[fsname],
+                                            cstr.CSTR_QOS)
+            if (qos_config is None or
+                    qos_config_without_users(old_qos_config) !=
+                    qos_config_without_users(qos_config)):
+                continue
+
+            qos_user_configs = utils.config_value(qos_config, cstr.CSTR_USERS)
+            if qos_user_configs is None:
+                qos_user_configs = []
+
+            qos_users = {}
+            for qos_user_config in qos_user_configs:
+                ret = parse_qos_user_config(log, lustre_fs, qos_user_config,
+                                            config_fpath, qos_users,
+                                            qos.cdqos_interval,
+                                            qos.cdqos_mbps_threshold,
+                                            qos.cdqos_iops_threshold,
+                                            qos.cdqos_throttled_oss_rpc_rate,
+                                            qos.cdqos_throttled_mds_rpc_rate)
+                if ret:
+                    log.cl_error("failed to parse QoS users of file system "
+                                 "[%s]", fsname)
+                    return -1, None
+            qos_users_dict[fsname] = qos_users
+        return 0, qos_users_dict
+
+    def ci_reload(self, log):
+        """
+        Reload the config file and apply the changes to the running instance.
+        The status of the services that are not changed is kept, and the
+        QoS is only restarted for the file systems with changed QoS config.
+        """
+        # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+        config_fpath = self.ci_config_fpath
+        if config_fpath is None:
+            log.cl_stderr("no config file to reload")
+            return -1
+
+        config = lconfig.config_load(log, config_fpath,
+                                     lconfig.CLOWNFISH_CONFIG_SCHEMA,
+                                     cache_dir=constants.CLOWNFISH_CONFIG_CACHE_DIR)
+        if config is None:
+            log.cl_stderr("failed to load config [%s]", config_fpath)
+            return -1
+
+        instance_config = parse_instance_config(log, config, config_fpath,
+                                                host_factory=self.ci_host_factory,
+                                                prepared_distributions=self.ci_lustre_distributions)
+        if instance_config is None:
+            log.cl_stderr("failed to parse config [%s], nothing is changed",
+                          config_fpath)
+            return -1
+
+        # Parse the QoS users before changing anything, so nothing is
+        # changed if the config is invalid
+        ret, qos_users_dict = self._ci_reload_qos(log, instance_config)
+        if ret:
+            log.cl_stderr("failed to parse QoS in config [%s], nothing is "
+                          "changed", config_fpath)
+            return -1
+
+        old_services = clownfish_services(self.ci_mgs_dict, self.ci_lustres)
+        services = clownfish_services(instance_config.cic_mgs_dict,
+                                      instance_config.cic_lustres)
+        added_services = []
+        changed_services = []
+        for service_name, service in services.items():
+            if service_name not in old_services:
+                added_services.append(service_name)
+            elif (old_services[service_name].ls_signature() !=
+                  service.ls_signature()):
+                changed_services.append(service_name)
+        removed_services = []
+        for service_name in old_services:
+            if service_name not in services:
+                removed_services.append(service_name)
+
+        added_hosts = []
+        for host_id in instance_config.cic_hosts:
+            if host_id not in self.ci_hosts:
+                added_hosts.append(host_id)
+        removed_hosts = []
+        for host_id in self.ci_hosts:
+            if host_id not in instance_config.cic_hosts:
+                removed_hosts.append(host_id)
+
+        # Wait until the running operations on the old objects finish
+        lock_handles = []
+        for mgs in self.ci_mgs_dict.values():
+            mgs_lock_handle = mgs.ls_lock.rwl_writer_acquire(log)
+            if mgs_lock_handle is None:
+                log.cl_stderr("aborting reloading config")
+                for lock_handle in reversed(lock_handles):
+                    lock_handle.rwh_release()
+                return -1
+            lock_handles.append(mgs_lock_handle)
+
+        for lustrefs in self.ci_lustres.values():
+            fs_lock_handle = lustrefs.lf_lock.rwl_writer_acquire(log)
+            if fs_lock_handle is None:
+                log.cl_stderr("aborting reloading config")
+                for lock_handle in reversed(lock_handles):
+                    lock_handle.rwh_release()
+                return -1
+            lock_handles.append(fs_lock_handle)
+
+        self.ci_hosts = instance_config.cic_hosts
+        self.ci_mgs_dict = instance_config.cic_mgs_dict
+        self.ci_lustres = instance_config.cic_lustres
+        self.ci_lustre_configs = instance_config.cic_lustre_configs
+        self.ci_lustre_distributions = instance_config.cic_lustre_distributions
+        self.ci_lazy_prepare = instance_config.cic_lazy_prepare
+        self.ci_standby_hosts = instance_config.cic_standby_hosts
+        self.ci_config_generation += 1
+        if self.ci_service_status is not None:
+            self.ci_service_status.css_services_replace(services,
+                                                        removed_services +
+                                                        changed_services)
+
+        for lock_handle in reversed(lock_handles):
+            lock_handle.rwh_release()
+
+        for service_name in added_services:
+            log.cl_info("service [%s] is added", service_name)
+        for service_name in changed_services:
+            log.cl_info("service [%s] is changed", service_name)
+        for service_name in removed_services:
+            log.cl_info("service [%s] is removed", service_name)
+
+        ret = 0
+        # Keep the high availability changed by commands unless the config
+        # of it is changed
+        if (instance_config.cic_high_availability !=
+                self.ci_high_availability_config):
+            self.ci_high_availability_config = \
+                instance_config.cic_high_availability
+            if instance_config.cic_high_availability:
+                self.ci_high_availability_enable()
+            elif self.ci_service_status is not None:
+                ret = self.ci_high_availability_disable(log)
+            else:
+                self.ci_high_availability = False
+
+        qos_dict = {}
+        for fsname, qos in self.ci_qos_dict.items():
+            if fsname in qos_users_dict:
+                lustre_fs = instance_config.cic_lustres[fsname]
+                if qos.cdqos_update(log, lustre_fs, qos_users_dict[fsname]):
+                    log.cl_stderr("failed to update QoS of file system [%s]",
+                                  fsname)
+                    ret = -1
+                    continue
+                qos_dict[fsname] = qos
+                continue
+
+            # The file system or its QoS is removed or changed
+            if qos.cqqos_disable(log):
+                log.cl_stderr("failed to stop QoS of file system [%s]",
+                              fsname)
+                ret = -1
+            qos.cdqos_thread_log.cl_fini()
+
+        # Each QoS thread runs until the QoS is stopped
+        utils.thread_pool_get(utils.THREAD_POOL_QOS,
+                              max_threads=max(len(self.ci_lustres), 1))
+        if not self.ci_no_operation:
+            for fsname, lustre_fs in self.ci_lustres.items():
+                if fsname in qos_dict:
+                    continue
+                rc, qos = parse_qos_config(log, lustre_fs,
+                                           self.ci_lustre_configs[fsname],
+                                           config_fpath, self.ci_workspace)
+                if rc:
+                    log.cl_stderr("failed to parse QoS for file system [%s]",
+                                  fsname)
+                    ret = -1
+                    continue
+                if qos is not None:
+                    qos_dict[fsname] = qos
+        self.ci_qos_dict = qos_dict
+
+        log.cl_stdout("reloaded config [%s], hosts: [%d] added, [%d] "
+                      "removed, services: [%d] added, [%d] changed, [%d] "
+                      "removed", config_fpath, len(added_hosts),
+                      len(removed_hosts), len(added_services),
+                      len(changed_services), len(removed_services))
+        return ret
+
+    def ci_fini(self, log):
         """
         quiting
         """
         self.ci_running = False
+        if self.ci_service_status is not None:
+            self.ci_service_status.css_stop()
+        # Let the QoS threads quit, but keep the TBF rules since the
+        # QoS might be enabled again when the service restarts.
+        for qos in self.ci_qos_dict.values():
+            qos.cdqos_enabled = False
+        utils.thread_pools_shutdown(log, [utils.THREAD_POOL_COMMANDS,
+                                          utils.THREAD_POOL_STATUS,
+                                          utils.THREAD_POOL_FIX,
+                                          utils.THREAD_POOL_QOS,
+                                          utils.THREAD_POOL_IO],
+                                    timeout=CLOWNFISH_THREAD_POOL_SHUTDOWN_TIMEOUT)
 
     def ci_high_availability_enable(self):
         """
@@ -1026,14 +1857,6 @@ class ClownfishInstance(object):
         return instance_code
 
 
-def clownfish_entry_escape(entry_name):
-    r"""
-    Return the escaped entry ename by replacing the "/" to "\/"
-    """
-    escaped_name = entry_name.replace("/", r"\/")
-    return escaped_name
-
-
 class ClownfishEntry(object):
     """
     Common entry
@@ -1043,7 +1866,7 @@ class ClownfishEntry(object):
         self.ce_walk = walk
         self.ce_entry_name = entry_name
         self.ce_parent_entry = parent_entry
-        self.ce_escaped_name = clownfish_entry_escape(entry_name)
+        self.ce_escaped_name = clownfish_common.clownfish_entry_escape(entry_name)
         if parent_entry is None:
             assert entry_name == "/"
             self.ce_path = "/"
@@ -2732,9 +3555,11 @@ def parse_qos_user_config(log, lustre_fs, qos_user_config, config_fpath,
     return 0
 
 
-def parse_qos_config(log, lustre_fs, lustre_config, config_fpath, workspace):
+def parse_qos_config(log, lustre_fs, lustre_config, config_fpath, workspace,
+                     state=None):
     """
-    Parse the config for QoS
+    Parse the config for QoS, state is the throttling state saved by the
+    previous server
     """
     # pylint: disable=too-many-locals,too-many-branches
     qos_config = utils.config_value(lustre_config, cstr.CSTR_QOS)
@@ -2848,13 +3673,45 @@ def parse_qos_config(log, lustre_fs, lustre_config, config_fpath, workspace):
                                           qos_iops_threshold,
                                           qos_throttled_mds_rpc_rate,
                                           esmon_collect_interval,
-                                          qos_users, qos_enabled, workspace)
+                                          qos_users, qos_enabled, workspace,
+                                          state=state)
     return 0, qos
 
 
-def init_instance(log, workspace, config, config_fpath, no_operation=False):
+class ClownfishInstanceConfig(object):
     """
-    Parse the config and init the instance
+    The objects parsed from the config of Clownfish
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, lazy_prepare, high_availability, lustre_distributions,
+                 hosts, mgs_dict, lustres, lustre_configs, standby_hosts):
+        self.cic_lazy_prepare = lazy_prepare
+        self.cic_high_availability = high_availability
+        # Keys are the distribution IDs, values are LustreRPMs
+        self.cic_lustre_distributions = lustre_distributions
+        # Keys are the host IDs, values are the hosts
+        self.cic_hosts = hosts
+        # Keys are the MGS IDs, values ares instances of LustreService
+        self.cic_mgs_dict = mgs_dict
+        # Keys are the fsname, values ares instances of LustreFilesystem
+        self.cic_lustres = lustres
+        # Keys are the fsname, values are the configs of the file systems
+        self.cic_lustre_configs = lustre_configs
+        # The hosts to send the status snapshot to, not including local host
+        self.cic_standby_hosts = standby_hosts
+
+
+def parse_instance_config(log, config, config_fpath, host_factory=None,
+                          prepared_distributions=None):
+    """
+    Parse the config and return ClownfishInstanceConfig, None on error
+
+    If host_factory is not None, it is called like the constructor of
+    LustreServerHost to create the hosts, e.g. the simulated hosts of
+    lustre_sim, and the Lustre RPMs will not be prepared.
+
+    If prepared_distributions is not None, the LustreRPMs in it are reused
+    for the distributions that are not changed.
     """
     # pylint: disable=too-many-locals,too-many-return-statements
     # pylint: disable=too-many-branches,too-many-statements
@@ -2925,12 +3782,22 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
 
         e2fsprogs_rpm_dir = e2fsprogs_rpm_dir.rstrip("/")
 
-        lustre_rpms = lustre.LustreRPMs(lustre_distribution_id,
-                                        lustre_rpm_dir, e2fsprogs_rpm_dir)
-        ret = lustre_rpms.lr_prepare(log)
-        if ret:
-            log.cl_error("failed to prepare Lustre RPMs")
-            return None
+        lustre_rpms = None
+        if prepared_distributions is not None:
+            lustre_rpms = prepared_distributions.get(lustre_distribution_id)
+            if (lustre_rpms is not None and
+                    (lustre_rpms.lr_rpm_dir != lustre_rpm_dir or
+                     lustre_rpms.lr_e2fsprogs_rpm_dir != e2fsprogs_rpm_dir)):
+                lustre_rpms = None
+
+        if lustre_rpms is None:
+            lustre_rpms = lustre.LustreRPMs(lustre_distribution_id,
+                                            lustre_rpm_dir, e2fsprogs_rpm_dir)
+            if host_factory is None:
+                ret = lustre_rpms.lr_prepare(log)
+                if ret:
+                    log.cl_error("failed to prepare Lustre RPMs")
+                    return None
 
         lustre_distributions[lustre_distribution_id] = lustre_rpms
 
@@ -2941,6 +3808,9 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
                      cstr.CSTR_SSH_HOSTS, config_fpath)
         return None
 
+    if host_factory is None:
+        host_factory = lustre.LustreServerHost
+
     hosts = {}
     for host_config in ssh_host_configs:
         host_id = utils.config_value(host_config,
@@ -2980,12 +3850,32 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
 
         ssh_identity_file = utils.config_value(host_config, cstr.CSTR_SSH_IDENTITY_FILE)
 
-        host = lustre.LustreServerHost(hostname,
-                                       lustre_rpms=lustre_distribution,
-                                       identity_file=ssh_identity_file,
-                                       host_id=host_id)
+        host = host_factory(hostname, lustre_rpms=lustre_distribution,
+                            identity_file=ssh_identity_file, host_id=host_id)
         hosts[host_id] = host
 
+    standby_host_configs = utils.config_value(config, cstr.CSTR_STANDBY_HOSTS)
+    if standby_host_configs is None:
+        standby_host_configs = []
+
+    local_hostname = socket.gethostname()
+    standby_hosts = []
+    for host_config in standby_host_configs:
+        hostname = utils.config_value(host_config, cstr.CSTR_HOSTNAME)
+        if hostname is None:
+            log.cl_error("can NOT find [%s] in the config of a standby "
+                         "host, please correct file [%s]",
+                         cstr.CSTR_HOSTNAME, config_fpath)
+            return None
+
+        # The same config is used on all the hosts of the cluster
+        if hostname in (local_hostname, local_hostname.split(".")[0]):
+            continue
+
+        ssh_identity_file = utils.config_value(host_config, cstr.CSTR_SSH_IDENTITY_FILE)
+        standby_hosts.append(ssh_host.SSHHost(hostname,
+                                              identity_file=ssh_identity_file))
+
     lustre_configs = utils.config_value(config, cstr.CSTR_LUSTRES)
     if lustre_configs is None:
         log.cl_error("no [%s] is configured, please correct file [%s]",
@@ -3093,7 +3983,7 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
                                      nid, add_to_host=True)
 
     lustres = {}
-    qos_dict = {}
+    lustre_fs_configs = {}
     for lustre_config in lustre_configs:
         # Parse general configs of Lustre file system
         fsname = utils.config_value(lustre_config, cstr.CSTR_FSNAME)
@@ -3110,6 +4000,7 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
 
         lustre_fs = lustre.LustreFilesystem(fsname)
         lustres[fsname] = lustre_fs
+        lustre_fs_configs[fsname] = lustre_config
 
         mgs_configured = False
 
@@ -3396,24 +4287,117 @@ def init_instance(log, workspace, config, config_fpath, no_operation=False):
 
             lustre.LustreClient(log, lustre_fs, lustre_host, mnt, add_to_host=True)
 
-        # No operation means this instance should not do any operation.
-        # QoS won't be used.
-        if no_operation:
-            continue
+    return ClownfishInstanceConfig(lazy_prepare, high_availability,
+                                   lustre_distributions, hosts, mgs_dict,
+                                   lustres, lustre_fs_configs, standby_hosts)
 
-        ret, qos = parse_qos_config(log, lustre_fs, lustre_config,
-                                    config_fpath, workspace)
-        if ret:
-            log.cl_error("failed to parse QoS for file system [%s]",
-                         lustre_fs.lf_fsname)
-            return None
 
-        if qos is None:
-            continue
-        qos_dict[lustre_fs.lf_fsname] = qos
+def clownfish_metrics_thread_pools_busy():
+    """
+    Collect the number of busy threads of thread pools
+    """
+    values = []
+    for name, stats in utils.thread_pools_stats().items():
+        values.append(((name, ), stats["busy_threads"]))
+    return values
+
+
+def clownfish_metrics_thread_pools_queued():
+    """
+    Collect the number of queued tasks of thread pools
+    """
+    values = []
+    for name, stats in utils.thread_pools_stats().items():
+        values.append(((name, ), stats["queued"]))
+    return values
+
+
+def clownfish_metrics_register(instance):
+    """
+    Register the gauges of the instance that are computed when scraped
+    """
+    metrics.metrics_gauge("clownfish_fix_queue_depth",
+                          "Number of services waiting to be fixed",
+                          instance.ci_metrics_fix_waiting)
+    metrics.metrics_gauge("clownfish_fix_in_progress",
+                          "Number of services being fixed",
+                          instance.ci_metrics_fix_running)
+    metrics.metrics_gauge("clownfish_qos_throttled_uids",
+                          "Number of UIDs throttled by QoS",
+                          instance.ci_metrics_qos_throttled_uids,
+                          label_names=("fsname", "service"))
+    metrics.metrics_gauge("clownfish_thread_pool_busy_threads",
+                          "Number of threads running tasks in thread pools",
+                          clownfish_metrics_thread_pools_busy,
+                          label_names=("pool", ))
+    metrics.metrics_gauge("clownfish_thread_pool_queued",
+                          "Number of tasks waiting in thread pools",
+                          clownfish_metrics_thread_pools_queued,
+                          label_names=("pool", ))
+
+
+def clownfish_metrics_unregister():
+    """
+    Unregister the gauges registered by clownfish_metrics_register()
+    """
+    for name in CLOWNFISH_METRICS_GAUGES:
+        metrics.metrics_unregister(name)
+
+
+def init_instance(log, workspace, config, config_fpath, no_operation=False,
+                  host_factory=None, snapshot_fpath=None):
+    """
+    Parse the config and init the instance
+
+    If host_factory is not None, it is called like the constructor of
+    LustreServerHost to create the hosts, e.g. the simulated hosts of
+    lustre_sim, and the Lustre RPMs will not be prepared.
+
+    If snapshot_fpath is not None, the instance starts from the status
+    snapshot in it, and saves the snapshot to it periodically.
+    """
+    # pylint: disable=too-many-locals
+    instance_config = parse_instance_config(log, config, config_fpath,
+                                            host_factory=host_factory)
+    if instance_config is None:
+        return None
+
+    snapshot = None
+    if snapshot_fpath is not None and not no_operation:
+        snapshot = clownfish_snapshot_load(log, snapshot_fpath)
+
+    qos_dict = {}
+    # No operation means this instance should not do any operation.
+    # QoS won't be used.
+    if not no_operation:
+        # Each QoS thread runs until the QoS is stopped, so the pool needs
+        # a thread for each file system before any QoS is enabled
+        utils.thread_pool_get(utils.THREAD_POOL_QOS,
+                              max_threads=max(len(instance_config.cic_lustres),
+                                              1))
+        for fsname, lustre_fs in instance_config.cic_lustres.items():
+            lustre_config = instance_config.cic_lustre_configs[fsname]
+            qos_state = None
+            if snapshot is not None:
+                qos_state = snapshot[4].get(fsname)
+            ret, qos = parse_qos_config(log, lustre_fs, lustre_config,
+                                        config_fpath, workspace,
+                                        state=qos_state)
+            if ret:
+                log.cl_error("failed to parse QoS for file system [%s]",
+                             fsname)
+                return None
+
+            if qos is None:
+                continue
+            qos_dict[fsname] = qos
 
-    return ClownfishInstance(log, workspace, lazy_prepare, hosts, mgs_dict, lustres,
-                             high_availability, qos_dict, no_operation=no_operation)
+    return ClownfishInstance(log, workspace, instance_config, qos_dict,
+                             config_fpath=config_fpath,
+                             host_factory=host_factory,
+                             no_operation=no_operation,
+                             snapshot_fpath=snapshot_fpath,
+                             snapshot=snapshot)
 
 
 def clownfish_entry_path(obj):
@@ -3429,7 +4413,7 @@ def clownfish_entry_path(obj):
         # return the first one
         return (clownfish_entry_path(obj.lc_lustre_fs) + "/" +
                 cstr.CSTR_CLIENTS + "/" +
-                clownfish_entry_escape(obj.lc_client_name))
+                clownfish_common.clownfish_entry_escape(obj.lc_client_name))
     elif isinstance(obj, lustre.LustreMDT):
         # Two paths:
         # 1. lustres/$fsname/mdts/$service_name
@@ -3462,7 +4446,7 @@ def clownfish_entry_path(obj):
         # 3. hosts/$hostname/mgs
         # return the first one
         return (clownfish_entry_path(obj.lsi_service) + "/" +
-                clownfish_entry_escape(obj.lsi_service_instance_name))
+                clownfish_common.clownfish_entry_escape(obj.lsi_service_instance_name))
     reason = ("not able to get clownfish entry path for object [%s]" %
               type(obj))
     raise Exception(reason)
@@ -0,0 +1,421 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Benchmark Library for clownfish
+Clownfish is an automatic management system for Lustre
+
+The benchmark starts a Clownfish server with a synthetic instance on a
+simulated Lustre cluster, drives multiple consoles to the server at the same
+time, and reports the latency and throughput of the server.
+"""
+import os
+import sys
+import time
+import subprocess
+import threading
+import traceback
+import yaml
+
+# Local libs
+from pylcommon import utils
+from pylcommon import cstr
+from pylcommon import cmd_general
+from pylcommon import constants
+from pylcommon import lustre_sim
+from pyclownfish import clownfish
+from pyclownfish import clownfish_console
+from pyclownfish import clownfish_server
+
+# The port of the benchmark server, not the same with the real server
+BENCHMARK_DEFAULT_PORT = constants.CLOWNFISH_DEFAULT_SERVER_PORT + 1
+BENCHMARK_DEFAULT_HOST_NUMBER = 100
+BENCHMARK_DEFAULT_MDT_NUMBER = 4
+BENCHMARK_DEFAULT_OST_NUMBER = 1000
+BENCHMARK_DEFAULT_CONSOLE_NUMBER = 8
+# Seconds to drive the consoles
+BENCHMARK_DEFAULT_DURATION = 30
+# Seconds that each command on the simulated hosts costs
+BENCHMARK_DEFAULT_LATENCY = 0.001
+BENCHMARK_FSNAME = "bench"
+BENCHMARK_RESULT_FNAME = "benchmark_result.yaml"
+# The operations that the consoles run in turn
+BENCHMARK_OPERATION_LS = "ls_status_recursive"
+BENCHMARK_OPERATION_CD = "cd"
+BENCHMARK_OPERATION_COMPLETION = "completion"
+BENCHMARK_OPERATION_UMOUNT = "umount"
+BENCHMARK_OPERATION_MOUNT = "mount"
+BENCHMARK_OPERATIONS = [BENCHMARK_OPERATION_LS, BENCHMARK_OPERATION_CD,
+                        BENCHMARK_OPERATION_COMPLETION,
+                        BENCHMARK_OPERATION_UMOUNT,
+                        BENCHMARK_OPERATION_MOUNT]
+# Running "clownfish_console host command" as a new process
+BENCHMARK_OPERATION_CONSOLE_STARTUP = "console_startup"
+BENCHMARK_RESULT_OPERATIONS = (BENCHMARK_OPERATIONS +
+                               [BENCHMARK_OPERATION_CONSOLE_STARTUP])
+# How many times to run the one-shot console after the other operations
+BENCHMARK_CONSOLE_STARTUP_NUMBER = 20
+
+
+def benchmark_instance(log, workspace, host_number, mdt_number, ost_number,
+                       latency):
+    """
+    Return a synthetic instance on a simulated cluster
+    """
+    # pylint: disable=too-many-arguments
+    cluster = lustre_sim.LustreSimCluster(latency=latency)
+    config = cluster.lsc_lustre_config(BENCHMARK_FSNAME, host_number,
+                                       mdt_number, ost_number)
+    return clownfish.init_instance(log, workspace, config, None,
+                                   host_factory=cluster.lsc_host_create)
+
+
+class BenchmarkResult(object):
+    """
+    The latencies of the operations from all consoles
+    """
+    def __init__(self):
+        # Keys are operation names, values are lists of latencies
+        self.br_latencies = {}
+        # Keys are operation names, values are the numbers of failures
+        self.br_failures = {}
+        for operation in BENCHMARK_RESULT_OPERATIONS:
+            self.br_latencies[operation] = []
+            self.br_failures[operation] = 0
+        # The indexes of the consoles that failed
+        self.br_failed_consoles = []
+        # Protects all the fields
+        self.br_lock = threading.Lock()
+
+    def br_add(self, operation, latency, failed):
+        """
+        Add the latency of an operation
+        """
+        self.br_lock.acquire()
+        self.br_latencies[operation].append(latency)
+        if failed:
+            self.br_failures[operation] += 1
+        self.br_lock.release()
+
+    def br_console_failed(self, console_index):
+        """
+        Add a console that failed
+        """
+        self.br_lock.acquire()
+        self.br_failed_consoles.append(console_index)
+        self.br_lock.release()
+
+    def br_encode(self, duration):
+        """
+        Return the encoded result which can be dumped to YAML string
+        """
+        encoded = {}
+        total = 0
+        for operation in BENCHMARK_RESULT_OPERATIONS:
+            latencies = sorted(self.br_latencies[operation])
+            if operation in BENCHMARK_OPERATIONS:
+                total += len(latencies)
+            operation_code = {"count": len(latencies),
+                              "failures": self.br_failures[operation]}
+            if len(latencies) > 0:
+                for name, percent in [("p50", 0.5), ("p99", 0.99)]:
+                    index = int(round((len(latencies) - 1) * percent))
+                    operation_code[name] = round(latencies[index], 6)
+                operation_code["max"] = round(latencies[-1], 6)
+            encoded[operation] = operation_code
+        encoded["requests_per_second"] = round(total / duration, 3)
+        encoded["failed_consoles"] = sorted(self.br_failed_consoles)
+        return encoded
+
+
+def benchmark_run_operation(log, console_client, operation, ost_path):
+    """
+    Run an operation on the console, return True if failed
+    """
+    result = log.cl_result
+    if operation == BENCHMARK_OPERATION_LS:
+        commands = ["cd /",
+                    "%s -%s -%s" % (clownfish.CLOWNFISH_COMMNAD_LS,
+                                    clownfish.CLOWNFISH_COMMNAD_LS_OPTION_SHORT_STATUS,
+                                    clownfish.CLOWNFISH_COMMNAD_LS_OPTION_SHORT_RECURSIVE)]
+    elif operation == BENCHMARK_OPERATION_CD:
+        commands = ["cd " + ost_path, "cd /"]
+    elif operation == BENCHMARK_OPERATION_COMPLETION:
+        # What the readline completer asks the server when pressing tab
+        command_dict = console_client.cc_command_dict()
+        children = console_client.cc_children()
+        return len(command_dict) == 0 or len(children) == 0
+    elif operation == BENCHMARK_OPERATION_UMOUNT:
+        commands = ["cd " + ost_path, clownfish.CLOWNFISH_COMMNAD_UMOUNT]
+    else:
+        commands = ["cd " + ost_path, clownfish.CLOWNFISH_COMMNAD_MOUNT]
+
+    for command in commands:
+        console_client.cc_command(log, command)
+        if result.cr_exit_status:
+            log.cl_debug("failed to run command [%s]", command)
+            return True
+    return False
+
+
+def benchmark_console_thread(log, workspace, server_url, console_index,
+                             ost_number, deadline, result):
+    """
+    Connect to the server and run the operations until the deadline
+    """
+    # pylint: disable=too-many-arguments,broad-except
+    name = "console_%d" % console_index
+    console_workspace = workspace + "/" + name
+    ret = utils.mkdir(console_workspace)
+    if ret:
+        log.cl_error("failed to create directory [%s] on local host",
+                     console_workspace)
+        result.br_console_failed(console_index)
+        return -1
+    console_log = log.cl_get_child(name, resultsdir=console_workspace)
+    console_client = clownfish_console.ClownfishClient(console_log,
+                                                       console_workspace,
+                                                       server_url)
+    ret = console_client.cc_init()
+    if ret:
+        log.cl_error("console [%d] failed to connect to Clownfish server",
+                     console_index)
+        result.br_console_failed(console_index)
+    else:
+        ost_path = ("/%s/%s/%s/%s-OST%04x" %
+                    (cstr.CSTR_LUSTRES, BENCHMARK_FSNAME, cstr.CSTR_OSTS,
+                     BENCHMARK_FSNAME, console_index % ost_number))
+        operation_index = 0
+        while time.time() < deadline:
+            operation = BENCHMARK_OPERATIONS[operation_index %
+                                             len(BENCHMARK_OPERATIONS)]
+            operation_index += 1
+            time_start = time.time()
+            try:
+                failed = benchmark_run_operation(console_log, console_client,
+                                                 operation, ost_path)
+            except Exception:
+                log.cl_error("exception when running operation [%s]: %s",
+                             operation, traceback.format_exc())
+                failed = True
+            result.br_add(operation, time.time() - time_start, failed)
+
+    console_client.cc_fini()
+    console_log.cl_fini()
+    return ret
+
+
+def benchmark_console_startup(log, port, result):
+    """
+    Run the one-shot console as a new process for multiple times
+    """
+    # The console command is installed in the same directory of this command
+    console_fpath = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                                 "clownfish_console")
+    command = [sys.executable, console_fpath, "-P", str(port), "127.0.0.1",
+               clownfish.CLOWNFISH_COMMNAD_PWD]
+    for _ in range(BENCHMARK_CONSOLE_STARTUP_NUMBER):
+        time_start = time.time()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        failed = process.returncode != 0
+        result.br_add(BENCHMARK_OPERATION_CONSOLE_STARTUP,
+                      time.time() - time_start, failed)
+        if failed:
+            log.cl_error("failed to run command [%s], ret = [%d], "
+                         "stdout = [%s], stderr = [%s]",
+                         " ".join(command), process.returncode,
+                         stdout, stderr)
+
+
+def benchmark_process_stats(cpu_start, wall_time):
+    """
+    Return the resource usage of this process
+    """
+    rss_kb = 0
+    with open("/proc/self/status") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+                break
+    times = os.times()
+    cpu_time = times[0] + times[1] - cpu_start
+    return {"threads": threading.active_count(),
+            "rss_kb": rss_kb,
+            "cpu_seconds": round(cpu_time, 3),
+            "cpu_percent": round(cpu_time * 100 / wall_time, 1)}
+
+
+def benchmark_config_value(log, config, key, default):
+    """
+    Return the positive number configured, or the default value
+    """
+    value = utils.config_value(config, key)
+    if value is None:
+        log.cl_debug("no [%s] is configured, using [%s]", key, default)
+        return default
+    if not isinstance(value, (int, float)) or value < 0:
+        log.cl_error("invalid [%s] [%s]", key, value)
+        return None
+    return value
+
+
+def clownfish_benchmark_config(log, workspace, config, config_fpath):
+    """
+    Start the server and run the benchmark
+    """
+    # pylint: disable=too-many-locals,too-many-return-statements
+    # pylint: disable=too-many-branches,too-many-statements
+    if config is None:
+        config = {}
+    values = {}
+    for key, default in [(cstr.CSTR_CLOWNFISH_PORT, BENCHMARK_DEFAULT_PORT),
+                         (cstr.CSTR_HOST_NUMBER, BENCHMARK_DEFAULT_HOST_NUMBER),
+                         (cstr.CSTR_MDT_NUMBER, BENCHMARK_DEFAULT_MDT_NUMBER),
+                         (cstr.CSTR_OST_NUMBER, BENCHMARK_DEFAULT_OST_NUMBER),
+                         (cstr.CSTR_CONSOLE_NUMBER,
+                          BENCHMARK_DEFAULT_CONSOLE_NUMBER),
+                         (cstr.CSTR_DURATION, BENCHMARK_DEFAULT_DURATION),
+                         (cstr.CSTR_LATENCY, BENCHMARK_DEFAULT_LATENCY)]:
+        value = benchmark_config_value(log, config, key, default)
+        if value is None:
+            log.cl_error("please correct file [%s]", config_fpath)
+            return -1
+        values[key] = value
+    if values[cstr.CSTR_HOST_NUMBER] < 2 or values[cstr.CSTR_OST_NUMBER] < 1:
+        log.cl_error("at least 2 hosts and 1 OST are needed, please correct "
+                     "file [%s]", config_fpath)
+        return -1
+
+    # Keys are operation names, values are the limits of p99 latency. The
+    # latency depends on the host running the benchmark, so no limit is
+    # enforced unless configured.
+    p99_limits = utils.config_value(config, cstr.CSTR_P99_LIMITS)
+    if p99_limits is None:
+        p99_limits = {}
+
+    log.cl_info("creating synthetic instance with [%d] hosts, [%d] MDTs "
+                "and [%d] OSTs", values[cstr.CSTR_HOST_NUMBER],
+                values[cstr.CSTR_MDT_NUMBER], values[cstr.CSTR_OST_NUMBER])
+    time_start = time.time()
+    instance = benchmark_instance(log, workspace,
+                                  values[cstr.CSTR_HOST_NUMBER],
+                                  values[cstr.CSTR_MDT_NUMBER],
+                                  values[cstr.CSTR_OST_NUMBER],
+                                  values[cstr.CSTR_LATENCY])
+    if instance is None:
+        log.cl_error("failed to create synthetic instance")
+        return -1
+    init_seconds = time.time() - time_start
+
+    port = values[cstr.CSTR_CLOWNFISH_PORT]
+    cserver = clownfish_server.ClownfishServer(log, port, instance)
+    utils.thread_start(cserver.cs_loop, ())
+
+    server_url = "tcp://127.0.0.1:%s" % port
+    duration = values[cstr.CSTR_DURATION]
+    result = BenchmarkResult()
+    cpu_start = sum(os.times()[0:2])
+    time_start = time.time()
+    deadline = time_start + duration
+    threads = []
+    for console_index in range(values[cstr.CSTR_CONSOLE_NUMBER]):
+        thread = utils.thread_start(benchmark_console_thread,
+                                    (log, workspace, server_url,
+                                     console_index,
+                                     values[cstr.CSTR_OST_NUMBER],
+                                     deadline, result))
+        threads.append(thread)
+    # The threads are counted before the consoles quit
+    time.sleep(max(deadline - time.time(), 0))
+    wall_time = time.time() - time_start
+    process_stats = benchmark_process_stats(cpu_start, wall_time)
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - time_start
+
+    # Run after the other consoles quit, so only the startup is measured
+    benchmark_console_startup(log, port, result)
+
+    encoded = result.br_encode(wall_time)
+    encoded["instance_init_seconds"] = round(init_seconds, 3)
+    encoded["process"] = process_stats
+    encoded["thread_pools"] = utils.thread_pools_stats()
+    cserver.cs_fini()
+
+    result_fpath = workspace + "/" + BENCHMARK_RESULT_FNAME
+    result_string = yaml.dump(encoded, default_flow_style=False)
+    with open(result_fpath, "w") as result_file:
+        result_file.write(result_string)
+    log.cl_info("benchmark result saved to [%s]:\n%s", result_fpath,
+                result_string)
+
+    ret = 0
+    if len(encoded["failed_consoles"]) > 0:
+        log.cl_error("consoles %s failed", encoded["failed_consoles"])
+        ret = -1
+    for operation in BENCHMARK_RESULT_OPERATIONS:
+        if encoded[operation]["count"] == 0:
+            log.cl_error("no sample of operation [%s] is measured",
+                         operation)
+            ret = -1
+    for operation, limit in p99_limits.iteritems():
+        if operation not in BENCHMARK_RESULT_OPERATIONS:
+            log.cl_error("unknown operation [%s] in [%s], please correct "
+                         "file [%s]", operation, cstr.CSTR_P99_LIMITS,
+                         config_fpath)
+            ret = -1
+            continue
+        operation_code = encoded[operation]
+        if operation_code["failures"] > 0:
+            log.cl_error("[%d] operations of [%s] failed",
+                         operation_code["failures"], operation)
+            ret = -1
+        if "p99" not in operation_code or operation_code["p99"] > limit:
+            log.cl_error("p99 latency of [%s] is [%s], exceeds the limit "
+                         "[%s]", operation, operation_code.get("p99"), limit)
+            ret = -1
+    return ret
+
+
+def clownfish_benchmark(log, workspace, config_fpath):
+    """
+    Run the benchmark
+    """
+    # pylint: disable=bare-except
+    config = None
+    if config_fpath is not None and not os.path.exists(config_fpath):
+        log.cl_info("config file [%s] doesn't exist, using the default "
+                    "values", config_fpath)
+    elif config_fpath is not None:
+        config_fd = open(config_fpath)
+        ret = 0
+        try:
+            config = yaml.load(config_fd)
+        except:
+            log.cl_error("not able to load [%s] as yaml file: %s", config_fpath,
+                         traceback.format_exc())
+            ret = -1
+        config_fd.close()
+        if ret:
+            return -1
+
+    return clownfish_benchmark_config(log, workspace, config, config_fpath)
+
+
+def usage():
+    """
+    Print usage string
+    """
+    utils.eprint("Usage: %s <config_file>" %
+                 sys.argv[0])
+
+
+def main():
+    """
+    Start clownfish benchmark
+    """
+    cmd_general.main(constants.CLOWNFISH_BENCHMARK_CONFIG,
+                     constants.CLOWNFISH_BENCHMARK_LOG_DIR,
+                     clownfish_benchmark)
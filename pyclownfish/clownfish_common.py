@@ -1,5 +1,8 @@
 """
 Common library for clownfish
+
+This library is imported by clownfish_console, so please do not import
+any heavy library here.
 """
 #
 # pacemaker, corosync, pcs are needed by HA of Clownfish
@@ -17,3 +20,11 @@ CLOWNFISH_DEPENDENT_RPMS = ["corosync",
                             "python-zmq",
                             "protobuf-python",
                             "python-requests"]
+
+
+def clownfish_entry_escape(entry_name):
+    r"""
+    Return the escaped entry ename by replacing the "/" to "\/"
+    """
+    escaped_name = entry_name.replace("/", r"\/")
+    return escaped_name
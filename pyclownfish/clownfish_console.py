@@ -4,21 +4,24 @@
 """
 Deamon Library for clownfish
 Clownfish is an automatic management system for Lustre
+
+Scripts run "clownfish_console host command" frequently, so the startup of
+the console should be fast. Please do not import any heavy library, e.g.
+pyclownfish.clownfish or yaml, in this library. Readline, the workspace
+and the ping thread are only used in interactive mode.
 """
 import sys
 import os
 import time
 import threading
-import readline
 import zmq
 
 # Local libs
 from pylcommon import utils
 from pylcommon import clog
-from pylcommon import time_util
 from pylcommon import constants
 from pyclownfish import clownfish_pb2
-from pyclownfish import clownfish
+from pyclownfish import clownfish_common
 
 CLOWNFISH_CONSOLE_QUERY_INTERVAL = 1
 CLOWNFISH_CONSOLE_PING_INTERVAL = 1
@@ -241,7 +244,7 @@ class ClownfishClient(object):
             return children
 
         for name in message.ccm_reply.cm_command_children_reply.cccry_children:
-            escaped_name = clownfish.clownfish_entry_escape(name)
+            escaped_name = clownfish_common.clownfish_entry_escape(name)
             children.append(escaped_name)
         return children
 
@@ -279,6 +282,7 @@ class ClownfishClient(object):
         """
         The complete function of the input completer
         """
+        import readline
         response = None
         if state == 0:
             # This is the first time for this text,
@@ -403,15 +407,19 @@ class ClownfishClient(object):
         """
         Loop and execute the command
         """
-        # pylint: disable=unused-variable
+        # pylint: disable=unused-variable,too-many-branches
         log = self.cc_log
 
-        readline.parse_and_bind("tab: complete")
-        readline.parse_and_bind("set editing-mode vi")
-        # This enables completer of options with prefix "-" or "--"
-        # becase "-" is one of the delimiters by default
-        readline.set_completer_delims(" \t\n")
-        readline.set_completer(self.cc_completer)
+        if cmdline is None:
+            # Importing readline costs time and might print escape sequence
+            # to the terminal, so only import it in interactive mode
+            import readline
+            readline.parse_and_bind("tab: complete")
+            readline.parse_and_bind("set editing-mode vi")
+            # This enables completer of options with prefix "-" or "--"
+            # becase "-" is one of the delimiters by default
+            readline.set_completer_delims(" \t\n")
+            readline.set_completer(self.cc_completer)
         while self.cc_running:
             if cmdline is None:
                 try:
@@ -432,7 +440,8 @@ class ClownfishClient(object):
 
             self.cc_abort_event.clear()
             command_thread = utils.thread_start(self.cc_command,
-                                                (log, cmd_line))
+                                                (log, cmd_line),
+                                                pool=utils.THREAD_POOL_COMMANDS)
             while command_thread.is_alive():
                 try:
                     command_thread.join(CLOWNFISH_CONSOLE_QUERY_INTERVAL)
@@ -449,7 +458,8 @@ class ClownfishClient(object):
             if cmdline is not None:
                 break
 
-        readline.set_completer(None)
+        if cmdline is None:
+            readline.set_completer(None)
 
     def cc_fini(self):
         """
@@ -468,9 +478,10 @@ class ClownfishClient(object):
         self.cc_context.term()
         log.cl_debug("terminated ZMQ context")
 
-    def cc_init(self):
+    def cc_init(self, ping=True):
         """
         Init the connection to server
+        If ping, start a thread to ping the server constantly
         """
         log = self.cc_log
 
@@ -504,7 +515,9 @@ class ClownfishClient(object):
         self.cc_uuid = message.ccm_reply.cm_client_uuid
         log.cl_debug("connected to server [%s] successfully, UUID is [%s]",
                      server_url, self.cc_uuid)
-        utils.thread_start(self.cc_ping_thread, ())
+        if ping:
+            utils.thread_start(self.cc_ping_thread, (),
+                               pool=utils.THREAD_POOL_IO)
         return 0
 
 
@@ -513,7 +526,9 @@ def clownfish_console_loop(log, workspace, server_url, cmdline=None):
     Start to run console
     """
     console_client = ClownfishClient(log, workspace, server_url)
-    ret = console_client.cc_init()
+    # The command will fail with timeout if the server is down, no need to
+    # ping in one-shot mode
+    ret = console_client.cc_init(ping=(cmdline is None))
     if ret == 0:
         ret = console_client.cc_loop(cmdline=cmdline)
     else:
@@ -596,7 +611,16 @@ def main():
             cmdline += sys.argv[arg_index]
         server_url = "tcp://%s:%s" % (host, port_string)
 
-    identity = time_util.local_strftime(time_util.utcnow(), "%Y-%m-%d-%H_%M_%S")
+    if cmdline is not None:
+        # One-shot mode, no workspace is needed since there is no ping thread
+        log = clog.get_log(simple_console=True)
+        ret = clownfish_console_loop(log, None, server_url, cmdline=cmdline)
+        if ret:
+            log.cl_error("Clownfish console exited with failure")
+            sys.exit(ret)
+        sys.exit(0)
+
+    identity = time.strftime("%Y-%m-%d-%H_%M_%S")
     workspace = CLOWNFISH_CONSOLE_LOG_DIR + "/" + identity
 
     if not os.path.exists(CLOWNFISH_CONSOLE_LOG_DIR):
@@ -617,10 +641,9 @@ def main():
         sys.stderr.write("[%s] is not a directory" % workspace)
         sys.exit(-1)
 
-    if cmdline is None:
-        print("Starting Clownfish console to server [%s], "
-              "please check [%s] for more log" %
-              (server_url, workspace))
+    print("Starting Clownfish console to server [%s], "
+          "please check [%s] for more log" %
+          (server_url, workspace))
 
     log = clog.get_log(resultsdir=workspace, simple_console=True)
 
@@ -629,7 +652,6 @@ def main():
         log.cl_error("Clownfish console exited with failure, please check [%s] for "
                      "more log\n", workspace)
         sys.exit(ret)
-    if cmdline is None:
-        log.cl_info("Clownfish console exited, please check [%s] for more log",
-                    workspace)
+    log.cl_info("Clownfish console exited, please check [%s] for more log",
+                workspace)
     sys.exit(0)
@@ -17,6 +17,7 @@ from pylcommon import cstr
 from pylcommon import cmd_general
 from pylcommon import install_common
 from pylcommon import install_common_nodeps
+from pylcommon import lconfig
 from pylcommon import constants
 from pyclownfish import clownfish_common
 
@@ -606,6 +607,13 @@ def clownfish_install_parse_config(log, workspace, config, config_fpath, mnt_pat
                      cstr.CSTR_CONFIG_FPATH, config_fpath)
         return -1
 
+    # Find all the errors of the Clownfish config before installing
+    clownfish_config = lconfig.config_load(log, clownfish_config_fpath,
+                                           lconfig.CLOWNFISH_CONFIG_SCHEMA)
+    if clownfish_config is None:
+        log.cl_error("invalid Clownfish config [%s]", clownfish_config_fpath)
+        return None
+
     return ClownfishCluster(workspace, clownfish_hosts, virtual_ip, bindnetaddr,
                             mnt_path, clownfish_config_fpath)
 
@@ -663,7 +671,8 @@ def clownfish_mount_and_install(log, workspace, config_fpath):
     """
     ret = install_common_nodeps.mount_iso_and_install(log, workspace,
                                                       config_fpath,
-                                                      clownfish_install)
+                                                      clownfish_install,
+                                                      schema=lconfig.CLOWNFISH_INSTALL_CONFIG_SCHEMA)
     if ret:
         log.cl_info("Failed to install Clownfish cluster, please check [%s] "
                     "for more log", workspace)
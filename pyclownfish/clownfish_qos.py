@@ -15,10 +15,17 @@ import hashlib
 from pylcommon import utils
 from pylcommon import lustre
 from pylcommon import cstr
+from pylcommon import pdsh
+from pylcommon import metrics
 from pyclownfish import esmon_influxdb
 
 
 INFLUXDB_DATABASE_NAME = "esmon_database"
+# The time of each iteration of the QoS loop
+QOS_ITERATION_SECONDS = metrics.metrics_histogram("clownfish_qos_iteration_seconds",
+                                                  "Time of each iteration of the "
+                                                  "QoS loop",
+                                                  label_names=("fsname",))
 
 
 class ClownfishDecayQoSUser(object):
@@ -402,7 +409,8 @@ class ClownfishDecayQoS(object):
     def __init__(self, log, lustrefs, esmon_server_hostname,
                  interval, mbps_threshold, throttled_oss_rpc_rate,
                  iops_threshold, throttled_mds_rpc_rate,
-                 esmon_collect_interval, users, enabled, global_workspace):
+                 esmon_collect_interval, users, enabled, global_workspace,
+                 state=None):
         # pylint: disable=too-many-arguments
         self.cdqos_lustrefs = lustrefs
         self.cdqos_global_workspace = global_workspace
@@ -428,6 +436,8 @@ class ClownfishDecayQoS(object):
                                                                    INFLUXDB_DATABASE_NAME)
         self.cdqos_oss_throttled_uids = []
         self.cdqos_mds_throttled_uids = []
+        # The index of the interval that the limitations are enforced in
+        self.cdqos_interval_index = None
         self.cdqos_users = users
         self.cdqos_log = log
         self.cdqos_enabled = enabled
@@ -443,6 +453,8 @@ class ClownfishDecayQoS(object):
                       (self.cdqos_lustrefs.lf_fsname))
             log.cl_error(reason)
             raise Exception(reason)
+        if state is not None:
+            self._cdqos_state_restore(log, state)
         if enabled:
             ret = self.cqqos_enable(log)
             if ret:
@@ -453,9 +465,33 @@ class ClownfishDecayQoS(object):
         """
         Init Lustre clients information
         """
+        clients = {}
         for client_index, client in self.cdqos_lustrefs.lf_clients.iteritems():
             qos_client = ClownfishDecayQosClient(client)
-            self.cdqos_clients[client_index] = qos_client
+            clients[client_index] = qos_client
+        self.cdqos_clients = clients
+        return 0
+
+    def cdqos_update(self, log, lustrefs, users):
+        """
+        Move the QoS to the file system parsed again when reloading the
+        config, and replace the users. The QoS keeps running if enabled.
+        """
+        self.cdqos_condition.acquire()
+        ret = lustrefs.lf_qos_add(self)
+        if ret:
+            self.cdqos_condition.release()
+            log.cl_error("QoS already configured in file system [%s]",
+                         lustrefs.lf_fsname)
+            return -1
+        self.cdqos_lustrefs = lustrefs
+        self.cdqos_users = users
+        ret = self._cdqos_init_clients()
+        self.cdqos_condition.release()
+        if ret:
+            log.cl_error("failed to init QoS Lustre clients for file system [%s]",
+                         lustrefs.lf_fsname)
+            return -1
         return 0
 
     def _cdqos_init(self, log):
@@ -486,6 +522,32 @@ class ClownfishDecayQoS(object):
             return -1
         return 0
 
+    def cdqos_state(self):
+        """
+        Return the throttling state that can be saved by marshal
+        """
+        return (self.cdqos_interval_index,
+                list(self.cdqos_oss_throttled_uids),
+                list(self.cdqos_mds_throttled_uids))
+
+    def _cdqos_state_restore(self, log, state):
+        """
+        Restore the throttling state saved by the previous server, so the
+        limitations of the current interval are kept rather than cleared
+        """
+        interval_index, oss_throttled_uids, mds_throttled_uids = state
+        if interval_index != int(time.time()) / self.cdqos_interval:
+            log.cl_debug("the saved QoS state of file system [%s] is "
+                         "expired", self.cdqos_lustrefs.lf_fsname)
+            return
+        self.cdqos_interval_index = interval_index
+        self.cdqos_oss_throttled_uids = list(oss_throttled_uids)
+        self.cdqos_mds_throttled_uids = list(mds_throttled_uids)
+        log.cl_info("restored the QoS state of file system [%s], [%d] uids "
+                    "are throttled on OSS, [%d] on MDS",
+                    self.cdqos_lustrefs.lf_fsname,
+                    len(oss_throttled_uids), len(mds_throttled_uids))
+
     def cqqos_enable(self, log):
         """
         Enable QoS management
@@ -664,21 +726,26 @@ class ClownfishDecayQoS(object):
                          lustre.JOBID_VAR_PROCNAME_UID)
             return -1
 
-        for host in lustrefs.lf_oss_list():
-            ret = host.lsh_enable_ost_io_tbf(log, lustre.TBF_TYPE_GENERAL)
-            if ret:
-                log.cl_error("failed to enable TBF for ost_io on file system "
-                             "[%s]", fsname)
-                return -1
+        command = lustre.tbf_enable_command(lustre.PARAM_PATH_OST_IO,
+                                            lustre.TBF_TYPE_GENERAL)
+        result = pdsh.pdsh_run(log, lustrefs.lf_oss_list(), command)
+        if result.pr_retval():
+            log.cl_error("failed to enable TBF for ost_io on file system "
+                         "[%s]", fsname)
+            result.pr_dshbak(log, is_stdout=False)
+            return -1
 
-        for host in lustrefs.lf_mds_list():
-            ret = host.lsh_enable_mdt_tbf(log, lustre.TBF_TYPE_GENERAL)
-            if ret:
-                log.cl_error("failed to enable TBF for all MDT services on file system "
-                             "[%s]", fsname)
-                return -1
+        command = lustre.tbf_enable_command(lustre.PARAM_PATH_MDT,
+                                            lustre.TBF_TYPE_GENERAL)
+        result = pdsh.pdsh_run(log, lustrefs.lf_mds_list(), command)
+        if result.pr_retval():
+            log.cl_error("failed to enable TBF for all MDT services on file system "
+                         "[%s]", fsname)
+            result.pr_dshbak(log, is_stdout=False)
+            return -1
 
-        self.cdqos_thread = utils.thread_start(self.cdqos_thread_main, ())
+        self.cdqos_thread = utils.thread_start(self.cdqos_thread_main, (),
+                                               pool=utils.THREAD_POOL_QOS)
         return 0
 
     def cdqos_stop(self, log):
@@ -697,19 +764,28 @@ class ClownfishDecayQoS(object):
                 return -1
 
         self.cdqos_thread = None
-        for host in lustrefs.lf_oss_list():
-            ret = host.lsh_enable_ost_io_fifo(log)
-            if ret:
-                log.cl_error("failed to enable FIFO NRS policy for ost_io on "
-                             "file system [%s]", fsname)
-                return -1
+        # The limitations will be removed by the FIFO policy
+        self.cdqos_interval_index = None
+        command = lustre.fifo_enable_command(lustre.PARAM_PATH_OST_IO)
+        result = pdsh.pdsh_run(log, lustrefs.lf_oss_list(), command)
+        if result.pr_retval():
+            log.cl_error("failed to enable FIFO NRS policy for ost_io on "
+                         "file system [%s]", fsname)
+            result.pr_dshbak(log, is_stdout=False)
+            return -1
 
-        for host in lustrefs.lf_mds_list():
-            ret = host.lsh_enable_mdt_all_fifo(log)
-            if ret:
-                log.cl_error("failed to enable FIFO NRS policy for all MDT "
-                             "services on file system [%s]", fsname)
-                return -1
+        commands = []
+        for param_path in [lustre.PARAM_PATH_MDT,
+                           lustre.PARAM_PATH_MDT_READPAGE,
+                           lustre.PARAM_PATH_MDT_SETATTR]:
+            commands.append(lustre.fifo_enable_command(param_path))
+        result = pdsh.pdsh_run(log, lustrefs.lf_mds_list(),
+                               " && ".join(commands))
+        if result.pr_retval():
+            log.cl_error("failed to enable FIFO NRS policy for all MDT "
+                         "services on file system [%s]", fsname)
+            result.pr_dshbak(log, is_stdout=False)
+            return -1
 
         return 0
 
@@ -893,8 +969,8 @@ class ClownfishDecayQoS(object):
         # pylint: disable=too-many-locals,too-many-statements,too-many-branches
         fsname = self.cdqos_lustrefs.lf_fsname
         log = self.cdqos_thread_log
+        iteration_seconds = QOS_ITERATION_SECONDS.mf_child(fsname)
 
-        current_interval_index = None
         first = True
         while self.cdqos_enabled:
             if not first:
@@ -902,20 +978,22 @@ class ClownfishDecayQoS(object):
             if not self.cdqos_enabled:
                 break
             first = False
-            time_now = int(time.time())
+            iteration_start = time.time()
+            time_now = int(iteration_start)
             interval_index = time_now / self.cdqos_interval
-            if interval_index != current_interval_index:
+            if interval_index != self.cdqos_interval_index:
                 ret = self.cdqos_clear_limitations(log)
                 if ret:
                     log.cl_error("failed to clear limitations, try next time")
                     continue
 
-                current_interval_index = interval_index
+                self.cdqos_interval_index = interval_index
 
             start_time = interval_index * self.cdqos_interval
 
             self._cdqos_throughput_check(log, fsname, start_time)
             self._cdqos_metadata_check(log, fsname, start_time)
             # self._cdqos_mds_congestion_check(log)
+            iteration_seconds.mc_observe(time.time() - iteration_start)
         log.cl_info("quiting QoS thread")
         return 0
@@ -10,7 +10,6 @@ import traceback
 import sys
 import os
 import time
-import yaml
 import zmq
 
 # Local libs
@@ -18,6 +17,8 @@ from pylcommon import utils
 from pylcommon import cstr
 from pylcommon import cmd_general
 from pylcommon import constants
+from pylcommon import lconfig
+from pylcommon import metrics
 from pyclownfish import clownfish_pb2
 from pyclownfish import clownfish
 
@@ -25,6 +26,11 @@ CLOWNFISH_WORKER_NUMBER = 10
 CLOWNFISH_CONNECTION_TIMEOUT = 30
 
 CLOWNFISH_SERVER_LOG_DIR = "/var/log/clownfish_server"
+# The number of requests received from consoles, labeled by the type
+CLOWNFISH_REQUESTS = metrics.metrics_counter("clownfish_requests_total",
+                                             "Number of requests received "
+                                             "from consoles",
+                                             label_names=("type",))
 
 
 def remove_tailing_newline(log, output):
@@ -199,7 +205,8 @@ class ClownfishConnection(object):
         log.cl_result.cr_clear()
         log.cl_abort = False
 
-        utils.thread_start(self.cc_cmdline_thread, (cmd_line, ))
+        utils.thread_start(self.cc_cmdline_thread, (cmd_line, ),
+                           pool=utils.THREAD_POOL_COMMANDS)
         # Wait a little bit for the command that can finish quickly
         self.cc_condition.acquire()
         self.cc_condition.wait(clownfish.MAX_FAST_COMMAND_TIME)
@@ -213,7 +220,9 @@ class ClownfishServer(object):
     This server that listen and handle requests from console
     """
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
-    def __init__(self, log, server_port, instance):
+    def __init__(self, log, server_port, instance, metrics_port=0,
+                 metrics_address=constants.CLOWNFISH_DEFAULT_METRICS_ADDRESS):
+        # pylint: disable=too-many-arguments
         self.cs_log = log
         self.cs_running = True
         self.cs_instance = instance
@@ -229,6 +238,18 @@ class ClownfishServer(object):
         # The key is the sequence of the connection, protected by cs_condition
         self.cs_connections = {}
         self.cs_condition = threading.Condition()
+        # Keys are the message types, values are the counters of requests
+        self.cs_request_counters = {}
+        cmessage = clownfish_pb2.ClownfishMessage
+        for value in cmessage.ClownfishMessageType.DESCRIPTOR.values:
+            self.cs_request_counters[value.number] = \
+                CLOWNFISH_REQUESTS.mf_child(value.name)
+        self.cs_metrics_server = None
+        if metrics_port:
+            clownfish.clownfish_metrics_register(instance)
+            self.cs_metrics_server = \
+                metrics.metrics_server_start(log, metrics_address,
+                                             metrics_port)
         for worker_index in range(CLOWNFISH_WORKER_NUMBER):
             log.cl_info("starting worker thread [%d]", worker_index)
             utils.thread_start(self.cs_worker_thread, (worker_index, ))
@@ -320,7 +341,11 @@ class ClownfishServer(object):
         """
         Finish server
         """
-        self.cs_instance.ci_fini()
+        if self.cs_metrics_server is not None:
+            self.cs_metrics_server.ms_stop()
+            self.cs_metrics_server = None
+        clownfish.clownfish_metrics_unregister()
+        self.cs_instance.ci_fini(self.cs_log)
         self.cs_running = False
         self.cs_client_socket.close()
         self.cs_worker_socket.close()
@@ -364,6 +389,10 @@ class ClownfishServer(object):
             request = cmessage()
             request.ParseFromString(request_message)
             log.cl_debug("received request with type [%s]", request.cm_type)
+            request_counter = self.cs_request_counters.get(request.cm_type)
+            if request_counter is None:
+                request_counter = CLOWNFISH_REQUESTS.mf_child(str(request.cm_type))
+            request_counter.mc_inc()
             reply = cmessage()
             reply.cm_protocol_version = cmessage.CPV_ZERO
             reply.cm_errno = cmessage.CE_NO_ERROR
@@ -399,9 +428,13 @@ class ClownfishServer(object):
                                 item.cci_arguments.append(argument)
                 elif request.cm_type == cmessage.CMT_PWD_REQUEST:
                     reply.cm_type = cmessage.CMT_PWD_REPLY
+                    # The config might have been reloaded by another
+                    # connection
+                    clownfish.clownfish_walk_refresh(connection)
                     reply.cm_pwd_reply.cpry_pwd = clownfish.clownfish_pwd(connection.cc_walk)
                 elif request.cm_type == cmessage.CMT_COMMAND_REQUEST:
                     reply.cm_type = cmessage.CMT_COMMAND_REPLY
+                    clownfish.clownfish_walk_refresh(connection)
                     cmd_line = request.cm_command_request.ccrt_cmd_line
                     connection.cc_command(log, cmd_line, reply.cm_command_reply)
                 elif request.cm_type == cmessage.CMT_COMMAND_PARTWAY_QUERY:
@@ -413,6 +446,7 @@ class ClownfishServer(object):
                                                       reply.cm_command_reply)
                 elif request.cm_type == cmessage.CMT_COMMAND_CHILDREN_REQUEST:
                     reply.cm_type = cmessage.CMT_COMMAND_CHILDREN_REPLY
+                    clownfish.clownfish_walk_refresh(connection)
                     children = clownfish.clownfish_children(connection.cc_walk)
                     item_list = reply.cm_command_children_reply.cccry_children
                     for child in children:
@@ -458,13 +492,24 @@ def clownfish_server_do_loop(log, workspace, config, config_fpath):
                     constants.CLOWNFISH_DEFAULT_SERVER_PORT)
         clownfish_server_port = constants.CLOWNFISH_DEFAULT_SERVER_PORT
 
+    metrics_port = utils.config_value(config, cstr.CSTR_METRICS_PORT)
+    if metrics_port is None:
+        metrics_port = constants.CLOWNFISH_DEFAULT_METRICS_PORT
+
+    metrics_address = utils.config_value(config, cstr.CSTR_METRICS_ADDRESS)
+    if metrics_address is None:
+        metrics_address = constants.CLOWNFISH_DEFAULT_METRICS_ADDRESS
+
     clownfish_instance = clownfish.init_instance(log, workspace, config,
-                                                 config_fpath)
+                                                 config_fpath,
+                                                 snapshot_fpath=constants.CLOWNFISH_STATUS_SNAPSHOT)
     if clownfish_instance is None:
         log.cl_error("failed to init Clownfish")
         return -1
 
-    cserver = ClownfishServer(log, clownfish_server_port, clownfish_instance)
+    cserver = ClownfishServer(log, clownfish_server_port, clownfish_instance,
+                              metrics_port=metrics_port,
+                              metrics_address=metrics_address)
     cserver.cs_loop()
     cserver.cs_fini()
 
@@ -475,16 +520,11 @@ def clownfish_server_loop(log, workspace, config_fpath):
     """
     # pylint: disable=too-many-branches,bare-except,too-many-locals
     # pylint: disable=too-many-statements
-    config_fd = open(config_fpath)
-    ret = 0
-    try:
-        config = yaml.load(config_fd)
-    except:
-        log.cl_error("not able to load [%s] as yaml file: %s", config_fpath,
-                     traceback.format_exc())
-        ret = -1
-    config_fd.close()
-    if ret:
+    config = lconfig.config_load(log, config_fpath,
+                                 lconfig.CLOWNFISH_CONFIG_SCHEMA,
+                                 cache_dir=constants.CLOWNFISH_CONFIG_CACHE_DIR)
+    if config is None:
+        log.cl_error("failed to load config [%s]", config_fpath)
         return -1
 
     try:
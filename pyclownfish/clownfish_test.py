@@ -7,8 +7,9 @@ Clownfish is an automatic management system for Lustre
 """
 # pylint: disable=too-many-lines
 import traceback
-import os
 import time
+import os
+import threading
 import yaml
 
 # Local libs
@@ -17,13 +18,34 @@ from pylcommon import cstr
 from pylcommon import cmd_general
 from pylcommon import ssh_host
 from pylcommon import test_common
+from pylcommon import broadcast
 from pylcommon import constants
 from pyclownfish import clownfish_console
 from pyclownfish import clownfish
 from pyclownfish import clownfish_install_nodeps
+from pyclownfish import clownfish_common
 
 COMMAND_ABORT_TIMEOUT = 10
 CLOWNFISH_TESTS = []
+# The resource that conflicts with all other tests, even the ones using no
+# resource
+TEST_RESOURCE_ALL = "all"
+# The mount status and data of all Lustre file systems
+TEST_RESOURCE_LUSTRES = cstr.CSTR_LUSTRES
+# The installed packages and kernel modules of all hosts
+TEST_RESOURCE_HOSTS = cstr.CSTR_HOSTS
+# The global HA state
+TEST_RESOURCE_HA = cstr.CSTR_HIGH_AVAILABILITY
+# Keys are test names, values are lists of the resources that the test
+# changes. Tests with disjoint resources run at the same time, tests with
+# conflicting resources run in the order of CLOWNFISH_TESTS. A test that
+# doesn't declare its resources uses TEST_RESOURCE_ALL.
+CLOWNFISH_TEST_RESOURCES = {}
+# The default number of tests that run at the same time
+CLOWNFISH_TEST_PARALLELISM = 4
+# The file under the parent of the workspace that records the time of tests
+# in all runs, each line is "start_time test_name status seconds"
+CLOWNFISH_TEST_TIME_HISTORY = "clownfish_test_time_history"
 
 
 def run_commands(log, cclient, cmds):
@@ -90,6 +112,7 @@ def path_tests(log, workspace, cclient):
     return 0
 
 CLOWNFISH_TESTS.append(path_tests)
+CLOWNFISH_TEST_RESOURCES[path_tests.__name__] = []
 
 
 def delimiter_tests(log, workspace, cclient):
@@ -302,6 +325,7 @@ def delimiter_tests(log, workspace, cclient):
 
 
 CLOWNFISH_TESTS.append(delimiter_tests)
+CLOWNFISH_TEST_RESOURCES[delimiter_tests.__name__] = []
 
 
 def nonexistent_command(log, workspace, cclient):
@@ -323,6 +347,7 @@ def nonexistent_command(log, workspace, cclient):
     return 0
 
 CLOWNFISH_TESTS.append(nonexistent_command)
+CLOWNFISH_TEST_RESOURCES[nonexistent_command.__name__] = []
 
 
 def pwd_manual_ls_cd(log, workspace, cclient):
@@ -434,7 +459,7 @@ def pwd_manual_ls_cd(log, workspace, cclient):
     subdirs = result.cr_stdout.splitlines()
     for subdir in subdirs:
         command = (clownfish.CLOWNFISH_COMMNAD_CD + " " +
-                   clownfish.clownfish_entry_escape(subdir))
+                   clownfish_common.clownfish_entry_escape(subdir))
         cclient.cc_command(log, command)
         if result.cr_exit_status:
             log.cl_error("failed to run command [%s]", command)
@@ -452,6 +477,7 @@ def pwd_manual_ls_cd(log, workspace, cclient):
     return 0
 
 CLOWNFISH_TESTS.append(pwd_manual_ls_cd)
+CLOWNFISH_TEST_RESOURCES[pwd_manual_ls_cd.__name__] = []
 
 
 def umount_prepare_format_mount_umount_mount_format(log, workspace, cclient):
@@ -486,6 +512,8 @@ def umount_prepare_format_mount_umount_mount_format(log, workspace, cclient):
 
 
 CLOWNFISH_TESTS.append(umount_prepare_format_mount_umount_mount_format)
+CLOWNFISH_TEST_RESOURCES[umount_prepare_format_mount_umount_mount_format.__name__] = \
+    [TEST_RESOURCE_ALL]
 
 
 def umount_x2_mount_x2_umount_x2(log, workspace, cclient):
@@ -529,6 +557,8 @@ def umount_x2_mount_x2_umount_x2(log, workspace, cclient):
     return 0
 
 CLOWNFISH_TESTS.append(umount_x2_mount_x2_umount_x2)
+CLOWNFISH_TEST_RESOURCES[umount_x2_mount_x2_umount_x2.__name__] = \
+    [TEST_RESOURCE_LUSTRES]
 
 
 def service_mount_check(log, cclient, service_name, expect_status):
@@ -852,6 +882,8 @@ def ha_fix_umount(log, workspace, cclient):
 
 
 CLOWNFISH_TESTS.append(ha_fix_umount)
+CLOWNFISH_TEST_RESOURCES[ha_fix_umount.__name__] = \
+    [TEST_RESOURCE_LUSTRES, TEST_RESOURCE_HA]
 
 
 def abort_command(log, workspace, cclient):
@@ -907,6 +939,7 @@ def abort_command(log, workspace, cclient):
 
 
 CLOWNFISH_TESTS.append(abort_command)
+CLOWNFISH_TEST_RESOURCES[abort_command.__name__] = [TEST_RESOURCE_ALL]
 
 
 def prepare_twice(log, workspace, cclient):
@@ -930,13 +963,233 @@ def prepare_twice(log, workspace, cclient):
 
 
 CLOWNFISH_TESTS.append(prepare_twice)
+CLOWNFISH_TEST_RESOURCES[prepare_twice.__name__] = \
+    [TEST_RESOURCE_HOSTS, TEST_RESOURCE_LUSTRES]
+
+
+class ClownfishTestRun(object):
+    """
+    A run of a test
+    """
+    # pylint: disable=too-few-public-methods
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_PASSED = "passed"
+    STATUS_FAILED = "failed"
+    STATUS_SKIPPED = "skipped"
+    # Not run because of the failure of other tests
+    STATUS_ABORTED = "aborted"
+
+    def __init__(self, test_funct):
+        self.ctr_funct = test_funct
+        self.ctr_name = test_funct.__name__
+        if self.ctr_name in CLOWNFISH_TEST_RESOURCES:
+            self.ctr_resources = CLOWNFISH_TEST_RESOURCES[self.ctr_name]
+        else:
+            self.ctr_resources = [TEST_RESOURCE_ALL]
+        self.ctr_status = ClownfishTestRun.STATUS_PENDING
+        self.ctr_start_time = None
+        self.ctr_seconds = None
+
+    def ctr_conflict(self, test_run):
+        """
+        Return True if the two tests can not run at the same time
+        """
+        # Tests using no resource still read the state that a test using
+        # all resources changes
+        if (TEST_RESOURCE_ALL in self.ctr_resources or
+                TEST_RESOURCE_ALL in test_run.ctr_resources):
+            return True
+        for resource in self.ctr_resources:
+            if resource in test_run.ctr_resources:
+                return True
+        return False
+
+
+class ClownfishTestScheduler(object):
+    """
+    Schedule the tests to the console connections
+    """
+    def __init__(self, test_runs, quit_on_error):
+        # The test runs in the order of CLOWNFISH_TESTS
+        self.cts_test_runs = test_runs
+        self.cts_quit_on_error = quit_on_error
+        # Whether to stop starting new tests
+        self.cts_quit = False
+        # Protects all the fields
+        self.cts_condition = threading.Condition()
+
+    def _cts_runnable(self, test_run):
+        """
+        A pending test is runnable if it conflicts with none of the former
+        tests that are not finished
+        """
+        for former_run in self.cts_test_runs:
+            if former_run is test_run:
+                return True
+            if (former_run.ctr_status in [ClownfishTestRun.STATUS_PENDING,
+                                          ClownfishTestRun.STATUS_RUNNING] and
+                    former_run.ctr_conflict(test_run)):
+                return False
+        return True
+
+    def cts_next(self):
+        """
+        Wait and return the next test to run, None if no more
+        """
+        self.cts_condition.acquire()
+        while True:
+            pending = False
+            for test_run in self.cts_test_runs:
+                if test_run.ctr_status != ClownfishTestRun.STATUS_PENDING:
+                    continue
+                if self.cts_quit:
+                    test_run.ctr_status = ClownfishTestRun.STATUS_ABORTED
+                    continue
+                pending = True
+                if self._cts_runnable(test_run):
+                    test_run.ctr_status = ClownfishTestRun.STATUS_RUNNING
+                    test_run.ctr_start_time = time.time()
+                    self.cts_condition.release()
+                    return test_run
+            if not pending:
+                self.cts_condition.notifyAll()
+                self.cts_condition.release()
+                return None
+            self.cts_condition.wait()
+
+    def cts_finish(self, test_run, status):
+        """
+        The test finished
+        """
+        self.cts_condition.acquire()
+        test_run.ctr_status = status
+        test_run.ctr_seconds = time.time() - test_run.ctr_start_time
+        if status == ClownfishTestRun.STATUS_FAILED and self.cts_quit_on_error:
+            self.cts_quit = True
+        self.cts_condition.notifyAll()
+        self.cts_condition.release()
+
+    def cts_abort(self):
+        """
+        Stop starting new tests
+        """
+        self.cts_condition.acquire()
+        self.cts_quit = True
+        self.cts_condition.notifyAll()
+        self.cts_condition.release()
+
+
+def run_test(log, workspace, console_client, test_run):
+    """
+    Run a test with its own log, return the status
+    """
+    # pylint: disable=broad-except
+    test_workspace = workspace + "/" + test_run.ctr_name
+    ret = utils.mkdir(test_workspace)
+    if ret:
+        log.cl_error("failed to create directory [%s] on local host",
+                     test_workspace)
+        return ClownfishTestRun.STATUS_FAILED
+
+    test_log = log.cl_get_child(test_run.ctr_name, resultsdir=test_workspace)
+    # The connection might be used by other tests before, so start from root
+    console_client.cc_abort_event.clear()
+    command = clownfish.CLOWNFISH_COMMNAD_CD
+    console_client.cc_command(test_log, command)
+    if test_log.cl_result.cr_exit_status:
+        log.cl_error("failed to run command [%s]", command)
+        test_log.cl_fini()
+        return ClownfishTestRun.STATUS_FAILED
+
+    try:
+        ret = test_run.ctr_funct(test_log, test_workspace, console_client)
+    except Exception:
+        log.cl_error("exception when running test [%s]: %s",
+                     test_run.ctr_name, traceback.format_exc())
+        ret = -1
+    test_log.cl_fini()
+
+    if ret < 0:
+        log.cl_error("test [%s] failed", test_run.ctr_name)
+        return ClownfishTestRun.STATUS_FAILED
+    elif ret == 1:
+        log.cl_warning("test [%s] skipped", test_run.ctr_name)
+        return ClownfishTestRun.STATUS_SKIPPED
+    log.cl_info("test [%s] passed", test_run.ctr_name)
+    return ClownfishTestRun.STATUS_PASSED
+
+
+def test_console_thread(log, workspace, server_url, scheduler, console_index):
+    """
+    Connect to the server and run tests until no more
+    """
+    # pylint: disable=too-many-arguments
+    name = "console_%d" % console_index
+    console_workspace = workspace + "/" + name
+    ret = utils.mkdir(console_workspace)
+    if ret:
+        log.cl_error("failed to create directory [%s] on local host",
+                     console_workspace)
+        scheduler.cts_abort()
+        return
+    console_log = log.cl_get_child(name, resultsdir=console_workspace)
+    console_client = clownfish_console.ClownfishClient(console_log,
+                                                       console_workspace,
+                                                       server_url)
+    ret = console_client.cc_init()
+    if ret:
+        log.cl_error("failed to connect to Clownfish server")
+        scheduler.cts_abort()
+    else:
+        while True:
+            test_run = scheduler.cts_next()
+            if test_run is None:
+                break
+            status = run_test(log, workspace, console_client, test_run)
+            scheduler.cts_finish(test_run, status)
+
+    # No matter connection fails or not, need to finish
+    console_client.cc_fini()
+    console_log.cl_fini()
 
 
-def do_test_connected(log, workspace, console_client,
+def test_time_record(log, workspace, test_runs):
+    """
+    Print the time of the tests from the slowest, and append them to the
+    history file
+    """
+    history_fpath = (os.path.dirname(os.path.abspath(workspace)) + "/" +
+                     CLOWNFISH_TEST_TIME_HISTORY)
+    lines = ""
+    finished_runs = []
+    for test_run in test_runs:
+        if test_run.ctr_seconds is None:
+            continue
+        finished_runs.append(test_run)
+        lines += ("%d %s %s %.3f\n" %
+                  (test_run.ctr_start_time, test_run.ctr_name,
+                   test_run.ctr_status, test_run.ctr_seconds))
+
+    finished_runs.sort(key=lambda test_run: test_run.ctr_seconds,
+                       reverse=True)
+    for test_run in finished_runs:
+        log.cl_info("test [%s] %s in [%.3f] seconds", test_run.ctr_name,
+                    test_run.ctr_status, test_run.ctr_seconds)
+
+    try:
+        with open(history_fpath, "a") as history_file:
+            history_file.write(lines)
+    except IOError:
+        log.cl_warning("failed to save time of tests to file [%s]: %s",
+                       history_fpath, traceback.format_exc())
+
+
+def do_test_connected(log, workspace, server_url,
                       test_config, test_config_fpath,
                       test_functs):
     """
-    Run test with the console connected
+    Run tests over multiple console connections to the server
     """
      # pylint: disable=too-many-branches,too-many-locals,too-many-arguments
     test_dict = {}
@@ -960,53 +1213,55 @@ def do_test_connected(log, workspace, console_client,
             test_funct = test_dict[test_name]
             selected_tests.append(test_funct)
 
+    parallelism = utils.config_value(test_config,
+                                     cstr.CSTR_TEST_PARALLELISM)
+    if parallelism is None:
+        log.cl_debug("no [%s] is configured, using [%d]",
+                     cstr.CSTR_TEST_PARALLELISM, CLOWNFISH_TEST_PARALLELISM)
+        parallelism = CLOWNFISH_TEST_PARALLELISM
+    if not isinstance(parallelism, int) or parallelism < 1:
+        log.cl_error("invalid [%s] [%s], please correct file [%s]",
+                     cstr.CSTR_TEST_PARALLELISM, parallelism,
+                     test_config_fpath)
+        return -1
+
     not_selected_tests = []
     for test_funct in test_functs:
         if test_funct not in selected_tests:
             not_selected_tests.append(test_funct)
 
-    passed_tests = []
-    failed_tests = []
-    skipped_tests = []
+    test_runs = []
+    for test_funct in selected_tests:
+        test_runs.append(ClownfishTestRun(test_funct))
+    scheduler = ClownfishTestScheduler(test_runs, quit_on_error)
 
-    for test_func in selected_tests:
-        test_workspace = workspace + "/" + test_func.__name__
-        ret = utils.mkdir(test_workspace)
-        if ret:
-            log.cl_error("failed to create directory [%s] on local host",
-                         test_workspace)
-            return -1
+    threads = []
+    for console_index in range(min(parallelism, len(test_runs))):
+        thread = utils.thread_start(test_console_thread,
+                                    (log, workspace, server_url, scheduler,
+                                     console_index))
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
 
-        ret = test_func(log, test_workspace, console_client)
-        if ret < 0:
-            log.cl_error("test [%s] failed", test_func.__name__)
-            failed_tests.append(test_func)
-            if quit_on_error:
-                return -1
-        elif ret == 1:
-            log.cl_warning("test [%s] skipped", test_func.__name__)
-            skipped_tests.append(test_func)
-        else:
-            log.cl_info("test [%s] passed", test_func.__name__)
-            passed_tests.append(test_func)
+    test_time_record(log, workspace, test_runs)
 
     if len(not_selected_tests) != 0:
         for not_selected_test in not_selected_tests:
             log.cl_warning("test [%s] is not selected", not_selected_test.__name__)
 
-    if len(skipped_tests) != 0:
-        for skipped_test in skipped_tests:
-            log.cl_warning("test [%s] skipped", skipped_test.__name__)
-
     ret = 0
-    if len(failed_tests) != 0:
-        for failed_test in failed_tests:
-            log.cl_error("test [%s] failed", failed_test.__name__)
+    for test_run in test_runs:
+        if test_run.ctr_status == ClownfishTestRun.STATUS_SKIPPED:
+            log.cl_warning("test [%s] skipped", test_run.ctr_name)
+        elif test_run.ctr_status == ClownfishTestRun.STATUS_PASSED:
+            log.cl_info("test [%s] passed", test_run.ctr_name)
+        elif test_run.ctr_status == ClownfishTestRun.STATUS_FAILED:
+            log.cl_error("test [%s] failed", test_run.ctr_name)
+            ret = -1
+        else:
+            log.cl_error("test [%s] is not finished", test_run.ctr_name)
             ret = -1
-
-    if len(passed_tests) != 0:
-        for passed_test in passed_tests:
-            log.cl_info("test [%s] passed", passed_test.__name__)
     return ret
 
 
@@ -1032,25 +1287,16 @@ def connect_and_test(log, workspace, test_config, test_config_fpath,
         return -1
 
     server_url = "tcp://%s:%s" % (clownfish_server_ip, clownfish_server_port)
-    console_client = clownfish_console.ClownfishClient(log, workspace,
-                                                       server_url)
-    ret = console_client.cc_init()
-    if ret == 0:
-        ret = do_test_connected(log, workspace, console_client,
-                                test_config, test_config_fpath,
-                                test_functs)
-        if ret:
-            log.cl_error("failed to run test with console connected to "
-                         "Clownfish server")
-    else:
-        log.cl_error("failed to connect to Clownfish server")
-
-    # No matter connection fails or not, need to finish
-    console_client.cc_fini()
+    ret = do_test_connected(log, workspace, server_url,
+                            test_config, test_config_fpath,
+                            test_functs)
+    if ret:
+        log.cl_error("failed to run test with console connected to "
+                     "Clownfish server")
     return ret
 
 
-def clownfish_send_lustre_rpms(log, install_config,
+def clownfish_send_lustre_rpms(log, workspace, install_config,
                                install_config_fpath,
                                config, config_fpath):
     """
@@ -1095,28 +1341,14 @@ def clownfish_send_lustre_rpms(log, install_config,
         if e2fsprogs_rpm_dir not in directories:
             directories.append(e2fsprogs_rpm_dir)
 
-    for server_host in server_hosts:
-        for directory in directories:
-            parent = os.path.dirname(directory)
-            command = "mkdir -p %s" % parent
-            retval = server_host.sh_run(log, command)
-            if retval.cr_exit_status:
-                log.cl_error("failed to run command [%s] on host [%s], "
-                             "ret = [%d], stdout = [%s], stderr = [%s]",
-                             command,
-                             server_host.sh_hostname,
-                             retval.cr_exit_status,
-                             retval.cr_stdout,
-                             retval.cr_stderr)
-                return -1
-
-            ret = server_host.sh_send_file(log, directory, parent)
-            if ret:
-                log.cl_error("failed to send file [%s] on local host to "
-                             "directory [%s] on host [%s]",
-                             directory, parent,
-                             server_host.sh_hostname)
-                return -1
+    # The server hosts that got the RPMs send them to the others
+    for directory in directories:
+        ret = broadcast.broadcast_dir(log, workspace, server_hosts,
+                                      directory, directory)
+        if ret:
+            log.cl_error("failed to send dir [%s] on local host to "
+                         "server hosts", directory)
+            return -1
     return 0
 
 
@@ -1179,7 +1411,7 @@ def clownfish_do_test(log, workspace, test_config, test_config_fpath):
         return -1
 
     if not skip_install:
-        ret = clownfish_send_lustre_rpms(log, install_config,
+        ret = clownfish_send_lustre_rpms(log, workspace, install_config,
                                          install_config_fpath,
                                          clownfish_config,
                                          clownfish_config_fpath)
@@ -5,14 +5,21 @@
 Library for access Influxdb through HTTP API
 """
 import traceback
+import time
 import sys
 import httplib
 import requests
 
 from pylcommon import clog
+from pylcommon import metrics
 from pylcommon import time_util
 from pylcommon import utils
 
+# The latency of the queries to InfluxDB
+INFLUXDB_QUERY_SECONDS = metrics.metrics_histogram("influxdb_query_seconds",
+                                                   "Latency of queries to InfluxDB",
+                                                   label_names=("server",))
+
 
 class InfluxdbClient(object):
     """
@@ -32,6 +39,7 @@ class InfluxdbClient(object):
             'Accept': 'text/plain'
         }
         self.ic_session = requests.Session()
+        self.ic_query_seconds = INFLUXDB_QUERY_SECONDS.mf_child(host)
 
     def ic_query(self, log, query, epoch=None):
         """
@@ -50,6 +58,7 @@ class InfluxdbClient(object):
             params['epoch'] = epoch
 
         log.cl_debug("querying [%s] to [%s]", query, self.ic_queryurl)
+        time_start = time.time()
         try:
             response = self.ic_session.request(method='GET',
                                                url=self.ic_queryurl,
@@ -59,6 +68,8 @@ class InfluxdbClient(object):
             log.cl_error("got exception with query [%s]: %s", query,
                          traceback.format_exc())
             return None
+        finally:
+            self.ic_query_seconds.mc_observe(time.time() - time_start)
 
         return response
 
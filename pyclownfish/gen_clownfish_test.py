@@ -52,18 +52,23 @@ def main():
     for test_funct in clownfish_test.CLOWNFISH_TESTS:
         tests.append(test_funct.__name__)
     config[cstr.CSTR_ONLY_TESTS] = tests
+    config[cstr.CSTR_TEST_PARALLELISM] = clownfish_test.CLOWNFISH_TEST_PARALLELISM
     config_string = ("""#
 # Configuration file for testing Clownfish from DDN
 #
 # Please comment the test names under "%s" if want to skip some tests
 #
+# Please set "%s" to the number of console connections that run tests at
+# the same time. Tests that change the same resources never run together.
+#
 # Please set "%s" to true if Clownfish is already installed and
 # properly running.
 #
 # Please set "%s" to true if the virtual machines are already
 # installed and properly running.
 #
-""" % (cstr.CSTR_ONLY_TESTS, cstr.CSTR_SKIP_INSTALL, cstr.CSTR_SKIP_VIRT))
+""" % (cstr.CSTR_ONLY_TESTS, cstr.CSTR_TEST_PARALLELISM,
+       cstr.CSTR_SKIP_INSTALL, cstr.CSTR_SKIP_VIRT))
     config_string += yaml.dump(config, Dumper=lyaml.YamlDumper,
                                default_flow_style=False)
     try:
@@ -8,11 +8,14 @@ __all__ = ["clog",
            "hsm",
            "install_common",
            "install_common_nodeps",
+           "lconfig",
            "lvirt",
            "lustre",
            "lustre_test",
            "lyaml",
+           "metrics",
            "parallel",
+           "pdsh",
            "rwlock",
            "test_common",
            "time_util",
@@ -0,0 +1,255 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library to distribute a directory to multiple hosts in a fan-out tree
+
+The hosts that already got the directory send it to the other hosts, so
+the uplink of the local host is not the bottleneck, and the distribution
+time is logarithmic in the number of hosts.
+
+A manifest with the SHA1 checksums of all files is saved beside the
+directory on each host. Hosts with the same manifest are skipped, and the
+received directories are verified against the manifest.
+
+Sending between the hosts needs SSH from host to host. If a host can not
+connect to the host it should send to, all of the remaining hosts get the
+directory from the local host instead.
+
+DO NOT import any library that needs extra python package,
+since this might cause failure of commands that uses this
+library to install python packages.
+"""
+import os
+import hashlib
+import threading
+
+from pylcommon import pdsh
+from pylcommon import ssh_host
+
+# How many hosts a host that has the directory sends to in each round
+BROADCAST_FANOUT = 2
+# Seconds to wait when checking whether a host can connect to another host
+BROADCAST_PEER_CONNECT_TIMEOUT = 10
+# The suffix of the manifest file beside the directory
+BROADCAST_MANIFEST_SUFFIX = ".manifest"
+# Keys are the file paths on local host, values are (size, mtime, sha1)
+BROADCAST_CHECKSUM_CACHE = {}
+# Protects BROADCAST_CHECKSUM_CACHE
+BROADCAST_CHECKSUM_LOCK = threading.Lock()
+
+
+def file_sha1sum(fpath):
+    """
+    Return the SHA1 checksum of a local file, cached until it is changed
+    """
+    stat = os.stat(fpath)
+    BROADCAST_CHECKSUM_LOCK.acquire()
+    cached = BROADCAST_CHECKSUM_CACHE.get(fpath)
+    BROADCAST_CHECKSUM_LOCK.release()
+    if (cached is not None and cached[0] == stat.st_size and
+            cached[1] == stat.st_mtime):
+        return cached[2]
+
+    sha1 = hashlib.sha1()
+    with open(fpath, "rb") as fd:
+        while True:
+            data = fd.read(1048576)
+            if not data:
+                break
+            sha1.update(data)
+    checksum = sha1.hexdigest()
+    BROADCAST_CHECKSUM_LOCK.acquire()
+    BROADCAST_CHECKSUM_CACHE[fpath] = (stat.st_size, stat.st_mtime, checksum)
+    BROADCAST_CHECKSUM_LOCK.release()
+    return checksum
+
+
+def broadcast_manifest(source_dir):
+    """
+    Return the manifest of a local directory in the format of sha1sum, the
+    paths are relative to the directory
+    """
+    lines = []
+    for root, dirs, fnames in os.walk(source_dir, followlinks=True):
+        dirs.sort()
+        for fname in sorted(fnames):
+            fpath = os.path.join(root, fname)
+            if not os.path.isfile(fpath):
+                continue
+            relative_path = os.path.relpath(fpath, source_dir)
+            lines.append("%s  %s\n" % (file_sha1sum(fpath), relative_path))
+    return "".join(lines)
+
+
+def _broadcast_peer_check(log, seed, host):
+    """
+    Check whether the seed can connect to the host by SSH
+    """
+    ssh_string = ssh_host.make_ssh_command(identity_file=host.sh_identity_file)
+    command = ("%s -o ConnectTimeout=%d %s true" %
+               (ssh_string, BROADCAST_PEER_CONNECT_TIMEOUT, host.sh_hostname))
+    retval = seed.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_info("host [%s] can not connect to host [%s], sending from "
+                    "local host instead, ret = [%d], stderr = [%s]",
+                    seed.sh_hostname, host.sh_hostname,
+                    retval.cr_exit_status, retval.cr_stderr)
+        return -1
+    return 0
+
+
+def _broadcast_host_send(log, host, seed, source_dir, dest_dir,
+                         delete_dest):
+    """
+    Send the directory to the host from the seed, None means local host
+    """
+    # pylint: disable=too-many-arguments
+    if seed is None:
+        ret = host.sh_send_file(log, source_dir + "/", dest_dir,
+                                delete_dest=delete_dest)
+        if ret:
+            log.cl_error("failed to send dir [%s] on local host to "
+                         "directory [%s] on host [%s]",
+                         source_dir, dest_dir, host.sh_hostname)
+        return ret
+
+    ret = seed.sh_send_file(log, dest_dir + "/", dest_dir,
+                            delete_dest=delete_dest, from_local=False,
+                            remote_host=host)
+    if ret:
+        log.cl_error("failed to send dir [%s] on host [%s] to "
+                     "directory [%s] on host [%s]",
+                     dest_dir, seed.sh_hostname, dest_dir,
+                     host.sh_hostname)
+    return ret
+
+
+def _broadcast_host(log, host, seed_dict, source_dir, dest_dir,
+                    manifest_fpath, delete_dest, unreachable_seeds):
+    """
+    Send the directory to the host and verify it, used by pdsh_call. The
+    seeds that can not connect to the host are added to unreachable_seeds.
+    """
+    # pylint: disable=too-many-arguments
+    host_manifest_fpath = dest_dir + BROADCAST_MANIFEST_SUFFIX
+    tmp_manifest_fpath = host_manifest_fpath + ".tmp"
+    # Remove the old manifest first, so an interrupted transfer won't be
+    # taken as up to date
+    command = ("rm -f %s && mkdir -p %s" % (host_manifest_fpath, dest_dir))
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+
+    ret = host.sh_send_file(log, manifest_fpath, tmp_manifest_fpath)
+    if ret:
+        log.cl_error("failed to send file [%s] on local host to "
+                     "host [%s]", manifest_fpath, host.sh_hostname)
+        return -1
+
+    seed = seed_dict[host.sh_hostname]
+    # Fall back to send from local host if the seed fails
+    seeds = [seed]
+    if seed is not None:
+        if _broadcast_peer_check(log, seed, host):
+            unreachable_seeds.append(seed.sh_hostname)
+            seeds = []
+        seeds.append(None)
+    command = ("cd %s && sha1sum --quiet --strict -c %s && mv %s %s" %
+               (dest_dir, tmp_manifest_fpath, tmp_manifest_fpath,
+                host_manifest_fpath))
+    for seed in seeds:
+        ret = _broadcast_host_send(log, host, seed, source_dir, dest_dir,
+                                   delete_dest)
+        if ret:
+            continue
+
+        retval = host.sh_run(log, command)
+        if retval.cr_exit_status == 0:
+            return 0
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+    return -1
+
+
+def broadcast_dir(log, workspace, hosts, source_dir, dest_dir,
+                  fanout=BROADCAST_FANOUT, delete_dest=False):
+    """
+    Send the local directory source_dir to dest_dir on all of the hosts.
+    The manifest is saved in workspace on local host. The files in dest_dir
+    that are not in source_dir are removed only if delete_dest is True.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    source_dir = source_dir.rstrip("/")
+    dest_dir = dest_dir.rstrip("/")
+    manifest = broadcast_manifest(source_dir)
+    manifest_fpath = (workspace + "/" + os.path.basename(dest_dir) +
+                      BROADCAST_MANIFEST_SUFFIX)
+    with open(manifest_fpath, "wt") as manifest_file:
+        manifest_file.write(manifest)
+
+    # The hosts with the same manifest already have the directory
+    result = pdsh.pdsh_run(log, hosts, "cat %s%s" %
+                           (dest_dir, BROADCAST_MANIFEST_SUFFIX))
+    seeds = [None]
+    pending_hosts = []
+    for host in hosts:
+        host_result = result.pr_result(host.sh_hostname)
+        if (host_result is not None and host_result.cr_exit_status == 0 and
+                host_result.cr_stdout == manifest):
+            log.cl_debug("dir [%s] on host [%s] is up to date, skipping",
+                         dest_dir, host.sh_hostname)
+            seeds.append(host)
+        else:
+            pending_hosts.append(host)
+
+    log.cl_info("distributing dir [%s] to [%s] of [%d] hosts",
+                source_dir, len(pending_hosts), len(hosts))
+    failed_hostnames = []
+    # The hostnames of the seeds that can not connect to other hosts
+    unreachable_seeds = []
+    while len(pending_hosts) > 0:
+        if len(unreachable_seeds) > 0:
+            # The hosts can not send to each other, so send to all of the
+            # remaining hosts from local host at the same time
+            seeds = [None]
+            fanout = len(pending_hosts)
+        # Keys are hostnames, values are the seed hosts to send from
+        seed_dict = {}
+        round_hosts = []
+        for seed in seeds:
+            for _ in range(fanout):
+                if len(pending_hosts) == 0:
+                    break
+                host = pending_hosts.pop(0)
+                seed_dict[host.sh_hostname] = seed
+                round_hosts.append(host)
+
+        result = pdsh.pdsh_call(log, round_hosts, _broadcast_host,
+                                args=(seed_dict, source_dir, dest_dir,
+                                      manifest_fpath, delete_dest,
+                                      unreachable_seeds))
+        round_failed_hostnames = result.pr_failed_hostnames()
+        for host in round_hosts:
+            if host.sh_hostname in round_failed_hostnames:
+                failed_hostnames.append(host.sh_hostname)
+            else:
+                seeds.append(host)
+
+    if len(failed_hostnames) > 0:
+        log.cl_error("failed to distribute dir [%s] to hosts [%s]",
+                     source_dir, pdsh.hostlist_compress(failed_hostnames))
+        return -1
+    return 0
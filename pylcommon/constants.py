@@ -4,6 +4,11 @@ Constatnts used in Clownfish
 ETC_DIR_PATH = "/etc/"
 VAR_LOG_PATH = "/var/log"
 
+CLOWNFISH_BENCHMARK_CONFIG_FNAME = "clownfish_benchmark.conf"
+CLOWNFISH_BENCHMARK_CONFIG = ETC_DIR_PATH + CLOWNFISH_BENCHMARK_CONFIG_FNAME
+CLOWNFISH_BENCHMARK_LOG_DIR_BASENAME = "clownfish_benchmark"
+CLOWNFISH_BENCHMARK_LOG_DIR = VAR_LOG_PATH + "/" + CLOWNFISH_BENCHMARK_LOG_DIR_BASENAME
+
 CLOWNFISH_BUILD_CONFIG_FNAME = "clownfish_build.conf"
 CLOWNFISH_BUILD_CONFIG = ETC_DIR_PATH + CLOWNFISH_BUILD_CONFIG_FNAME
 CLOWNFISH_BUILD_LOG_DIR_BASENAME = "clownfish_build_log"
@@ -16,6 +21,10 @@ CLOWNFISH_INSTALL_LOG_DIR = VAR_LOG_PATH + "/" + CLOWNFISH_INSTALL_LOG_DIR_BASEN
 CLOWNFISH_CONFIG_FNAME = "clownfish.conf"
 CLOWNFISH_CONFIG = "/etc/" + CLOWNFISH_CONFIG_FNAME
 CLOWNFISH_LOG_DIR = "/var/log/clownfish"
+# The directory to cache the compiled configs
+CLOWNFISH_CONFIG_CACHE_DIR = "/var/cache/clownfish"
+# The snapshot of the service status that the server warm starts from
+CLOWNFISH_STATUS_SNAPSHOT = "/var/lib/clownfish/status_snapshot"
 
 CLOWNFISH_TEST_LOG_DIR_BASENAME = "clownfish_test"
 CLOWNFISH_TEST_LOG_DIR = VAR_LOG_PATH + "/" + CLOWNFISH_TEST_LOG_DIR_BASENAME
@@ -23,3 +32,7 @@ CLOWNFISH_TEST_CONFIG_FNAME = "clownfish_test.conf"
 CLOWNFISH_TEST_CONFIG = "/etc/" + CLOWNFISH_TEST_CONFIG_FNAME
 
 CLOWNFISH_DEFAULT_SERVER_PORT = 3002
+# The port to export the metrics of Clownfish server, 0 means disabled
+CLOWNFISH_DEFAULT_METRICS_PORT = 0
+# The address to export the metrics of Clownfish server
+CLOWNFISH_DEFAULT_METRICS_ADDRESS = "127.0.0.1"
@@ -11,11 +11,15 @@ CSTR_BUS_IDE = "ide"
 CSTR_BUS_SCSI = "scsi"
 CSTR_BUS_VIRTIO = "virtio"
 CSTR_CLIENTS = "clients"
+CSTR_CLONE_MODE = "clone_mode"
+CSTR_CLONE_MODE_FULL = "full"
+CSTR_CLONE_MODE_OVERLAY = "overlay"
 CSTR_CLIENT_NAME = "client_name"
 CSTR_CONFIG_FPATH = "config_fpath"
 CSTR_CLOWNFISH_INSTALL_CONFIG = "clownfish_install_config"
 CSTR_CLOWNFISH_PORT = "clownfish_port"
 CSTR_CLUSTER = "cluster"
+CSTR_CONSOLE_NUMBER = "console_number"
 CSTR_DEVICE = "device"
 CSTR_DEVICE_ID = "device_id"
 CSTR_DISK_ID = "disk_id"
@@ -28,6 +32,7 @@ CSTR_DISK_VIRTIO_PREFIX = "vd"
 CSTR_DISK_VIRTIO_PRIMARY = "vda"
 CSTR_DISTRO = "distro"
 CSTR_DNS = "dns"
+CSTR_DURATION = "duration"
 CSTR_E2FSPROGS_RPM_DIR = "e2fsprogs_rpm_dir"
 CSTR_ENABLED = "enabled"
 CSTR_ESMON_SERVER_HOSTNAME = "esmon_server_hostname"
@@ -44,6 +49,7 @@ CSTR_IMAGE_DIR = "image_dir"
 CSTR_IMAGE_FILE = "image_file"
 CSTR_INDEX = "index"
 CSTR_INSTANCES = "instances"
+CSTR_HOST_NUMBER = "host_number"
 CSTR_INSTALL_CONFIG = "install_config"
 CSTR_INSTALL_SERVER = "install_server"
 CSTR_INTERNET = "internet"
@@ -54,6 +60,7 @@ CSTR_IP = "ip"
 CSTR_ISO = "iso"
 CSTR_IS_MGS = "is_mgs"
 CSTR_IS_MOUNTED = "is_mounted"
+CSTR_LATENCY = "latency"
 CSTR_LAZY_PREPARE = "lazy_prepare"
 CSTR_LUSTRE_DISTRIBUTION_ID = "lustre_distribution_id"
 CSTR_LUSTRE_DISTRIBUTIONS = "lustre_distributions"
@@ -63,6 +70,9 @@ CSTR_MBPS_THRESHOLD = "mbps_threshold"
 CSTR_MDTS = "mdts"
 CSTR_MDT_HOSTS = "mdt_hosts"
 CSTR_MDT_INSTANCES = "mdt_instances"
+CSTR_MDT_NUMBER = "mdt_number"
+CSTR_METRICS_ADDRESS = "metrics_address"
+CSTR_METRICS_PORT = "metrics_port"
 CSTR_MGS = "mgs"
 CSTR_MGS_ID = "mgs_id"
 CSTR_MGS_LIST = "mgs_list"
@@ -73,14 +83,19 @@ CSTR_NID = "nid"
 CSTR_IP_ADDRESSES = "ip_addresses"
 CSTR_IP_ADDRESS = "ip_address"
 CSTR_ISO_PATH = "iso_path"
+CSTR_OFFLINE = "offline"
 CSTR_ONLY_TESTS = "only_tests"
 CSTR_OSTS = "osts"
+CSTR_OST_NUMBER = "ost_number"
 CSTR_OST_INSTANCES = "ost_instances"
+CSTR_P99_LIMITS = "p99_limits"
 CSTR_PACKAGES = "Packages"
 CSTR_PIP = "pip"
 CSTR_QOS = "qos"
 CSTR_RAM_SIZE = "ram_size"
 CSTR_REINSTALL = "reinstall"
+CSTR_RPM_CACHE_DIR = "rpm_cache_dir"
+CSTR_SERVER_CONCURRENCY = "server_concurrency"
 CSTR_SERVER_HOST_ID = "server_host_id"
 CSTR_SERVICE_NAME = "service_name"
 CSTR_SERVICE_INSTANCE_NAME = "service_instance_name"
@@ -91,6 +106,7 @@ CSTR_SKIP_INSTALL = "skip_install"
 CSTR_SKIP_VIRT = "skip_virt"
 CSTR_SSH_HOSTS = "ssh_hosts"
 CSTR_SSH_IDENTITY_FILE = "ssh_identity_file"
+CSTR_STANDBY_HOSTS = "standby_hosts"
 CSTR_STATUS = "status"
 CSTR_TAG = "tag"
 CSTR_TEMPLATE_HOSTNAME = "template_hostname"
@@ -110,11 +126,14 @@ CSTR_ZFS_SUPPORT = "zfs_support"
 CSTR_ZPOOL_CREATE = "zpool_create"
 
 CSTR_TEST_HOSTS = "test_hosts"
+CSTR_TEST_PARALLELISM = "test_parallelism"
 CSTR_CONCURRENCY = "concurrency"
 CSTR_PURPOSE = "purpose"
 CSTR_NET_CONFIGS = "network_configs"
 CSTR_IPS = "ips"
 CSTR_KVM_SERVER_HOSTNAME = "kvm_server_hostname"
 CSTR_PORT = "port"
+CSTR_RECOVERY_CONCURRENCY = "recovery_concurrency"
+CSTR_KVM_RECOVERY_CONCURRENCY = "kvm_recovery_concurrency"
 CSTR_KVM_TEMPLATE_IPV4_ADDRESS = "kvm_template_ipv4_address"
 CSTR_KVM = "kvm"
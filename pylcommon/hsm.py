@@ -5,18 +5,61 @@
 HSM library
 """
 
+import os
+import re
 import time
+import threading
 
 # Local libs
 from pylcommon import utils
+from pylcommon import lustre
 from pylcommon import watched_io
 from pylcommon import daemon
 from pylcommon import time_util
+from pylcommon import pdsh
 
 
 REMOVER_INTERVAL = 60
+# The maximum number of changelog records processed in a batch by the
+# streaming remover
+REMOVER_BATCH_SIZE = 1000
+# Seconds to wait before processing a batch that is not full
+REMOVER_BATCH_TIMEOUT = 5
+# The number of workers that remove archive objects at the same time
+REMOVER_WORKERS = 4
+# The file under the workspace that saves the last processed record
+REMOVER_CURSOR_FNAME = "changelog_cursor"
+# The file under the workspace that saves the changelog user of the
+# streaming remover, so that the cursor is still valid after restarting
+REMOVER_USER_FNAME = "changelog_user"
+# Flags of UNLNK changelog records
+CLF_UNLINK_LAST = 0x0001
+CLF_UNLINK_HSM_EXISTS = 0x0002
+# Seconds between two scaling checks of the copytool manager
+COPYTOOL_SCALE_INTERVAL = 10
+# The number of waiting HSM requests that a copytool is expected to handle
+COPYTOOL_REQUESTS_PER_MOVER = 100
+# Seconds to wait before stopping an idle copytool
+COPYTOOL_SCALE_DOWN_DELAY = 300
+# The maximum seconds to wait before restarting a failed copytool
+COPYTOOL_MAX_BACKOFF = 300
+COPYTOOL_ACTION_PATTERN = r"action (ARCHIVE|RESTORE|REMOVE|CANCEL)"
+COPYTOOL_ACTION_REGULAR = re.compile(COPYTOOL_ACTION_PATTERN)
+# Seconds to trust a healthy result of HSM storage check
+HSM_STORAGE_CHECK_TTL = 60
+# Keys are frozensets of (hostname, hsm_root), values are the check times
+HSM_STORAGE_CHECK_CACHE = {}
+# Protects HSM_STORAGE_CHECK_CACHE
+HSM_STORAGE_CHECK_LOCK = threading.Lock()
 COMMAND_HSM_REMOVER = "hsm_remover"
 COMMAND_LSHMTOOL_POSIX = "lhsmtool_posix"
+# Seconds between two reads of the changelogs by the HSM state tracker
+HSM_TRACKER_INTERVAL = 1
+# Seconds between two checks of all the pending files, in case of missing
+# changelog records
+HSM_TRACKER_RECHECK_INTERVAL = 30
+HSM_CHANGELOG_FID_PATTERN = r" t=\[(?P<fid>[^\]]+)\]"
+HSM_CHANGELOG_FID_REGULAR = re.compile(HSM_CHANGELOG_FID_PATTERN)
 
 
 class HSMCopytool(object):
@@ -40,6 +83,11 @@ class HSMCopytool(object):
         self.hc_stderr_file = (self.hc_workspace + "/" +
                                "copytool_command_watching.stderr")
         self.hc_compress = compress
+        # Whether the copytool is being stopped on purpose
+        self.hc_stopping = False
+        # The number of HSM actions the copytool has handled
+        self.hc_actions = 0
+        self.hc_start_time = time.time()
         compress_string = ""
         if compress:
             compress_string = " --compress"
@@ -59,7 +107,7 @@ class HSMCopytool(object):
         command = ("pkill -f -x -c '%s'" % (self.hc_command))
         log.cl_debug("start to run command [%s] on host [%s]", command,
                      host.sh_hostname)
-        retval = host.sh_run(log, log, command)
+        retval = host.sh_run(log, command)
         if (retval.cr_stderr != "" or
                 (retval.cr_exit_status != 0 and retval.cr_exit_status != 1)):
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -82,16 +130,17 @@ class HSMCopytool(object):
         """
         # pylint: disable=too-many-locals,too-many-statements
         # pylint: disable=too-many-return-statements,too-many-arguments
-        log = parent_log.cl_get_child("copytool", resultsdir=self.hc_workspace)
+        log = parent_log.cl_get_child("copytool_" + self.hc_copytool_id,
+                                      resultsdir=self.hc_workspace)
 
         host = self.hc_host
         args = {}
-        args[watched_io.WATCHEDIO_LOG] = host.sh_hostname
-        args[watched_io.WATCHEDIO_HOSTNAME] = log
+        args[watched_io.WATCHEDIO_LOG] = log
+        args[watched_io.WATCHEDIO_HOSTNAME] = host.sh_hostname
         stdout_fd = watched_io.watched_io_open(self.hc_stdout_file,
                                                watched_io.log_watcher_debug, args)
         stderr_fd = watched_io.watched_io_open(self.hc_stderr_file,
-                                               watched_io.log_watcher_error, args)
+                                               self._hc_stderr_watcher, args)
         log.cl_debug("start to run command [%s] on host [%s]",
                      self.hc_command, host.sh_hostname)
         retval = host.sh_run(log, self.hc_command, stdout_tee=stdout_fd,
@@ -99,7 +148,7 @@ class HSMCopytool(object):
                              return_stderr=False, timeout=None, flush_tee=True)
         stdout_fd.close()
         stderr_fd.close()
-        if daemon.SHUTTING_DOWN:
+        if daemon.SHUTTING_DOWN or self.hc_stopping:
             log.cl_debug("finished running command [%s] on host [%s], "
                          "ret = [%d], "
                          "stdout = [%s], stderr = [%s]",
@@ -121,12 +170,25 @@ class HSMCopytool(object):
 
         log.cl_debug("thread of copytool [%s] is exiting",
                      self.hc_copytool_id)
+        # Release the name so that the copytool can be restarted
+        log.cl_fini()
         return
 
+    def _hc_stderr_watcher(self, args, new_log):
+        """
+        Log the output of copytool and count the actions
+        """
+        self.hc_actions += len(COPYTOOL_ACTION_REGULAR.findall(new_log))
+        watched_io.log_watcher_error(args, new_log)
+
     def hc_thread_start(self, log):
         """
         Start the thread
         """
+        self.hc_status = 0
+        self.hc_stopping = False
+        self.hc_actions = 0
+        self.hc_start_time = time.time()
         if utils.mkdir(self.hc_workspace):
             log.cl_error("failed to create directory [%s] on local host, "
                          "exiting the thread",
@@ -142,6 +204,248 @@ class HSMCopytool(object):
         if self.hc_thread is not None:
             self.hc_thread.join()
 
+    def hc_is_running(self):
+        """
+        Return True if the thread of the copytool is running
+        """
+        return self.hc_thread is not None and self.hc_thread.is_alive()
+
+    def hc_stop(self, log):
+        """
+        Kill the copytool and wait for the thread to exit
+        """
+        self.hc_stopping = True
+        ret = self.hc_killall(log)
+        if ret:
+            log.cl_error("failed to kill copytool [%s]", self.hc_copytool_id)
+            return -1
+        self.hc_thread_join()
+        return 0
+
+    def hc_throughput(self):
+        """
+        Return the actions per second since the copytool started
+        """
+        elapsed = time.time() - self.hc_start_time
+        if elapsed <= 0:
+            return 0
+        return self.hc_actions / elapsed
+
+
+class HSMCopytoolManager(object):
+    """
+    Run copytools of an archive on multiple client hosts, and scale the
+    number of running copytools with the depth of the HSM request queue
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, archive_id, hosts, hsm_root, lustre_mount_point,
+                 parent_directory, mdtis, min_movers=1, max_movers=None,
+                 compress=False,
+                 requests_per_mover=COPYTOOL_REQUESTS_PER_MOVER):
+        self.hcm_archive_id = archive_id
+        # The client hosts to run copytools on, at most one per host since
+        # pkill can't tell copytools of the same archive apart
+        self.hcm_hosts = hosts
+        # List of LustreMDTInstance, to check the HSM request queue
+        self.hcm_mdtis = mdtis
+        self.hcm_min_movers = min_movers
+        if max_movers is None or max_movers > len(hosts):
+            max_movers = len(hosts)
+        self.hcm_max_movers = max_movers
+        self.hcm_requests_per_mover = requests_per_mover
+        self.hcm_workspace = parent_directory
+        # Keys are hostnames, values are HSMCopytool
+        self.hcm_copytools = {}
+        for host in hosts:
+            copytool_id = "%s_archive%s" % (host.sh_hostname, archive_id)
+            copytool = HSMCopytool(copytool_id, host, archive_id, hsm_root,
+                                   lustre_mount_point, parent_directory,
+                                   compress=compress)
+            self.hcm_copytools[host.sh_hostname] = copytool
+        # Hostnames of the copytools that should be running, in the order
+        # of starting
+        self.hcm_running = []
+        # Keys are hostnames, values are (restart time, backoff seconds)
+        self.hcm_backoffs = {}
+        # Keys are hostnames, values are how many times they are restarted
+        self.hcm_restarts = {}
+        self.hcm_queue_depth = 0
+        # The last time that more copytools were needed
+        self.hcm_busy_time = time.time()
+        self.hcm_stopping = False
+        # Notifies the thread to stop
+        self.hcm_condition = threading.Condition()
+        self.hcm_thread = None
+
+    def hcm_queue_depth_get(self, log):
+        """
+        Return the number of waiting HSM requests on the MDTs, -1 on failure
+        """
+        depth = 0
+        for mdti in self.hcm_mdtis:
+            mdt = mdti.lsi_service
+            host = mdti.lsi_host
+            command = ("lctl get_param -n mdt.%s-%s.hsm.actions | "
+                       "grep -c status=WAITING" %
+                       (mdt.ls_lustre_fs.lf_fsname, mdt.ls_index_string))
+            retval = host.sh_run(log, command)
+            # grep exits with 1 if nothing is waiting
+            if (retval.cr_exit_status not in (0, 1) or
+                    not retval.cr_stdout.strip().isdigit()):
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command,
+                             host.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                return -1
+            depth += int(retval.cr_stdout.strip())
+        return depth
+
+    def _hcm_copytool_start(self, log, hostname):
+        """
+        Start the copytool on the host
+        """
+        copytool = self.hcm_copytools[hostname]
+        copytool.hc_thread_start(log)
+        if copytool.hc_status:
+            log.cl_error("failed to start copytool [%s]",
+                         copytool.hc_copytool_id)
+            return -1
+        log.cl_info("started copytool [%s]", copytool.hc_copytool_id)
+        return 0
+
+    def _hcm_restart_failed(self, log):
+        """
+        Restart the copytools that exited unexpectedly, with backoff
+        """
+        now = time.time()
+        for hostname in self.hcm_running:
+            copytool = self.hcm_copytools[hostname]
+            if copytool.hc_is_running():
+                # Forget the backoff of copytools that work for long
+                if (hostname in self.hcm_backoffs and
+                        now - copytool.hc_start_time > COPYTOOL_MAX_BACKOFF):
+                    del self.hcm_backoffs[hostname]
+                continue
+
+            restart_time, backoff = self.hcm_backoffs.get(hostname, (0, 0))
+            if restart_time == 0:
+                backoff = min(max(backoff * 2, COPYTOOL_SCALE_INTERVAL),
+                              COPYTOOL_MAX_BACKOFF)
+                log.cl_error("copytool [%s] exited, restarting in [%d] "
+                             "seconds", copytool.hc_copytool_id, backoff)
+                self.hcm_backoffs[hostname] = (now + backoff, backoff)
+                continue
+            if now < restart_time:
+                continue
+            self.hcm_restarts[hostname] = self.hcm_restarts.get(hostname, 0) + 1
+            self._hcm_copytool_start(log, hostname)
+            self.hcm_backoffs[hostname] = (0, backoff)
+
+    def _hcm_scale(self, log):
+        """
+        Start or stop copytools according to the depth of request queue
+        """
+        depth = self.hcm_queue_depth_get(log)
+        if depth < 0:
+            log.cl_error("failed to get the depth of HSM request queue, "
+                         "not scaling copytools")
+            return
+        self.hcm_queue_depth = depth
+        wanted = ((depth + self.hcm_requests_per_mover - 1) /
+                  self.hcm_requests_per_mover)
+        wanted = min(max(wanted, self.hcm_min_movers), self.hcm_max_movers)
+        now = time.time()
+        if wanted >= len(self.hcm_running):
+            self.hcm_busy_time = now
+
+        for host in self.hcm_hosts:
+            if len(self.hcm_running) >= wanted:
+                break
+            hostname = host.sh_hostname
+            if hostname in self.hcm_running:
+                continue
+            if self._hcm_copytool_start(log, hostname) == 0:
+                self.hcm_running.append(hostname)
+
+        # Only scale down when less copytools are needed for a while
+        if now - self.hcm_busy_time < COPYTOOL_SCALE_DOWN_DELAY:
+            return
+        while len(self.hcm_running) > wanted:
+            hostname = self.hcm_running[-1]
+            copytool = self.hcm_copytools[hostname]
+            if copytool.hc_stop(log):
+                break
+            log.cl_info("stopped idle copytool [%s]", copytool.hc_copytool_id)
+            self.hcm_running.remove(hostname)
+            if hostname in self.hcm_backoffs:
+                del self.hcm_backoffs[hostname]
+
+    def hcm_thread_main(self, log):
+        """
+        Thread that restarts and scales the copytools
+        """
+        while True:
+            self._hcm_restart_failed(log)
+            self._hcm_scale(log)
+            self.hcm_condition.acquire()
+            if not self.hcm_stopping and not daemon.SHUTTING_DOWN:
+                self.hcm_condition.wait(COPYTOOL_SCALE_INTERVAL)
+            stopping = self.hcm_stopping or daemon.SHUTTING_DOWN
+            self.hcm_condition.release()
+            if stopping:
+                break
+        log.cl_debug("thread of copytool manager of archive [%s] is exiting",
+                     self.hcm_archive_id)
+
+    def hcm_start(self, log):
+        """
+        Start the manager thread
+        """
+        if utils.mkdir(self.hcm_workspace):
+            log.cl_error("failed to create directory [%s] on local host",
+                         self.hcm_workspace)
+            return -1
+        self.hcm_thread = utils.thread_start(self.hcm_thread_main, (log, ))
+        return 0
+
+    def hcm_stop(self, log):
+        """
+        Stop the manager thread and all of the copytools
+        """
+        self.hcm_condition.acquire()
+        self.hcm_stopping = True
+        self.hcm_condition.notifyAll()
+        self.hcm_condition.release()
+        if self.hcm_thread is not None:
+            self.hcm_thread.join()
+            self.hcm_thread = None
+
+        ret = 0
+        for hostname in list(self.hcm_running):
+            if self.hcm_copytools[hostname].hc_stop(log):
+                ret = -1
+                continue
+            self.hcm_running.remove(hostname)
+        return ret
+
+    def hcm_stats(self):
+        """
+        Return the queue depth and per-copytool throughput
+        """
+        copytools = {}
+        for hostname in self.hcm_running:
+            copytool = self.hcm_copytools[hostname]
+            copytools[copytool.hc_copytool_id] = {
+                "running": copytool.hc_is_running(),
+                "actions": copytool.hc_actions,
+                "actions_per_second": round(copytool.hc_throughput(), 3),
+                "restarts": self.hcm_restarts.get(hostname, 0)}
+        return {"queue_depth": self.hcm_queue_depth,
+                "copytools": copytools}
+
 
 class HSMRemover(object):
     """
@@ -151,23 +455,113 @@ class HSMRemover(object):
     # pylint: disable=too-many-arguments
     # mdt_uuid: MDT0000
     def __init__(self, log, remover_id, host, fsname, mdti, hsm_root,
-                 parent_directory):
+                 parent_directory, streaming=False):
         self.hr_remover_id = remover_id
         self.hr_host = host
         self.hr_mdti = mdti
         self.hr_fsname = fsname
         self.hr_thread = None
-        self.hr_changelog_user = mdti.mdti_changelog_register(log)
+        self.hr_hsm_root = hsm_root
+        self.hr_workspace = parent_directory + "/" + remover_id
+        # Keep one changelog consumer running instead of restarting the
+        # remover command every REMOVER_INTERVAL
+        self.hr_streaming = streaming
+        self.hr_mdt_name = "%s-%s" % (fsname, mdti.lsi_service.ls_index_string)
+        self.hr_user_fpath = self.hr_workspace + "/" + REMOVER_USER_FNAME
+        if streaming:
+            self.hr_changelog_user = self._hr_changelog_user_load(log)
+        else:
+            self.hr_changelog_user = mdti.mdti_changelog_register(log)
         if self.hr_changelog_user is None:
             reason = "failed to register changelog user"
             raise Exception(reason)
-        self.hr_hsm_root = hsm_root
-        self.hr_workspace = parent_directory + "/" + remover_id
         self.hr_command = ("%s --hsm_root %s --mdt=%s-%s "
                            "--changelog_user %s" %
                            (COMMAND_HSM_REMOVER, hsm_root,
                             fsname, mdti.lsi_service.ls_index_string,
                             self.hr_changelog_user))
+        if streaming:
+            self.hr_command = "lfs changelog --follow %s" % self.hr_mdt_name
+        self.hr_cursor_fpath = self.hr_workspace + "/" + REMOVER_CURSOR_FNAME
+        # The last record that has been processed and cleared
+        self.hr_cursor = 0
+        # The last record that has been read
+        self.hr_last_read = 0
+        # The incomplete line of the changelog output
+        self.hr_partial_line = ""
+        # List of (record number, FID or None, record time) to process
+        self.hr_pending = []
+        # Protects the fields above and notifies the batch thread
+        self.hr_condition = threading.Condition()
+        self.hr_removed = 0
+        # The number of archive objects that failed to be removed, each
+        # object is counted once even if its batch is retried
+        self.hr_failed = 0
+        # The archive objects of the current batch that failed to be removed
+        self.hr_failed_fpaths = set()
+        # Seconds between the time of last processed record and processing
+        self.hr_lag = 0
+        self.hr_start_time = time.time()
+        self.hr_record_regular = re.compile(r"^(?P<index>\d+) \d+(?P<type>\w+) "
+                                            r"(?P<time>\S+) (?P<date>\S+) "
+                                            r"(?P<flags>0x[0-9a-fA-F]+) "
+                                            r"t=\[(?P<fid>[^\]]+)\]")
+
+    def _hr_changelog_user_load(self, log):
+        """
+        Return the changelog user saved by the previous streaming remover if
+        it is still registered, otherwise register a new one and save it
+        """
+        mdti = self.hr_mdti
+        host = mdti.lsi_host
+        if os.path.exists(self.hr_user_fpath):
+            try:
+                with open(self.hr_user_fpath) as user_file:
+                    user = user_file.read().strip()
+            except IOError:
+                log.cl_error("failed to load changelog user from file [%s]",
+                             self.hr_user_fpath)
+                return None
+
+            command = ("lctl get_param -n mdd.%s.changelog_users" %
+                       self.hr_mdt_name)
+            retval = host.sh_run(log, command)
+            if retval.cr_exit_status:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command,
+                             host.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                return None
+            for line in retval.cr_stdout.splitlines():
+                fields = line.split()
+                if len(fields) > 0 and fields[0] == user:
+                    log.cl_info("reusing changelog user [%s] of [%s]",
+                                user, self.hr_mdt_name)
+                    return user
+            log.cl_warning("changelog user [%s] saved in file [%s] is no "
+                           "longer registered on [%s], the records after "
+                           "the cursor might have been purged",
+                           user, self.hr_user_fpath, self.hr_mdt_name)
+
+        user = mdti.mdti_changelog_register(log)
+        if user is None:
+            return None
+        ret = utils.mkdir(self.hr_workspace)
+        if ret:
+            log.cl_error("failed to create directory [%s] on local host",
+                         self.hr_workspace)
+            mdti.mdti_changelog_deregister(log, user)
+            return None
+        tmp_fpath = self.hr_user_fpath + ".tmp"
+        with open(tmp_fpath, "w") as user_file:
+            user_file.write("%s\n" % user)
+            user_file.flush()
+            os.fsync(user_file.fileno())
+        os.rename(tmp_fpath, self.hr_user_fpath)
+        return user
 
     def hr_run(self, log):
         """
@@ -226,12 +620,252 @@ class HSMRemover(object):
         """
         log = parent_log.cl_get_child("hsm_remover",
                                       resultsdir=self.hr_workspace)
+        if self.hr_streaming:
+            self.hr_stream_main(log)
+            return
         while not daemon.SHUTTING_DOWN:
             ret = self.hr_run(log)
             if ret:
                 log.cl_error("failed to run remover")
             time.sleep(REMOVER_INTERVAL)
 
+    def hr_cursor_load(self, log):
+        """
+        Load the durable cursor of the changelog
+        """
+        if not os.path.exists(self.hr_cursor_fpath):
+            self.hr_cursor = 0
+            return 0
+        try:
+            with open(self.hr_cursor_fpath) as cursor_file:
+                self.hr_cursor = int(cursor_file.read().strip())
+        except (IOError, ValueError):
+            log.cl_error("failed to load cursor from file [%s]",
+                         self.hr_cursor_fpath)
+            return -1
+        return 0
+
+    def hr_cursor_save(self, log, cursor):
+        """
+        Save the cursor durably and clear the changelog before it
+        """
+        tmp_fpath = self.hr_cursor_fpath + ".tmp"
+        with open(tmp_fpath, "w") as cursor_file:
+            cursor_file.write("%d\n" % cursor)
+            cursor_file.flush()
+            os.fsync(cursor_file.fileno())
+        os.rename(tmp_fpath, self.hr_cursor_fpath)
+
+        host = self.hr_host
+        command = ("lfs changelog_clear %s %s %d" %
+                   (self.hr_mdt_name, self.hr_changelog_user, cursor))
+        retval = host.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         host.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+        return 0
+
+    def _hr_stream_watcher(self, log, data):
+        """
+        Parse the records from the output of changelog consumer
+        """
+        records = []
+        lines = (self.hr_partial_line + data).split("\n")
+        self.hr_partial_line = lines[-1]
+        for line in lines[:-1]:
+            match = self.hr_record_regular.match(line)
+            if not match:
+                log.cl_debug("skipping changelog line [%s]", line)
+                continue
+            index = int(match.group("index"))
+            if index <= self.hr_last_read:
+                continue
+            self.hr_last_read = index
+            fid = None
+            flags = int(match.group("flags"), 16)
+            if (match.group("type") == "UNLNK" and
+                    flags & CLF_UNLINK_LAST and
+                    flags & CLF_UNLINK_HSM_EXISTS):
+                fid = match.group("fid")
+            try:
+                record_time = time.mktime(time.strptime(match.group("date") +
+                                                        " " +
+                                                        match.group("time").split(".")[0],
+                                                        "%Y.%m.%d %H:%M:%S"))
+            except ValueError:
+                record_time = time.time()
+            records.append((index, fid, record_time))
+
+        if len(records) == 0:
+            return
+        self.hr_condition.acquire()
+        self.hr_pending += records
+        if len(self.hr_pending) >= REMOVER_BATCH_SIZE:
+            self.hr_condition.notifyAll()
+        self.hr_condition.release()
+
+    def _hr_remove_chunk(self, log, host, chunk, result):
+        """
+        Remove a chunk of archive objects, used by lustre.hsm_bulk_call()
+        """
+        fpaths = []
+        for fpath in chunk:
+            fpaths.append(fpath)
+            fpaths.append(fpath + ".lov")
+        command = "rm -f %s" % " ".join(fpaths)
+        retval = host.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         host.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+        for fpath in chunk:
+            result.hbr_set(fpath, retval.cr_exit_status)
+
+    def hr_batch_process(self, log, batch):
+        """
+        Remove the archive objects of a batch of records and move the
+        cursor forward, return 0 if all objects are removed
+        """
+        fpaths = []
+        for index, fid, record_time in batch:
+            if fid is None:
+                continue
+            lustre_fid = lustre.LustreFID(log, fid)
+            fpaths.append(lustre_fid.lf_posix_archive_path(self.hr_hsm_root))
+
+        if len(fpaths) > 0:
+            result = lustre.hsm_bulk_call(log, fpaths, self._hr_remove_chunk,
+                                          hosts=[self.hr_host],
+                                          parallelism=REMOVER_WORKERS)
+            failed_fpaths = result.hbr_failed_fpaths()
+            if len(failed_fpaths) > 0:
+                log.cl_error("failed to remove [%d] archive objects of "
+                             "[%d] records", len(failed_fpaths), len(batch))
+                for fpath in failed_fpaths:
+                    if fpath not in self.hr_failed_fpaths:
+                        self.hr_failed_fpaths.add(fpath)
+                        self.hr_failed += 1
+                return -1
+            self.hr_failed_fpaths.clear()
+            self.hr_removed += len(fpaths)
+
+        index, fid, record_time = batch[-1]
+        self.hr_cursor = index
+        self.hr_lag = time.time() - record_time
+        return self.hr_cursor_save(log, index)
+
+    def hr_stats(self):
+        """
+        Return the throughput and lag of the streaming remover
+        """
+        elapsed = time.time() - self.hr_start_time
+        if elapsed <= 0:
+            elapsed = 1
+        return {"removed": self.hr_removed,
+                "failed": self.hr_failed,
+                "removed_per_second": round(self.hr_removed / elapsed, 3),
+                "cursor": self.hr_cursor,
+                "record_lag": max(self.hr_last_read - self.hr_cursor, 0),
+                "lag_seconds": round(self.hr_lag, 3)}
+
+    def hr_batch_thread_main(self, log):
+        """
+        Thread that processes the records in batches
+        """
+        last_report = time.time()
+        while True:
+            self.hr_condition.acquire()
+            if (len(self.hr_pending) < REMOVER_BATCH_SIZE and
+                    not daemon.SHUTTING_DOWN):
+                self.hr_condition.wait(REMOVER_BATCH_TIMEOUT)
+            batch = self.hr_pending[:REMOVER_BATCH_SIZE]
+            self.hr_condition.release()
+
+            if time.time() - last_report >= REMOVER_INTERVAL:
+                log.cl_info("HSM remover [%s]: %s", self.hr_remover_id,
+                            self.hr_stats())
+                last_report = time.time()
+
+            if len(batch) == 0:
+                if daemon.SHUTTING_DOWN:
+                    break
+                continue
+
+            ret = self.hr_batch_process(log, batch)
+            if ret:
+                # Retry the batch later
+                if daemon.SHUTTING_DOWN:
+                    break
+                time.sleep(REMOVER_BATCH_TIMEOUT)
+                continue
+            self.hr_condition.acquire()
+            self.hr_pending = self.hr_pending[len(batch):]
+            self.hr_condition.release()
+
+    def hr_stream_main(self, log):
+        """
+        Keep one changelog consumer running and process the records
+        """
+        ret = self.hr_cursor_load(log)
+        if ret:
+            return
+        self.hr_last_read = self.hr_cursor
+        batch_thread = utils.thread_start(self.hr_batch_thread_main, (log, ))
+
+        host = self.hr_host
+        stdout_file = self.hr_workspace + "/" + "remover_watching.stdout"
+        stderr_file = self.hr_workspace + "/" + "remover_watching.stderr"
+        args = {}
+        args[watched_io.WATCHEDIO_HOSTNAME] = host.sh_hostname
+        args[watched_io.WATCHEDIO_LOG] = log
+        backoff = 1
+        while not daemon.SHUTTING_DOWN:
+            # Restart from the last record read, the records before it are
+            # still pending
+            command = "%s %d" % (self.hr_command, self.hr_last_read + 1)
+            self.hr_partial_line = ""
+            stdout_fd = watched_io.watched_io_open(stdout_file,
+                                                   self._hr_stream_watcher,
+                                                   log)
+            stderr_fd = watched_io.watched_io_open(stderr_file,
+                                                   watched_io.log_watcher_error,
+                                                   args)
+            log.cl_debug("start to run command [%s] on host [%s]",
+                         command, host.sh_hostname)
+            time_start = time.time()
+            retval = host.sh_run(log, command, stdout_tee=stdout_fd,
+                                 stderr_tee=stderr_fd, return_stdout=False,
+                                 return_stderr=False, timeout=None,
+                                 quit_func=lambda: daemon.SHUTTING_DOWN,
+                                 flush_tee=True)
+            stdout_fd.close()
+            stderr_fd.close()
+            if daemon.SHUTTING_DOWN:
+                break
+            log.cl_error("changelog consumer [%s] on host [%s] exited, "
+                         "ret = [%d], restarting in [%d] seconds",
+                         command, host.sh_hostname, retval.cr_exit_status,
+                         backoff)
+            if time.time() - time_start > REMOVER_INTERVAL:
+                backoff = 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, REMOVER_INTERVAL)
+
+        self.hr_condition.acquire()
+        self.hr_condition.notifyAll()
+        self.hr_condition.release()
+        batch_thread.join()
+
     def hr_thread_start(self, parent_log):
         """
         Start the thread
@@ -247,7 +881,11 @@ class HSMRemover(object):
         Kill the process of running remover
         """
         host = self.hr_host
-        command = ("pkill -f -x -c '%s'" % (self.hr_command))
+        if self.hr_streaming:
+            # The start record is appended to the command of consumer
+            command = ("pkill -f -c '^%s '" % (self.hr_command))
+        else:
+            command = ("pkill -f -x -c '%s'" % (self.hr_command))
         log.cl_debug("start to run command [%s] on host [%s]", command,
                      host.sh_hostname)
         retval = host.sh_run(log, command)
@@ -272,6 +910,10 @@ class HSMRemover(object):
         """
         Cleanup resource allocated when initing
         """
+        # The changelog user of streaming remover is kept, so that the
+        # records after the cursor are not purged before restarting
+        if self.hr_streaming:
+            return 0
         ret = self.hr_mdti.mdti_changelog_deregister(log, self.hr_changelog_user)
         return ret
 
@@ -283,103 +925,384 @@ class HSMRemover(object):
             self.hr_thread.join()
 
 
-def check_hsm_remover_storage(log, removers):
+class HSMStateWaiter(object):
     """
-    Check the HSM storage status of removers
+    The files that a caller of HSMStateTracker.hst_wait_many() waits for
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, expected_state, pending):
+        self.hsw_expected_state = expected_state
+        # Keys are FIDs, values are file paths that have not reached the
+        # expected state
+        self.hsw_pending = pending
+
+
+class HSMStateTracker(object):
     """
-    random_fpaths = []
-    for remover_id, remover in removers.iteritems():
-        random_fpath = remover.hr_hsm_root + "/" + utils.random_word(8)
-        command = "touch %s" % random_fpath
-        retval = remover.hr_host.sh_run(log, command)
+    Track the HSM states of files by following the changelogs of MDTs, so
+    that a lot of waits can be resolved by a few commands
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, host, fsname, mdtis, interval=HSM_TRACKER_INTERVAL,
+                 recheck_interval=HSM_TRACKER_RECHECK_INTERVAL):
+        # The client host to run the commands on
+        self.hst_host = host
+        self.hst_fsname = fsname
+        # List of LustreMDTInstance
+        self.hst_mdtis = mdtis
+        self.hst_interval = interval
+        self.hst_recheck_interval = recheck_interval
+        # Keys are MDT names, values are changelog users
+        self.hst_changelog_users = {}
+        # Keys are MDT names, values are the last processed records
+        self.hst_cursors = {}
+        # List of HSMStateWaiter
+        self.hst_waiters = []
+        # Protects hst_waiters and notifies the waiters
+        self.hst_condition = threading.Condition()
+        self.hst_stopping = False
+        self.hst_thread = None
+
+    def _hst_mdt_name(self, mdti):
+        """
+        Return the MDT name used by changelog commands
+        """
+        # pylint: disable=no-self-use
+        mdt = mdti.lsi_service
+        return "%s-%s" % (mdt.ls_lustre_fs.lf_fsname, mdt.ls_index_string)
+
+    def hst_start(self, log):
+        """
+        Register the changelog users and start the thread
+        """
+        for mdti in self.hst_mdtis:
+            user_id = mdti.mdti_changelog_register(log)
+            if user_id is None:
+                log.cl_error("failed to register changelog user")
+                self.hst_stop(log)
+                return -1
+            mdt_name = self._hst_mdt_name(mdti)
+            self.hst_changelog_users[mdt_name] = user_id
+            self.hst_cursors[mdt_name] = 0
+        self.hst_thread = utils.thread_start(self.hst_thread_main, (log, ))
+        return 0
+
+    def hst_stop(self, log):
+        """
+        Stop the thread and deregister the changelog users
+        """
+        self.hst_condition.acquire()
+        self.hst_stopping = True
+        self.hst_condition.notifyAll()
+        self.hst_condition.release()
+        if self.hst_thread is not None:
+            self.hst_thread.join()
+            self.hst_thread = None
+
+        ret = 0
+        for mdti in self.hst_mdtis:
+            mdt_name = self._hst_mdt_name(mdti)
+            if mdt_name not in self.hst_changelog_users:
+                continue
+            user_id = self.hst_changelog_users[mdt_name]
+            if mdti.mdti_changelog_deregister(log, user_id):
+                ret = -1
+            del self.hst_changelog_users[mdt_name]
+        return ret
+
+    def _hst_changelog_read(self, log, mdt_name):
+        """
+        Read the new records of the changelog, return the changed FIDs.
+        Return None on failure.
+        """
+        host = self.hst_host
+        cursor = self.hst_cursors[mdt_name]
+        command = "lfs changelog %s %d" % (mdt_name, cursor + 1)
+        retval = host.sh_run(log, command, silent=True)
         if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on remover host [%s], "
-                         "ret = [%d], "
-                         "stdout = [%s], stderr = [%s]",
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
                          command,
-                         remover_id,
+                         host.sh_hostname,
                          retval.cr_exit_status,
                          retval.cr_stdout,
                          retval.cr_stderr)
-            return -1
-        random_fpaths.append(random_fpath)
+            return None
 
-    for random_fpath in random_fpaths:
-        for remover_id, remover in removers.iteritems():
-            command = "ls %s" % random_fpath
-            retval = remover.hr_host.sh_run(log, command)
-            if retval.cr_exit_status:
-                log.cl_error("failed to run command [%s] on remover host "
-                             "[%s], ret = [%d], "
-                             "stdout = [%s], stderr = [%s]",
-                             command,
-                             remover_id,
-                             retval.cr_exit_status,
-                             retval.cr_stdout,
-                             retval.cr_stderr)
-                return -1
-        remover = removers.values()[0]
-        command = "rm -f %s" % random_fpath
-        retval = remover.hr_host.sh_run(log, command)
+        fids = []
+        for line in retval.cr_stdout.splitlines():
+            fields = line.split(" ", 1)
+            if len(fields) != 2 or not fields[0].isdigit():
+                continue
+            cursor = max(cursor, int(fields[0]))
+            match = HSM_CHANGELOG_FID_REGULAR.search(line)
+            if match:
+                fids.append(match.group("fid"))
+
+        if cursor == self.hst_cursors[mdt_name]:
+            return fids
+        self.hst_cursors[mdt_name] = cursor
+        command = ("lfs changelog_clear %s %s %d" %
+                   (mdt_name, self.hst_changelog_users[mdt_name], cursor))
+        retval = host.sh_run(log, command, silent=True)
         if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on remover host [%s], "
-                         "ret = [%d], "
-                         "stdout = [%s], stderr = [%s]",
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
                          command,
-                         remover_id,
+                         host.sh_hostname,
                          retval.cr_exit_status,
                          retval.cr_stdout,
                          retval.cr_stderr)
-            return -1
-    return 0
+        return fids
+
+    def _hst_check(self, log, fids):
+        """
+        Check the states of the files with the FIDs, and notify the waiters
+        whose files all reached the expected states. None FIDs means all
+        pending files.
+        """
+        # Keys are FIDs, values are file paths
+        checking = {}
+        self.hst_condition.acquire()
+        for waiter in self.hst_waiters:
+            for fid, fpath in waiter.hsw_pending.iteritems():
+                if fids is None or fid in fids:
+                    checking[fid] = fpath
+        self.hst_condition.release()
+        if len(checking) == 0:
+            return
+
+        result = lustre.lfs_hsm_state_bulk(log, checking.values(),
+                                           hosts=[self.hst_host])
+        self.hst_condition.acquire()
+        for waiter in self.hst_waiters:
+            for fid, fpath in checking.iteritems():
+                if fid not in waiter.hsw_pending:
+                    continue
+                state = result.hbr_value(fpath)
+                if state is not None and state == waiter.hsw_expected_state:
+                    del waiter.hsw_pending[fid]
+        self.hst_condition.notifyAll()
+        self.hst_condition.release()
+
+    def hst_thread_main(self, log):
+        """
+        Thread that follows the changelogs and resolves the waits
+        """
+        last_recheck = time.time()
+        while True:
+            self.hst_condition.acquire()
+            if not self.hst_stopping:
+                self.hst_condition.wait(self.hst_interval)
+            stopping = self.hst_stopping
+            waiting = len(self.hst_waiters) > 0
+            self.hst_condition.release()
+            if stopping:
+                break
+
+            fids = set()
+            for mdt_name in self.hst_cursors:
+                mdt_fids = self._hst_changelog_read(log, mdt_name)
+                if mdt_fids is None:
+                    # Not able to know the changes, check all files
+                    fids = None
+                    break
+                fids.update(mdt_fids)
+            if not waiting:
+                continue
+
+            if time.time() - last_recheck >= self.hst_recheck_interval:
+                fids = None
+            if fids is None:
+                last_recheck = time.time()
+            self._hst_check(log, fids)
+        log.cl_debug("thread of HSM state tracker is exiting")
+
+    def hst_wait_many(self, log, fpaths, states, archive_id=0, timeout=90):
+        """
+        Wait until all of the files change to the expected HSM state.
+        Return the list of files that failed to reach the state.
+        """
+        # pylint: disable=too-many-arguments
+        expected_state = lustre.HSMState(states, archive_id=archive_id)
+        hosts = [self.hst_host]
+        result = lustre.lfs_path2fid_bulk(log, fpaths, hosts=hosts)
+        failed_fpaths = result.hbr_failed_fpaths()
+        if len(failed_fpaths) > 0:
+            log.cl_error("failed to get the FIDs of [%d] files",
+                         len(failed_fpaths))
+            return failed_fpaths
+
+        pending = {}
+        for fpath in fpaths:
+            pending[result.hbr_value(fpath)] = fpath
+        waiter = HSMStateWaiter(expected_state, pending)
+
+        # Register the waiter before the first check, so no change is missed
+        self.hst_condition.acquire()
+        self.hst_waiters.append(waiter)
+        self.hst_condition.release()
 
+        state_result = lustre.lfs_hsm_state_bulk(log, fpaths, hosts=hosts)
+        deadline = time.time() + timeout
+        self.hst_condition.acquire()
+        for fid, fpath in pending.items():
+            state = state_result.hbr_value(fpath)
+            if state is not None and state == expected_state:
+                del pending[fid]
+        while len(pending) > 0 and not self.hst_stopping:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.hst_condition.wait(remaining)
+        self.hst_waiters.remove(waiter)
+        failed_fpaths = pending.values()
+        self.hst_condition.release()
 
-def check_hsm_copytool_storage(log, copytools):
+        if len(failed_fpaths) > 0:
+            log.cl_error("timeout when waiting [%d] files for HSM state [%s]",
+                         len(failed_fpaths), expected_state.hs_string())
+        else:
+            log.cl_debug("[%d] files reached HSM state [%s]", len(fpaths),
+                         expected_state.hs_string())
+        return failed_fpaths
+
+
+def _check_hsm_storage_write(log, host, probe_dict):
     """
-    Check the HSM storage status of copytools
+    Write the probe files of the host, used by pdsh_call
     """
-    random_fpaths = []
-    for copytool_id, copytool in copytools.iteritems():
-        random_fpath = copytool.hc_hsm_root + "/" + utils.random_word(8)
-        command = "touch %s" % random_fpath
-        retval = copytool.hc_host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on copytool host [%s], "
-                         "ret = [%d], "
-                         "stdout = [%s], stderr = [%s]",
-                         command,
-                         copytool_id,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-        random_fpaths.append(random_fpath)
+    command = "touch " + " ".join(probe_dict[host.sh_hostname])
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+    return 0
 
-    for random_fpath in random_fpaths:
-        for copytool_id, copytool in copytools.iteritems():
-            command = "ls %s" % random_fpath
-            retval = copytool.hc_host.sh_run(log, command)
-            if retval.cr_exit_status:
-                log.cl_error("failed to run command [%s] on copytool "
-                             "host [%s], ret = [%d], "
-                             "stdout = [%s], stderr = [%s]",
-                             command,
-                             copytool_id,
-                             retval.cr_exit_status,
-                             retval.cr_stdout,
-                             retval.cr_stderr)
-                return -1
-        copytool = copytools.values()[0]
-        command = "rm -f %s" % random_fpath
-        retval = copytool.hc_host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on copytool host "
-                         "[%s], ret = [%d], "
-                         "stdout = [%s], stderr = [%s]",
-                         command,
-                         copytool_id,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
+
+def _check_hsm_storage_read(log, host, probe_fpaths):
+    """
+    Check that all probe files are visible on the host, used by pdsh_call
+    """
+    command = "ls " + " ".join(probe_fpaths)
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
     return 0
+
+
+def check_hsm_storage(log, host_roots, ttl=HSM_STORAGE_CHECK_TTL):
+    """
+    Check that the HSM roots are shared by all of the hosts. host_roots is a
+    list of (host, hsm_root). A probe file is written to each HSM root on
+    its host, and all the probe files should be visible on all the hosts.
+    Healthy results are cached for ttl seconds.
+    """
+    # pylint: disable=too-many-locals
+    if len(host_roots) == 0:
+        return 0
+
+    # Keys are hostnames, values are the hosts
+    host_dict = {}
+    # Keys are hostnames, values are the probe files written by the host
+    probe_dict = {}
+    probe_fpaths = []
+    cache_key = []
+    for host, hsm_root in host_roots:
+        hostname = host.sh_hostname
+        cache_key.append((hostname, hsm_root))
+        if hostname not in host_dict:
+            host_dict[hostname] = host
+            probe_dict[hostname] = []
+        probe_fpath = hsm_root + "/" + utils.random_word(8)
+        probe_dict[hostname].append(probe_fpath)
+        probe_fpaths.append(probe_fpath)
+    cache_key = frozenset(cache_key)
+    hosts = host_dict.values()
+
+    now = time.time()
+    HSM_STORAGE_CHECK_LOCK.acquire()
+    check_time = HSM_STORAGE_CHECK_CACHE.get(cache_key)
+    HSM_STORAGE_CHECK_LOCK.release()
+    if check_time is not None and now - check_time < ttl:
+        log.cl_debug("HSM storage of hosts [%s] was healthy [%.1f] seconds "
+                     "ago, skipping check",
+                     pdsh.hostlist_compress(host_dict.keys()),
+                     now - check_time)
+        return 0
+
+    ret = 0
+    result = pdsh.pdsh_call(log, hosts, _check_hsm_storage_write,
+                            args=(probe_dict, ))
+    failed_hostnames = result.pr_failed_hostnames()
+    if len(failed_hostnames) > 0:
+        log.cl_error("failed to write HSM storage on hosts [%s]",
+                     pdsh.hostlist_compress(failed_hostnames))
+        ret = -1
+    else:
+        result = pdsh.pdsh_call(log, hosts, _check_hsm_storage_read,
+                                args=(probe_fpaths, ))
+        failed_hostnames = result.pr_failed_hostnames()
+        if len(failed_hostnames) > 0:
+            log.cl_error("HSM storage is not consistent on hosts [%s]",
+                         pdsh.hostlist_compress(failed_hostnames))
+            ret = -1
+
+    # The storage is shared, so the probe files can be removed by one host
+    cleanup_hosts = []
+    for host in hosts:
+        if host.sh_hostname not in failed_hostnames:
+            cleanup_hosts.append(host)
+    if len(cleanup_hosts) == 0:
+        cleanup_hosts = hosts
+    command = "rm -f " + " ".join(probe_fpaths)
+    host = cleanup_hosts[0]
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        ret = -1
+
+    if ret == 0:
+        HSM_STORAGE_CHECK_LOCK.acquire()
+        HSM_STORAGE_CHECK_CACHE[cache_key] = now
+        HSM_STORAGE_CHECK_LOCK.release()
+    return ret
+
+
+def check_hsm_remover_storage(log, removers, ttl=HSM_STORAGE_CHECK_TTL):
+    """
+    Check the HSM storage status of removers
+    """
+    host_roots = []
+    for remover in removers.values():
+        host_roots.append((remover.hr_host, remover.hr_hsm_root))
+    return check_hsm_storage(log, host_roots, ttl=ttl)
+
+
+def check_hsm_copytool_storage(log, copytools, ttl=HSM_STORAGE_CHECK_TTL):
+    """
+    Check the HSM storage status of copytools
+    """
+    host_roots = []
+    for copytool in copytools.values():
+        host_roots.append((copytool.hc_host, copytool.hc_hsm_root))
+    return check_hsm_storage(log, host_roots, ttl=ttl)
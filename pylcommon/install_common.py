@@ -13,6 +13,8 @@ import os
 from pylcommon import utils
 from pylcommon import ssh_host
 from pylcommon import cstr
+from pylcommon import pdsh
+from pylcommon import broadcast
 
 RPM_PATTERN_RHEL7 = r"^%s-\d.+(\.el7|).*\.(x86_64|noarch)\.rpm$"
 RPM_PATTERN_RHEL6 = r"^%s-\d.+(\.el6|).*\.(x86_64|noarch)\.rpm$"
@@ -252,60 +254,6 @@ class InstallationCluster(object):
         self.ic_rpm_fnames = None
         self.ic_repo_config_fpath = workspace + "/clownfish.repo"
 
-    def _ic_send_iso_files(self, log, host):
-        """
-        send RPMs to a host
-        """
-        # pylint: disable=too-many-return-statements
-        command = ("mkdir -p %s" % (self.ic_workspace))
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
-        ret = host.sh_send_file(log, self.ic_mnt_path, self.ic_workspace)
-        if ret:
-            log.cl_error("failed to send file [%s] on local host to "
-                         "directory [%s] on host [%s]",
-                         self.ic_mnt_path, self.ic_workspace,
-                         host.sh_hostname)
-            return -1
-
-        basename = os.path.basename(self.ic_mnt_path)
-        command = ("cd %s && mv %s %s" %
-                   (self.ic_workspace, basename,
-                    self.ic_iso_basename))
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
-        command = "ls %s" % self.ic_iso_dir
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-        self.ic_rpm_fnames = retval.cr_stdout.split()
-        return 0
-
     def _ic_host_install(self, log, host, pip_libs, dependent_rpms):
         """
         Install Clownfish on a host
@@ -318,12 +266,6 @@ class InstallationCluster(object):
                          hostname)
             return -1
 
-        ret = self._ic_send_iso_files(log, host)
-        if ret:
-            log.cl_error("failed to send ISO files to host [%s]",
-                         hostname)
-            return -1
-
         log.cl_info("installing dependent RPMs %s on host [%s]",
                     dependent_rpms, hostname)
         ret = host.sh_send_file(log, self.ic_repo_config_fpath, self.ic_workspace)
@@ -372,11 +314,20 @@ class InstallationCluster(object):
         packages_dir = self.ic_iso_dir + "/" + cstr.CSTR_PACKAGES
         generate_repo_file(self.ic_repo_config_fpath, packages_dir,
                            "Clownfish")
-        ret = 0
-        for host in self.ic_hosts:
-            ret = self._ic_host_install(log, host, pip_libs, dependent_rpms)
-            if ret:
-                log.cl_error("failed to prepare host [%s] for Clownfish cluster",
-                             host.sh_hostname)
-                return -1
-        return ret
+
+        # The hosts that got the ISO files send them to the others
+        ret = broadcast.broadcast_dir(log, self.ic_workspace, self.ic_hosts,
+                                      self.ic_mnt_path, self.ic_iso_dir)
+        if ret:
+            log.cl_error("failed to send ISO files to hosts")
+            return -1
+        self.ic_rpm_fnames = sorted(os.listdir(self.ic_mnt_path))
+
+        result = pdsh.pdsh_call(log, self.ic_hosts, self._ic_host_install,
+                                args=(pip_libs, dependent_rpms))
+        failed_hostnames = result.pr_failed_hostnames()
+        if len(failed_hostnames) > 0:
+            log.cl_error("failed to prepare hosts %s for Clownfish cluster",
+                         failed_hostnames)
+            return -1
+        return 0
@@ -11,6 +11,7 @@ from pylcommon import utils
 from pylcommon import ssh_host
 from pylcommon import cstr
 from pylcommon import install_common
+from pylcommon import lconfig
 
 
 def _iso_mount_and_install(log, workspace, config, config_fpath, install_funct):
@@ -77,24 +78,32 @@ def _iso_mount_and_install(log, workspace, config, config_fpath, install_funct):
     return ret
 
 
-def mount_iso_and_install(log, workspace, config_fpath, install_funct):
+def mount_iso_and_install(log, workspace, config_fpath, install_funct,
+                          schema=None):
     """
     Start Clownfish holding the configure lock
+    If schema is not None, the config is validated against it
     """
     # pylint: disable=too-many-branches,bare-except,too-many-locals
     # pylint: disable=too-many-statements
-    ret = 0
-    try:
-        config_fd = open(config_fpath)
-        config = yaml.load(config_fd)
-        config_fd.close()
-    except:
-        log.cl_error("not able to load [%s] as yaml file: %s", config_fpath,
-                     traceback.format_exc())
-        ret = -1
+    if schema is not None:
+        config = lconfig.config_load(log, config_fpath, schema)
+        if config is None:
+            log.cl_error("failed to load config [%s]", config_fpath)
+            return -1
+    else:
+        ret = 0
+        try:
+            config_fd = open(config_fpath)
+            config = yaml.load(config_fd)
+            config_fd.close()
+        except:
+            log.cl_error("not able to load [%s] as yaml file: %s", config_fpath,
+                         traceback.format_exc())
+            ret = -1
 
-    if ret:
-        return -1
+        if ret:
+            return -1
 
     try:
         ret = _iso_mount_and_install(log, workspace, config, config_fpath,
@@ -0,0 +1,516 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library for validating and compiling config files
+
+A config is validated against a schema in a single pass, so all of the
+errors are reported together instead of one per run. The compiled config is
+the validated config with the default values filled. It is cached on disk
+keyed by the SHA1 of the file and the schema, so loading an unchanged config
+doesn't need to parse YAML or validate again.
+"""
+import os
+import re
+import hashlib
+import marshal
+import traceback
+import yaml
+
+from pylcommon import utils
+from pylcommon import cstr
+from pylcommon import constants
+from pylcommon import lustre
+
+CONFIG_TYPE_ANY = "any"
+CONFIG_TYPE_BOOLEAN = "boolean"
+# Dictionary with the sub fields
+CONFIG_TYPE_DICT = "dict"
+CONFIG_TYPE_INTEGER = "integer"
+# List of dictionaries with the sub fields
+CONFIG_TYPE_LIST = "list"
+CONFIG_TYPE_STRING = "string"
+# The suffix of the compiled config files in the cache directory
+CONFIG_COMPILED_SUFFIX = ".compiled"
+# Bump this when the format of the compiled files changes
+CONFIG_COMPILED_VERSION = "1"
+
+
+def _config_type_check(value, value_type):
+    """
+    Return True if the value is of the type
+    """
+    # pylint: disable=too-many-return-statements
+    if value_type == CONFIG_TYPE_ANY:
+        return True
+    if value_type == CONFIG_TYPE_BOOLEAN:
+        return isinstance(value, bool)
+    if value_type == CONFIG_TYPE_DICT:
+        return isinstance(value, dict)
+    if value_type == CONFIG_TYPE_INTEGER:
+        return isinstance(value, (int, long)) and not isinstance(value, bool)
+    if value_type == CONFIG_TYPE_LIST:
+        return isinstance(value, list)
+    if value_type == CONFIG_TYPE_STRING:
+        return isinstance(value, basestring)
+    return False
+
+
+class ConfigField(object):
+    """
+    A field in the config
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, key, value_type, required=True, default=None,
+                 fields=None, unique=False, id_namespace=None, reference=None,
+                 check=None):
+        # pylint: disable=too-many-arguments
+        self.cf_key = key
+        self.cf_type = value_type
+        self.cf_required = required
+        # The value if the field is not required and not configured
+        self.cf_default = default
+        # The sub fields of CONFIG_TYPE_DICT or items of CONFIG_TYPE_LIST,
+        # None means the sub fields are not checked
+        self.cf_fields = fields
+        # Whether the value should be unique in the items of the parent list
+        self.cf_unique = unique
+        # If not None, the value should be unique in the whole config, and
+        # could be referenced by the other fields with the same namespace
+        self.cf_id_namespace = id_namespace
+        # If not None, the value should be an ID in the namespace
+        self.cf_reference = reference
+        # For CONFIG_TYPE_DICT and CONFIG_TYPE_LIST, funct(item) is called
+        # for each compiled dictionary, and returns a list of error messages
+        # about the relations between the sub fields
+        self.cf_check = check
+
+    def cf_signature(self):
+        """
+        Return a string that changes when the field changes
+        """
+        check_name = None
+        if self.cf_check is not None:
+            check_name = self.cf_check.__name__
+        sub_signatures = None
+        if self.cf_fields is not None:
+            sub_signatures = [field.cf_signature() for field in self.cf_fields]
+        return repr((self.cf_key, self.cf_type, self.cf_required,
+                     self.cf_default, self.cf_unique, self.cf_id_namespace,
+                     self.cf_reference, check_name, sub_signatures))
+
+
+class ConfigSchema(object):
+    """
+    The schema of a config file
+    """
+    def __init__(self, name, fields, check=None):
+        self.cs_name = name
+        self.cs_fields = fields
+        # The check function of the top level dictionary, see cf_check
+        self.cs_check = check
+        self.cs_signature = None
+
+    def cs_get_signature(self):
+        """
+        Return a string that changes when the schema changes
+        """
+        if self.cs_signature is None:
+            root = ConfigField("", CONFIG_TYPE_DICT, fields=self.cs_fields,
+                               check=self.cs_check)
+            self.cs_signature = (CONFIG_COMPILED_VERSION + self.cs_name +
+                                 root.cf_signature())
+        return self.cs_signature
+
+
+class ConfigCompiler(object):
+    """
+    Validate a config against the schema and collect all of the errors
+    """
+    def __init__(self, schema):
+        self.ccr_schema = schema
+        self.ccr_errors = []
+        # Keys are namespaces, values are dicts with IDs as keys and paths
+        # as values
+        self.ccr_ids = {}
+        # List of (namespace, ID, path) to check after walking the config
+        self.ccr_references = []
+
+    def _ccr_error(self, path, message):
+        """
+        Save an error
+        """
+        if path == "":
+            path = "/"
+        self.ccr_errors.append("[%s]: %s" % (path, message))
+
+    def _ccr_compile_value(self, field, value, path):
+        """
+        Return the compiled value of a field
+        """
+        if not _config_type_check(value, field.cf_type):
+            self._ccr_error(path, "expected [%s], got [%s]" %
+                            (field.cf_type, value))
+            return value
+
+        if field.cf_id_namespace is not None:
+            ids = self.ccr_ids.setdefault(field.cf_id_namespace, {})
+            if value in ids:
+                self._ccr_error(path, "[%s] is already configured in [%s]" %
+                                (value, ids[value]))
+            else:
+                ids[value] = path
+        if field.cf_reference is not None:
+            self.ccr_references.append((field.cf_reference, value, path))
+
+        if field.cf_type == CONFIG_TYPE_DICT:
+            if field.cf_fields is None:
+                return value
+            return self._ccr_compile_dict(field, value, path)
+        if field.cf_type == CONFIG_TYPE_LIST and field.cf_fields is not None:
+            compiled = []
+            # Keys are the unique keys, values are dicts with values as keys
+            # and item paths as values
+            unique_values = {}
+            for index, item in enumerate(value):
+                item_path = "%s[%d]" % (path, index)
+                if not isinstance(item, dict):
+                    self._ccr_error(item_path, "expected [%s], got [%s]" %
+                                    (CONFIG_TYPE_DICT, item))
+                    continue
+                compiled_item = self._ccr_compile_dict(field, item, item_path)
+                compiled.append(compiled_item)
+                for sub_field in field.cf_fields:
+                    if not sub_field.cf_unique:
+                        continue
+                    sub_value = compiled_item.get(sub_field.cf_key)
+                    if sub_value is None:
+                        continue
+                    values = unique_values.setdefault(sub_field.cf_key, {})
+                    if sub_value in values:
+                        self._ccr_error(item_path + "/" + sub_field.cf_key,
+                                        "[%s] is already configured in [%s]" %
+                                        (sub_value, values[sub_value]))
+                    else:
+                        values[sub_value] = item_path
+            return compiled
+        return value
+
+    def _ccr_compile_dict(self, field, config, path):
+        """
+        Return the compiled dictionary with the default values filled
+        """
+        compiled = dict(config)
+        for sub_field in field.cf_fields:
+            key = sub_field.cf_key
+            if path == "":
+                sub_path = key
+            else:
+                sub_path = path + "/" + key
+            value = config.get(key)
+            if value is None:
+                if sub_field.cf_required:
+                    self._ccr_error(sub_path, "not configured")
+                else:
+                    compiled[key] = sub_field.cf_default
+                continue
+            compiled[key] = self._ccr_compile_value(sub_field, value, sub_path)
+        if field.cf_check is not None:
+            for message in field.cf_check(compiled):
+                self._ccr_error(path, message)
+        return compiled
+
+    def ccr_compile(self, config):
+        """
+        Return the compiled config. The errors are saved in ccr_errors.
+        """
+        if not isinstance(config, dict):
+            self._ccr_error("", "expected [%s], got [%s]" %
+                            (CONFIG_TYPE_DICT, config))
+            return None
+        root = ConfigField("", CONFIG_TYPE_DICT,
+                           fields=self.ccr_schema.cs_fields,
+                           check=self.ccr_schema.cs_check)
+        compiled = self._ccr_compile_dict(root, config, "")
+        for namespace, value, path in self.ccr_references:
+            if value not in self.ccr_ids.get(namespace, {}):
+                self._ccr_error(path, "no [%s] with ID [%s] is configured" %
+                                (namespace, value))
+        return compiled
+
+
+def config_compile(log, config, schema, config_fpath):
+    """
+    Validate the config and return the compiled config, None on error.
+    All of the errors are reported.
+    """
+    compiler = ConfigCompiler(schema)
+    compiled = compiler.ccr_compile(config)
+    if len(compiler.ccr_errors) > 0:
+        for error in compiler.ccr_errors:
+            log.cl_error("invalid config %s", error)
+        log.cl_error("[%d] errors in the [%s] config, please correct file "
+                     "[%s]", len(compiler.ccr_errors), schema.cs_name,
+                     config_fpath)
+        return None
+    return compiled
+
+
+def _config_compiled_fpath(cache_dir, config_fpath, key):
+    """
+    Return the path of compiled file
+    """
+    return (cache_dir + "/" + os.path.basename(config_fpath) + "." + key +
+            CONFIG_COMPILED_SUFFIX)
+
+
+def config_load(log, config_fpath, schema, cache_dir=None):
+    """
+    Load, validate and compile the config file, return None on error.
+    If cache_dir is not None, the compiled config is cached in it.
+    """
+    # pylint: disable=bare-except,too-many-return-statements
+    try:
+        with open(config_fpath, "rb") as config_file:
+            content = config_file.read()
+    except:
+        log.cl_error("failed to read file [%s]: %s", config_fpath,
+                     traceback.format_exc())
+        return None
+
+    compiled_fpath = None
+    if cache_dir is not None:
+        sha1 = hashlib.sha1(schema.cs_get_signature())
+        sha1.update(content)
+        compiled_fpath = _config_compiled_fpath(cache_dir, config_fpath,
+                                                sha1.hexdigest())
+        if os.path.isfile(compiled_fpath):
+            try:
+                with open(compiled_fpath, "rb") as compiled_file:
+                    compiled = marshal.load(compiled_file)
+                log.cl_debug("loaded compiled config [%s] of file [%s]",
+                             compiled_fpath, config_fpath)
+                return compiled
+            except:
+                log.cl_debug("failed to load compiled config [%s], "
+                             "compiling again: %s", compiled_fpath,
+                             traceback.format_exc())
+
+    try:
+        config = yaml.load(content)
+    except:
+        log.cl_error("not able to load [%s] as yaml file: %s", config_fpath,
+                     traceback.format_exc())
+        return None
+
+    compiled = config_compile(log, config, schema, config_fpath)
+    if compiled is None or compiled_fpath is None:
+        return compiled
+
+    # The cache is only an optimization, ignore the failures
+    if utils.mkdir(cache_dir):
+        log.cl_debug("failed to create directory [%s], not caching the "
+                     "compiled config", cache_dir)
+        return compiled
+    tmp_fpath = compiled_fpath + ".tmp"
+    try:
+        with open(tmp_fpath, "wb") as compiled_file:
+            marshal.dump(compiled, compiled_file)
+        os.rename(tmp_fpath, compiled_fpath)
+    except:
+        log.cl_debug("failed to save compiled config [%s]: %s",
+                     compiled_fpath, traceback.format_exc())
+        return compiled
+
+    # Remove the stale compiled files of the same config
+    prefix = os.path.basename(config_fpath) + "."
+    for fname in os.listdir(cache_dir):
+        fpath = cache_dir + "/" + fname
+        if (fname.startswith(prefix) and
+                fname.endswith(CONFIG_COMPILED_SUFFIX) and
+                fpath != compiled_fpath):
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+    return compiled
+
+
+def _config_check_service(service_config):
+    """
+    Check the instances of a MGS/MDT/OST
+    """
+    errors = []
+    index = service_config.get(cstr.CSTR_INDEX)
+    if index is not None and isinstance(index, int) and index < 0:
+        errors.append("negative [%s] [%s]" % (cstr.CSTR_INDEX, index))
+    backfstype = service_config[cstr.CSTR_BACKFSTYPE]
+    if backfstype not in [lustre.BACKFSTYPE_LDISKFS, lustre.BACKFSTYPE_ZFS]:
+        errors.append("unsupported [%s] [%s]" %
+                      (cstr.CSTR_BACKFSTYPE, backfstype))
+        return errors
+    instances = service_config.get(cstr.CSTR_INSTANCES)
+    if not isinstance(instances, list):
+        return errors
+    for index, instance_config in enumerate(instances):
+        device = instance_config.get(cstr.CSTR_DEVICE)
+        if not isinstance(device, basestring):
+            continue
+        if backfstype == lustre.BACKFSTYPE_ZFS:
+            if device.startswith("/"):
+                errors.append("device [%s] of instance [%d] should not be "
+                              "absolute path with [%s] type" %
+                              (device, index, backfstype))
+            if instance_config.get(cstr.CSTR_ZPOOL_CREATE) is None:
+                errors.append("no [%s] is configured for instance [%d] with "
+                              "[%s] type" %
+                              (cstr.CSTR_ZPOOL_CREATE, index, backfstype))
+        elif not device.startswith("/"):
+            errors.append("device [%s] of instance [%d] should be absolute "
+                          "path with [%s] type" % (device, index, backfstype))
+    return errors
+
+
+def _config_check_lustre(lustre_config):
+    """
+    Check the MGS of a file system
+    """
+    mgs_number = 0
+    if lustre_config.get(cstr.CSTR_MGS_ID) is not None:
+        mgs_number += 1
+    mdt_configs = lustre_config.get(cstr.CSTR_MDTS)
+    if isinstance(mdt_configs, list):
+        for mdt_config in mdt_configs:
+            if mdt_config.get(cstr.CSTR_IS_MGS):
+                mgs_number += 1
+    if mgs_number > 1:
+        return ["multiple MGS are configured"]
+    return []
+
+
+CONFIG_IP_PATTERN = (r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}"
+                     r"(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$")
+CONFIG_IP_REGULAR = re.compile(CONFIG_IP_PATTERN)
+
+
+def _config_check_install(install_config):
+    """
+    Check the IP addresses of the installation config
+    """
+    errors = []
+    for key in [cstr.CSTR_VIRTUAL_IP, cstr.CSTR_BINDNETADDR]:
+        value = install_config.get(key)
+        if (isinstance(value, basestring) and
+                CONFIG_IP_REGULAR.match(value) is None):
+            errors.append("wrong format of [%s] [%s]" % (key, value))
+    return errors
+
+
+def _config_instance_fields():
+    """
+    Return the fields of an instance of MGS/MDT/OST
+    """
+    return [ConfigField(cstr.CSTR_HOST_ID, CONFIG_TYPE_STRING,
+                        reference=cstr.CSTR_SSH_HOSTS),
+            ConfigField(cstr.CSTR_DEVICE, CONFIG_TYPE_STRING),
+            ConfigField(cstr.CSTR_NID, CONFIG_TYPE_STRING),
+            ConfigField(cstr.CSTR_ZPOOL_CREATE, CONFIG_TYPE_STRING,
+                        required=False)]
+
+
+def _config_service_fields(is_mdt):
+    """
+    Return the fields of a MDT/OST
+    """
+    fields = [ConfigField(cstr.CSTR_INDEX, CONFIG_TYPE_INTEGER, unique=True),
+              ConfigField(cstr.CSTR_BACKFSTYPE, CONFIG_TYPE_STRING,
+                          required=False, default=lustre.BACKFSTYPE_LDISKFS),
+              ConfigField(cstr.CSTR_INSTANCES, CONFIG_TYPE_LIST,
+                          fields=_config_instance_fields())]
+    if is_mdt:
+        fields.append(ConfigField(cstr.CSTR_IS_MGS, CONFIG_TYPE_BOOLEAN,
+                                  required=False, default=False))
+    return fields
+
+
+# Schema of clownfish.conf
+CLOWNFISH_CONFIG_SCHEMA = ConfigSchema(constants.CLOWNFISH_CONFIG_FNAME, [
+    ConfigField(cstr.CSTR_LAZY_PREPARE, CONFIG_TYPE_BOOLEAN, required=False,
+                default=False),
+    ConfigField(cstr.CSTR_HIGH_AVAILABILITY, CONFIG_TYPE_BOOLEAN,
+                required=False, default=False),
+    ConfigField(cstr.CSTR_CLOWNFISH_PORT, CONFIG_TYPE_INTEGER,
+                required=False,
+                default=constants.CLOWNFISH_DEFAULT_SERVER_PORT),
+    ConfigField(cstr.CSTR_METRICS_PORT, CONFIG_TYPE_INTEGER,
+                required=False,
+                default=constants.CLOWNFISH_DEFAULT_METRICS_PORT),
+    ConfigField(cstr.CSTR_METRICS_ADDRESS, CONFIG_TYPE_STRING,
+                required=False,
+                default=constants.CLOWNFISH_DEFAULT_METRICS_ADDRESS),
+    ConfigField(cstr.CSTR_LUSTRE_DISTRIBUTIONS, CONFIG_TYPE_LIST, fields=[
+        ConfigField(cstr.CSTR_LUSTRE_DISTRIBUTION_ID, CONFIG_TYPE_STRING,
+                    id_namespace=cstr.CSTR_LUSTRE_DISTRIBUTIONS),
+        ConfigField(cstr.CSTR_LUSTRE_RPM_DIR, CONFIG_TYPE_STRING),
+        ConfigField(cstr.CSTR_E2FSPROGS_RPM_DIR, CONFIG_TYPE_STRING)]),
+    ConfigField(cstr.CSTR_SSH_HOSTS, CONFIG_TYPE_LIST, fields=[
+        ConfigField(cstr.CSTR_HOST_ID, CONFIG_TYPE_STRING,
+                    id_namespace=cstr.CSTR_SSH_HOSTS),
+        ConfigField(cstr.CSTR_HOSTNAME, CONFIG_TYPE_STRING),
+        ConfigField(cstr.CSTR_LUSTRE_DISTRIBUTION_ID, CONFIG_TYPE_STRING,
+                    reference=cstr.CSTR_LUSTRE_DISTRIBUTIONS),
+        ConfigField(cstr.CSTR_SSH_IDENTITY_FILE, CONFIG_TYPE_STRING,
+                    required=False)]),
+    ConfigField(cstr.CSTR_STANDBY_HOSTS, CONFIG_TYPE_LIST, required=False,
+                default=[], fields=[
+                    ConfigField(cstr.CSTR_HOSTNAME, CONFIG_TYPE_STRING,
+                                unique=True),
+                    ConfigField(cstr.CSTR_SSH_IDENTITY_FILE,
+                                CONFIG_TYPE_STRING, required=False)]),
+    ConfigField(cstr.CSTR_MGS_LIST, CONFIG_TYPE_LIST, required=False,
+                default=[], check=_config_check_service, fields=[
+                    ConfigField(cstr.CSTR_MGS_ID, CONFIG_TYPE_STRING,
+                                id_namespace=cstr.CSTR_MGS_LIST),
+                    ConfigField(cstr.CSTR_BACKFSTYPE, CONFIG_TYPE_STRING,
+                                required=False,
+                                default=lustre.BACKFSTYPE_LDISKFS),
+                    ConfigField(cstr.CSTR_INSTANCES, CONFIG_TYPE_LIST,
+                                fields=_config_instance_fields())]),
+    ConfigField(cstr.CSTR_LUSTRES, CONFIG_TYPE_LIST,
+                check=_config_check_lustre, fields=[
+                    ConfigField(cstr.CSTR_FSNAME, CONFIG_TYPE_STRING,
+                                unique=True),
+                    ConfigField(cstr.CSTR_MGS_ID, CONFIG_TYPE_STRING,
+                                required=False,
+                                reference=cstr.CSTR_MGS_LIST),
+                    ConfigField(cstr.CSTR_MDTS, CONFIG_TYPE_LIST,
+                                check=_config_check_service,
+                                fields=_config_service_fields(True)),
+                    ConfigField(cstr.CSTR_OSTS, CONFIG_TYPE_LIST,
+                                check=_config_check_service,
+                                fields=_config_service_fields(False)),
+                    ConfigField(cstr.CSTR_CLIENTS, CONFIG_TYPE_LIST, fields=[
+                        ConfigField(cstr.CSTR_HOST_ID, CONFIG_TYPE_STRING,
+                                    reference=cstr.CSTR_SSH_HOSTS),
+                        ConfigField(cstr.CSTR_MNT, CONFIG_TYPE_STRING)]),
+                    # Checked by parse_qos_config()
+                    ConfigField(cstr.CSTR_QOS, CONFIG_TYPE_DICT,
+                                required=False)])])
+
+# Schema of clownfish_install.conf
+CLOWNFISH_INSTALL_CONFIG_SCHEMA = ConfigSchema(
+    constants.CLOWNFISH_INSTALL_CONFIG_FNAME, [
+        ConfigField(cstr.CSTR_CONFIG_FPATH, CONFIG_TYPE_STRING),
+        ConfigField(cstr.CSTR_ISO_PATH, CONFIG_TYPE_STRING, required=False),
+        ConfigField(cstr.CSTR_VIRTUAL_IP, CONFIG_TYPE_STRING),
+        ConfigField(cstr.CSTR_BINDNETADDR, CONFIG_TYPE_STRING),
+        ConfigField(cstr.CSTR_SSH_HOSTS, CONFIG_TYPE_LIST, fields=[
+            ConfigField(cstr.CSTR_HOST_ID, CONFIG_TYPE_STRING,
+                        id_namespace=cstr.CSTR_SSH_HOSTS),
+            ConfigField(cstr.CSTR_HOSTNAME, CONFIG_TYPE_STRING),
+            ConfigField(cstr.CSTR_SSH_IDENTITY_FILE, CONFIG_TYPE_STRING,
+                        required=False)]),
+        ConfigField(cstr.CSTR_CLUSTER, CONFIG_TYPE_LIST, fields=[
+            ConfigField(cstr.CSTR_HOST_ID, CONFIG_TYPE_STRING,
+                        reference=cstr.CSTR_SSH_HOSTS)])],
+    check=_config_check_install)
@@ -8,12 +8,17 @@ Library for Lustre file system management
 import os
 import re
 import time
+import pipes
+import traceback
+import threading
+import Queue
 
 # Local libs
 from pylcommon import utils
 from pylcommon import ssh_host
 from pylcommon import cstr
 from pylcommon import rwlock
+from pylcommon import metrics
 
 EPEL_RPM_RHEL6_RPM = ("http://download.fedoraproject.org/pub/epel/6/x86_64/"
                       "epel-release-6-8.noarch.rpm")
@@ -23,6 +28,12 @@ LUSTRE_TEST_SCRIPT_DIR = "/usr/lib64/lustre/tests"
 LUSTRE_SERVICE_TYPE_MGS = "MGS"
 LUSTRE_SERVICE_TYPE_MDT = "MDT"
 LUSTRE_SERVICE_TYPE_OST = "OST"
+# The latency of checking whether service instances are mounted on hosts
+LUSTRE_STATUS_CHECK_SECONDS = metrics.metrics_histogram("lustre_status_check_seconds",
+                                                        "Latency of checking whether "
+                                                        "service instances are "
+                                                        "mounted on hosts",
+                                                        label_names=("host",))
 
 JOBID_VAR_PROCNAME_UID = "procname_uid"
 
@@ -109,6 +120,8 @@ class LustreServiceInstance(object):
         self.lsi_nid = nid
         self.lsi_lock = rwlock.RWLock()
         self.lsi_service_instance_name = host.sh_hostname + ":" + device
+        self.lsi_status_check_seconds = \
+            LUSTRE_STATUS_CHECK_SECONDS.mf_child(host.sh_hostname)
         if zpool_create is None and service.ls_backfstype == BACKFSTYPE_ZFS:
             reason = ("no zpool_create configured for ZFS service instance %s" %
                       (self.lsi_service_instance_name))
@@ -578,7 +591,9 @@ class LustreServiceInstance(object):
                           instance_name, service_name, hostname)
             return -1
 
+        time_start = time.time()
         ret = self._lsi_check_mounted(log)
+        self.lsi_status_check_seconds.mc_observe(time.time() - time_start)
         instance_handle.rwh_release()
         host_handle.rwh_release()
         return ret
@@ -640,6 +655,19 @@ class LustreServiceStatus(object):
         """
         return bool(self.lss_mounted_instance is None)
 
+    def lss_rebind(self, service):
+        """
+        Return a copy of this status for another object of the same service,
+        e.g. the one parsed again when reloading the config
+        """
+        status = LustreServiceStatus(service)
+        status.lss_update_time = self.lss_update_time
+        instance = self.lss_mounted_instance
+        if instance is not None:
+            status.lss_mounted_instance = \
+                service.ls_instances.get(instance.lsi_service_instance_name)
+        return status
+
     def lss_fix_problem(self, log):
         """
         Fix the problem of the service
@@ -743,6 +771,19 @@ class LustreService(object):
         else:
             self.ls_service_name = lustre_fs.lf_fsname + "-" + self.ls_index_string
 
+    def ls_signature(self):
+        """
+        Return the signature of the service configuration, two services with
+        the same signature have the same status
+        """
+        instances = []
+        for instance in self.ls_instances.values():
+            instances.append((instance.lsi_service_instance_name,
+                              instance.lsi_mnt, instance.lsi_nid,
+                              instance.lsi_zpool_create))
+        return (self.ls_service_type, self.ls_service_name,
+                self.ls_backfstype, tuple(sorted(instances)))
+
     def ls_service_string(self):
         """
         Return the service string used by mkfs.lustre or tunefs.lustre
@@ -2202,6 +2243,25 @@ def lustre_mdt_id(fsname, mdt_index):
     return "%s:%s" % (fsname, mdt_index)
 
 
+def tbf_enable_command(param_path, tbf_type):
+    """
+    Return the command that changes the NRS policy to TBF
+    param_path example: ost.OSS.ost_io
+    """
+    if tbf_type == TBF_TYPE_GENERAL:
+        return ('lctl set_param %s.nrs_policies="tbf"' % (param_path))
+    return ('lctl set_param %s.nrs_policies="tbf %s"' %
+            (param_path, tbf_type))
+
+
+def fifo_enable_command(param_path):
+    """
+    Return the command that changes the NRS policy to FIFO
+    param_path example: ost.OSS.ost_io
+    """
+    return 'lctl set_param %s.nrs_policies="fifo"' % param_path
+
+
 class LustreServerHost(ssh_host.SSHHost):
     # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
@@ -2269,12 +2329,7 @@ class LustreServerHost(ssh_host.SSHHost):
         Change the NRS policy to TBF
         param_path example: ost.OSS.ost_io
         """
-        if tbf_type == TBF_TYPE_GENERAL:
-            command = ('lctl set_param %s.nrs_policies="tbf"' %
-                       (param_path))
-        else:
-            command = ('lctl set_param %s.nrs_policies="tbf %s"' %
-                       (param_path, tbf_type))
+        command = tbf_enable_command(param_path, tbf_type)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -2340,7 +2395,7 @@ class LustreServerHost(ssh_host.SSHHost):
         Change the policy to FIFO
         param_path example: ost.OSS.ost_io
         """
-        command = ('lctl set_param %s.nrs_policies="fifo"' % param_path)
+        command = fifo_enable_command(param_path)
         retval = self.sh_run(log, command)
         if retval.cr_exit_status != 0:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -3993,7 +4048,13 @@ def lfs_hsm_state(log, fpath, host=None):
                      retval.cr_stderr)
         return None
 
-    output = retval.cr_stdout.strip()
+    return hsm_state_parse(log, fpath, retval.cr_stdout.strip())
+
+
+def hsm_state_parse(log, fpath, output):
+    """
+    Parse the output line of "lfs hsm_state" for a file
+    """
     if not output.startswith(fpath):
         log.cl_error("unexpected output [%s]", output)
         return None
@@ -4138,6 +4199,355 @@ class LustreFID(object):
                  self.lf_fid_string))
 
 
+# The maximum number of files in a single bulk HSM command
+HSM_BULK_CHUNK_SIZE = 1000
+# The maximum length of the file paths in a single bulk HSM command, so
+# that the command line doesn't exceed the argv limit
+HSM_BULK_ARGV_MAX = 65536
+# The number of chunks handled on each host at the same time
+HSM_BULK_PARALLELISM = 4
+HSM_BULK_FID_PATTERN = (r"^\[?(?P<fid>0x[0-9a-fA-F]+:0x[0-9a-fA-F]+:"
+                        r"0x[0-9a-fA-F]+)\]?$")
+HSM_BULK_FID_REGULAR = re.compile(HSM_BULK_FID_PATTERN)
+
+
+class HSMBulkResult(object):
+    """
+    The per-file results of a bulk HSM operation
+    """
+    def __init__(self, fpaths):
+        self.hbr_fpaths = list(fpaths)
+        # Keys are file paths, values are exit status, 0 means success
+        self.hbr_statuses = {}
+        # Keys are file paths, values are the outputs of the operation,
+        # e.g. HSMState or FID string
+        self.hbr_values = {}
+        # Keys are file paths, values are the error messages
+        self.hbr_errors = {}
+        # Protects all the fields
+        self.hbr_lock = threading.Lock()
+
+    def hbr_set(self, fpath, exit_status, value=None, error=None):
+        """
+        Save the result of a file
+        """
+        self.hbr_lock.acquire()
+        self.hbr_statuses[fpath] = exit_status
+        if value is not None:
+            self.hbr_values[fpath] = value
+        if error is not None:
+            self.hbr_errors[fpath] = error
+        self.hbr_lock.release()
+
+    def hbr_value(self, fpath):
+        """
+        Return the output of the operation on a file, None if failed
+        """
+        self.hbr_lock.acquire()
+        value = self.hbr_values.get(fpath)
+        self.hbr_lock.release()
+        return value
+
+    def hbr_failed_fpaths(self):
+        """
+        Return the files that the operation failed on or never run on
+        """
+        failed_fpaths = []
+        self.hbr_lock.acquire()
+        for fpath in self.hbr_fpaths:
+            exit_status = self.hbr_statuses.get(fpath)
+            if exit_status is None or exit_status != 0:
+                failed_fpaths.append(fpath)
+        self.hbr_lock.release()
+        return failed_fpaths
+
+    def hbr_retval(self):
+        """
+        Return 0 if the operation succeeded on all files, otherwise -1
+        """
+        if len(self.hbr_failed_fpaths()) > 0:
+            return -1
+        return 0
+
+
+def hsm_bulk_chunks(fpaths, chunk_size=HSM_BULK_CHUNK_SIZE,
+                    argv_max=HSM_BULK_ARGV_MAX):
+    """
+    Split the files into chunks bounded by number and total length
+    """
+    chunks = []
+    chunk = []
+    chunk_length = 0
+    for fpath in fpaths:
+        if (len(chunk) > 0 and
+                (len(chunk) >= chunk_size or
+                 chunk_length + len(fpath) + 1 > argv_max)):
+            chunks.append(chunk)
+            chunk = []
+            chunk_length = 0
+        chunk.append(fpath)
+        chunk_length += len(fpath) + 1
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def hsm_filelist_read(log, filelist, fsname_rootpath, host=None):
+    """
+    Read the file list with a path or a FID per line. The FIDs are changed
+    to the FID paths under the root of the file system. Return None on
+    failure.
+    """
+    command = "cat %s" % filelist
+    extra_string = ""
+    if host is None:
+        retval = utils.run(command)
+    else:
+        retval = host.sh_run(log, command)
+        extra_string = (" on host [%s]" % host.sh_hostname)
+    if retval.cr_exit_status != 0:
+        log.cl_error("failed to run command [%s]%s, "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command, extra_string,
+                     retval.cr_exit_status, retval.cr_stdout,
+                     retval.cr_stderr)
+        return None
+
+    fpaths = []
+    for line in retval.cr_stdout.splitlines():
+        line = line.strip()
+        if line == "":
+            continue
+        match = HSM_BULK_FID_REGULAR.match(line)
+        if match:
+            fpaths.append(fid_path(match.group("fid"), fsname_rootpath))
+        else:
+            fpaths.append(line)
+    return fpaths
+
+
+def _hsm_bulk_run(log, host, command):
+    """
+    Run the bulk command on the host, None means local host
+    """
+    if host is None:
+        return utils.run(command, silent=True)
+    return host.sh_run(log, command, silent=True)
+
+
+def _hsm_bulk_action(log, host, chunk, result, lfs_command):
+    """
+    Run the HSM action on a chunk of files. If the bulk command fails, run
+    the files one by one in a single shell to find out the failed ones.
+    """
+    command = "%s %s" % (lfs_command, " ".join(chunk))
+    retval = _hsm_bulk_run(log, host, command)
+    if retval.cr_exit_status == 0:
+        for fpath in chunk:
+            result.hbr_set(fpath, 0)
+        return
+
+    quoted_fpaths = [pipes.quote(fpath) for fpath in chunk]
+    command = ("printf '%%s\\n' %s | while IFS= read -r fpath; do "
+               "%s \"$fpath\" > /dev/null 2>&1; echo \"$? $fpath\"; done" %
+               (" ".join(quoted_fpaths), lfs_command))
+    retval = _hsm_bulk_run(log, host, command)
+    for line in retval.cr_stdout.splitlines():
+        fields = line.split(" ", 1)
+        if len(fields) != 2 or not fields[0].isdigit():
+            continue
+        exit_status = int(fields[0])
+        error = None
+        if exit_status:
+            error = ("failed to run command [%s %s], ret = [%d]" %
+                     (lfs_command, fields[1], exit_status))
+        result.hbr_set(fields[1], exit_status, error=error)
+
+
+def _hsm_bulk_state(log, host, chunk, result):
+    """
+    Get the HSM states of a chunk of files
+    """
+    command = "lfs hsm_state %s" % " ".join(chunk)
+    retval = _hsm_bulk_run(log, host, command)
+    # Keys are file paths, values are the output lines. The states never
+    # contain ": ", so the file path is before the last one.
+    lines = {}
+    for line in retval.cr_stdout.splitlines():
+        fields = line.rsplit(": ", 1)
+        if len(fields) == 2:
+            lines[fields[0]] = line
+    for fpath in chunk:
+        state = None
+        if fpath in lines:
+            state = hsm_state_parse(log, fpath, lines[fpath].strip())
+        if state is None:
+            result.hbr_set(fpath, -1, error=retval.cr_stderr)
+        else:
+            result.hbr_set(fpath, 0, value=state)
+
+
+def _hsm_bulk_path2fid(log, host, chunk, result):
+    """
+    Get the FIDs of a chunk of files
+    """
+    command = "lfs path2fid %s" % " ".join(chunk)
+    retval = _hsm_bulk_run(log, host, command)
+    # Keys are file paths, values are FIDs
+    fids = {}
+    for line in retval.cr_stdout.splitlines():
+        if len(chunk) == 1:
+            # No file path is printed for a single file
+            fpath = chunk[0]
+            fid_string = line.strip()
+        else:
+            fields = line.rsplit(": ", 1)
+            if len(fields) != 2:
+                continue
+            fpath = fields[0]
+            fid_string = fields[1].strip()
+        match = HSM_BULK_FID_REGULAR.match(fid_string)
+        if match:
+            fids[fpath] = match.group("fid")
+    for fpath in chunk:
+        if fpath in fids:
+            result.hbr_set(fpath, 0, value=fids[fpath])
+        else:
+            result.hbr_set(fpath, -1, error=retval.cr_stderr)
+
+
+def _hsm_bulk_worker(log, host, chunk_queue, result, funct, args):
+    """
+    Thread that handles the chunks in the queue on the host
+    """
+    # pylint: disable=broad-except,too-many-arguments
+    while not log.cl_abort:
+        try:
+            chunk = chunk_queue.get_nowait()
+        except Queue.Empty:
+            break
+
+        try:
+            funct(log, host, chunk, result, *args)
+        except Exception:
+            log.cl_error("exception when running bulk HSM operation: [%s]",
+                         traceback.format_exc())
+
+
+def hsm_bulk_call(log, fpaths, funct, args=(), hosts=None,
+                  chunk_size=HSM_BULK_CHUNK_SIZE,
+                  parallelism=HSM_BULK_PARALLELISM):
+    """
+    Split the files into chunks and call funct(log, host, chunk, result,
+    *args) on the chunks concurrently across the hosts. None hosts means
+    local host. Returns HSMBulkResult.
+    """
+    # pylint: disable=too-many-arguments
+    result = HSMBulkResult(fpaths)
+    chunk_queue = Queue.Queue()
+    for chunk in hsm_bulk_chunks(fpaths, chunk_size=chunk_size):
+        chunk_queue.put(chunk)
+    if hosts is None:
+        hosts = [None]
+
+    thread_number = min(chunk_queue.qsize(), len(hosts) * parallelism)
+    threads = []
+    for thread_index in range(thread_number):
+        host = hosts[thread_index % len(hosts)]
+        thread = utils.thread_start(_hsm_bulk_worker,
+                                    (log, host, chunk_queue, result, funct,
+                                     args),
+                                    pool=utils.THREAD_POOL_IO)
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    failed_fpaths = result.hbr_failed_fpaths()
+    if len(failed_fpaths) > 0:
+        log.cl_debug("bulk HSM operation failed on [%d] of [%d] files",
+                     len(failed_fpaths), len(fpaths))
+    return result
+
+
+def lfs_hsm_archive_bulk(log, fpaths, archive_id, hosts=None,
+                         chunk_size=HSM_BULK_CHUNK_SIZE,
+                         parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM archive multiple files, return HSMBulkResult
+    """
+    # pylint: disable=too-many-arguments
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_action,
+                         args=("lfs hsm_archive --archive %s" % archive_id,),
+                         hosts=hosts, chunk_size=chunk_size,
+                         parallelism=parallelism)
+
+
+def lfs_hsm_restore_bulk(log, fpaths, hosts=None,
+                         chunk_size=HSM_BULK_CHUNK_SIZE,
+                         parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM restore multiple files, return HSMBulkResult
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_action,
+                         args=("lfs hsm_restore",), hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
+def lfs_hsm_release_bulk(log, fpaths, hosts=None,
+                         chunk_size=HSM_BULK_CHUNK_SIZE,
+                         parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM release multiple files, return HSMBulkResult
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_action,
+                         args=("lfs hsm_release",), hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
+def lfs_hsm_remove_bulk(log, fpaths, hosts=None,
+                        chunk_size=HSM_BULK_CHUNK_SIZE,
+                        parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM remove multiple files, return HSMBulkResult
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_action,
+                         args=("lfs hsm_remove",), hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
+def lfs_hsm_cancel_bulk(log, fpaths, hosts=None,
+                        chunk_size=HSM_BULK_CHUNK_SIZE,
+                        parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM cancel multiple files, return HSMBulkResult
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_action,
+                         args=("lfs hsm_cancel",), hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
+def lfs_hsm_state_bulk(log, fpaths, hosts=None,
+                       chunk_size=HSM_BULK_CHUNK_SIZE,
+                       parallelism=HSM_BULK_PARALLELISM):
+    """
+    HSM state of multiple files, return HSMBulkResult with HSMState values
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_state, hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
+def lfs_path2fid_bulk(log, fpaths, hosts=None,
+                      chunk_size=HSM_BULK_CHUNK_SIZE,
+                      parallelism=HSM_BULK_PARALLELISM):
+    """
+    Transfer multiple fpaths to FID strings, return HSMBulkResult with FID
+    values
+    """
+    return hsm_bulk_call(log, fpaths, _hsm_bulk_path2fid, hosts=hosts,
+                         chunk_size=chunk_size, parallelism=parallelism)
+
+
 def host_lustre_prepare(log, workspace, host, lazy_prepare=False):
     """
     wrapper of lsh_lustre_prepare for parrallism
@@ -0,0 +1,532 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library of a simulated Lustre cluster for offline scale testing
+
+The simulated hosts answer the commands that Clownfish runs on Lustre
+servers from an in-process model of the cluster, which includes the mount
+tables, the labels of the shared devices, the NRS policies and TBF rules.
+Latency and failures of the commands can be injected, and hosts can be
+crashed and booted, so that the status checking, HA fixing and QoS of a
+large cluster can be tested and profiled without any real server.
+"""
+import re
+import time
+import random
+import threading
+
+from pylcommon import utils
+from pylcommon import cstr
+from pylcommon import lustre
+
+# The Lustre version that the simulated hosts report
+LUSTRE_SIM_VERSION_STRING = "lctl 2.12.2_ddn1"
+# The exit status of SSH when the host is not reachable
+LUSTRE_SIM_SSH_FAILURE = 255
+LUSTRE_SIM_DISTRIBUTION_ID = "lustre_sim"
+LUSTRE_SIM_DEFAULT_RATE = 10000
+
+
+class LustreSimFailure(object):
+    """
+    A failure or delay injected into the commands of the simulated hosts
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, pattern, hostname=None, exit_status=1, count=None,
+                 probability=1.0, latency=0):
+        # Commands that match this regular expression will be affected
+        self.lsf_regular = re.compile(pattern)
+        # None means all hosts
+        self.lsf_hostname = hostname
+        # None means the command won't fail, only the latency is added
+        self.lsf_exit_status = exit_status
+        # How many more times the failure happens, None means forever
+        self.lsf_count = count
+        self.lsf_probability = probability
+        # Extra seconds that the command costs
+        self.lsf_latency = latency
+
+    def lsf_match(self, hostname, command):
+        """
+        Return True if the failure happens on the command, the lock of the
+        cluster should be held
+        """
+        if self.lsf_count is not None and self.lsf_count <= 0:
+            return False
+        if self.lsf_hostname is not None and self.lsf_hostname != hostname:
+            return False
+        if not self.lsf_regular.search(command):
+            return False
+        if (self.lsf_probability < 1.0 and
+                random.random() >= self.lsf_probability):
+            return False
+        if self.lsf_count is not None:
+            self.lsf_count -= 1
+        return True
+
+
+class LustreSimCluster(object):
+    """
+    The model of a simulated Lustre cluster shared by the simulated hosts
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, latency=0):
+        # Default seconds that each command costs
+        self.lsc_latency = latency
+        # Protects all of the states below
+        self.lsc_lock = threading.Lock()
+        # Keys are devices, values are labels
+        self.lsc_labels = {}
+        # Keys are hostnames, values are dicts with mount points as keys
+        # and devices as values
+        self.lsc_mounts = {}
+        # Keys are devices, values are the hostnames that mount them
+        self.lsc_device_hostnames = {}
+        # Hostnames of the hosts that are down
+        self.lsc_down_hostnames = []
+        # Keys are hostnames, values are dicts with param paths as keys
+        # and NRS policies as values
+        self.lsc_nrs_policies = {}
+        # Keys are hostnames, values are dicts with param paths as keys
+        # and lists of (name, expression, rate) as values
+        self.lsc_tbf_rules = {}
+        # List of LustreSimFailure
+        self.lsc_failures = []
+        # Keys are command names, values are how many times they are run
+        self.lsc_command_counts = {}
+        self.lsc_mount_regular = re.compile(r"^mount -t lustre (?P<device>\S+) "
+                                            r"(?P<mnt>\S+)$")
+        self.lsc_zfs_regular = re.compile(r"^zfs get -H lustre:svname "
+                                          r"(?P<device>\S+) \|")
+        self.lsc_policy_regular = re.compile(r"^lctl set_param "
+                                             r"(?P<param_path>\S+)"
+                                             r"\.nrs_policies="
+                                             r"\"(?P<policy>.+)\"$")
+        self.lsc_rule_regular = re.compile(r"^lctl set_param "
+                                           r"(?P<param_path>\S+)"
+                                           r"\.nrs_tbf_rule="
+                                           r"\"(?P<rule>.+)\"$")
+        self.lsc_get_rule_regular = re.compile(r"^lctl get_param -n "
+                                               r"(?P<param_path>\S+)"
+                                               r"\.nrs_tbf_rule$")
+
+    def lsc_host_create(self, hostname, lustre_rpms=None, identity_file=None,
+                        host_id=None):
+        """
+        Create a simulated host, can be used as the host factory of
+        clownfish.init_instance()
+        """
+        # pylint: disable=unused-argument
+        return LustreSimHost(self, hostname, lustre_rpms=lustre_rpms,
+                             host_id=host_id)
+
+    def lsc_device_add(self, device, label):
+        """
+        Add a shared device with the label
+        """
+        self.lsc_lock.acquire()
+        self.lsc_labels[device] = label
+        self.lsc_lock.release()
+
+    def lsc_mount(self, hostname, device, mnt):
+        """
+        Mount the device on the host, return exit status
+        """
+        self.lsc_lock.acquire()
+        mounts = self.lsc_mounts.setdefault(hostname, {})
+        if device not in self.lsc_labels:
+            ret = 1
+        elif mnt in mounts or device in self.lsc_device_hostnames:
+            ret = 1
+        else:
+            mounts[mnt] = device
+            self.lsc_device_hostnames[device] = hostname
+            ret = 0
+        self.lsc_lock.release()
+        return ret
+
+    def lsc_umount(self, hostname, mnt):
+        """
+        Umount the mount point on the host, return exit status
+        """
+        self.lsc_lock.acquire()
+        mounts = self.lsc_mounts.get(hostname, {})
+        if mnt in mounts:
+            del self.lsc_device_hostnames[mounts[mnt]]
+            del mounts[mnt]
+            ret = 0
+        else:
+            ret = 1
+        self.lsc_lock.release()
+        return ret
+
+    def lsc_host_crash(self, hostname):
+        """
+        Crash the host, all of its devices will be umounted
+        """
+        self.lsc_lock.acquire()
+        if hostname not in self.lsc_down_hostnames:
+            self.lsc_down_hostnames.append(hostname)
+        for device in self.lsc_mounts.get(hostname, {}).values():
+            del self.lsc_device_hostnames[device]
+        self.lsc_mounts[hostname] = {}
+        self.lsc_nrs_policies[hostname] = {}
+        self.lsc_tbf_rules[hostname] = {}
+        self.lsc_lock.release()
+
+    def lsc_host_boot(self, hostname):
+        """
+        Boot the crashed host
+        """
+        self.lsc_lock.acquire()
+        if hostname in self.lsc_down_hostnames:
+            self.lsc_down_hostnames.remove(hostname)
+        self.lsc_lock.release()
+
+    def lsc_host_is_down(self, hostname):
+        """
+        Return True if the host is down
+        """
+        self.lsc_lock.acquire()
+        is_down = hostname in self.lsc_down_hostnames
+        self.lsc_lock.release()
+        return is_down
+
+    def lsc_failure_add(self, pattern, hostname=None, exit_status=1,
+                        count=None, probability=1.0, latency=0):
+        """
+        Inject a failure or delay into the commands that match the pattern
+        """
+        # pylint: disable=too-many-arguments
+        failure = LustreSimFailure(pattern, hostname=hostname,
+                                   exit_status=exit_status, count=count,
+                                   probability=probability, latency=latency)
+        self.lsc_lock.acquire()
+        self.lsc_failures.append(failure)
+        self.lsc_lock.release()
+        return failure
+
+    def lsc_failures_clear(self):
+        """
+        Remove all of the injected failures
+        """
+        self.lsc_lock.acquire()
+        self.lsc_failures = []
+        self.lsc_lock.release()
+
+    def lsc_stats(self):
+        """
+        Return how many times each command has been run
+        """
+        self.lsc_lock.acquire()
+        command_counts = dict(self.lsc_command_counts)
+        self.lsc_lock.release()
+        return command_counts
+
+    def _lsc_tbf_rules_string(self, hostname, param_path):
+        """
+        Return the output of nrs_tbf_rule, the lock should be held
+        """
+        rules = self.lsc_tbf_rules.get(hostname, {}).get(param_path, [])
+        lines = ""
+        for queue in ["regular_requests", "high_priority_requests"]:
+            lines += "%s:\nCPT 0:\n" % queue
+            for name, expression, rate in rules:
+                lines += "%s {%s} %d, ref 0\n" % (name, expression, rate)
+            lines += "default {*} %d, ref 0\n" % LUSTRE_SIM_DEFAULT_RATE
+        return lines
+
+    def _lsc_tbf_rule_set(self, hostname, param_path, rule):
+        """
+        Start/stop/change a TBF rule, return exit status. The lock should be
+        held.
+        """
+        rules = self.lsc_tbf_rules.setdefault(hostname, {})
+        rules = rules.setdefault(param_path, [])
+        fields = rule.split()
+        if len(fields) < 2:
+            return 1
+        operation = fields[0]
+        name = fields[1]
+        rule_index = None
+        for index, old_rule in enumerate(rules):
+            if old_rule[0] == name:
+                rule_index = index
+                break
+
+        if operation == "stop":
+            if rule_index is None:
+                return 1
+            del rules[rule_index]
+            return 0
+
+        rate = None
+        expression_fields = []
+        for field in fields[2:]:
+            if field.startswith("rate="):
+                rate = field[len("rate="):]
+            else:
+                expression_fields.append(field)
+        if operation == "change":
+            # Old versions use "change NAME RATE"
+            if rate is None and len(expression_fields) == 1:
+                rate = expression_fields[0]
+            if rule_index is None or rate is None or not rate.isdigit():
+                return 1
+            old_rule = rules[rule_index]
+            rules[rule_index] = (old_rule[0], old_rule[1], int(rate))
+            return 0
+        if operation == "start":
+            if rule_index is not None or rate is None or not rate.isdigit():
+                return 1
+            expression = " ".join(expression_fields)
+            rules.insert(0, (name, expression, int(rate)))
+            return 0
+        return 1
+
+    def _lsc_run(self, hostname, command):
+        """
+        Run a single command without "&&", return (exit_status, stdout)
+        """
+        # pylint: disable=too-many-return-statements,too-many-branches
+        fields = command.split()
+        if len(fields) == 0:
+            return 0, ""
+        if command == "cat /proc/mounts":
+            lines = ""
+            self.lsc_lock.acquire()
+            mounts = self.lsc_mounts.get(hostname, {})
+            for mnt, device in mounts.iteritems():
+                lines += "%s %s lustre ro 0 0\n" % (device, mnt)
+            self.lsc_lock.release()
+            return 0, lines
+        if len(fields) == 3 and fields[:2] == ["readlink", "-f"]:
+            return 0, fields[2] + "\n"
+        if len(fields) == 2 and fields[0] == "e2label":
+            self.lsc_lock.acquire()
+            label = self.lsc_labels.get(fields[1])
+            self.lsc_lock.release()
+            if label is None:
+                return 1, ""
+            return 0, label + "\n"
+        match = self.lsc_zfs_regular.match(command)
+        if match:
+            self.lsc_lock.acquire()
+            label = self.lsc_labels.get(match.group("device"))
+            self.lsc_lock.release()
+            if label is None:
+                return 1, ""
+            return 0, label + "\n"
+        match = self.lsc_mount_regular.match(command)
+        if match:
+            return self.lsc_mount(hostname, match.group("device"),
+                                  match.group("mnt")), ""
+        if len(fields) == 2 and fields[0] == "umount":
+            return self.lsc_umount(hostname, fields[1]), ""
+        if command == "lctl lustre_build_version":
+            return 0, LUSTRE_SIM_VERSION_STRING + "\n"
+        match = self.lsc_get_rule_regular.match(command)
+        if match:
+            self.lsc_lock.acquire()
+            lines = self._lsc_tbf_rules_string(hostname,
+                                               match.group("param_path"))
+            self.lsc_lock.release()
+            return 0, lines
+        match = self.lsc_policy_regular.match(command)
+        if match:
+            self.lsc_lock.acquire()
+            policies = self.lsc_nrs_policies.setdefault(hostname, {})
+            policies[match.group("param_path")] = match.group("policy")
+            self.lsc_lock.release()
+            return 0, ""
+        match = self.lsc_rule_regular.match(command)
+        if match:
+            self.lsc_lock.acquire()
+            ret = self._lsc_tbf_rule_set(hostname, match.group("param_path"),
+                                         match.group("rule"))
+            self.lsc_lock.release()
+            return ret, ""
+        # Other commands, e.g. "true", "mkdir -p" always succeed
+        return 0, ""
+
+    def lsc_run(self, hostname, command, latency=None):
+        """
+        Run the command on the host, return CommandResult
+        """
+        if latency is None:
+            latency = self.lsc_latency
+
+        self.lsc_lock.acquire()
+        name = command.split(" ", 1)[0]
+        self.lsc_command_counts[name] = self.lsc_command_counts.get(name, 0) + 1
+        is_down = hostname in self.lsc_down_hostnames
+        failure_status = None
+        for failure in self.lsc_failures:
+            if failure.lsf_match(hostname, command):
+                latency += failure.lsf_latency
+                if failure.lsf_exit_status is not None:
+                    failure_status = failure.lsf_exit_status
+        self.lsc_lock.release()
+
+        if latency > 0:
+            time.sleep(latency)
+
+        if is_down:
+            return utils.CommandResult(stderr="ssh: connect to host %s port "
+                                       "22: No route to host\n" % hostname,
+                                       exit_status=LUSTRE_SIM_SSH_FAILURE)
+        if failure_status is not None:
+            return utils.CommandResult(stderr="injected failure of command "
+                                       "[%s]\n" % command,
+                                       exit_status=failure_status)
+
+        stdout = ""
+        for sub_command in command.split(" && "):
+            exit_status, output = self._lsc_run(hostname, sub_command.strip())
+            stdout += output
+            if exit_status:
+                return utils.CommandResult(stdout=stdout,
+                                           stderr="failed to run command "
+                                           "[%s]\n" % sub_command,
+                                           exit_status=exit_status)
+        return utils.CommandResult(stdout=stdout, exit_status=0)
+
+    def _lsc_service_config(self, hostname_list, host_index, device, label):
+        """
+        Add the device and return the config of a service with two instances
+        on neighbouring hosts, together with the hostname of the first
+        instance, which is the one to mount
+        """
+        instance_configs = []
+        for offset in range(2):
+            hostname = hostname_list[(host_index + offset) %
+                                     len(hostname_list)]
+            instance_configs.append({cstr.CSTR_HOST_ID: hostname,
+                                     cstr.CSTR_DEVICE: device,
+                                     cstr.CSTR_NID: hostname + "@tcp"})
+        self.lsc_device_add(device, label)
+        hostname = instance_configs[0][cstr.CSTR_HOST_ID]
+        return instance_configs, hostname
+
+    def lsc_lustre_config(self, fsname, host_number, mdt_number, ost_number,
+                          high_availability=False):
+        """
+        Return the config of a file system on the simulated hosts, which
+        can be used by clownfish.init_instance(). The devices are added and
+        mounted.
+        """
+        # pylint: disable=too-many-arguments,too-many-locals
+        hostname_list = []
+        ssh_host_configs = []
+        for host_index in range(host_number):
+            hostname = "sim_host%d" % host_index
+            hostname_list.append(hostname)
+            ssh_host_configs.append({cstr.CSTR_HOST_ID: hostname,
+                                     cstr.CSTR_HOSTNAME: hostname,
+                                     cstr.CSTR_LUSTRE_DISTRIBUTION_ID:
+                                     LUSTRE_SIM_DISTRIBUTION_ID})
+
+        # Keys are mount points, values are (hostname, device)
+        mounts = {}
+        mgs_id = fsname + "_mgs"
+        device = "/dev/sim_%s_mgs" % fsname
+        instance_configs, hostname = self._lsc_service_config(hostname_list,
+                                                              0, device,
+                                                              "MGS")
+        mounts["/mnt/mgs_%s" % mgs_id] = (hostname, device)
+        mgs_config = {cstr.CSTR_MGS_ID: mgs_id,
+                      cstr.CSTR_INSTANCES: instance_configs}
+
+        host_index = 1
+        mdt_configs = []
+        for mdt_index in range(mdt_number):
+            device = "/dev/sim_%s_mdt%d" % (fsname, mdt_index)
+            label = "%s-MDT%04x" % (fsname, mdt_index)
+            instance_configs, hostname = self._lsc_service_config(hostname_list,
+                                                                  host_index,
+                                                                  device, label)
+            mounts["/mnt/%s_mdt_%s" % (fsname, mdt_index)] = (hostname, device)
+            mdt_configs.append({cstr.CSTR_INDEX: mdt_index,
+                                cstr.CSTR_IS_MGS: False,
+                                cstr.CSTR_INSTANCES: instance_configs})
+            host_index += 1
+
+        ost_configs = []
+        for ost_index in range(ost_number):
+            device = "/dev/sim_%s_ost%d" % (fsname, ost_index)
+            label = "%s-OST%04x" % (fsname, ost_index)
+            instance_configs, hostname = self._lsc_service_config(hostname_list,
+                                                                  host_index,
+                                                                  device, label)
+            mounts["/mnt/%s_ost_%s" % (fsname, ost_index)] = (hostname, device)
+            ost_configs.append({cstr.CSTR_INDEX: ost_index,
+                                cstr.CSTR_INSTANCES: instance_configs})
+            host_index += 1
+
+        for mnt, host_device in mounts.iteritems():
+            hostname, device = host_device
+            ret = self.lsc_mount(hostname, device, mnt)
+            if ret:
+                reason = ("failed to mount device [%s] on host [%s]" %
+                          (device, hostname))
+                raise Exception(reason)
+
+        lustre_config = {cstr.CSTR_FSNAME: fsname,
+                         cstr.CSTR_MGS_ID: mgs_id,
+                         cstr.CSTR_MDTS: mdt_configs,
+                         cstr.CSTR_OSTS: ost_configs,
+                         cstr.CSTR_CLIENTS: []}
+        dist_config = {cstr.CSTR_LUSTRE_DISTRIBUTION_ID:
+                       LUSTRE_SIM_DISTRIBUTION_ID,
+                       cstr.CSTR_LUSTRE_RPM_DIR: "/nonexistent",
+                       cstr.CSTR_E2FSPROGS_RPM_DIR: "/nonexistent"}
+        return {cstr.CSTR_HIGH_AVAILABILITY: high_availability,
+                cstr.CSTR_LAZY_PREPARE: True,
+                cstr.CSTR_LUSTRE_DISTRIBUTIONS: [dist_config],
+                cstr.CSTR_SSH_HOSTS: ssh_host_configs,
+                cstr.CSTR_MGS_LIST: [mgs_config],
+                cstr.CSTR_LUSTRES: [lustre_config]}
+
+
+class LustreSimHost(lustre.LustreServerHost):
+    """
+    A simulated Lustre server host that runs the commands on the model of
+    the cluster instead of on a real host
+    """
+    def __init__(self, cluster, hostname, lustre_rpms=None, host_id=None):
+        super(LustreSimHost, self).__init__(hostname, lustre_rpms=lustre_rpms,
+                                            host_id=host_id)
+        self.lsih_cluster = cluster
+        # Seconds that each command costs, None means the cluster default
+        self.lsih_latency = None
+
+    def sh_run(self, log, command, silent=False, login_name="root",
+               timeout=None, stdout_tee=None, stderr_tee=None, stdin=None,
+               return_stdout=True, return_stderr=True, quit_func=None,
+               flush_tee=False):
+        """
+        Run the command on the simulated cluster
+        """
+        # pylint: disable=too-many-arguments,unused-argument
+        if not silent:
+            log.cl_debug("starting [%s] on simulated host [%s]", command,
+                         self.sh_hostname)
+        retval = self.lsih_cluster.lsc_run(self.sh_hostname, command,
+                                           latency=self.lsih_latency)
+        if not silent:
+            log.cl_debug("ran [%s] on simulated host [%s], ret = [%d], "
+                         "stdout = [%s], stderr = [%s]",
+                         command, self.sh_hostname, retval.cr_exit_status,
+                         retval.cr_stdout, retval.cr_stderr)
+        return retval
+
+    def sh_ping(self, log, silent=False):
+        """
+        Check whether the simulated host is up
+        """
+        if self.lsih_cluster.lsc_host_is_down(self.sh_hostname):
+            if not silent:
+                log.cl_error("simulated host [%s] is down", self.sh_hostname)
+            return -1
+        return 0
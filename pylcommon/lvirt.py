@@ -5,9 +5,12 @@
 Library for installing virtual machines
 """
 # pylint: disable=too-many-lines
+import os
 import sys
+import re
 import traceback
 import random
+import threading
 import yaml
 
 # Local libs
@@ -16,11 +19,25 @@ from pylcommon import ssh_host
 from pylcommon import lustre
 from pylcommon import cstr
 from pylcommon import cmd_general
+from pylcommon import pdsh
 
 LVIRT_CONFIG_FNAME = "lvirt.conf"
 LVIRT_CONFIG = "/etc/" + LVIRT_CONFIG_FNAME
 LVIRT_LOG_DIR = "/var/log/lvirt"
 LVIRT_UDEV_RULES = "/etc/udev/rules.d/80-lvirt-name.rules"
+# The lock file to serialize the updates of known_hosts on the server host
+LVIRT_KNOWN_HOSTS_LOCK = "/root/.ssh/.known_hosts.lock"
+# The default max number of VMs being built on a server host at the same time
+LVIRT_SERVER_CONCURRENCY = 4
+# The sub-directory of image_dir to cache the base images of templates
+LVIRT_BASE_IMAGE_DIR = "lvirt_base"
+# The name of the internal snapshot of overlays that saves the clean state
+LVIRT_CLEAN_SNAPSHOT = "lvirt_clean"
+# Keys are (server hostname, base image dir, template hostname), values are
+# locks that serialize the converting of the base images
+LVIRT_BASE_IMAGE_LOCKS = {}
+# Protects LVIRT_BASE_IMAGE_LOCKS
+LVIRT_BASE_IMAGE_LOCK = threading.Lock()
 
 
 class VirtTemplate(object):
@@ -32,7 +49,8 @@ class VirtTemplate(object):
     def __init__(self, iso, template_hostname, internet, network_configs,
                  image_dir, distro, ram_size, disk_sizes, dns,
                  bus_type=cstr.CSTR_BUS_SCSI,
-                 server_host=None, server_host_id=None, reinstall=None):
+                 server_host=None, server_host_id=None, reinstall=None,
+                 clone_mode=cstr.CSTR_CLONE_MODE_FULL):
         self.vt_server_host = server_host
         self.vt_server_host_id = server_host_id
         self.vt_reinstall = reinstall
@@ -47,6 +65,7 @@ class VirtTemplate(object):
         self.vt_ram_size = ram_size
         self.vt_disk_sizes = disk_sizes
         self.vt_bus_type = bus_type
+        self.vt_clone_mode = clone_mode
 
 
 class SharedDisk(object):
@@ -315,10 +334,351 @@ def vm_delete(log, server_host, hostname):
     return 0
 
 
+def _server_host_run(log, server_host, command):
+    """
+    Run a command on the server host, return 0 on success
+    """
+    retval = server_host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     server_host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+    return 0
+
+
+def _server_host_run_stdout(log, server_host, command):
+    """
+    Run a command on the server host, return the stdout or None on failure
+    """
+    retval = server_host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     server_host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return None
+    return retval.cr_stdout
+
+
+def vm_backing_files(log, server_host):
+    """
+    Return the set of the backing files of the disks of all domains on the
+    server host, return None on failure
+    """
+    stdout = _server_host_run_stdout(log, server_host,
+                                     "virsh list --all --name")
+    if stdout is None:
+        return None
+    disk_fpaths = []
+    for domain in stdout.split():
+        stdout = _server_host_run_stdout(log, server_host,
+                                         "virsh domblklist %s" % domain)
+        if stdout is None:
+            return None
+        # The first two lines are the header and the separator
+        for line in stdout.splitlines()[2:]:
+            fields = line.split()
+            if len(fields) >= 2 and fields[1] != "-":
+                disk_fpaths.append(fields[1])
+
+    backing_fpaths = set()
+    for disk_fpath in disk_fpaths:
+        # The -U option is needed to read the images of running domains,
+        # but old versions of qemu-img don't support it
+        command = ("qemu-img info -U %s 2>/dev/null || qemu-img info %s" %
+                   (disk_fpath, disk_fpath))
+        stdout = _server_host_run_stdout(log, server_host, command)
+        if stdout is None:
+            return None
+        for line in stdout.splitlines():
+            if line.startswith("backing file: "):
+                backing_fpath = line[len("backing file: "):]
+                backing_fpath = backing_fpath.split(" (actual path: ")[0]
+                backing_fpaths.add(os.path.normpath(backing_fpath))
+    return backing_fpaths
+
+
+def vm_base_images_cleanup(log, server_host, base_dir, template_hostname,
+                           disk_index, base_fpath, backing_fpaths):
+    """
+    Remove the base images of the template disk that are superseded by
+    base_fpath and not used by any domain
+    """
+    # pylint: disable=too-many-arguments
+    command = ("ls %s" % base_dir)
+    stdout = _server_host_run_stdout(log, server_host, command)
+    if stdout is None:
+        return -1
+    base_regular = re.compile(r"^%s_%d_\d+\.qcow2$" %
+                              (re.escape(template_hostname), disk_index))
+    for fname in stdout.split():
+        fpath = base_dir + "/" + fname
+        if fpath == base_fpath or not base_regular.match(fname):
+            continue
+        if os.path.normpath(fpath) in backing_fpaths:
+            log.cl_debug("superseded base image [%s] on host [%s] is still "
+                         "used, keeping it", fpath, server_host.sh_hostname)
+            continue
+        log.cl_info("removing superseded base image [%s] on host [%s]",
+                    fpath, server_host.sh_hostname)
+        ret = _server_host_run(log, server_host, "rm -f %s" % fpath)
+        if ret:
+            return -1
+    return 0
+
+
+def vm_base_images_prepare(log, server_host, template_hostname, image_dir,
+                           disk_number):
+    """
+    Return the paths of the read-only qcow2 base images of the template on
+    the server host, convert them from the template disks if not cached yet.
+    Return None on failure.
+
+    The modify time of the template disk is part of the base image name, so
+    a reinstalled template gets new base images while the overlays on top
+    of the old ones keep working. The old base images are removed once no
+    domain uses them.
+    """
+    # pylint: disable=too-many-locals
+    base_dir = image_dir + "/" + LVIRT_BASE_IMAGE_DIR
+    key = (server_host.sh_hostname, base_dir, template_hostname)
+    LVIRT_BASE_IMAGE_LOCK.acquire()
+    if key not in LVIRT_BASE_IMAGE_LOCKS:
+        LVIRT_BASE_IMAGE_LOCKS[key] = threading.Lock()
+    template_lock = LVIRT_BASE_IMAGE_LOCKS[key]
+    LVIRT_BASE_IMAGE_LOCK.release()
+
+    # Clones of the same template on the same server host wait for the
+    # first one to convert the base images
+    template_lock.acquire()
+    base_fpaths = []
+    # The backing files of all domains, got when a new base image is created
+    backing_fpaths = None
+    for disk_index in range(disk_number):
+        template_fpath = ("%s/%s_%d.img" %
+                          (image_dir, template_hostname, disk_index))
+        command = ("stat -c %%Y %s" % template_fpath)
+        retval = server_host.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         server_host.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            template_lock.release()
+            return None
+        mtime = retval.cr_stdout.strip()
+
+        base_fpath = ("%s/%s_%d_%s.qcow2" %
+                      (base_dir, template_hostname, disk_index, mtime))
+        base_fpaths.append(base_fpath)
+        command = ("test -f %s" % base_fpath)
+        retval = server_host.sh_run(log, command)
+        if retval.cr_exit_status == 0:
+            log.cl_debug("using cached base image [%s] on host [%s]",
+                         base_fpath, server_host.sh_hostname)
+            continue
+
+        log.cl_info("converting disk [%s] of template [%s] to base image "
+                    "[%s] on host [%s]", template_fpath, template_hostname,
+                    base_fpath, server_host.sh_hostname)
+        tmp_fpath = base_fpath + ".tmp"
+        command = ("mkdir -p %s && qemu-img convert -O qcow2 %s %s && "
+                   "chmod 444 %s && mv %s %s" %
+                   (base_dir, template_fpath, tmp_fpath, tmp_fpath,
+                    tmp_fpath, base_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            template_lock.release()
+            return None
+
+        if backing_fpaths is None:
+            backing_fpaths = vm_backing_files(log, server_host)
+            if backing_fpaths is None:
+                log.cl_error("failed to get the backing files of domains on "
+                             "host [%s], not removing superseded base images",
+                             server_host.sh_hostname)
+                continue
+        ret = vm_base_images_cleanup(log, server_host, base_dir,
+                                     template_hostname, disk_index,
+                                     base_fpath, backing_fpaths)
+        if ret:
+            log.cl_error("failed to remove superseded base images of disk "
+                         "[%s] on host [%s]", template_fpath,
+                         server_host.sh_hostname)
+    template_lock.release()
+    return base_fpaths
+
+
+def vm_overlay_create(log, server_host, hostname, template_hostname,
+                      image_dir, disk_number):
+    """
+    Define the virtual machine from the template with qcow2 overlays on top
+    of the template base images, so no disk data is copied
+    """
+    # pylint: disable=too-many-arguments
+    base_fpaths = vm_base_images_prepare(log, server_host, template_hostname,
+                                         image_dir, disk_number)
+    if base_fpaths is None:
+        log.cl_error("failed to prepare base images of template [%s] on "
+                     "host [%s]", template_hostname, server_host.sh_hostname)
+        return -1
+
+    file_options = ""
+    for disk_index in range(disk_number):
+        overlay_fpath = ("%s/%s_%d.img" % (image_dir, hostname, disk_index))
+        file_options += (" --file %s" % overlay_fpath)
+        command = ("rm -f %s && qemu-img create -f qcow2 "
+                   "-o backing_file=%s,backing_fmt=qcow2 %s" %
+                   (overlay_fpath, base_fpaths[disk_index], overlay_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            return -1
+
+    command = ("virt-clone --original %s --name %s --preserve-data%s" %
+               (template_hostname, hostname, file_options))
+    ret = _server_host_run(log, server_host, command)
+    if ret:
+        return -1
+
+    # The disks of the template might be raw
+    for disk_index in range(disk_number):
+        overlay_fpath = ("%s/%s_%d.img" % (image_dir, hostname, disk_index))
+        command = ("virt-xml %s --edit path=%s --disk driver_type=qcow2" %
+                   (hostname, overlay_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            return -1
+    return 0
+
+
+def vm_snapshot_create(log, server_host, hostname, image_dir, disk_number):
+    """
+    Save the clean state of the shut off virtual machine as an internal
+    snapshot of its overlays
+    """
+    for disk_index in range(disk_number):
+        overlay_fpath = ("%s/%s_%d.img" % (image_dir, hostname, disk_index))
+        # Replace the snapshot taken by the last installation if any
+        command = ("if qemu-img snapshot -l %s | grep -qw %s; then "
+                   "qemu-img snapshot -d %s %s; fi" %
+                   (overlay_fpath, LVIRT_CLEAN_SNAPSHOT,
+                    LVIRT_CLEAN_SNAPSHOT, overlay_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            return -1
+
+        command = ("qemu-img snapshot -c %s %s" %
+                   (LVIRT_CLEAN_SNAPSHOT, overlay_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            return -1
+    return 0
+
+
+def vm_snapshot_take(log, host, virt_host_dict):
+    """
+    Shut off the prepared virtual machine, save its clean state as a
+    snapshot and start it again, used by pdsh_call
+    """
+    virt_host = virt_host_dict[host.sh_hostname]
+    template = virt_host.vh_template
+    server_host = template.vt_server_host
+    hostname = host.sh_hostname
+
+    # Do not check the return status, because the connection could be stopped
+    command = "init 0"
+    host.sh_run(log, command)
+
+    ret = utils.wait_condition(log, vm_check_shut_off, (server_host, hostname))
+    if ret:
+        log.cl_error("failed when waiting host [%s] on [%s] shut off",
+                     hostname, server_host.sh_hostname)
+        return -1
+
+    ret = vm_snapshot_create(log, server_host, hostname,
+                             template.vt_image_dir,
+                             len(template.vt_disk_sizes))
+    if ret:
+        log.cl_error("failed to create snapshot of host [%s]", hostname)
+        return -1
+
+    command = ("virsh start %s" % hostname)
+    ret = _server_host_run(log, server_host, command)
+    if ret:
+        return -1
+
+    ret = host.sh_wait_up(log)
+    if ret:
+        log.cl_error("failed to wait host [%s] up", hostname)
+        return -1
+    return 0
+
+
+def vm_revert(log, server_host, hostname, host_ip, image_dir, disk_number,
+              distro, internet):
+    """
+    Revert the virtual machine cloned in overlay mode to its clean snapshot
+    and boot it. This is much faster than cloning it again.
+    """
+    # pylint: disable=too-many-arguments,too-many-return-statements
+    log.cl_info("reverting virtual machine [%s] to snapshot [%s]", hostname,
+                LVIRT_CLEAN_SNAPSHOT)
+    state = server_host.sh_virsh_dominfo_state(log, hostname)
+    if state is None:
+        log.cl_error("virtual machine [%s] doesn't exist on host [%s]",
+                     hostname, server_host.sh_hostname)
+        return -1
+
+    if state != "shut off":
+        command = ("virsh destroy %s" % hostname)
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            return -1
+
+    ret = 0
+    for disk_index in range(disk_number):
+        overlay_fpath = ("%s/%s_%d.img" % (image_dir, hostname, disk_index))
+        command = ("qemu-img snapshot -a %s %s" %
+                   (LVIRT_CLEAN_SNAPSHOT, overlay_fpath))
+        ret = _server_host_run(log, server_host, command)
+        if ret:
+            break
+
+    # Start the virtual machine even if the revert failed, so it is
+    # not left shut off
+    command = ("virsh start %s" % hostname)
+    if _server_host_run(log, server_host, command) or ret:
+        return -1
+
+    vm_host = ssh_host.SSHHost(host_ip)
+    ret = vm_host.sh_wait_up(log)
+    if ret:
+        log.cl_error("failed to wait host [%s] up", host_ip)
+        return -1
+
+    return vm_check(log, hostname, host_ip, distro, internet)
+
+
 def vm_clone(log, workspace, server_host, hostname, network_configs, ips,
-             template_hostname, image_dir, distro, internet, disk_number):
+             template_hostname, image_dir, distro, internet, disk_number,
+             clone_mode=cstr.CSTR_CLONE_MODE_FULL):
     """
     Create virtual machine
+
+    In overlay mode, the disks are qcow2 overlays on top of the cached base
+    images of the template. The clean state is saved as a snapshot by
+    vm_snapshot_take() after the virtual machine is prepared.
     """
     # pylint: disable=too-many-arguments,too-many-locals,too-many-return-statements
     # pylint: disable=too-many-branches,too-many-statements
@@ -329,13 +689,13 @@ def vm_clone(log, workspace, server_host, hostname, network_configs, ips,
     if ret:
         return -1
 
-    command = ("ping -c 1 %s" % host_ip)
+    command = ("ping -c 1 -W 1 %s" % host_ip)
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status == 0:
         log.cl_error("IP [%s] already used by a host", host_ip)
         return -1
 
-    command = ("ping -c 1 %s" % hostname)
+    command = ("ping -c 1 -W 1 %s" % hostname)
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status == 0:
         log.cl_error("host [%s] already up", hostname)
@@ -363,13 +723,34 @@ def vm_clone(log, workspace, server_host, hostname, network_configs, ips,
                          retval.cr_stderr)
             return -1
 
-    file_options = ""
-    for disk_index in range(disk_number):
-        file_options += (" --file %s/%s_%d.img" %
-                         (image_dir, hostname, disk_index))
+    if clone_mode == cstr.CSTR_CLONE_MODE_OVERLAY:
+        ret = vm_overlay_create(log, server_host, hostname, template_hostname,
+                                image_dir, disk_number)
+        if ret:
+            log.cl_error("failed to create overlays of host [%s] on "
+                         "template [%s]", hostname, template_hostname)
+            return -1
+    else:
+        file_options = ""
+        for disk_index in range(disk_number):
+            file_options += (" --file %s/%s_%d.img" %
+                             (image_dir, hostname, disk_index))
+
+            command = ("rm -f %s/%s_%d.img" %
+                       (image_dir, hostname, disk_index))
+            retval = server_host.sh_run(log, command)
+            if retval.cr_exit_status:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command,
+                             server_host.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                return -1
 
-        command = ("rm -f %s/%s_%d.img" %
-                   (image_dir, hostname, disk_index))
+        command = ("virt-clone --original %s --name %s%s" %
+                   (template_hostname, hostname, file_options))
         retval = server_host.sh_run(log, command)
         if retval.cr_exit_status:
             log.cl_error("failed to run command [%s] on host [%s], "
@@ -381,8 +762,17 @@ def vm_clone(log, workspace, server_host, hostname, network_configs, ips,
                          retval.cr_stderr)
             return -1
 
-    command = ("virt-clone --original %s --name %s%s" %
-               (template_hostname, hostname, file_options))
+    local_host_dir = workspace + "/" + hostname
+    ret = utils.mkdir(local_host_dir)
+    if ret:
+        log.cl_error("failed to create directory [%s] on local host",
+                     local_host_dir)
+        return -1
+
+    # Multiple VMs could be cloned on the same server host at the same time,
+    # so use a directory of this VM on the server host to save the files
+    host_dir = local_host_dir
+    command = ("mkdir -p %s" % host_dir)
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -394,13 +784,6 @@ def vm_clone(log, workspace, server_host, hostname, network_configs, ips,
                      retval.cr_stderr)
         return -1
 
-    local_host_dir = workspace + "/" + hostname
-    ret = utils.mkdir(local_host_dir)
-    if ret:
-        log.cl_error("failed to create directory [%s] on local host",
-                     local_host_dir)
-        return -1
-
     # net.ifnames=0 biosdevname=0 has been added to grub, so the interface
     # name will always be eth*
     eth_number = 0
@@ -423,12 +806,12 @@ NM_CONTROLLED=no
         with open(ifcfg_fpath, "wt") as fout:
             fout.write(ifcfg)
 
-        host_ifcfg_fpath = workspace + "/" + ifcfg_fname
-        ret = server_host.sh_send_file(log, ifcfg_fpath, workspace)
+        host_ifcfg_fpath = host_dir + "/" + ifcfg_fname
+        ret = server_host.sh_send_file(log, ifcfg_fpath, host_dir)
         if ret:
             log.cl_error("failed to send file [%s] on local host to "
                          "directory [%s] on host [%s]",
-                         ifcfg_fpath, workspace,
+                         ifcfg_fpath, host_dir,
                          server_host.sh_hostname)
             return -1
 
@@ -460,7 +843,7 @@ NM_CONTROLLED=no
             return -1
         eth_number += 1
 
-    host_rules_fpath = workspace + "/70-persistent-net.rules"
+    host_rules_fpath = host_dir + "/70-persistent-net.rules"
     command = ("> %s" % host_rules_fpath)
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status:
@@ -494,12 +877,12 @@ NM_CONTROLLED=no
         with open(network_fpath, "wt") as fout:
             fout.write(network_string)
 
-        host_network_fpath = workspace + "/" + network_fname
-        ret = server_host.sh_send_file(log, network_fpath, workspace)
+        host_network_fpath = host_dir + "/" + network_fname
+        ret = server_host.sh_send_file(log, network_fpath, host_dir)
         if ret:
             log.cl_error("failed to send file [%s] on local host to "
                          "directory [%s] on host [%s]",
-                         network_fpath, workspace,
+                         network_fpath, host_dir,
                          server_host.sh_hostname)
             return -1
 
@@ -516,7 +899,7 @@ NM_CONTROLLED=no
                          retval.cr_stderr)
             return -1
     else:
-        host_hostname_fpath = workspace + "/hostname"
+        host_hostname_fpath = host_dir + "/hostname"
         command = ("echo %s > %s" % (hostname, host_hostname_fpath))
         retval = server_host.sh_run(log, command)
         if retval.cr_exit_status:
@@ -554,8 +937,10 @@ NM_CONTROLLED=no
                      retval.cr_stderr)
         return -1
 
-    # Remove the record in known_hosts, otherwise ssh will fail
-    command = ('sed -i "/%s /d" /root/.ssh/known_hosts' % (host_ip))
+    # Remove the record in known_hosts, otherwise ssh will fail. Lock it
+    # since other VMs might be cloned on the server host at the same time.
+    command = ('flock %s sed -i "/%s /d" /root/.ssh/known_hosts' %
+               (LVIRT_KNOWN_HOSTS_LOCK, host_ip))
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -568,7 +953,8 @@ NM_CONTROLLED=no
         return -1
 
     # Remove the record in known_hosts, otherwise ssh will fail
-    command = ('sed -i "/%s /d" /root/.ssh/known_hosts' % (hostname))
+    command = ('flock %s sed -i "/%s /d" /root/.ssh/known_hosts' %
+               (LVIRT_KNOWN_HOSTS_LOCK, hostname))
     retval = server_host.sh_run(log, command)
     if retval.cr_exit_status:
         log.cl_error("failed to run command [%s] on host [%s], "
@@ -651,7 +1037,8 @@ def vm_check(log, hostname, host_ip, distro, internet):
 
 
 def vm_start(log, workspace, server_host, hostname, network_configs, ips,
-             template_hostname, image_dir, distro, internet, disk_number):
+             template_hostname, image_dir, distro, internet, disk_number,
+             clone_mode=cstr.CSTR_CLONE_MODE_FULL):
     """
     Start virtual machine, if vm is bad, clone it
     """
@@ -682,8 +1069,15 @@ def vm_start(log, workspace, server_host, hostname, network_configs, ips,
         if ret == 0:
             return 0
 
+    if clone_mode == cstr.CSTR_CLONE_MODE_OVERLAY:
+        ret = vm_revert(log, server_host, hostname, host_ip, image_dir,
+                        disk_number, distro, internet)
+        if ret == 0:
+            return 0
+
     ret = vm_clone(log, workspace, server_host, hostname, network_configs, ips,
-                   template_hostname, image_dir, distro, internet, disk_number)
+                   template_hostname, image_dir, distro, internet, disk_number,
+                   clone_mode=clone_mode)
     if ret:
         log.cl_error("failed to create virtual machine [%s] based on "
                      "template [%s]", hostname, template_hostname)
@@ -1245,6 +1639,20 @@ def parse_templates_config(log, workspace, config, config_fpath, hosts=None):
                         cstr.CSTR_BUS_TYPE)
             bus_type = cstr.CSTR_BUS_SCSI
 
+        clone_mode = utils.config_value(template_config,
+                                        cstr.CSTR_CLONE_MODE)
+        if clone_mode is None:
+            log.cl_debug("no [%s] is configured, use [%s] as default",
+                         cstr.CSTR_CLONE_MODE, cstr.CSTR_CLONE_MODE_FULL)
+            clone_mode = cstr.CSTR_CLONE_MODE_FULL
+        elif clone_mode not in [cstr.CSTR_CLONE_MODE_FULL,
+                                cstr.CSTR_CLONE_MODE_OVERLAY]:
+            log.cl_error("invalid [%s] [%s], expected [%s] or [%s], please "
+                         "correct file [%s]", cstr.CSTR_CLONE_MODE,
+                         clone_mode, cstr.CSTR_CLONE_MODE_FULL,
+                         cstr.CSTR_CLONE_MODE_OVERLAY, config_fpath)
+            return None
+
         network_configs = utils.config_value(template_config,
                                              cstr.CSTR_NETWORK_CONFIGS)
         if network_configs is None:
@@ -1315,14 +1723,304 @@ def parse_templates_config(log, workspace, config, config_fpath, hosts=None):
                                 bus_type=bus_type,
                                 server_host=server_host,
                                 server_host_id=server_host_id,
-                                reinstall=reinstall)
+                                reinstall=reinstall,
+                                clone_mode=clone_mode)
         templates[template_hostname] = template
     return templates
 
 
+def vm_lustre_umount_services(log, host, client_only):
+    """
+    Umount Lustre services on the VM, used by pdsh_call
+    """
+    return host.lsh_lustre_umount_services(log, client_only=client_only)
+
+
+class VirtHost(object):
+    """
+    Each virtual machine to build has an object of this type
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, host, ips, template, reinstall):
+        self.vh_host = host
+        self.vh_ips = ips
+        self.vh_template = template
+        self.vh_reinstall = reinstall
+
+
+class VirtServer(object):
+    """
+    Each server host that templates and virtual machines are built on has
+    an object of this type
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, server_host):
+        self.vs_server_host = server_host
+        # The templates on this server host
+        self.vs_templates = []
+        # The VirtHost of the virtual machines on this server host
+        self.vs_virt_hosts = []
+        # The shared disks on this server host
+        self.vs_shared_disks = []
+
+
+def vm_build(log, host, workspace, virt_host_dict):
+    """
+    Start or clone the virtual machine, used by pdsh_call
+    """
+    virt_host = virt_host_dict[host.sh_hostname]
+    template = virt_host.vh_template
+    hostname = host.sh_hostname
+    reinstall = virt_host.vh_reinstall
+    state = template.vt_server_host.sh_virsh_dominfo_state(log, hostname)
+    if state is None:
+        reinstall = True
+
+    if not reinstall:
+        ret = vm_start(log, workspace,
+                       template.vt_server_host,
+                       hostname,
+                       template.vt_network_configs,
+                       virt_host.vh_ips,
+                       template.vt_template_hostname,
+                       template.vt_image_dir,
+                       template.vt_distro,
+                       template.vt_internet,
+                       len(template.vt_disk_sizes),
+                       clone_mode=template.vt_clone_mode)
+        if ret:
+            log.cl_error("virtual machine [%s] can't be started",
+                         hostname)
+            return -1
+    else:
+        ret = vm_clone(log, workspace,
+                       template.vt_server_host,
+                       hostname,
+                       template.vt_network_configs,
+                       virt_host.vh_ips,
+                       template.vt_template_hostname,
+                       template.vt_image_dir,
+                       template.vt_distro,
+                       template.vt_internet,
+                       len(template.vt_disk_sizes),
+                       clone_mode=template.vt_clone_mode)
+        if ret:
+            log.cl_error("failed to create virtual machine [%s] based on "
+                         "template [%s]", hostname,
+                         template.vt_template_hostname)
+            return -1
+    return 0
+
+
+def server_build(log, server_host, workspace, virt_server_dict,
+                 vm_concurrency):
+    """
+    Install the templates on the server host, and then build the virtual
+    machines based on them in parallel, used by pdsh_call
+    """
+    # pylint: disable=too-many-locals
+    virt_server = virt_server_dict[server_host.sh_hostname]
+    for template in virt_server.vs_templates:
+        template_hostname = template.vt_template_hostname
+        state = server_host.sh_virsh_dominfo_state(log, template_hostname)
+        if template.vt_reinstall or state is None:
+            ret = vm_install(log, workspace, server_host, template.vt_iso,
+                             template_hostname, template.vt_internet,
+                             template.vt_dns, template.vt_network_configs,
+                             template.vt_image_dir, template.vt_distro,
+                             template.vt_ram_size, template.vt_disk_sizes,
+                             template.vt_bus_type)
+            if ret:
+                log.cl_error("failed to create virtual machine template [%s]",
+                             template_hostname)
+                return -1
+        else:
+            log.cl_debug("skipping reinstall of template [%s] according to config",
+                         template_hostname)
+
+        # Shut off the template before cloning, otherwise the clones in
+        # parallel would race to destroy it
+        if not vm_is_shut_off(log, server_host, template_hostname):
+            command = ("virsh destroy %s" % template_hostname)
+            retval = server_host.sh_run(log, command)
+            if retval.cr_exit_status:
+                log.cl_error("failed to run command [%s] on host [%s], "
+                             "ret = [%d], stdout = [%s], stderr = [%s]",
+                             command,
+                             server_host.sh_hostname,
+                             retval.cr_exit_status,
+                             retval.cr_stdout,
+                             retval.cr_stderr)
+                return -1
+
+    virt_host_dict = {}
+    vm_hosts = []
+    for virt_host in virt_server.vs_virt_hosts:
+        virt_host_dict[virt_host.vh_host.sh_hostname] = virt_host
+        vm_hosts.append(virt_host.vh_host)
+    result = pdsh.pdsh_call(log, vm_hosts, vm_build,
+                            args=(workspace, virt_host_dict),
+                            parallelism=vm_concurrency)
+    failed_hostnames = result.pr_failed_hostnames()
+    if len(failed_hostnames) > 0:
+        log.cl_error("failed to build virtual machines [%s] on host [%s]",
+                     pdsh.hostlist_compress(failed_hostnames),
+                     server_host.sh_hostname)
+        return -1
+    return 0
+
+
+def server_share_disks(log, server_host, virt_server_dict):
+    """
+    Share the disks on the server host one by one, used by pdsh_call
+
+    The disks of the same server host might be shared to the same VM,
+    and the sharing checks the device number on the VM, so they can't
+    be shared at the same time.
+    """
+    virt_server = virt_server_dict[server_host.sh_hostname]
+    for shared_disk in virt_server.vs_shared_disks:
+        ret = shared_disk.sd_share(log)
+        if ret:
+            log.cl_error("failed to share disk [%s] on server host with "
+                         "ID [%s]", shared_disk.sd_image_fpath,
+                         shared_disk.sd_server_host_id)
+            return -1
+    return 0
+
+
+def vm_prepare(log, host, hosts_fpath, udev_hostnames):
+    """
+    Prepare the virtual machine after starting it, used by pdsh_call
+    """
+    # pylint: disable=too-many-return-statements
+    commands = []
+    if host.sh_hostname in udev_hostnames:
+        commands.append("> %s" % LVIRT_UDEV_RULES)
+    # Cleanup log dirs, as previous clownfish testing may generate
+    # lots of logs.
+    commands.append("rm -rf /var/log/lvirt*")
+    commands.append("rm -rf /var/log/clownfish*")
+    for command in commands:
+        retval = host.sh_run(log, command)
+        if retval.cr_exit_status:
+            log.cl_error("failed to run command [%s] on host [%s], "
+                         "ret = [%d], stdout = [%s], stderr = [%s]",
+                         command,
+                         host.sh_hostname,
+                         retval.cr_exit_status,
+                         retval.cr_stdout,
+                         retval.cr_stderr)
+            return -1
+
+    log.cl_info("preparing virtual machine [%s] after starting it",
+                host.sh_hostname)
+    ret = host.sh_send_file(log, hosts_fpath, "/etc")
+    if ret:
+        log.cl_error("failed to send hosts file [%s] on local host to "
+                     "directory [/etc] on host [%s]",
+                     hosts_fpath, host.sh_hostname)
+        return -1
+
+    # Clear the known_hosts, otherwise the reinstalled hosts can't be
+    # accessed by other hosts
+    command = "> /root/.ssh/known_hosts"
+    retval = host.sh_run(log, command)
+    if retval.cr_exit_status:
+        log.cl_error("failed to run command [%s] on host [%s], "
+                     "ret = [%d], stdout = [%s], stderr = [%s]",
+                     command,
+                     host.sh_hostname,
+                     retval.cr_exit_status,
+                     retval.cr_stdout,
+                     retval.cr_stderr)
+        return -1
+
+    # Stop Corosync to kill all possible Clownfish server
+    service_names = ["corosync", "pacemaker"]
+    for service_name in service_names:
+        ret = host.sh_service_stop(log, service_name)
+        if ret:
+            log.cl_error("failed to stop service [%s] on host [%s]",
+                         service_name, host.sh_hostname)
+            return -1
+
+        ret = host.sh_service_disable(log, service_name)
+        if ret:
+            log.cl_error("failed to disable service [%s] on host [%s]",
+                         service_name, host.sh_hostname)
+            return -1
+    return 0
+
+
+def vm_reboot(log, host, hosts_servers_mapping):
+    """
+    Reboot the virtual machine, used by pdsh_call
+    """
+    ret = lvirt_vm_reboot(log, host, hosts_servers_mapping[host.sh_hostname])
+    if ret:
+        log.cl_error("failed to reboot host [%s]", host.sh_hostname)
+        return -1
+    return 0
+
+
+def vm_destroy_zfs_pools(log, host, hosts_servers_mapping):
+    """
+    Destroy all ZFS pools on the virtual machine, reboot it if necessary,
+    used by pdsh_call
+    """
+    ret = host.sh_destroy_zfs_pools(log)
+    if ret == 0:
+        return 0
+
+    log.cl_info("failed to destroy ZFS pools on host [%s], "
+                "reboot is needed", host.sh_hostname)
+    ret = vm_reboot(log, host, hosts_servers_mapping)
+    if ret:
+        return -1
+
+    ret = host.sh_destroy_zfs_pools(log)
+    if ret:
+        log.cl_info("failed to destroy ZFS pools on host [%s] even "
+                    "after reboot", host.sh_hostname)
+        return -1
+    return 0
+
+
+def vm_detach_domblks(log, host, hosts_servers_mapping):
+    """
+    Detach all the shared disks of the virtual machine, used by pdsh_call
+    """
+    hostname = host.sh_hostname
+    server_host = hosts_servers_mapping[hostname]
+    ret = server_host.sh_virsh_detach_domblks(log, hostname)
+    if ret:
+        log.cl_error("failed to deatch disks on VM [%s]",
+                     hostname)
+        return -1
+    return 0
+
+
+def lvirt_pdsh_check(log, result, action):
+    """
+    Print the hosts failed to run the action, return -1 if any
+    """
+    failed_hostnames = result.pr_failed_hostnames()
+    if len(failed_hostnames) > 0:
+        log.cl_error("failed to %s on hosts [%s]", action,
+                     pdsh.hostlist_compress(failed_hostnames))
+        return -1
+    return 0
+
+
 def lvirt_vm_install(log, workspace, config, config_fpath):
     """
     Start to install virtual machine
+
+    The templates and virtual machines are built in parallel on different
+    server hosts. On each server host, the templates are installed first,
+    and then at most server_concurrency virtual machines are cloned or
+    started at the same time.
     """
     # pylint: disable=too-many-return-statements,too-many-locals
     # pylint: disable=too-many-branches,too-many-statements
@@ -1358,38 +2056,34 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
         host = ssh_host.SSHHost(hostname, ssh_identity_file)
         hosts[host_id] = host
 
+    server_concurrency = utils.config_value(config,
+                                            cstr.CSTR_SERVER_CONCURRENCY)
+    if server_concurrency is None:
+        server_concurrency = LVIRT_SERVER_CONCURRENCY
+    elif (not isinstance(server_concurrency, int) or
+          isinstance(server_concurrency, bool) or server_concurrency < 1):
+        log.cl_error("invalid [%s] with value [%s], it should be a positive "
+                     "integer, please correct file [%s]",
+                     cstr.CSTR_SERVER_CONCURRENCY, server_concurrency,
+                     config_fpath)
+        return -1
+
     kvm_template_dict = parse_templates_config(log, workspace, config, config_fpath, hosts=hosts)
     if kvm_template_dict is None:
         log.cl_error("failed to parse the config of templates")
         return -1
 
+    # Keys are the hostnames of server hosts, values are VirtServer
+    virt_server_dict = {}
+    # The server hosts in the order of the config
+    server_hosts = []
     for template in kvm_template_dict.values():
-        iso = template.vt_iso
-        template_hostname = template.vt_template_hostname
-        internet = template.vt_internet
-        network_configs = template.vt_network_configs
-        image_dir = template.vt_image_dir
-        distro = template.vt_distro
-        ram_size = template.vt_ram_size
-        disk_sizes = template.vt_disk_sizes
-        bus_type = template.vt_bus_type
         server_host = template.vt_server_host
-        reinstall = template.vt_reinstall
-        dns = template.vt_dns
-
-        state = server_host.sh_virsh_dominfo_state(log, template_hostname)
-        if not reinstall and state is not None:
-            log.cl_debug("skipping reinstall of template [%s] according to config",
-                         template_hostname)
-            continue
-
-        ret = vm_install(log, workspace, server_host, iso, template_hostname,
-                         internet, dns, network_configs, image_dir, distro,
-                         ram_size, disk_sizes, bus_type)
-        if ret:
-            log.cl_error("failed to create virtual machine template [%s]",
-                         template_hostname)
-            return -1
+        server_hostname = server_host.sh_hostname
+        if server_hostname not in virt_server_dict:
+            virt_server_dict[server_hostname] = VirtServer(server_host)
+            server_hosts.append(server_host)
+        virt_server_dict[server_hostname].vs_templates.append(template)
 
     shared_disks = {}
     shared_disk_configs = utils.config_value(config, cstr.CSTR_SHARED_DISKS)
@@ -1414,8 +2108,12 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
         return -1
 
     vm_hosts = []
+    # Keys are the hostnames of VMs, values are VirtHost
+    virt_host_dict = {}
     hosts_servers_mapping = dict()
     hosts_string = ""
+    # The hostnames of the VMs that have shared disks
+    udev_hostnames = []
     for vm_host_config in vm_host_configs:
         hostname = utils.config_value(vm_host_config, cstr.CSTR_HOSTNAME)
         if hostname is None:
@@ -1447,66 +2145,24 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
         template = kvm_template_dict[template_hostname]
 
         reinstall = utils.config_value(vm_host_config, cstr.CSTR_REINSTALL)
-        state = template.vt_server_host.sh_virsh_dominfo_state(log, hostname)
         if reinstall is None:
             reinstall = False
-        if state is None:
-            reinstall = True
-
-        if not reinstall:
-            ret = vm_start(log, workspace,
-                           template.vt_server_host,
-                           hostname,
-                           template.vt_network_configs,
-                           ips,
-                           template.vt_template_hostname,
-                           template.vt_image_dir,
-                           template.vt_distro,
-                           template.vt_internet,
-                           len(template.vt_disk_sizes))
-            if ret:
-                log.cl_error("virtual machine [%s] can't be started",
-                             hostname)
-                return -1
-        else:
-            ret = vm_clone(log, workspace,
-                           template.vt_server_host,
-                           hostname,
-                           template.vt_network_configs,
-                           ips,
-                           template.vt_template_hostname,
-                           template.vt_image_dir,
-                           template.vt_distro,
-                           template.vt_internet,
-                           len(template.vt_disk_sizes))
-            if ret:
-                log.cl_error("failed to create virtual machine [%s] based on "
-                             "template [%s]", hostname,
-                             template.vt_template_hostname)
-                return -1
 
         host_ip = ips[0]
         vm_host = lustre.LustreServerHost(hostname)
         hosts_string += ("%s %s\n" % (host_ip, hostname))
         vm_hosts.append(vm_host)
         hosts_servers_mapping[hostname] = template.vt_server_host
+        virt_host = VirtHost(vm_host, ips, template, reinstall)
+        virt_host_dict[hostname] = virt_host
+        virt_server = virt_server_dict[template.vt_server_host.sh_hostname]
+        virt_server.vs_virt_hosts.append(virt_host)
         shared_disk_ids = utils.config_value(vm_host_config,
                                              cstr.CSTR_SHARED_DISK_IDS)
         if shared_disk_ids is None or shared_disk_configs is None:
             continue
 
-        command = ("> %s" % LVIRT_UDEV_RULES)
-        retval = vm_host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         server_host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
+        udev_hostnames.append(hostname)
         target_index = 0
         for shared_disk_id in shared_disk_ids:
             if shared_disk_id not in shared_disks:
@@ -1531,6 +2187,16 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
             shared_disk.sd_add_target(shared_target)
             target_index += 1
 
+    for shared_disk in shared_disks.values():
+        if len(shared_disk.sd_targets) == 0:
+            continue
+        server_host = shared_disk.sd_server_host
+        server_hostname = server_host.sh_hostname
+        if server_hostname not in virt_server_dict:
+            virt_server_dict[server_hostname] = VirtServer(server_host)
+            server_hosts.append(server_host)
+        virt_server_dict[server_hostname].vs_shared_disks.append(shared_disk)
+
     host_configs = utils.config_value(config, cstr.CSTR_HOSTS)
     if host_configs is not None:
         for host_config in host_configs:
@@ -1553,6 +2219,14 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
                      "ignore it",
                      cstr.CSTR_HOSTS, config_fpath)
 
+    # Build the templates and VMs on all server hosts in parallel
+    result = pdsh.pdsh_call(log, server_hosts, server_build,
+                            args=(workspace, virt_server_dict,
+                                  server_concurrency))
+    ret = lvirt_pdsh_check(log, result, "build virtual machines")
+    if ret:
+        return -1
+
     hosts_fpath = workspace + "/hosts"
     with open(hosts_fpath, "wt") as hosts_file:
         with open("/etc/hosts") as local_hosts:
@@ -1562,136 +2236,70 @@ def lvirt_vm_install(log, workspace, config, config_fpath):
         hosts_file.write(hosts_string)
         hosts_file.flush()
 
-    for host in vm_hosts:
-        # Cleanup log dirs, as previous clownfish testing may generate
-        # lots of logs.
-        command = "rm -rf /var/log/lvirt*"
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
-        command = "rm -rf /var/log/clownfish*"
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
-        log.cl_info("preparing virtual machine [%s] after starting it",
-                    host.sh_hostname)
-        ret = host.sh_send_file(log, hosts_fpath, "/etc")
-        if ret:
-            log.cl_error("failed to send hosts file [%s] on local host to "
-                         "directory [%s] on host [%s]",
-                         hosts_fpath, workspace,
-                         host.sh_hostname)
-            return -1
-
-        # Clear the known_hosts, otherwise the reinstalled hosts can't be
-        # accessed by other hosts
-        command = "> /root/.ssh/known_hosts"
-        retval = host.sh_run(log, command)
-        if retval.cr_exit_status:
-            log.cl_error("failed to run command [%s] on host [%s], "
-                         "ret = [%d], stdout = [%s], stderr = [%s]",
-                         command,
-                         host.sh_hostname,
-                         retval.cr_exit_status,
-                         retval.cr_stdout,
-                         retval.cr_stderr)
-            return -1
-
-    # Stop Corosync to kill all possible Clownfish server
-    for host in vm_hosts:
-        service_names = ["corosync", "pacemaker"]
-        for service_name in service_names:
-            ret = host.sh_service_stop(log, service_name)
-            if ret:
-                log.cl_error("failed to stop service [%s] on host [%s]",
-                             service_name, host.sh_hostname)
-                return -1
-
-            ret = host.sh_service_disable(log, service_name)
-            if ret:
-                log.cl_error("failed to disable service [%s] on host [%s]",
-                             service_name, host.sh_hostname)
-                return -1
+    result = pdsh.pdsh_call(log, vm_hosts, vm_prepare,
+                            args=(hosts_fpath, udev_hostnames))
+    ret = lvirt_pdsh_check(log, result, "prepare virtual machines")
+    if ret:
+        return -1
 
     # umount all Lustre clients first
     reboot_hosts = []
+    result = pdsh.pdsh_call(log, vm_hosts, vm_lustre_umount_services,
+                            args=(True, ))
+    failed_hostnames = result.pr_failed_hostnames()
     for host in vm_hosts:
-        ret = host.lsh_lustre_umount_services(log, client_only=True)
-        if ret:
+        if host.sh_hostname in failed_hostnames:
             log.cl_info("failed to umount Lustre clients on host [%s], "
                         "reboot is needed", host.sh_hostname)
             reboot_hosts.append(host)
 
     # umount all Lustre servers
+    result = pdsh.pdsh_call(log, vm_hosts, vm_lustre_umount_services,
+                            args=(False, ))
+    failed_hostnames = result.pr_failed_hostnames()
     for host in vm_hosts:
-        ret = host.lsh_lustre_umount_services(log)
-        if ret:
+        if host.sh_hostname in failed_hostnames:
             log.cl_info("failed to umount Lustre servers on host [%s], "
                         "reboot is needed", host.sh_hostname)
             if host not in reboot_hosts:
                 reboot_hosts.append(host)
 
-    for host in reboot_hosts:
-        ret = lvirt_vm_reboot(log, host,
-                             hosts_servers_mapping[host.sh_hostname])
-        if ret:
-            log.cl_error("failed to reboot host [%s]",
-                         host.sh_hostname)
-            return -1
+    result = pdsh.pdsh_call(log, reboot_hosts, vm_reboot,
+                            args=(hosts_servers_mapping, ))
+    ret = lvirt_pdsh_check(log, result, "reboot virtual machines")
+    if ret:
+        return -1
 
     # Destroy all ZFS pool
-    for host in vm_hosts:
-        ret = host.sh_destroy_zfs_pools(log)
-        if ret:
-            log.cl_info("failed to destroy ZFS pools on host [%s], "
-                        "reboot is needed", host.sh_hostname)
-            ret = lvirt_vm_reboot(log, host,
-                                 hosts_servers_mapping[host.sh_hostname])
-            if ret:
-                log.cl_error("failed to reboot host [%s]",
-                             host.sh_hostname)
-                return -1
-
-            ret = host.sh_destroy_zfs_pools(log)
-            if ret:
-                log.cl_info("failed to destroy ZFS pools on host [%s] even "
-                            "after reboot", host.sh_hostname)
-                return -1
+    result = pdsh.pdsh_call(log, vm_hosts, vm_destroy_zfs_pools,
+                            args=(hosts_servers_mapping, ))
+    ret = lvirt_pdsh_check(log, result, "destroy ZFS pools")
+    if ret:
+        return -1
 
     # Cleanup all shared disk first
-    for host in vm_hosts:
-        hostname = host.sh_hostname
-        server_host = hosts_servers_mapping[hostname]
-        ret = server_host.sh_virsh_detach_domblks(log, hostname)
-        if ret:
-            log.cl_error("failed to deatch disks on VM [%s]",
-                         hostname)
-            return -1
+    result = pdsh.pdsh_call(log, vm_hosts, vm_detach_domblks,
+                            args=(hosts_servers_mapping, ))
+    ret = lvirt_pdsh_check(log, result, "detach disks")
+    if ret:
+        return -1
 
-    for shared_disk in shared_disks.values():
-        ret = shared_disk.sd_share(log)
-        if ret:
-            log.cl_error("failed to share disk [%s] on server host with "
-                         "ID [%s]", shared_disk.sd_image_fpath,
-                         shared_disk.sd_server_host_id)
-            return -1
-    return 0
+    # Take the snapshots after the virtual machines are prepared, so
+    # reverting to them doesn't lose the preparation
+    overlay_hosts = []
+    for vm_host in vm_hosts:
+        virt_host = virt_host_dict[vm_host.sh_hostname]
+        if virt_host.vh_template.vt_clone_mode == cstr.CSTR_CLONE_MODE_OVERLAY:
+            overlay_hosts.append(vm_host)
+    result = pdsh.pdsh_call(log, overlay_hosts, vm_snapshot_take,
+                            args=(virt_host_dict, ))
+    ret = lvirt_pdsh_check(log, result, "take snapshots")
+    if ret:
+        return -1
+
+    result = pdsh.pdsh_call(log, server_hosts, server_share_disks,
+                            args=(virt_server_dict, ))
+    return lvirt_pdsh_check(log, result, "share disks")
 
 
 def lvirt(log, workspace, config_fpath):
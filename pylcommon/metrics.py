@@ -0,0 +1,337 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library of metrics exported in the text format of Prometheus
+
+Counters and histograms are aggregated in place when they are updated. The
+child of a label value is created when it is updated for the first time,
+and is cached in the metric after that, so updating a metric allocates no
+object. Gauges are computed by callbacks only when the metrics are scraped.
+"""
+import bisect
+import threading
+import BaseHTTPServer
+
+from pylcommon import utils
+
+# The type of metrics that only increase
+METRICS_TYPE_COUNTER = "counter"
+# The type of metrics that are computed when scraped
+METRICS_TYPE_GAUGE = "gauge"
+# The type of metrics that count the observed values in buckets
+METRICS_TYPE_HISTOGRAM = "histogram"
+# The upper bounds of the buckets of durations in seconds
+METRICS_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                            2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# The path of HTTP request to scrape the metrics
+METRICS_HTTP_PATH = "/metrics"
+# The content type of the text format of Prometheus
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Keys are the metric names, values are the instances of MetricFamily
+METRICS_FAMILIES = {}
+# Protects METRICS_FAMILIES
+METRICS_LOCK = threading.Lock()
+
+
+def metrics_escape(value):
+    """
+    Escape a label value
+    """
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"").
+            replace("\n", "\\n"))
+
+
+def metrics_format_float(value):
+    """
+    Format a float value
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class MetricChild(object):
+    """
+    The values of a metric with the same label values
+    """
+    def __init__(self, family, label_values):
+        self.mc_family = family
+        # The rendered labels, e.g. {host="server1"}
+        self.mc_labels = family.mf_labels_format(label_values)
+        # Protects the values
+        self.mc_lock = threading.Lock()
+        # The value of counter, or the sum of histogram
+        self.mc_value = 0
+        # The count of observed values of histogram
+        self.mc_count = 0
+        # The count of observed values in each bucket of histogram, not
+        # accumulated
+        self.mc_bucket_counts = [0] * len(family.mf_buckets)
+
+    def mc_inc(self, amount=1):
+        """
+        Increase the counter
+        """
+        self.mc_lock.acquire()
+        self.mc_value += amount
+        self.mc_lock.release()
+
+    def mc_observe(self, value):
+        """
+        Observe a value of histogram
+        """
+        index = bisect.bisect_left(self.mc_family.mf_buckets, value)
+        self.mc_lock.acquire()
+        if index < len(self.mc_bucket_counts):
+            self.mc_bucket_counts[index] += 1
+        self.mc_value += value
+        self.mc_count += 1
+        self.mc_lock.release()
+
+    def mc_render(self, lines):
+        """
+        Append the lines of this child to the list
+        """
+        family = self.mc_family
+        self.mc_lock.acquire()
+        value = self.mc_value
+        count = self.mc_count
+        bucket_counts = list(self.mc_bucket_counts)
+        self.mc_lock.release()
+
+        name = family.mf_name
+        if family.mf_type == METRICS_TYPE_COUNTER:
+            lines.append("%s%s %s" % (name, self.mc_labels, value))
+            return
+
+        if self.mc_labels == "":
+            prefix = "{"
+        else:
+            prefix = self.mc_labels[:-1] + ","
+        accumulated = 0
+        for index, bucket in enumerate(family.mf_buckets):
+            accumulated += bucket_counts[index]
+            lines.append("%s_bucket%sle=\"%s\"} %s" %
+                         (name, prefix, metrics_format_float(bucket),
+                          accumulated))
+        lines.append("%s_bucket%sle=\"+Inf\"} %s" % (name, prefix, count))
+        lines.append("%s_sum%s %s" % (name, self.mc_labels,
+                                      metrics_format_float(value)))
+        lines.append("%s_count%s %s" % (name, self.mc_labels, count))
+
+
+class MetricFamily(object):
+    """
+    A metric with all of its label values
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, description, metric_type, label_names=(),
+                 buckets=None, collect=None):
+        self.mf_name = name
+        self.mf_description = description
+        self.mf_type = metric_type
+        self.mf_label_names = tuple(label_names)
+        if buckets is None:
+            buckets = ()
+        self.mf_buckets = tuple(sorted(buckets))
+        # Function to collect the values of gauge, returns a list of
+        # (label_values, value)
+        self.mf_collect = collect
+        # Keys are the tuples of label values, values are the instances of
+        # MetricChild
+        self.mf_children = {}
+        # Protects the creation of children
+        self.mf_lock = threading.Lock()
+
+    def mf_labels_format(self, label_values):
+        """
+        Return the rendered labels
+        """
+        assert len(label_values) == len(self.mf_label_names)
+        if len(label_values) == 0:
+            return ""
+        labels = []
+        for index, label_name in enumerate(self.mf_label_names):
+            labels.append("%s=\"%s\"" %
+                          (label_name, metrics_escape(label_values[index])))
+        return "{" + ",".join(labels) + "}"
+
+    def mf_child(self, *label_values):
+        """
+        Return the child of the label values, create it if not exists
+        """
+        child = self.mf_children.get(label_values)
+        if child is not None:
+            return child
+        self.mf_lock.acquire()
+        child = self.mf_children.get(label_values)
+        if child is None:
+            child = MetricChild(self, label_values)
+            self.mf_children[label_values] = child
+        self.mf_lock.release()
+        return child
+
+    def mf_render(self, log, lines):
+        """
+        Append the lines of this metric to the list
+        """
+        # pylint: disable=bare-except
+        lines.append("# HELP %s %s" % (self.mf_name, self.mf_description))
+        lines.append("# TYPE %s %s" % (self.mf_name, self.mf_type))
+        if self.mf_collect is None:
+            self.mf_lock.acquire()
+            children = self.mf_children.values()
+            self.mf_lock.release()
+            for child in children:
+                child.mc_render(lines)
+            return
+
+        try:
+            values = self.mf_collect()
+        except:
+            log.cl_error("failed to collect the values of metric [%s]",
+                         self.mf_name)
+            return
+        for label_values, value in values:
+            lines.append("%s%s %s" % (self.mf_name,
+                                      self.mf_labels_format(label_values),
+                                      value))
+
+
+def _metrics_register(name, description, metric_type, label_names,
+                      buckets=None, collect=None):
+    """
+    Register a metric, return the existing one if registered
+    """
+    # pylint: disable=too-many-arguments
+    METRICS_LOCK.acquire()
+    family = METRICS_FAMILIES.get(name)
+    if family is None:
+        family = MetricFamily(name, description, metric_type,
+                              label_names=label_names, buckets=buckets,
+                              collect=collect)
+        METRICS_FAMILIES[name] = family
+    elif collect is not None:
+        family.mf_collect = collect
+    METRICS_LOCK.release()
+    assert family.mf_type == metric_type
+    assert family.mf_label_names == tuple(label_names)
+    return family
+
+
+def metrics_counter(name, description, label_names=()):
+    """
+    Register a counter
+    """
+    return _metrics_register(name, description, METRICS_TYPE_COUNTER,
+                             label_names)
+
+
+def metrics_histogram(name, description, label_names=(),
+                      buckets=METRICS_DURATION_BUCKETS):
+    """
+    Register a histogram
+    """
+    return _metrics_register(name, description, METRICS_TYPE_HISTOGRAM,
+                             label_names, buckets=buckets)
+
+
+def metrics_gauge(name, description, collect, label_names=()):
+    """
+    Register a gauge, the collect function will replace the old one
+    """
+    return _metrics_register(name, description, METRICS_TYPE_GAUGE,
+                             label_names, collect=collect)
+
+
+def metrics_unregister(name):
+    """
+    Unregister a metric
+    """
+    METRICS_LOCK.acquire()
+    if name in METRICS_FAMILIES:
+        del METRICS_FAMILIES[name]
+    METRICS_LOCK.release()
+
+
+def metrics_render(log):
+    """
+    Return all of the metrics in the text format of Prometheus
+    """
+    METRICS_LOCK.acquire()
+    families = METRICS_FAMILIES.values()
+    METRICS_LOCK.release()
+    lines = []
+    for family in sorted(families, key=lambda family: family.mf_name):
+        family.mf_render(log, lines)
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handler of the HTTP requests to scrape the metrics
+    """
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """
+        Reply the metrics
+        """
+        if self.path.split("?")[0] != METRICS_HTTP_PATH:
+            self.send_error(404)
+            return
+        output = metrics_render(self.server.ms_log)
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        """
+        Log the requests to the debug log rather than stderr
+        """
+        # pylint: disable=redefined-builtin
+        self.server.ms_log.cl_debug("metrics request from [%s]: %s",
+                                    self.client_address[0], format % args)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server to export the metrics
+    """
+    def __init__(self, log, address, port):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port),
+                                           MetricsHTTPRequestHandler)
+        self.ms_log = log
+
+    def ms_start(self):
+        """
+        Start serving in a thread
+        """
+        utils.thread_start(self.serve_forever, ())
+
+    def ms_stop(self):
+        """
+        Stop serving
+        """
+        self.shutdown()
+        self.server_close()
+
+
+def metrics_server_start(log, address, port):
+    """
+    Start the HTTP server to export metrics, return None on failure
+    """
+    # pylint: disable=bare-except
+    try:
+        server = MetricsServer(log, address, port)
+    except:
+        log.cl_error("failed to listen on [%s:%s] to export metrics",
+                     address, port)
+        return None
+    server.ms_start()
+    log.cl_info("exporting metrics on [http://%s:%s%s]", address, port,
+                METRICS_HTTP_PATH)
+    return server
@@ -5,6 +5,7 @@
 Library to execute a function in multiple threads
 """
 import traceback
+import threading
 import time
 
 from pylcommon import utils
@@ -47,6 +48,12 @@ class ParallelThread(object):
                              "/" + self.pt_id)
         self.pt_log = None
         self.pt_status = ParallelThread.STATUS_NOT_STARTED
+        # The return value of the function
+        self.pt_retval = None
+        # The time when the thread started
+        self.pt_start_time = None
+        # Whether the thread has been aborted because of timeout
+        self.pt_timed_out = False
 
     def pt_main(self):
         """
@@ -68,8 +75,10 @@ class ParallelThread(object):
 
         log = self.pt_log
         ret = target_wrap(log, self.pt_workspace, *self.pt_args)
-        log.cl_debug("thread [%s] returned [%d]", self.pt_id, ret)
+        log.cl_debug("thread [%s] returned [%s]", self.pt_id, ret)
         log.cl_result.cr_exit_status = ret
+        self.pt_retval = ret
+        self.pt_parallel_execute.pe_thread_finished(self)
 
     def pt_thread_start(self, parent_log):
         """
@@ -88,6 +97,7 @@ class ParallelThread(object):
         log.cl_result.cr_clear()
         log.cl_abort = False
         self.pt_status = ParallelThread.STATUS_RUNNING
+        self.pt_start_time = time.time()
         self.pt_thread = utils.thread_start(self.pt_main, ())
         return 0
 
@@ -111,15 +121,23 @@ class ParallelThread(object):
         """
         Cleanup the thread
         """
-        self.pt_log.cl_fini()
-        self.pt_log = None
+        if self.pt_log is not None:
+            self.pt_log.cl_fini()
+            self.pt_log = None
+
+
+# The longest time to wait before checking the abort flag of the parent log
+PARALLEL_ABORT_CHECK_INTERVAL = 1
 
 
 class ParallelExecute(object):
     """
     Each execute instance has an object of this type
+
+    Finishing threads notify pe_condition, so a pending thread is started
+    as soon as a running one finishes, without polling.
     """
-    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-instance-attributes
     def __init__(self, log, workspace, name, main, args_array, thread_ids=None,
                  parallelism=-1):
         # pylint: disable=too-many-arguments
@@ -130,6 +148,12 @@ class ParallelExecute(object):
         self.pe_name = name
         self.pe_log = log
         self.pe_threads = {}
+        # Protects pe_finished_threads and pe_aborting
+        self.pe_condition = threading.Condition()
+        # The threads that finished but have not been handled by pe_run
+        self.pe_finished_threads = []
+        # Whether pe_abort() has been called
+        self.pe_aborting = False
         thread_index = 0
         if thread_ids is not None:
             if len(thread_ids) != len(args_array):
@@ -138,25 +162,94 @@ class ParallelExecute(object):
                           (len(thread_ids), len(args_array)))
                 raise Exception(reason)
         for args in args_array:
-            thread_id = thread_ids[thread_index]
+            if thread_ids is None:
+                thread_id = None
+            else:
+                thread_id = thread_ids[thread_index]
             parallel_thread = ParallelThread(self, thread_index, main, args,
                                              thread_id=thread_id)
             self.pe_threads[thread_index] = parallel_thread
             thread_index += 1
 
-    def pe_run(self, sleep_interval=3, timeout=None):
+    def pe_thread_finished(self, parallel_thread):
+        """
+        Called by the thread when it finishes
+        """
+        self.pe_condition.acquire()
+        self.pe_finished_threads.append(parallel_thread)
+        self.pe_condition.notifyAll()
+        self.pe_condition.release()
+
+    def pe_abort(self):
+        """
+        Cancel the execution, could be called from any thread
+        The threads not started will never start, the running threads will
+        be aborted.
+        """
+        self.pe_condition.acquire()
+        self.pe_aborting = True
+        self.pe_condition.notifyAll()
+        self.pe_condition.release()
+
+    def pe_results(self):
+        """
+        Return the return values of the functions, keys are thread IDs.
+        The value is None if the thread has never started or finished.
+        """
+        results = {}
+        for parallel_thread in self.pe_threads.values():
+            results[parallel_thread.pt_id] = parallel_thread.pt_retval
+        return results
+
+    def _pe_wait_time(self, running_threads, time_start, timeout,
+                      task_timeout):
+        """
+        Return how long pe_run should wait for the next event
+        """
+        wait_time = PARALLEL_ABORT_CHECK_INTERVAL
+        now = time.time()
+        if timeout is not None:
+            wait_time = min(wait_time, time_start + timeout - now)
+        if task_timeout is not None:
+            for parallel_thread in running_threads:
+                if parallel_thread.pt_timed_out:
+                    continue
+                wait_time = min(wait_time,
+                                parallel_thread.pt_start_time +
+                                task_timeout - now)
+        return max(wait_time, 0)
+
+    def pe_run(self, timeout=None, task_timeout=None):
         """
         Start to run the threads
-        If timeout is None, threads will be aborted after the timeout
+        If timeout is not None, threads will be aborted after the timeout
+        If task_timeout is not None, each thread will be aborted after
+        running for that long.
         """
-        # pylint: disable=too-many-branches
+        # pylint: disable=too-many-branches,too-many-statements
         time_start = time.time()
         retval = 0
-        not_started_threads = list(self.pe_threads.values())
+        not_started_threads = sorted(self.pe_threads.values(),
+                                     key=lambda thread: thread.pt_index)
         running_threads = []
-        finished_threads = []
         log = self.pe_log
+        self.pe_condition.acquire()
         while True:
+            for parallel_thread in self.pe_finished_threads:
+                running_threads.remove(parallel_thread)
+                log.cl_info("thread [%s] of [%s] finished",
+                            parallel_thread.pt_id, self.pe_name)
+            self.pe_finished_threads = []
+
+            if log.cl_abort:
+                self.pe_aborting = True
+
+            if self.pe_aborting:
+                retval = -1
+                log.cl_info("parallel execute [%s] is cancelled, aborting",
+                            self.pe_name)
+                break
+
             # Start threads
             while (len(not_started_threads) > 0 and
                    (self.pe_parallelism == -1 or
@@ -166,7 +259,7 @@ class ParallelExecute(object):
                             parallel_thread.pt_id, self.pe_name)
                 retval = parallel_thread.pt_thread_start(log)
                 if retval:
-                    log.cl_error("failed to start thread [%d] of [%s]",
+                    log.cl_error("failed to start thread [%s] of [%s]",
                                  parallel_thread.pt_id, self.pe_name)
                     break
                 running_threads.append(parallel_thread)
@@ -175,13 +268,6 @@ class ParallelExecute(object):
             if retval:
                 break
 
-            for parallel_thread in running_threads[:]:
-                if not parallel_thread.pt_thread.is_alive():
-                    running_threads.remove(parallel_thread)
-                    finished_threads.append(parallel_thread)
-                    log.cl_info("thread [%s] of [%s] finished",
-                                parallel_thread.pt_id, self.pe_name)
-
             if len(running_threads) == 0 and len(not_started_threads) == 0:
                 log.cl_info("all threads of [%s] finished",
                             self.pe_name)
@@ -194,15 +280,33 @@ class ParallelExecute(object):
                 log.cl_info("parallel execute [%s] timeout after [%d] "
                             "seconds, aborting", self.pe_name, elapsed)
                 break
-            time.sleep(sleep_interval)
+
+            if task_timeout is not None:
+                for parallel_thread in running_threads:
+                    if parallel_thread.pt_timed_out:
+                        continue
+                    if time_now - parallel_thread.pt_start_time <= task_timeout:
+                        continue
+                    log.cl_error("thread [%s] of [%s] timeout after [%d] "
+                                 "seconds, aborting", parallel_thread.pt_id,
+                                 self.pe_name, task_timeout)
+                    parallel_thread.pt_timed_out = True
+                    parallel_thread.pt_thread_abort()
+
+            if len(self.pe_finished_threads) > 0:
+                continue
+            self.pe_condition.wait(self._pe_wait_time(running_threads,
+                                                      time_start, timeout,
+                                                      task_timeout))
+        self.pe_condition.release()
 
         for parallel_thread in running_threads:
-            log.cl_info("aborting thread [%s] of [%s] finished",
+            log.cl_info("aborting thread [%s] of [%s]",
                         parallel_thread.pt_id, self.pe_name)
             parallel_thread.pt_thread_abort()
 
         for parallel_thread in running_threads:
-            log.cl_info("joining thread [%s] of [%s] finished",
+            log.cl_info("joining thread [%s] of [%s]",
                         parallel_thread.pt_id, self.pe_name)
             parallel_thread.pt_thread_join()
 
@@ -210,7 +314,7 @@ class ParallelExecute(object):
             # Some thread might never starts, so pt_log might be None
             if parallel_thread.pt_log is not None:
                 ret = parallel_thread.pt_log.cl_result.cr_exit_status
-                if ret:
+                if ret or parallel_thread.pt_timed_out:
                     log.cl_error("failed to run thread [%s] of [%s]",
                                  parallel_thread.pt_id, self.pe_name)
                     retval = -1
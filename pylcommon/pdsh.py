@@ -0,0 +1,257 @@
+# Copyright (c) 2019 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Library to run the same command on multiple hosts in parallel, like pdsh
+
+DO NOT import any library that needs extra python package,
+since this might cause failure of commands that uses this
+library to install python packages.
+"""
+import traceback
+import threading
+import Queue
+import re
+
+from pylcommon import utils
+from pylcommon import ssh_host
+
+# The default number of hosts that a command runs on at the same time,
+# the same as the default fanout of pdsh
+PDSH_DEFAULT_PARALLELISM = 32
+
+
+def hostlist_compress(hostnames):
+    """
+    Compress the hostnames into a string like "server[1-3,5],client1"
+    """
+    # pylint: disable=too-many-branches
+    regular = re.compile(r"^(?P<prefix>.*?)(?P<number>\d+)$")
+    # Keys are (prefix, number width), values are lists of numbers
+    groups = {}
+    # The order of the groups/hostnames when printing
+    keys = []
+    for hostname in hostnames:
+        match = regular.match(hostname)
+        if match is None:
+            key = (hostname, None)
+            if key not in groups:
+                groups[key] = []
+                keys.append(key)
+            continue
+        number_string = match.group("number")
+        if number_string.startswith("0") and len(number_string) > 1:
+            width = len(number_string)
+        else:
+            width = 0
+        key = (match.group("prefix"), width)
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        number = int(number_string)
+        if number not in groups[key]:
+            groups[key].append(number)
+
+    host_strings = []
+    for key in keys:
+        prefix, width = key
+        numbers = sorted(groups[key])
+        if width is None:
+            host_strings.append(prefix)
+            continue
+        if len(numbers) == 1:
+            host_strings.append("%s%0*d" % (prefix, width, numbers[0]))
+            continue
+        ranges = []
+        start = numbers[0]
+        end = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number is not None and number == end + 1:
+                end = number
+                continue
+            if start == end:
+                ranges.append("%0*d" % (width, start))
+            else:
+                ranges.append("%0*d-%0*d" % (width, start, width, end))
+            if number is not None:
+                start = number
+                end = number
+        host_strings.append("%s[%s]" % (prefix, ",".join(ranges)))
+    return ",".join(host_strings)
+
+
+class PdshResult(object):
+    """
+    The results of running a command on multiple hosts
+    """
+    def __init__(self, hosts):
+        # The hostnames in the same order of the hosts
+        self.pr_hostnames = []
+        for host in hosts:
+            self.pr_hostnames.append(host.sh_hostname)
+        # Keys are hostnames, values are CommandResult
+        self.pr_results = {}
+        # Protects pr_results
+        self.pr_condition = threading.Condition()
+
+    def pr_result_set(self, hostname, result):
+        """
+        Save the result of a host
+        """
+        self.pr_condition.acquire()
+        self.pr_results[hostname] = result
+        self.pr_condition.release()
+
+    def pr_result(self, hostname):
+        """
+        Return the CommandResult of a host, None if not finished
+        """
+        self.pr_condition.acquire()
+        result = self.pr_results.get(hostname)
+        self.pr_condition.release()
+        return result
+
+    def pr_failed_hostnames(self):
+        """
+        Return the hostnames that failed to run the command
+        """
+        failed_hostnames = []
+        for hostname in self.pr_hostnames:
+            result = self.pr_result(hostname)
+            if result is None or result.cr_exit_status != 0:
+                failed_hostnames.append(hostname)
+        return failed_hostnames
+
+    def pr_retval(self):
+        """
+        Return 0 if the command succeeded on all hosts, otherwise -1
+        """
+        if len(self.pr_failed_hostnames()) > 0:
+            return -1
+        return 0
+
+    def pr_groups(self):
+        """
+        Group the hosts that have identical outputs and exit status like
+        dshbak -c. Return a list of (hostnames, CommandResult).
+        """
+        groups = []
+        # Keys are (exit_status, stdout, stderr), values are indexes in groups
+        group_indexes = {}
+        for hostname in self.pr_hostnames:
+            result = self.pr_result(hostname)
+            if result is None:
+                result = utils.CommandResult(stderr="not finished",
+                                             exit_status=-1)
+            key = (result.cr_exit_status, result.cr_stdout, result.cr_stderr)
+            if key in group_indexes:
+                groups[group_indexes[key]][0].append(hostname)
+            else:
+                group_indexes[key] = len(groups)
+                groups.append(([hostname], result))
+        return groups
+
+    def pr_dshbak(self, log, is_stdout=True):
+        """
+        Print the grouped outputs like dshbak -c
+        """
+        if is_stdout:
+            print_funct = log.cl_stdout
+        else:
+            print_funct = log.cl_info
+        for hostnames, result in self.pr_groups():
+            print_funct("----------------")
+            print_funct("%s", hostlist_compress(hostnames))
+            print_funct("----------------")
+            output = result.cr_stdout.rstrip("\n")
+            if output != "":
+                print_funct("%s", output)
+            output = result.cr_stderr.rstrip("\n")
+            if output != "":
+                print_funct("%s", output)
+            if result.cr_exit_status != 0:
+                print_funct("exit status: %s", result.cr_exit_status)
+
+
+def _pdsh_worker(log, host_queue, pdsh_result, funct, args):
+    """
+    Thread that handles the hosts in the queue one by one
+    """
+    # pylint: disable=broad-except
+    while not log.cl_abort:
+        try:
+            host = host_queue.get_nowait()
+        except Queue.Empty:
+            break
+
+        try:
+            result = funct(log, host, *args)
+        except Exception:
+            log.cl_error("exception when running on host [%s]: [%s]",
+                         host.sh_hostname, traceback.format_exc())
+            result = -1
+        if not isinstance(result, utils.CommandResult):
+            result = utils.CommandResult(exit_status=result)
+        pdsh_result.pr_result_set(host.sh_hostname, result)
+
+
+def pdsh_call(log, hosts, funct, args=(), parallelism=PDSH_DEFAULT_PARALLELISM):
+    """
+    Call funct(log, host, *args) on all of the hosts with bounded parallelism.
+
+    The function should return an integer or a CommandResult. The integer
+    will be saved as the exit status of the host. Returns a PdshResult.
+    """
+    pdsh_result = PdshResult(hosts)
+    host_queue = Queue.Queue()
+    for host in hosts:
+        host_queue.put(host)
+
+    thread_number = len(hosts)
+    if parallelism > 0 and parallelism < thread_number:
+        thread_number = parallelism
+
+    threads = []
+    for _ in range(thread_number):
+        run_thread = utils.thread_start(_pdsh_worker,
+                                        (log, host_queue, pdsh_result,
+                                         funct, args),
+                                        pool=utils.THREAD_POOL_IO)
+        threads.append(run_thread)
+
+    for run_thread in threads:
+        run_thread.join()
+    return pdsh_result
+
+
+def _pdsh_host_run(log, host, command_dict, timeout):
+    """
+    Run the command of the host
+    """
+    command = command_dict[host.sh_hostname]
+    return host.sh_run(log, command, timeout=timeout)
+
+
+def pdsh_run(log, hosts, command, parallelism=PDSH_DEFAULT_PARALLELISM,
+             timeout=ssh_host.LONGEST_SIMPLE_COMMAND_TIME):
+    """
+    Run a command on all of the hosts with bounded parallelism.
+
+    The command could be a string which will be run on all hosts, or a
+    dictionary with hostnames as keys and per-host commands as values.
+    Returns a PdshResult.
+    """
+    # pylint: disable=too-many-arguments
+    if isinstance(command, basestring):
+        command_dict = {}
+        for host in hosts:
+            command_dict[host.sh_hostname] = command
+    else:
+        command_dict = command
+        for host in hosts:
+            if host.sh_hostname not in command_dict:
+                reason = ("no command for host [%s]" % host.sh_hostname)
+                raise Exception(reason)
+    return pdsh_call(log, hosts, _pdsh_host_run,
+                     args=(command_dict, timeout),
+                     parallelism=parallelism)
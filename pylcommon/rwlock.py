@@ -9,6 +9,7 @@ import time
 import os
 
 from pylcommon import clog
+from pylcommon import metrics
 
 #
 # _RWLOCK_SRC_FILE is used when walking the stack to check when we've got the
@@ -20,6 +21,13 @@ else:
     _RWLOCK_SRC_FILE = __file__
 _RWLOCK_SRC_FILE = os.path.normcase(_RWLOCK_SRC_FILE)
 
+# The time waited to acquire the locks
+RWLOCK_WAIT_SECONDS = metrics.metrics_histogram("rwlock_wait_seconds",
+                                                "Time waited to acquire read/write locks",
+                                                label_names=("mode",))
+RWLOCK_READ_WAIT_SECONDS = RWLOCK_WAIT_SECONDS.mf_child("read")
+RWLOCK_WRITE_WAIT_SECONDS = RWLOCK_WAIT_SECONDS.mf_child("write")
+
 
 class RWLockHandle(object):
     """
@@ -141,6 +149,10 @@ class RWLock(object):
         else:
             self.rwl_write_handle = handle
         self.rwl_condition.release()
+        if is_read:
+            RWLOCK_READ_WAIT_SECONDS.mc_observe(time.time() - time_start)
+        else:
+            RWLOCK_WRITE_WAIT_SECONDS.mc_observe(time.time() - time_start)
         return handle
 
     def rwl_reader_acquire(self, log, warning_time=60):
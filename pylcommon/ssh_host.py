@@ -20,6 +20,7 @@ import stat
 # local libs
 from pylcommon import utils
 from pylcommon import watched_io
+from pylcommon import metrics
 
 
 # OS distribution RHEL6/CentOS6
@@ -39,6 +40,16 @@ LONGEST_TIME_YUM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 LONGEST_TIME_RPM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 # The longest time that a issue reboot would stop the SSH server
 LONGEST_TIME_ISSUE_REBOOT = 10
+# The durations of the commands run by SSHHost.sh_run, the count of the
+# histogram is the number of commands
+SSH_COMMAND_SECONDS = metrics.metrics_histogram("ssh_command_seconds",
+                                                "Duration of commands run on hosts",
+                                                label_names=("host",))
+# The number of the commands that exited with non-zero status
+SSH_COMMAND_FAILURES = metrics.metrics_counter("ssh_command_failures_total",
+                                               "Number of commands run on hosts "
+                                               "that exited with non-zero status",
+                                               label_names=("host",))
 
 
 def sh_escape(command):
@@ -149,6 +160,8 @@ class SSHHost(object):
         self.sh_cached_has_commands = {}
         self.sh_host_id = host_id
         self.sh_latest_uptime = 0
+        self.sh_command_seconds = SSH_COMMAND_SECONDS.mf_child(hostname)
+        self.sh_command_failures = SSH_COMMAND_FAILURES.mf_child(hostname)
 
     def sh_is_up(self, log, timeout=60):
         """
@@ -818,6 +831,7 @@ class SSHHost(object):
         if not silent:
             log.cl_debug("starting [%s] on host [%s]", command,
                          self.sh_hostname)
+        time_start = time.time()
         if self.sh_local:
             ret = utils.run(command, timeout=timeout, stdout_tee=stdout_tee,
                             stderr_tee=stderr_tee, stdin=stdin,
@@ -832,6 +846,9 @@ class SSHHost(object):
                           return_stderr=return_stderr, quit_func=quit_func,
                           identity_file=self.sh_identity_file,
                           flush_tee=flush_tee)
+        self.sh_command_seconds.mc_observe(time.time() - time_start)
+        if ret.cr_exit_status:
+            self.sh_command_failures.mc_inc()
         if not silent:
             log.cl_debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
                          "stderr = [%s]",
@@ -25,6 +25,7 @@ import random
 import string
 import stat
 import socket
+import traceback
 
 
 def eprint(*args, **kwargs):
@@ -361,10 +362,296 @@ def run(command, timeout=None, stdout_tee=None, stderr_tee=None, stdin=None,
     return job.cj_run()
 
 
-def thread_start(target, args):
+# Pool for running the console commands
+THREAD_POOL_COMMANDS = "commands"
+# Pool for checking the status of services
+THREAD_POOL_STATUS = "status"
+# Pool for fixing the services
+THREAD_POOL_FIX = "fix"
+# Pool for the QoS threads
+THREAD_POOL_QOS = "qos"
+# Pool for the threads that wait for remote hosts or network
+THREAD_POOL_IO = "io"
+# The default max number of threads in each pool
+THREAD_POOL_DEFAULT_SIZES = {
+    THREAD_POOL_COMMANDS: 32,
+    THREAD_POOL_STATUS: 16,
+    THREAD_POOL_FIX: 5,
+    THREAD_POOL_QOS: 4,
+    THREAD_POOL_IO: 64,
+}
+# The max number of threads of a pool that is not in the default sizes
+THREAD_POOL_DEFAULT_SIZE = 8
+
+
+class ThreadPoolTask(object):
+    """
+    A function submitted to a thread pool. It has the is_alive() and join()
+    methods so it could be used as a thread object.
+    """
+    def __init__(self, target, args):
+        self.tpt_target = target
+        self.tpt_args = args
+        # The time when the task is submitted
+        self.tpt_submit_time = time.time()
+        # The time when the task started running
+        self.tpt_start_time = None
+        # The return value of the target
+        self.tpt_retval = None
+        # Set when the task finishes
+        self.tpt_finished = threading.Event()
+
+    def is_alive(self):
+        """
+        Whether the task is queued or running
+        """
+        # pylint: disable=invalid-name
+        return not self.tpt_finished.is_set()
+
+    def join(self, timeout=None):
+        """
+        Wait until the task finishes
+        """
+        self.tpt_finished.wait(timeout)
+
+    def tpt_run(self):
+        """
+        Run the task
+        """
+        # pylint: disable=bare-except
+        self.tpt_start_time = time.time()
+        try:
+            self.tpt_retval = self.tpt_target(*self.tpt_args)
+        except:
+            logging.error("exception when running thread pool task: [%s]",
+                          traceback.format_exc())
+            self.tpt_retval = -1
+        self.tpt_finished.set()
+
+
+class ThreadPool(object):
+    """
+    A named pool with a bounded number of daemon threads. Tasks are queued
+    when all of the threads are busy.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name, max_threads):
+        self.tp_name = name
+        self.tp_max_threads = max_threads
+        # Protects all of the fields below
+        self.tp_condition = threading.Condition()
+        # The queued tasks
+        self.tp_tasks = []
+        # The worker threads
+        self.tp_threads = []
+        # The number of threads that are waiting for tasks
+        self.tp_idle_threads = 0
+        # Whether new tasks are accepted
+        self.tp_running = True
+        # Statistics
+        self.tp_submitted = 0
+        self.tp_completed = 0
+        # How many submitted tasks needed to wait because pool is saturated
+        self.tp_saturated = 0
+        # The max length of the queue in history
+        self.tp_queue_max = 0
+        # The total seconds that tasks waited in the queue
+        self.tp_wait_time = 0.0
+
+    def _tp_worker_thread(self):
+        """
+        Thread that runs the tasks in the queue
+        """
+        self.tp_condition.acquire()
+        while True:
+            while self.tp_running and len(self.tp_tasks) == 0:
+                self.tp_idle_threads += 1
+                self.tp_condition.wait()
+                self.tp_idle_threads -= 1
+            if len(self.tp_tasks) == 0:
+                break
+            task = self.tp_tasks.pop(0)
+            self.tp_wait_time += time.time() - task.tpt_submit_time
+            self.tp_condition.release()
+
+            task.tpt_run()
+
+            self.tp_condition.acquire()
+            self.tp_completed += 1
+        self.tp_threads.remove(threading.current_thread())
+        self.tp_condition.notifyAll()
+        self.tp_condition.release()
+
+    def _tp_thread_start(self):
+        """
+        Start a worker thread, tp_condition should be held
+        """
+        run_thread = threading.Thread(target=self._tp_worker_thread,
+                                      name="%s_%d" % (self.tp_name,
+                                                      len(self.tp_threads)))
+        run_thread.setDaemon(True)
+        self.tp_threads.append(run_thread)
+        run_thread.start()
+
+    def tp_submit(self, target, args):
+        """
+        Submit a task to the pool, return a ThreadPoolTask
+        """
+        task = ThreadPoolTask(target, args)
+        self.tp_condition.acquire()
+        if not self.tp_running:
+            self.tp_condition.release()
+            raise Exception("thread pool [%s] has been shut down" %
+                            self.tp_name)
+        self.tp_submitted += 1
+        if len(self.tp_tasks) < self.tp_idle_threads:
+            self.tp_tasks.append(task)
+            self.tp_condition.notify()
+        elif len(self.tp_threads) < self.tp_max_threads:
+            self.tp_tasks.append(task)
+            self._tp_thread_start()
+        elif threading.current_thread() in self.tp_threads:
+            # Waiting for a task queued by the thread of the same pool
+            # might deadlock, so run it directly.
+            self.tp_saturated += 1
+            self.tp_condition.release()
+            logging.debug("thread pool [%s] is saturated, running task in "
+                          "the submitting thread", self.tp_name)
+            task.tpt_run()
+            self.tp_condition.acquire()
+            self.tp_completed += 1
+            self.tp_condition.release()
+            return task
+        else:
+            self.tp_saturated += 1
+            self.tp_tasks.append(task)
+            if len(self.tp_tasks) > self.tp_queue_max:
+                self.tp_queue_max = len(self.tp_tasks)
+            logging.debug("thread pool [%s] is saturated, [%d] tasks queued",
+                          self.tp_name, len(self.tp_tasks))
+        self.tp_condition.release()
+        return task
+
+    def tp_resize(self, max_threads):
+        """
+        Change the max number of threads, only enlarging takes effect
+        immediately. When enlarging, threads are started for the queued
+        tasks.
+        """
+        self.tp_condition.acquire()
+        self.tp_max_threads = max_threads
+        # Each new thread takes one of the queued tasks
+        started = 0
+        while (self.tp_running and
+               len(self.tp_tasks) > self.tp_idle_threads + started and
+               len(self.tp_threads) < self.tp_max_threads):
+            self._tp_thread_start()
+            started += 1
+        self.tp_condition.release()
+
+    def tp_stats(self):
+        """
+        Return the statistics of the pool as a dict
+        """
+        self.tp_condition.acquire()
+        stats = {"max_threads": self.tp_max_threads,
+                 "threads": len(self.tp_threads),
+                 "busy_threads": len(self.tp_threads) - self.tp_idle_threads,
+                 "queued": len(self.tp_tasks),
+                 "queue_max": self.tp_queue_max,
+                 "submitted": self.tp_submitted,
+                 "completed": self.tp_completed,
+                 "saturated": self.tp_saturated,
+                 "wait_time": self.tp_wait_time}
+        self.tp_condition.release()
+        return stats
+
+    def tp_shutdown(self, timeout=None):
+        """
+        Stop accepting new tasks, wait until the queued tasks finish
+        Return 0 if all of the threads exited, -1 on timeout
+        """
+        time_start = time.time()
+        self.tp_condition.acquire()
+        self.tp_running = False
+        self.tp_condition.notifyAll()
+        ret = 0
+        while len(self.tp_threads) > 0:
+            if timeout is None:
+                self.tp_condition.wait()
+                continue
+            remain_time = time_start + timeout - time.time()
+            if remain_time <= 0:
+                ret = -1
+                break
+            self.tp_condition.wait(remain_time)
+        self.tp_condition.release()
+        return ret
+
+
+# Keys are names of thread pools, protected by THREAD_POOL_LOCK
+THREAD_POOLS = {}
+THREAD_POOL_LOCK = threading.Lock()
+
+
+def thread_pool_get(name, max_threads=None):
+    """
+    Return the thread pool with the name, create it if not exists
+    If max_threads is not None, the pool will be resized
+    """
+    THREAD_POOL_LOCK.acquire()
+    if name in THREAD_POOLS and THREAD_POOLS[name].tp_running:
+        pool = THREAD_POOLS[name]
+        if max_threads is not None:
+            pool.tp_resize(max_threads)
+    else:
+        if max_threads is None:
+            max_threads = THREAD_POOL_DEFAULT_SIZES.get(name,
+                                                        THREAD_POOL_DEFAULT_SIZE)
+        pool = ThreadPool(name, max_threads)
+        THREAD_POOLS[name] = pool
+    THREAD_POOL_LOCK.release()
+    return pool
+
+
+def thread_pools_stats():
+    """
+    Return the statistics of all thread pools, keys are the pool names
+    """
+    THREAD_POOL_LOCK.acquire()
+    pools = THREAD_POOLS.values()
+    THREAD_POOL_LOCK.release()
+    stats = {}
+    for pool in pools:
+        stats[pool.tp_name] = pool.tp_stats()
+    return stats
+
+
+def thread_pools_shutdown(log, names, timeout=None):
+    """
+    Shutdown the thread pools with the names
+    """
+    ret = 0
+    for name in names:
+        THREAD_POOL_LOCK.acquire()
+        pool = THREAD_POOLS.get(name)
+        THREAD_POOL_LOCK.release()
+        if pool is None:
+            continue
+        log.cl_debug("shutting down thread pool [%s]", name)
+        if pool.tp_shutdown(timeout=timeout):
+            log.cl_error("timeout when shutting down thread pool [%s]", name)
+            ret = -1
+    return ret
+
+
+def thread_start(target, args, pool=None):
     """
     Wrap the target function and start a thread to run it
+    If pool is not None, run it in the thread pool with that name
     """
+    if pool is not None:
+        return thread_pool_get(pool).tp_submit(target, args)
     run_thread = threading.Thread(target=target,
                                   args=args)
     run_thread.setDaemon(True)
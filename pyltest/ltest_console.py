@@ -4,7 +4,6 @@
 """
 Console that manages the scheduler
 """
-import xmlrpclib
 import readline
 import logging
 import getopt
@@ -305,7 +304,7 @@ def main():
             server = server + ":" + str(ltest_scheduler.TEST_SCHEDULER_PORT)
 
     log.cl_info("connecting to server [%s]", server)
-    proxy = xmlrpclib.ServerProxy(server, allow_none=True)
+    proxy = ltest_scheduler.scheduler_proxy(server)
 
     tconsole_input_init()
     tconsole_input_loop(proxy)
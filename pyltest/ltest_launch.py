@@ -5,7 +5,6 @@
 Console that manages the scheduler
 """
 # pylint: disable=too-many-lines
-import xmlrpclib
 import getopt
 import sys
 import os
@@ -20,8 +19,10 @@ from pylcommon import time_util
 from pylcommon import cstr
 from pylcommon import ssh_host
 from pylcommon import lyaml
+from pylcommon import lconfig
 from pylcommon import lvirt
 from pylcommon import lustre
+from pylcommon import broadcast
 from pylcommon import constants
 from pyltest import ltest_scheduler
 
@@ -31,7 +32,6 @@ CHECK_TIME = time_util.utcnow()
 EXIT_REASON = "unkown reason"
 SHUTTING_DOWN = False
 DEFAULT_HOST_TIMEOUT = 1800
-HOST_ALLOCATION_INTERVAL = 3
 DEFAULT_LUSTRE_RPM_DIR = "/lustre_rpms"
 DEFAULT_E2FSPROGS_RPM_DIR = "/e2fsprogs_rpms"
 DEV_MAPPER_PREFIX = "/dev/mapper/"
@@ -535,53 +535,24 @@ class TestCluster(object):
         """
         Send Lustre RPMs and E2fsprogs RPMs
         """
-        host = self.tc_test_host.crh_host
-        workspace = self.tc_workspace
-
-        local_rpm_dir = launch_argument.la_lustre_dir
         test_host = self.tc_test_host.crh_host
-        ret = test_host.sh_send_file(log, local_rpm_dir, workspace)
-        if ret:
-            log.cl_error("failed to send dir [%s] on local host to "
-                         "directory [%s] on host [%s]",
-                         local_rpm_dir, workspace, test_host.sh_hostname)
-            return -1
-
-        basename = os.path.basename(local_rpm_dir)
-        remote_rpm_dir = workspace + "/" + basename
-        remote_lustre_rpm_dir = self.tc_test_host_lustre_rpm_dir
-        if remote_rpm_dir != remote_lustre_rpm_dir:
-            command = ("mv %s %s" % (remote_rpm_dir, remote_lustre_rpm_dir))
-            retval = host.sh_run(log, command)
-            if retval.cr_exit_status != 0:
-                log.cl_error("failed to run command [%s] on host [%s], "
-                             "ret = [%d], stdout = [%s], stderr = [%s]",
-                             command, host.sh_hostname,
-                             retval.cr_exit_status, retval.cr_stdout,
-                             retval.cr_stderr)
-                return -1
+        workspace = self.tc_workspace
 
-        local_rpm_dir = launch_argument.la_e2fsprogs_dir
-        test_host = self.tc_test_host.crh_host
-        ret = test_host.sh_send_file(log, local_rpm_dir, workspace)
-        if ret:
-            log.cl_error("failed to send dir [%s] on local host to "
-                         "directory [%s] on host [%s]",
-                         local_rpm_dir, workspace, test_host.sh_hostname)
-            return -1
-        basename = os.path.basename(local_rpm_dir)
-        remote_rpm_dir = workspace + "/" + basename
-        remote_e2fsprogs_rpm_dir = self.tc_test_host_e2fsprogs_rpm_dir
-        if remote_rpm_dir != remote_e2fsprogs_rpm_dir:
-            command = ("mv %s %s" % (remote_rpm_dir, remote_e2fsprogs_rpm_dir))
-            retval = host.sh_run(log, command)
-            if retval.cr_exit_status != 0:
-                log.cl_error("failed to run command [%s] on host [%s], "
-                             "ret = [%d], stdout = [%s], stderr = [%s]",
-                             command, host.sh_hostname,
-                             retval.cr_exit_status, retval.cr_stdout,
-                             retval.cr_stderr)
+        # The unchanged RPMs on the host will be skipped
+        pairs = [(launch_argument.la_lustre_dir,
+                  self.tc_test_host_lustre_rpm_dir),
+                 (launch_argument.la_e2fsprogs_dir,
+                  self.tc_test_host_e2fsprogs_rpm_dir)]
+        for local_rpm_dir, remote_rpm_dir in pairs:
+            ret = broadcast.broadcast_dir(log, workspace, [test_host],
+                                          local_rpm_dir, remote_rpm_dir)
+            if ret:
+                log.cl_error("failed to send dir [%s] on local host to "
+                             "directory [%s] on host [%s]",
+                             local_rpm_dir, remote_rpm_dir,
+                             test_host.sh_hostname)
                 return -1
+        return 0
 
     def tc_get_and_clean_dir(self, log, host, logdir):
         """
@@ -919,6 +890,10 @@ class TestCluster(object):
         self._tc_generate_clownfish_config_lustres(config)
 
         config_fpath = self.tc_clownfish_config_fpath
+        if lconfig.config_compile(log, config, lconfig.CLOWNFISH_CONFIG_SCHEMA,
+                                  config_fpath) is None:
+            log.cl_error("generated invalid clownfish.conf")
+            return -1
         start_string = """#
 # Configuration file of Clownfish
 #
@@ -962,6 +937,11 @@ class TestCluster(object):
         self._tc_generate_clownfish_install_config_ssh_hosts(config)
 
         config_fpath = self.tc_clownfish_install_config_fpath
+        if lconfig.config_compile(log, config,
+                                  lconfig.CLOWNFISH_INSTALL_CONFIG_SCHEMA,
+                                  config_fpath) is None:
+            log.cl_error("generated invalid clownfish_install.conf")
+            return -1
         start_string = """#
 # Configuration file for installing Clownfish
 #
@@ -1233,14 +1213,31 @@ class TestCluster(object):
         return return_value
 
 
-def _allocate_resources(log, scheduler_id, jobid, proxy, descs):
+def allocate_resources(log, scheduler_id, jobid, proxy, descs,
+                       timeout=DEFAULT_HOST_TIMEOUT):
     """
-    Allocate resources from server
+    Allocate resources from server, wait in the allocation queue of the
+    server if necessary
     """
-    rpc_descriptors = proxy.ts_resources_allocate(scheduler_id, jobid, descs)
-    if len(rpc_descriptors) == 0:
-        log.cl_info("not enough resources to allocate")
-        return -1, None, None
+    # pylint: disable=too-many-arguments
+    time_start = time.time()
+    rpc_descriptors = []
+    while len(rpc_descriptors) == 0:
+        if SHUTTING_DOWN:
+            log.cl_error("shutting down when waiting for resources")
+            return -1, None, None
+        remain_time = time_start + timeout - time.time()
+        if remain_time <= 0:
+            log.cl_error("timeout after waiting [%d] seconds for resources",
+                         timeout)
+            return -1, None, None
+        rpc_descriptors = proxy.ts_resources_allocate_wait(scheduler_id,
+                                                           jobid, descs,
+                                                           remain_time)
+        if len(rpc_descriptors) == 0:
+            log.cl_info("not enough resources to allocate, waiting in the "
+                        "queue of the scheduler")
+
     same_kvm_host_descriptors = []
     other_descriptors = []
     ltest_scheduler.rpc2descriptors(log, rpc_descriptors,
@@ -1249,19 +1246,6 @@ def _allocate_resources(log, scheduler_id, jobid, proxy, descs):
     return 0, same_kvm_host_descriptors, other_descriptors
 
 
-def allocate_resources(log, scheduler_id, jobid, proxy, descs,
-                       timeout=DEFAULT_HOST_TIMEOUT,
-                       sleep_interval=HOST_ALLOCATION_INTERVAL):
-    """
-    Allocate resources from server, wait if necessary
-    """
-    # pylint: disable=too-many-arguments,unused-variable
-    return utils.wait_condition(log, _allocate_resources,
-                                (scheduler_id, jobid, proxy, descs),
-                                timeout=timeout,
-                                sleep_interval=sleep_interval)
-
-
 def allocate_hosts_and_ip(log, scheduler_id, jobid, proxy):
     """
     Allocate hosts and IP
@@ -1320,6 +1304,8 @@ def resource2host(res, kvm_server_dict):
             kvm_template_config[cstr.CSTR_RAM_SIZE] = kvm_template["vt_ram_size"]
             kvm_template_config[cstr.CSTR_DISK_SIZES] = kvm_template["vt_disk_sizes"]
             kvm_template_config[cstr.CSTR_BUS_TYPE] = kvm_template["vt_bus_type"]
+            kvm_template_config[cstr.CSTR_CLONE_MODE] = kvm_template.get("vt_clone_mode",
+                                                                         cstr.CSTR_CLONE_MODE_FULL)
             kvm_template_config[cstr.CSTR_SERVER_HOST_ID] = kvm_server_hostname
             kvm_template_config[cstr.CSTR_REINSTALL] = False
             kvm_template_per_sever_dict[global_template_hostname] = kvm_template_config
@@ -1536,12 +1522,18 @@ def run_test(log, workspace, launch_argument):
     Run the test
     """
     log.cl_info("connecting to server [%s]", launch_argument.la_server)
-    proxy = xmlrpclib.ServerProxy(launch_argument.la_server, allow_none=True)
+    proxy = ltest_scheduler.scheduler_proxy(launch_argument.la_server)
     scheduler_id = proxy.ts_get_id()
     jobid = proxy.ts_job_start(scheduler_id)
     log.cl_info("got job ID [%s]", jobid)
 
-    utils.thread_start(heartbeat_thread, (log, proxy, scheduler_id, jobid))
+    # The proxy keeps the connection alive and can not be shared between
+    # threads, so use a seperate one for heartbeat. The heartbeat should
+    # fail before the job times out on the scheduler.
+    heartbeat_proxy = ltest_scheduler.scheduler_proxy(launch_argument.la_server,
+                                                      timeout=ltest_scheduler.TEST_HEARTBEAT_INTERVAL)
+    utils.thread_start(heartbeat_thread, (log, heartbeat_proxy, scheduler_id,
+                                          jobid))
 
     ret = run_test_connected(log, workspace, launch_argument, scheduler_id,
                              jobid, proxy)
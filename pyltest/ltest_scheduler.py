@@ -7,6 +7,11 @@ need to allocate hosts from the scheduler.
 """
 # pylint: disable=too-many-lines
 import SimpleXMLRPCServer
+import collections
+import heapq
+import itertools
+import SocketServer
+import xmlrpclib
 import threading
 import signal
 import time
@@ -48,11 +53,27 @@ IP_CHECK_INTERVAL = 3
 # used by any host
 IP_MIN_CHECK_TIMES = 5
 
+# The max number of resources being cleaned up at the same time
+RECOVERY_CONCURRENCY = 16
+# The max number of VMs on the same KVM server being cleaned up at the
+# same time
+KVM_RECOVERY_CONCURRENCY = 2
+
 # The heatbeat interval
 TEST_HEARTBEAT_INTERVAL = 10
 # The heatbeat timeout. Both scheduler and client will abort the job if
 # heatbeat is not recived/sent correctly for this long time.
 TEST_HEARTBEAT_TIMEOUT = 20
+# The timeout of reading a request from a connection, including the idle
+# time of a kept-alive connection between two requests
+RPC_REQUEST_TIMEOUT = 60
+# The timeout of a client waiting for the reply of the scheduler
+RPC_CLIENT_TIMEOUT = 120
+# The interval of checking the shutting down flag when no request comes
+RPC_SERVE_INTERVAL = 1
+# The longest time an allocation request waits in the scheduler before
+# returning to the client, should be shorter than RPC_CLIENT_TIMEOUT
+RPC_LONG_POLL_TIMEOUT = 60
 
 
 class ScheduledResource(object):
@@ -74,6 +95,27 @@ class ScheduledResource(object):
         self.sr_error = 0
         self.sr_name = name
         self.sr_cleaning = False
+        # The due time of the entry in the recovery heap, entries with
+        # different due time are outdated
+        self.sr_recovery_due = None
+        # Whether the resource is in TestScheduler.ts_recovery_ready
+        self.sr_recovery_ready = False
+
+    def sr_recovery_key(self):
+        """
+        Return the key to limit the recovery concurrency, resources with
+        the same key are not cleaned up too much at the same time.
+        """
+        # pylint: disable=no-self-use
+        return None
+
+    def sr_due_time(self):
+        """
+        Return the time when the resource should be checked again
+        """
+        if self.sr_is_clean:
+            return self.sr_check_time + MIN_GOOD_RES_CHECK_INTERVAL
+        return self.sr_check_time + MIN_BAD_RES_CHECK_INTERVAL
 
     def sr_dirty(self):
         """
@@ -143,6 +185,13 @@ class TestHost(ScheduledResource):
         self.th_kvm_template = kvm_template
         self.th_host = ssh_host.SSHHost(hostname)
 
+    def sr_recovery_key(self):
+        """
+        VMs on the same KVM server should not be re-cloned too much at the
+        same time
+        """
+        return self.th_kvm_server_hostname
+
     def th_print_info(self, log):
         """
         Print the info of this host
@@ -155,17 +204,39 @@ class TestHost(ScheduledResource):
                      self.th_tag,
                      self.th_kvm_server_hostname)
 
+    def _th_revert(self, log):
+        """
+        Revert the VM cloned in overlay mode to its clean snapshot, so the
+        host is booted and ready when it is allocated again
+        """
+        template = self.th_kvm_template
+        server_host = ssh_host.SSHHost(self.th_kvm_server_hostname)
+        return lvirt.vm_revert(log, server_host, self.th_hostname,
+                               self.th_ipv4_addresses[0],
+                               template.vt_image_dir,
+                               len(template.vt_disk_sizes),
+                               template.vt_distro,
+                               template.vt_internet)
+
     def _sr_cleanup(self, log, scheduler):
         """
         Clean up the host
 
-        Improvement: call shared functions in lvirt directly
         Improvement: cleanup directories for spaces
         """
         # pylint: disable=unused-argument
         if self.th_purpose == PURPOSE_BUILD:
             return 0
 
+        template = self.th_kvm_template
+        if (template is not None and
+                template.vt_clone_mode == cstr.CSTR_CLONE_MODE_OVERLAY):
+            ret = self._th_revert(log)
+            if ret == 0:
+                return 0
+            log.cl_info("failed to revert host [%s] to snapshot, stopping "
+                        "services on it instead", self.th_hostname)
+
         host = self.th_host
         service_names = ["corosync", "pacemaker"]
         for service_name in service_names:
@@ -380,11 +451,93 @@ class ResourceDescriptorHost(ResourceDescriptor):
         self.rdh_tag = tag
 
 
-def resource_compare(host_x, host_y):
+class ResourcePool(object):
     """
-    Sort the resource according to cleanup time
+    The resources that have free concurrency. The resource that has been
+    free for the longest time is in the head, so allocating from the head
+    is round-robin.
     """
-    return host_x.sr_check_time > host_y.sr_check_time
+    def __init__(self):
+        # Keys are ScheduledResource.sr_name, values are ScheduledResource
+        self.rp_resources = collections.OrderedDict()
+
+    def rp_update(self, res):
+        """
+        Move the resource to the tail if it has free concurrency, otherwise
+        remove it from the pool
+        """
+        self.rp_resources.pop(res.sr_name, None)
+        if res.sr_concurrency < res.sr_max_concurrency:
+            self.rp_resources[res.sr_name] = res
+
+    def rp_number(self):
+        """
+        Return the number of resources in the pool
+        """
+        return len(self.rp_resources)
+
+    def rp_head(self, number):
+        """
+        Return at most number of resources from the head of the pool
+        """
+        return list(itertools.islice(self.rp_resources.itervalues(), number))
+
+
+class AllocationReservation(object):
+    """
+    The resources reserved by the allocation requests that are blocked in
+    the queue. The requests behind them can only use the other resources.
+    """
+    def __init__(self):
+        # Keys are (distro, purpose, tag) of hosts or RESOURCE_TYPE_IP_ADDRESS,
+        # values are the numbers of resources reserved
+        self.ares_numbers = {}
+        # The KVM servers reserved for the hosts that need to share the
+        # same KVM server
+        self.ares_kvm_servers = set()
+
+    def ares_reserve(self, key, number):
+        """
+        Reserve number of resources of the key
+        """
+        if key not in self.ares_numbers:
+            self.ares_numbers[key] = 0
+        self.ares_numbers[key] += number
+
+    def ares_number(self, key):
+        """
+        Return the number of reserved resources that might overlap with the
+        resources of the key. None tag matches any tag.
+        """
+        if key == RESOURCE_TYPE_IP_ADDRESS:
+            return self.ares_numbers.get(key, 0)
+        distro, purpose, tag = key
+        number = 0
+        for reserved_key, reserved_number in self.ares_numbers.iteritems():
+            if reserved_key == RESOURCE_TYPE_IP_ADDRESS:
+                continue
+            reserved_distro, reserved_purpose, reserved_tag = reserved_key
+            if reserved_distro != distro or reserved_purpose != purpose:
+                continue
+            if (tag is not None and reserved_tag is not None and
+                    reserved_tag != tag):
+                continue
+            number += reserved_number
+        return number
+
+
+class AllocationRequest(object):
+    """
+    A request of resources waiting in the allocation queue of the scheduler
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, job, same_kvm_host_descriptors, other_descriptors):
+        self.ar_job = job
+        self.ar_same_kvm_host_descriptors = same_kvm_host_descriptors
+        self.ar_other_descriptors = other_descriptors
+        # The allocated descriptors, None if not allocated yet
+        self.ar_descriptors = None
+        self.ar_enqueue_time = time.time()
 
 
 class TestSchedulerJob(object):
@@ -399,6 +552,8 @@ class TestSchedulerJob(object):
         self.laj_sequence = sequence
         self.laj_check_time = time_util.utcnow()
         self.laj_ip_addresses = []
+        # The AllocationRequest of this job in the allocation queue
+        self.laj_allocation_request = None
 
     def laj_host_add(self, lhost):
         """
@@ -499,7 +654,10 @@ class TestScheduler(object):
     The main object of the scheduler.
     """
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, log, scheduler_id, hosts, addresses):
+    def __init__(self, log, scheduler_id, hosts, addresses,
+                 recovery_concurrency=RECOVERY_CONCURRENCY,
+                 kvm_recovery_concurrency=KVM_RECOVERY_CONCURRENCY):
+        # pylint: disable=too-many-arguments
         self.ts_log = log
         self.ts_resources = hosts + addresses
         self.ts_hosts = []
@@ -510,9 +668,42 @@ class TestScheduler(object):
         self.ts_id = scheduler_id
         self.ts_id += ("_%d" % os.getpid())
         log.cl_info("ID of scheduler: [%s]", self.ts_id)
-        self.ts_kvm_hosts_dict = {}
+        # Keys are hostnames, values are TestHost
+        self.ts_host_dict = {}
+        # Keys are IP addresses, values are IPAddress
+        self.ts_address_dict = {}
+        # Keys are (distro, purpose, tag), values are ResourcePool of hosts.
+        # Each host is also in the pool with None tag, which is used when
+        # allocating hosts with any tag.
+        self.ts_host_pools = {}
+        # Keys are KVM server hostnames, values are dicts that are like
+        # ts_host_pools but only for the hosts on that KVM server
+        self.ts_kvm_host_pools = {}
+        # The KVM server hostnames in the order of round-robin
+        self.ts_kvm_servers = []
+        # The pool of free IP addresses
+        self.ts_address_pool = ResourcePool()
+        # The AllocationRequest in the order of arriving time
+        self.ts_allocation_queue = []
+        # Min-heap of (due time, sequence, resource) of the free resources
+        self.ts_recovery_heap = []
+        # Used to keep the heap order stable for the same due time
+        self.ts_recovery_sequence = 0
+        # The resources that are due but not being cleaned up yet
+        self.ts_recovery_ready = []
+        # Keys are ScheduledResource.sr_recovery_key(), values are the
+        # numbers of resources being cleaned up by the recovery thread
+        self.ts_recovery_running = {}
+        self.ts_recovery_running_number = 0
+        self.ts_recovery_concurrency = recovery_concurrency
+        self.ts_kvm_recovery_concurrency = kvm_recovery_concurrency
         for host in hosts:
             self._ts_add_host(host)
+        for address in addresses:
+            self.ts_address_dict[address.ipa_address] = address
+            self._ts_resource_pools_update(address)
+        for res in self.ts_resources:
+            self._ts_recovery_push(res)
 
     def _ts_add_host(self, host):
         """
@@ -521,32 +712,78 @@ class TestScheduler(object):
         log = self.ts_log
         host.th_print_info(log)
         self.ts_hosts.append(host)
+        self.ts_host_dict[host.th_hostname] = host
 
         kvm_server_hostname = host.th_kvm_server_hostname
+        if (kvm_server_hostname is not None and
+                kvm_server_hostname not in self.ts_kvm_host_pools):
+            self.ts_kvm_host_pools[kvm_server_hostname] = {}
+            self.ts_kvm_servers.append(kvm_server_hostname)
+        self._ts_resource_pools_update(host)
 
-        if kvm_server_hostname is not None:
-            if kvm_server_hostname not in self.ts_kvm_hosts_dict:
-                self.ts_kvm_hosts_dict[kvm_server_hostname] = []
-            kvm_hosts = self.ts_kvm_hosts_dict[kvm_server_hostname]
-            kvm_hosts.append(host)
+    def _ts_resource_pools(self, res):
+        """
+        Return the pools that the resource belongs to, create the pools if
+        not exist
+        """
+        if res.rr_resource_type == RESOURCE_TYPE_IP_ADDRESS:
+            return [self.ts_address_pool]
+
+        pool_dicts = [self.ts_host_pools]
+        if res.th_kvm_server_hostname is not None:
+            pool_dicts.append(self.ts_kvm_host_pools[res.th_kvm_server_hostname])
+        pools = []
+        for pool_dict in pool_dicts:
+            for tag in [res.th_tag, None]:
+                key = (res.th_distro, res.th_purpose, tag)
+                if key not in pool_dict:
+                    pool_dict[key] = ResourcePool()
+                pools.append(pool_dict[key])
+                # The host has no tag, only need one pool
+                if res.th_tag is None:
+                    break
+        return pools
+
+    def _ts_resource_pools_update(self, res):
+        """
+        Update the pools after the concurrency of the resource changes.
+        Lock should be acquired in advance.
+        """
+        for pool in self._ts_resource_pools(res):
+            pool.rp_update(res)
+
+    def _ts_resource_concurrency_set(self, res, concurrency):
+        """
+        Change the concurrency of the resource. Lock should be acquired in
+        advance.
+        """
+        res.sr_concurrency = concurrency
+        self._ts_resource_pools_update(res)
+        if concurrency == 0:
+            self._ts_recovery_push(res)
+
+    def _ts_recovery_push(self, res):
+        """
+        Push the free resource into the recovery heap. Lock should be
+        acquired in advance.
+        """
+        due_time = res.sr_due_time()
+        res.sr_recovery_due = due_time
+        heapq.heappush(self.ts_recovery_heap,
+                       (due_time, self.ts_recovery_sequence, res))
+        self.ts_recovery_sequence += 1
 
     def ts_find_ip_address(self, ip_address):
         """
         Find the IP address by its hostname. Lock should be acquired in advance.
         """
-        for ip_address_obj in self.ts_addresses:
-            if ip_address_obj.ipa_address == ip_address:
-                return ip_address_obj
-        return None
+        return self.ts_address_dict.get(ip_address)
 
     def ts_find_host(self, hostname):
         """
         Find the host by its hostname. Lock should be acquired in advance.
         """
-        for lhost in self.ts_hosts:
-            if lhost.th_hostname == hostname:
-                return lhost
-        return None
+        return self.ts_host_dict.get(hostname)
 
     def ts_get_id(self):
         """
@@ -663,51 +900,38 @@ class TestScheduler(object):
                         next_check_string))
         return output
 
-    def _ts_host_list_allocate(self, host_list, job, distro, number_min,
-                               number_max, purpose, tag):
+    def _ts_host_pool_allocate(self, pool, job, number_min, number_max,
+                               reservation, reserved_number):
         """
-        Allocate hosts from a list, if failed, return []
+        Allocate hosts from a pool, if failed, return []
+        The hosts on the KVM servers reserved by former requests and the
+        reserved_number of hosts are left for the former requests.
         """
-        # pylint: disable=too-many-arguments,no-self-use
+        # pylint: disable=too-many-arguments
         log = self.ts_log
-        log.cl_debug("listing IP addresses")
         rpc_hosts = []
-        hosts = []
-        # reverse the host from time to time, so that the host in the tail of
-        # the list have equal chance to be allocated
-        host_list.reverse()
-
-        # Check the potential hosts that can be allocated
-        for host in host_list:
-            if host.th_distro != distro:
-                log.cl_debug("the distro [%s] of host [%s] != [%s]",
-                             host.th_distro, host.th_hostname, distro)
-                continue
-            if host.th_purpose != purpose:
-                log.cl_debug("the purpose [%s] of host [%s] != [%s]",
-                             host.th_purpose, host.th_hostname, purpose)
-                continue
-            if tag is not None and host.th_tag != tag:
-                log.cl_debug("the tag [%s] of host [%s] != [%s]",
-                             host.th_tag, host.th_hostname, tag)
-                continue
-            if host.sr_max_concurrency <= host.sr_concurrency:
-                log.cl_debug("no currency for host [%s]", host.th_hostname)
-                continue
-            hosts.append(host)
+        if pool is None:
+            return rpc_hosts
+
+        if len(reservation.ares_kvm_servers) == 0:
+            usable = pool.rp_number() - reserved_number
+            hosts = pool.rp_head(min(number_max, usable))
+        else:
+            hosts = []
+            for host in pool.rp_resources.itervalues():
+                if host.th_kvm_server_hostname in reservation.ares_kvm_servers:
+                    continue
+                hosts.append(host)
+            usable = len(hosts) - reserved_number
+            hosts = hosts[:min(number_max, usable)]
 
         # Not enough hosts, abort
         if len(hosts) < number_min:
-            log.cl_error("not enough hosts to allocate, needs [%d], have [%d]",
-                         number_min, len(hosts))
             return rpc_hosts
 
-        hosts.sort(resource_compare)
-        # Allocate the hosts
+        # Allocate the hosts that have been free for the longest time
         for host in hosts:
-            if len(rpc_hosts) >= number_max:
-                break
-            host.sr_concurrency += 1
+            self._ts_resource_concurrency_set(host, host.sr_concurrency + 1)
             host.sr_job_sequence = job.laj_sequence
             job.laj_host_add(host)
             rpc_host = RPCHost(host.th_hostname,
@@ -720,26 +944,26 @@ class TestScheduler(object):
                          host.th_hostname, job.laj_jobid)
         return rpc_hosts
 
-    def _ts_job_allocate_ip_resource_holding_lock(self, job, desc):
+    def _ts_job_allocate_ip_resource_holding_lock(self, job, desc,
+                                                  reservation):
         """
         Allocated one resource for host, if fails, returen -1
         """
         log = self.ts_log
         log.cl_debug("allocating a IP resource for job [%s]", job.laj_jobid)
         rpc_addresses = []
-        # reverse the IPs from time to time, so that the host in the tail of
-        # the list have equal chance to be allocated
-        self.ts_addresses.reverse()
-
         addresses = []
-        # Check the potential addresses that can be allocated
-        for address in self.ts_addresses:
-            if address.sr_max_concurrency <= address.sr_concurrency:
-                continue
+        # Check the potential addresses that can be allocated, in the
+        # order of round-robin
+        for address in self.ts_address_pool.rp_resources.itervalues():
             # Can not allocate an IP that might being used
             if not address.sr_is_clean:
                 continue
             addresses.append(address)
+        # Leave the reserved addresses to the former requests
+        usable = (len(addresses) -
+                  reservation.ares_number(RESOURCE_TYPE_IP_ADDRESS))
+        addresses = addresses[:min(desc.rd_number_max, usable)]
 
         # Not enough hosts, abort
         if len(addresses) < desc.rd_number_min:
@@ -747,12 +971,10 @@ class TestScheduler(object):
                         desc.rd_number_min, len(addresses))
             return -1
 
-        addresses.sort(resource_compare)
         # Allocate the address
         for address in addresses:
-            if len(rpc_addresses) >= desc.rd_number_max:
-                break
-            address.sr_concurrency += 1
+            self._ts_resource_concurrency_set(address,
+                                              address.sr_concurrency + 1)
             address.sr_job_sequence = job.laj_sequence
             job.laj_ip_address_add(address)
             rpc_address = RPCIPAddress(address.ipa_address,
@@ -761,59 +983,71 @@ class TestScheduler(object):
         desc.rd_resources = rpc_addresses
         return 0
 
-    def _ts_job_allocate_host_resource_holding_lock(self, job, desc):
+    def _ts_job_allocate_host_resource_holding_lock(self, job, desc,
+                                                    reservation):
         """
         Allocated one resource for host, if fails, returen -1
         """
         log = self.ts_log
+        key = (desc.rdh_distro, desc.rdh_purpose, desc.rdh_tag)
+        rpc_hosts = []
         if not desc.rdh_same_kvm_server:
             log.cl_debug("allocating a host resource that doesn't need to "
                          "share KVM server for job [%s]", job.laj_jobid)
-            rpc_hosts = self._ts_host_list_allocate(self.ts_hosts, job,
-                                                    desc.rdh_distro,
-                                                    desc.rd_number_min,
+            rpc_hosts = self._ts_host_pool_allocate(self.ts_host_pools.get(key),
+                                                    job, desc.rd_number_min,
                                                     desc.rd_number_max,
-                                                    desc.rdh_purpose,
-                                                    desc.rdh_tag)
+                                                    reservation,
+                                                    reservation.ares_number(key))
         else:
             log.cl_debug("allocating a hosts resource that shares KVM server "
                          "for job [%s]", job.laj_jobid)
-            for host_list in self.ts_kvm_hosts_dict.values():
-                rpc_hosts = self._ts_host_list_allocate(host_list, job,
-                                                        desc.rdh_distro,
+            for index, kvm_server in enumerate(self.ts_kvm_servers):
+                if kvm_server in reservation.ares_kvm_servers:
+                    continue
+                pool = self.ts_kvm_host_pools[kvm_server].get(key)
+                rpc_hosts = self._ts_host_pool_allocate(pool, job,
                                                         desc.rd_number_min,
                                                         desc.rd_number_max,
-                                                        desc.rdh_purpose,
-                                                        desc.rdh_tag)
+                                                        reservation, 0)
                 if len(rpc_hosts) != 0:
+                    # Try other KVM servers first next time
+                    self.ts_kvm_servers = (self.ts_kvm_servers[index + 1:] +
+                                           self.ts_kvm_servers[:index + 1])
                     break
         if len(rpc_hosts) == 0:
+            log.cl_debug("not enough hosts with distro [%s], purpose [%s] and "
+                         "tag [%s] to allocate, needs [%d]", desc.rdh_distro,
+                         desc.rdh_purpose, desc.rdh_tag, desc.rd_number_min)
             return -1
         desc.rd_resources = rpc_hosts
         return 0
 
-    def _ts_job_allocate_resource_holding_lock(self, job, desc):
+    def _ts_job_allocate_resource_holding_lock(self, job, desc, reservation):
         """
         Allocated one resource, if fails, returen -1
         """
         log = self.ts_log
         log.cl_debug("allocating a resource for job [%s]", job.laj_jobid)
         if desc.rd_type == RESOURCE_TYPE_HOST:
-            return self._ts_job_allocate_host_resource_holding_lock(job, desc)
+            return self._ts_job_allocate_host_resource_holding_lock(job, desc,
+                                                                    reservation)
         elif desc.rd_type == RESOURCE_TYPE_IP_ADDRESS:
-            return self._ts_job_allocate_ip_resource_holding_lock(job, desc)
+            return self._ts_job_allocate_ip_resource_holding_lock(job, desc,
+                                                                  reservation)
         else:
             log.cl_error("wrong resource type [%s]", desc.rd_type)
             return -1
 
-    def _ts_job_allocate_resources_holding_lock(self, job, descs):
+    def _ts_job_allocate_resources_holding_lock(self, job, descs, reservation):
         """
         Allocate multiple resources holding lock, if any of them fails, -1
         """
         log = self.ts_log
         log.cl_debug("allocating resources for job [%s]", job.laj_jobid)
         for desc in descs:
-            ret = self._ts_job_allocate_resource_holding_lock(job, desc)
+            ret = self._ts_job_allocate_resource_holding_lock(job, desc,
+                                                              reservation)
             if ret:
                 log.cl_debug("failed to allocate resource, releasing "
                              "allocated resource of job [%s]", job.laj_jobid)
@@ -841,7 +1075,8 @@ class TestScheduler(object):
 
         job.laj_host_remove(test_host)
         test_host.sr_job_sequence = None
-        test_host.sr_concurrency -= 1
+        self._ts_resource_concurrency_set(test_host,
+                                          test_host.sr_concurrency - 1)
         return 0
 
     def _ts_job_release_one_ip_holding_lock(self, job, res):
@@ -863,7 +1098,8 @@ class TestScheduler(object):
 
         job.laj_ip_address_remove(ip_address_obj)
         ip_address_obj.sr_job_sequence = None
-        ip_address_obj.sr_concurrency -= 1
+        self._ts_resource_concurrency_set(ip_address_obj,
+                                          ip_address_obj.sr_concurrency - 1)
         return 0
 
     def _ts_job_release_one_holding_lock(self, job, res):
@@ -934,11 +1170,117 @@ class TestScheduler(object):
                      host_names, ip_addresses, jobid)
         return 0
 
-    def ts_resources_allocate(self, scheduler_id, jobid, descriptors):
+    def _ts_request_allocate_holding_lock(self, request, reservation):
         """
-        Allocate multiple resources, if any of them fails, return []
+        Try to allocate the resources of a request, return 0 if succeeded
         """
         log = self.ts_log
+        job = request.ar_job
+        jobid = job.laj_jobid
+        same_kvm_host_descriptors = request.ar_same_kvm_host_descriptors
+        other_descriptors = request.ar_other_descriptors
+        ret_descriptors = same_kvm_host_descriptors + other_descriptors
+        ret = self._ts_job_allocate_resources_holding_lock(job,
+                                                           same_kvm_host_descriptors,
+                                                           reservation)
+        if ret == 0:
+            ret = self._ts_job_allocate_resources_holding_lock(job,
+                                                               other_descriptors,
+                                                               reservation)
+            if ret:
+                log.cl_debug("failed to allocated resources for job [%s]", jobid)
+        else:
+            log.cl_debug("failed to allocated host resources that share the "
+                         "same KVM server for job [%s]", jobid)
+            ret = -1
+
+        if ret:
+            log.cl_debug("releasing allocated resource of job [%s]", jobid)
+            self._ts_job_release_resources_holding_lock(job, ret_descriptors)
+            return -1
+
+        ret = self._ts_resources_dirty_holding_lock(log, jobid,
+                                                    ret_descriptors)
+        if ret:
+            self._ts_job_release_resources_holding_lock(job, ret_descriptors)
+            return -1
+        request.ar_descriptors = ret_descriptors
+        return 0
+
+    def _ts_request_reserve_holding_lock(self, request, reservation):
+        """
+        Reserve the resources for a request that can not be allocated now,
+        so that the requests behind it won't starve it
+        """
+        for desc in request.ar_same_kvm_host_descriptors:
+            # Reserve the KVM server that is most likely to be ready first
+            key = (desc.rdh_distro, desc.rdh_purpose, desc.rdh_tag)
+            best_server = None
+            best_number = -1
+            for kvm_server in self.ts_kvm_servers:
+                if kvm_server in reservation.ares_kvm_servers:
+                    continue
+                pool = self.ts_kvm_host_pools[kvm_server].get(key)
+                if pool is None:
+                    continue
+                if pool.rp_number() > best_number:
+                    best_server = kvm_server
+                    best_number = pool.rp_number()
+            if best_server is not None:
+                reservation.ares_kvm_servers.add(best_server)
+
+        for desc in request.ar_other_descriptors:
+            if desc.rd_type == RESOURCE_TYPE_HOST:
+                key = (desc.rdh_distro, desc.rdh_purpose, desc.rdh_tag)
+            else:
+                key = RESOURCE_TYPE_IP_ADDRESS
+            reservation.ares_reserve(key, desc.rd_number_min)
+
+    def _ts_allocation_schedule_holding_lock(self):
+        """
+        Allocate resources for the queued requests in FIFO order. A request
+        behind a blocked request can still be allocated (backfill) if it
+        doesn't use the resources reserved for the blocked request.
+        Called whenever resources are freed or requests arrive.
+        """
+        log = self.ts_log
+        reservation = AllocationReservation()
+        allocated = False
+        for request in self.ts_allocation_queue:
+            if request.ar_descriptors is not None:
+                continue
+            ret = self._ts_request_allocate_holding_lock(request, reservation)
+            if ret == 0:
+                log.cl_info("allocated resources for job [%s] after waiting "
+                            "for [%d] seconds", request.ar_job.laj_jobid,
+                            time.time() - request.ar_enqueue_time)
+                allocated = True
+                continue
+            self._ts_request_reserve_holding_lock(request, reservation)
+        if allocated:
+            self.ts_condition.notifyAll()
+
+    def _ts_request_dequeue_holding_lock(self, job):
+        """
+        Remove the allocation request of the job from the queue
+        """
+        request = job.laj_allocation_request
+        if request is None:
+            return
+        self.ts_allocation_queue.remove(request)
+        job.laj_allocation_request = None
+
+    def ts_resources_allocate_wait(self, scheduler_id, jobid, descriptors,
+                                   timeout):
+        """
+        Allocate multiple resources, wait in the allocation queue for at
+        most timeout seconds (capped by RPC_LONG_POLL_TIMEOUT) if not
+        enough resources. Return [] if not allocated. The request keeps
+        its place in the queue until it is allocated or the job stops, so
+        the client should call again with the same descriptors.
+        """
+        # pylint: disable=too-many-arguments
+        log = self.ts_log
         log.cl_debug("allocating resources for job [%s]", jobid)
         if scheduler_id != self.ts_id:
             log.cl_error("wrong scheduler ID [%s], expected [%s]",
@@ -952,39 +1294,57 @@ class TestScheduler(object):
         if ret:
             log.cl_error("failed to parse resource descriptors from RPC")
             return []
-        ret_descriptors = same_kvm_host_descriptors + other_descriptors
 
+        deadline = time.time() + min(timeout, RPC_LONG_POLL_TIMEOUT)
         self.ts_condition.acquire()
-        if jobid not in self.ts_job_dict:
+        job = self.ts_job_dict.get(jobid)
+        if job is None:
             log.cl_error("resource allocation from unknown job [%s]", jobid)
             self.ts_condition.release()
             return []
-        job = self.ts_job_dict[jobid]
-        ret = self._ts_job_allocate_resources_holding_lock(job, same_kvm_host_descriptors)
-        if ret == 0:
-            ret = self._ts_job_allocate_resources_holding_lock(job, other_descriptors)
-            if ret:
-                log.cl_debug("failed to allocated resources for job [%s]", jobid)
-        else:
-            log.cl_error("failed to allocated host resources that share the "
-                         "same KVM server for job [%s]", jobid)
-            ret = -1
+        request = job.laj_allocation_request
+        if request is None:
+            request = AllocationRequest(job, same_kvm_host_descriptors,
+                                        other_descriptors)
+            job.laj_allocation_request = request
+            self.ts_allocation_queue.append(request)
+            log.cl_debug("queued allocation request of job [%s], [%d] "
+                         "requests in the queue", jobid,
+                         len(self.ts_allocation_queue))
+            self._ts_allocation_schedule_holding_lock()
+
+        while (request.ar_descriptors is None and
+               job.laj_allocation_request is request and
+               not SHUTTING_DOWN):
+            now = time.time()
+            if now >= deadline:
+                break
+            self.ts_condition.wait(deadline - now)
 
-        if ret:
-            log.cl_debug("releasing allocated resource of job [%s]", jobid)
-            self._ts_job_release_resources_holding_lock(job, ret_descriptors)
+        ret_descriptors = request.ar_descriptors
+        if ret_descriptors is None:
             ret_descriptors = []
-        else:
-            ret = self._ts_resources_dirty_holding_lock(log, jobid,
-                                                        ret_descriptors)
-            if ret:
-                self._ts_job_release_resources_holding_lock(job, ret_descriptors)
-                ret_descriptors = []
-
+        elif job.laj_allocation_request is request:
+            self._ts_request_dequeue_holding_lock(job)
         job.laj_check_time = time_util.utcnow()
         self.ts_condition.release()
         return ret_descriptors
 
+    def ts_resources_allocate(self, scheduler_id, jobid, descriptors):
+        """
+        Allocate multiple resources, if any of them fails, return []
+        The requests waiting in the allocation queue have higher priority.
+        """
+        ret_descriptors = self.ts_resources_allocate_wait(scheduler_id, jobid,
+                                                          descriptors, 0)
+        if len(ret_descriptors) == 0:
+            self.ts_condition.acquire()
+            job = self.ts_job_dict.get(jobid)
+            if job is not None:
+                self._ts_request_dequeue_holding_lock(job)
+            self.ts_condition.release()
+        return ret_descriptors
+
     def _ts_print_release_message(self, log, jobid, descs):
         """
         Print the release message
@@ -1035,6 +1395,7 @@ class TestScheduler(object):
         job = self.ts_job_dict[jobid]
         ret = self._ts_job_release_resources_holding_lock(job, descs)
         job.laj_check_time = time_util.utcnow()
+        self._ts_allocation_schedule_holding_lock()
         self.ts_condition.notifyAll()
         self.ts_condition.release()
         return ret
@@ -1107,9 +1468,9 @@ class TestScheduler(object):
         """
         log = self.ts_log
         log.cl_info("listing job")
-        format_string = "%-25s%-6s%-10s\n"
-        job_names = format_string % ("Name", "Hosts", "Heartbeat")
-        job_names += "{0:->30}".format("") + "\n"
+        format_string = "%-25s%-6s%-10s%-6s\n"
+        job_names = format_string % ("Name", "Hosts", "Heartbeat", "Queue")
+        job_names += "{0:->46}".format("") + "\n"
 
         now = time_util.utcnow()
         self.ts_condition.acquire()
@@ -1118,9 +1479,14 @@ class TestScheduler(object):
             diff_string = str(diff)
             if diff > TEST_HEARTBEAT_TIMEOUT:
                 diff_string += "*"
+            request = job.laj_allocation_request
+            if request is None:
+                queue_string = "-"
+            else:
+                queue_string = str(self.ts_allocation_queue.index(request))
             job_names += (format_string %
                           (job.laj_jobid, str(len(job.laj_hosts)),
-                           diff_string))
+                           diff_string, queue_string))
         self.ts_condition.release()
         return job_names
 
@@ -1149,7 +1515,8 @@ class TestScheduler(object):
         res.sr_check_time = time.time()
 
         self.ts_condition.acquire()
-        res.sr_concurrency = 0
+        self._ts_resource_concurrency_set(res, 0)
+        self._ts_allocation_schedule_holding_lock()
         self.ts_condition.release()
         return ret
 
@@ -1167,51 +1534,108 @@ class TestScheduler(object):
             log.cl_info("res [%s] is busy, skipping", res.sr_name)
             return ScheduledResource.RESOURCE_IS_BUSY
         # Set concurrency to max so no other one can use it.
-        res.sr_concurrency = res.sr_max_concurrency
+        self._ts_resource_concurrency_set(res, res.sr_max_concurrency)
         self.ts_condition.release()
 
         return self._ts_resource_cleanup_holding_concurrency(res)
 
+    def _ts_resource_wanted_holding_lock(self, res):
+        """
+        Return True if any blocked request in the allocation queue is
+        waiting for this kind of resource
+        """
+        for request in self.ts_allocation_queue:
+            if request.ar_descriptors is not None:
+                continue
+            for desc in (request.ar_same_kvm_host_descriptors +
+                         request.ar_other_descriptors):
+                if desc.rd_type != res.rr_resource_type:
+                    continue
+                if desc.rd_type == RESOURCE_TYPE_IP_ADDRESS:
+                    return True
+                if (desc.rdh_distro == res.th_distro and
+                        desc.rdh_purpose == res.th_purpose and
+                        (desc.rdh_tag is None or desc.rdh_tag == res.th_tag)):
+                    return True
+        return False
+
+    def _ts_recovery_cleanup(self, res):
+        """
+        Cleanup the resource for the recovery thread
+        """
+        self._ts_resource_cleanup_holding_concurrency(res)
+        key = res.sr_recovery_key()
+        self.ts_condition.acquire()
+        self.ts_recovery_running[key] -= 1
+        self.ts_recovery_running_number -= 1
+        self.ts_condition.notifyAll()
+        self.ts_condition.release()
+
+    def _ts_recovery_start_holding_lock(self):
+        """
+        Start to clean up the due resources as many as the concurrency
+        limitations allow. Return the time of next due.
+        """
+        log = self.ts_log
+        now = time.time()
+        heap = self.ts_recovery_heap
+        while len(heap) > 0 and heap[0][0] <= now:
+            due_time, _, res = heapq.heappop(heap)
+            # Outdated entry, a newer one is in the heap
+            if due_time != res.sr_recovery_due:
+                continue
+            res.sr_recovery_due = None
+            # The resource might be still waiting for the concurrency
+            # limitations after being allocated, released and pushed again
+            if res.sr_recovery_ready:
+                continue
+            res.sr_recovery_ready = True
+            self.ts_recovery_ready.append(res)
+
+        # Busy resources will be pushed to the heap again when freed
+        ready = []
+        for res in self.ts_recovery_ready:
+            if res.sr_concurrency == 0:
+                ready.append(res)
+            else:
+                res.sr_recovery_ready = False
+
+        # Clean up the resources that queued jobs are waiting for first,
+        # then the ones that have been due for the longest time
+        ready.sort(key=lambda res: (not self._ts_resource_wanted_holding_lock(res),
+                                    res.sr_due_time()))
+        self.ts_recovery_ready = []
+        for res in ready:
+            key = res.sr_recovery_key()
+            running = self.ts_recovery_running.get(key, 0)
+            if (self.ts_recovery_running_number >=
+                    self.ts_recovery_concurrency or
+                    (key is not None and
+                     running >= self.ts_kvm_recovery_concurrency)):
+                self.ts_recovery_ready.append(res)
+                continue
+            res.sr_recovery_ready = False
+            log.cl_debug("recovery thread is cleaning up resource [%s]",
+                         res.sr_name)
+            # Hold the concurrency and create a thread to fix it
+            self._ts_resource_concurrency_set(res, res.sr_max_concurrency)
+            self.ts_recovery_running[key] = running + 1
+            self.ts_recovery_running_number += 1
+            utils.thread_start(self._ts_recovery_cleanup, (res, ))
+
+        if len(heap) > 0:
+            return heap[0][0]
+        return now + MIN_GOOD_RES_CHECK_INTERVAL
+
     def ts_recovery_main(self):
         """
         Checking the health of each nodes, repaire them if necessary.
         """
-        # pylint: disable=bare-except
         self.ts_condition.acquire()
         log = self.ts_log
-        while True:
+        while not SHUTTING_DOWN:
             log.cl_debug("recovery thread is checking resources")
-            fix_res = None
-            res_fix_time = None
-            now = time.time()
-            wakeup_time = now + MIN_GOOD_RES_CHECK_INTERVAL
-            for res in self.ts_resources:
-                # Ignore the busy resources
-                if res.sr_concurrency > 0:
-                    continue
-
-                if res.sr_is_clean:
-                    fix_time = res.sr_check_time + MIN_GOOD_RES_CHECK_INTERVAL
-                else:
-                    fix_time = res.sr_check_time + MIN_BAD_RES_CHECK_INTERVAL
-
-                if fix_time > now:
-                    if fix_time < wakeup_time:
-                        wakeup_time = fix_time
-                    continue
-
-                if (fix_res is None or
-                        res_fix_time < fix_time):
-                    fix_res = res
-                    res_fix_time = fix_time
-            if fix_res is not None:
-                # Hold the concurrency and create a thread to fix it
-                fix_res.sr_concurrency = fix_res.sr_max_concurrency
-                self.ts_condition.release()
-                utils.thread_start(self._ts_resource_cleanup_holding_concurrency,
-                                   (fix_res, ))
-                self.ts_condition.acquire()
-                continue
+            wakeup_time = self._ts_recovery_start_holding_lock()
             # Sleep unless something happen or time for fixing again
             now = time.time()
             if wakeup_time > now:
@@ -1242,6 +1666,7 @@ class TestScheduler(object):
                 self._ts_job_stop(job)
                 stopped = True
         if stopped:
+            self._ts_allocation_schedule_holding_lock()
             self.ts_condition.notifyAll()
         self.ts_condition.release()
         log.cl_debug("scheduler checked jobs")
@@ -1255,11 +1680,12 @@ class TestScheduler(object):
         for lhost in job.laj_hosts[:]:
             job.laj_host_remove(lhost)
             lhost.sr_job_sequence = None
-            lhost.sr_concurrency -= 1
+            self._ts_resource_concurrency_set(lhost, lhost.sr_concurrency - 1)
         for res in job.laj_ip_addresses[:]:
             job.laj_ip_address_remove(res)
             res.sr_job_sequence = None
-            res.sr_concurrency -= 1
+            self._ts_resource_concurrency_set(res, res.sr_concurrency - 1)
+        self._ts_request_dequeue_holding_lock(job)
         del self.ts_job_dict[job.laj_jobid]
 
     def ts_job_stop(self, scheduler_id, jobid):
@@ -1276,6 +1702,7 @@ class TestScheduler(object):
             return -1
         job = self.ts_job_dict[jobid]
         self._ts_job_stop(job)
+        self._ts_allocation_schedule_holding_lock()
         self.ts_condition.notifyAll()
         self.ts_condition.release()
         return 0
@@ -1290,29 +1717,82 @@ class TestScheduler(object):
                         "ID, expected [%s], got [%s]", jobid, self.ts_id,
                         scheduler_id)
             return -1
-        log.cl_info("recived heatbeat of job [%s]", jobid)
-        self.ts_condition.acquire()
-        if jobid not in self.ts_job_dict:
+        log.cl_debug("recived heatbeat of job [%s]", jobid)
+        # Fast path without ts_condition, so heartbeats are never delayed
+        # by allocations or listings that are holding the lock. Getting
+        # the job from the dictionary and updating its time are both
+        # atomic. If the job is being stopped concurrently, updating
+        # the time of the removed job is harmless.
+        job = self.ts_job_dict.get(jobid)
+        if job is None:
             log.cl_error("heartbeat from unknown job [%s]", jobid)
-            self.ts_condition.release()
             return -1
-        job = self.ts_job_dict[jobid]
         job.laj_check_time = time_util.utcnow()
-        self.ts_condition.release()
         return 0
 
 
+class SchedulerRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """
+    Request handler that keeps the connection alive between requests
+    """
+    # pylint: disable=too-few-public-methods
+    protocol_version = "HTTP/1.1"
+    # Idle or slow connections are closed after this timeout, so they
+    # won't hold the handling threads forever
+    timeout = RPC_REQUEST_TIMEOUT
+
+
+class SchedulerRPCServer(SocketServer.ThreadingMixIn,
+                         SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+    RPC server that handles each connection in its own thread, so a slow
+    client or a big listing won't delay the heartbeats of other jobs
+    """
+    # pylint: disable=too-few-public-methods
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr,
+                                                       requestHandler=SchedulerRequestHandler,
+                                                       logRequests=False,
+                                                       allow_none=True)
+        self.timeout = RPC_SERVE_INTERVAL
+
+
+class SchedulerTransport(xmlrpclib.Transport):
+    """
+    Transport that reuses the HTTP connection and times out
+    """
+    def __init__(self, timeout=RPC_CLIENT_TIMEOUT):
+        xmlrpclib.Transport.__init__(self)
+        self.st_timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.st_timeout
+        return connection
+
+
+def scheduler_proxy(server_url, timeout=RPC_CLIENT_TIMEOUT):
+    """
+    Return a proxy to call the scheduler remotely. The proxy keeps the
+    connection alive, so it should not be shared between threads.
+    """
+    return xmlrpclib.ServerProxy(server_url, allow_none=True,
+                                 transport=SchedulerTransport(timeout=timeout))
+
+
 def server_main(scheduler, scheduler_port):
     """
     Main function of scheduler thread.
     """
-    server = SimpleXMLRPCServer.SimpleXMLRPCServer(("0.0.0.0",
-                                                    scheduler_port),
-                                                   allow_none=True)
+    server = SchedulerRPCServer(("0.0.0.0", scheduler_port))
     server.register_introspection_functions()
     server.register_instance(scheduler)
     while not SHUTTING_DOWN:
         server.handle_request()
+    server.server_close()
 
 
 def parse_config_test_hosts(log, test_host_configs, kvm_template_dict):
@@ -1544,7 +2024,23 @@ def ltest_scheduler(log, workspace, config_fpath):
         log.cl_error("failed to parse config test hosts and templates")
         return -1
 
-    scheduler = TestScheduler(log, scheduler_id, test_hosts, addresses)
+    recovery_concurrency = config.get(cstr.CSTR_RECOVERY_CONCURRENCY,
+                                      RECOVERY_CONCURRENCY)
+    kvm_recovery_concurrency = config.get(cstr.CSTR_KVM_RECOVERY_CONCURRENCY,
+                                          KVM_RECOVERY_CONCURRENCY)
+    # No resource would ever be recovered if the concurrency is below 1
+    for key, value in [(cstr.CSTR_RECOVERY_CONCURRENCY, recovery_concurrency),
+                       (cstr.CSTR_KVM_RECOVERY_CONCURRENCY,
+                        kvm_recovery_concurrency)]:
+        if (not isinstance(value, int) or isinstance(value, bool) or
+                value < 1):
+            log.cl_error("invalid [%s] with value [%s], it should be a "
+                         "positive integer, please correct file [%s]",
+                         key, value, config_fpath)
+            return -1
+    scheduler = TestScheduler(log, scheduler_id, test_hosts, addresses,
+                              recovery_concurrency=recovery_concurrency,
+                              kvm_recovery_concurrency=kvm_recovery_concurrency)
     output = scheduler.ts_host_list(False)
     log.cl_info("\n%s", output)
 